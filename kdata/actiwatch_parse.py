@@ -0,0 +1,173 @@
+"""Shared parsing of Philips Actiwatch export files.
+
+An Actiwatch upload is one CSV export with several sections
+(Statistics, Marker/Score List, Epoch-by-Epoch Data, ...).  The three
+Actiwatch converters each need one section of the same file, and a
+week of 15-second epochs is tens of thousands of timestamps.  So:
+
+- parse() decodes the file and finds where its sections are, in one
+  scan.  A section is csv-parsed only when a converter asks for it
+  (ActiwatchFile.rows()), so Statistics and Markers never parse the
+  large epoch section.  The result is cached per packet (keyed by a
+  digest of the stored data), so when ActiwatchFull,
+  ActiwatchStatistics and ActiwatchMarkers run over the same packets,
+  the file is decoded and split only once.
+
+- parse_date() parses the date part of a timestamp once per distinct
+  date (with the same dateutil/strptime logic as before) and adds the
+  time of day to it directly.  Anything not of the usual H:MM:SS /
+  HH.MM.SS form goes through the full slow path, parse_date_slow().
+
+Like converter.py, this module does not depend on django.
+"""
+
+import ast
+from collections import OrderedDict
+import csv
+from datetime import datetime, timedelta
+from functools import lru_cache
+from hashlib import blake2b
+import io
+import re
+import threading
+
+from dateutil.parser import parse as dateutil_parse
+
+CACHE_SIZE = 4
+
+# section key: (title in the file, first line of the table, whether the
+# table ends at a triple blank line (or else at the end of the file)).
+SECTIONS = {
+    'epochs':     ('Epoch-by-Epoch Data', '"Line",', False),
+    'statistics': ('Statistics', '"Interval Type",', True),
+    'markers':    ('Marker/Score List', '"Line","Date",', True),
+    }
+_section_keys = {title: key for key, (title, _, _) in SECTIONS.items()}
+_section_re = re.compile(r'--- (%s) -+"\s'%'|'.join(re.escape(title) for title, _, _ in SECTIONS.values()))
+_time_colon_re = re.compile(r'(\d{1,2}):(\d{2}):(\d{2})(?: ([AaPp])[Mm])?$')
+_time_dot_re = re.compile(r'(\d{2})\.(\d{2})\.(\d{2})$')
+
+
+
+class ActiwatchFile(object):
+    """One decoded export: tzoffset, and the sections, parsed on demand."""
+    def __init__(self, data, tzoffset, spans):
+        self.data = data
+        self.tzoffset = tzoffset
+        self._spans = spans    # section key: (start, end) in data
+    def rows(self, key):
+        """Iterator over the csv rows of a section, None if it is missing."""
+        if key not in self._spans:
+            return None
+        start, end = self._spans[key]
+        return csv.reader(io.StringIO(self.data[start:end]))
+
+
+def find_tzoffset(data):
+    """Find timezone offset and return as a string"""
+    tzoffset = re.search(r'"Time Zone Offset:","([-+\d:.]+)","hours:minutes"', data).group(1)
+    assert 4 <= len(tzoffset) <= 6
+    # Python 3.6 needs no separator in the time offset
+    tzoffset = tzoffset.replace(':', '').replace('.', '')
+    return tzoffset
+
+
+def parse_date_slow(a, b, tzoffset, dayfirst):
+    try:
+        return dateutil_parse("%s %s %s"%(a, b, tzoffset), dayfirst=dayfirst)
+    except ValueError:
+        pass
+    return datetime.strptime("%s %s %s"%(a, b, tzoffset.replace('.', ':')), '%d.%m.%Y %H.%M.%S %z')
+
+
+@lru_cache(maxsize=1024)
+def _midnight(a, tzoffset, dayfirst, dotted):
+    """Start of day a, parsed as parse_date_slow would parse it."""
+    if dotted:
+        # dateutil does not understand HH.MM.SS times, so these
+        # always end up in the strptime branch.
+        return datetime.strptime("%s 00.00.00 %s"%(a, tzoffset.replace('.', ':')),
+                                 '%d.%m.%Y %H.%M.%S %z')
+    return parse_date_slow(a, '00:00:00', tzoffset, dayfirst)
+
+
+def parse_date(a, b, tzoffset, dayfirst):
+    """Parse date a and time b, same result as parse_date_slow()."""
+    m = _time_colon_re.match(b)
+    if m is not None:
+        h, mi, s, ampm = m.groups()
+        h, mi, s = int(h), int(mi), int(s)
+        if ampm is not None:
+            if not 1 <= h <= 12:
+                return parse_date_slow(a, b, tzoffset, dayfirst)
+            h = h % 12 + (12 if ampm in 'Pp' else 0)
+        dotted = False
+    else:
+        m = _time_dot_re.match(b)
+        if m is None:
+            return parse_date_slow(a, b, tzoffset, dayfirst)
+        h, mi, s = (int(x) for x in m.groups())
+        dotted = True
+    if h > 23 or mi > 59 or s > 59:
+        return parse_date_slow(a, b, tzoffset, dayfirst)
+    try:
+        day = _midnight(a, tzoffset, dayfirst, dotted)
+    except ValueError:
+        return parse_date_slow(a, b, tzoffset, dayfirst)
+    return day + timedelta(hours=h, minutes=mi, seconds=s)
+
+
+def split_sections(data):
+    """Return {section key: (start, end) of its table}, for sections present."""
+    sections = { }
+    for m in _section_re.finditer(data):
+        key = _section_keys[m.group(1)]
+        if key in sections:
+            continue
+        _, first_line, ends_blank = SECTIONS[key]
+        start = data.find(first_line, m.end())
+        if start == -1:
+            continue
+        if ends_blank:
+            end = data.find('\r\n\r\n\r\n', start)
+            if end == -1:
+                continue
+        else:
+            end = len(data)
+        sections[key] = (start, end)
+    return sections
+
+
+def _parse(data):
+    if data.startswith("b'") and data.endswith("'"):
+        data = ast.literal_eval(data).decode()
+    if '---- Subject Properties------' not in data:
+        return None
+    return ActiwatchFile(data, find_tzoffset(data), split_sections(data))
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def parse(data):
+    """Parse one stored Actiwatch packet.
+
+    Returns an ActiwatchFile, or None if the data is not an Actiwatch
+    export.
+    """
+    key = blake2b(data.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    parsed = _parse(data)
+    with _cache_lock:
+        _cache[key] = parsed
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return parsed
+
+def cache_clear():
+    with _cache_lock:
+        _cache.clear()
+    _midnight.cache_clear()
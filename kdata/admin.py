@@ -75,6 +75,49 @@ admin.site.register(models.Consent, ConsentAdmin)
 
 
 
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'type', 'state', 'priority', 'ts_create', 'run_after',
+                    'attempts', 'lease_owner', 'heartbeat')
+    list_filter = ('state', 'type')
+admin.site.register(models.Job, JobAdmin)
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'state', 'converter', 'format', 'ts_create',
+                    'n_units_done', 'n_units')
+    list_filter = ('state', )
+    raw_id_fields = ('device', 'group', 'user', 'job')
+admin.site.register(models.ExportJob, ExportJobAdmin)
+
+class QuarantinedDataAdmin(admin.ModelAdmin):
+    list_display = ('id', 'device_id', 'device_type', 'ts_received', 'data_length',
+                    'state', 'reason')
+    list_filter = ('state', 'device_type')
+    search_fields = ('device_id', 'reason')
+    readonly_fields = ('sha256', 'data_length', 'ts_received', 'ts_processed', 'data_id')
+    actions = ['reprocess', 'force_save', 'discard']
+    def _reprocess(self, request, queryset, force):
+        from . import ingest
+        failed = [ ]
+        for q in queryset:
+            reason = ingest.reprocess(q, force=force)
+            if reason is not None:
+                failed.append('%s (%s)'%(q.id, reason))
+        self.message_user(request, "Saved %d packets as data.%s"%(
+            len(queryset)-len(failed), "  Not saved: "+', '.join(failed) if failed else ''))
+    def reprocess(self, request, queryset):
+        self._reprocess(request, queryset, force=False)
+    reprocess.short_description = "Check again and save as data if valid"
+    def force_save(self, request, queryset):
+        self._reprocess(request, queryset, force=True)
+    force_save.short_description = "Save as data without checking"
+    def discard(self, request, queryset):
+        from . import ingest
+        for q in queryset:
+            ingest.discard(q)
+    discard.short_description = "Discard"
+admin.site.register(models.QuarantinedData, QuarantinedDataAdmin)
+
+
 # The following overrides and changes the default django.contrib.auth
 # UserModel so that it will show our devices and groups info.  We add
 # the same information as we see from groups (what groups this user is
@@ -0,0 +1,205 @@
+"""Whitelist of common (non-identifying) app package names.
+
+Safe converters such as PRApplicationLaunchesSafe pass whitelisted app
+names through and hash everything else.  The list used to be
+downloaded from the server on every conversion.  Now it is a versioned
+data file shipped with the code (kdata/data/app_whitelist.txt), which
+is refreshed with:
+
+    python manage.py update_app_whitelist [--url=URL]
+
+File format: one app per line, the package name is the first
+comma-separated column (so the old softinfo.txt format works as-is).
+Lines starting with # are comments, "# version: X" names the version.
+A name ending in "*" matches all packages with that prefix.
+
+The file in the repository is empty: the list is not ours to ship, so
+it is downloaded on deployment.  If that was not done, the first
+checked_matcher() downloads it (like the converter used to on every
+conversion) and stores it, or keeps it in memory if the file can not
+be written.  Failed downloads are retried after DOWNLOAD_RETRY
+seconds, until then checked_matcher() raises WhitelistMissing, so safe
+converters fail loudly instead of hashing every app name.
+
+Like converter.py, this does not depend on django, except for
+optionally reading settings.APP_WHITELIST_URL and
+settings.APP_WHITELIST_DOWNLOAD (download when empty, default True).
+"""
+
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data', 'app_whitelist.txt')
+DEFAULT_URL = 'https://koota.cs.aalto.fi/static/softinfo.txt'
+DOWNLOAD = True
+DOWNLOAD_RETRY = 600    # seconds
+try:
+    from django.conf import settings
+    DEFAULT_URL = getattr(settings, 'APP_WHITELIST_URL', DEFAULT_URL)
+    DOWNLOAD = getattr(settings, 'APP_WHITELIST_DOWNLOAD', DOWNLOAD)
+    del settings
+except Exception:
+    pass
+
+
+class WhitelistMissing(Exception):
+    """The app whitelist is empty (not downloaded yet)."""
+
+
+class AppMatcher(object):
+    """Compiled whitelist: set lookup plus an optional prefix tuple."""
+    def __init__(self, names=(), prefixes=(), version=None):
+        self.names = frozenset(names)
+        self.prefixes = tuple(sorted(prefixes))
+        self.version = version
+    def __contains__(self, name):
+        if name in self.names:
+            return True
+        # str.startswith with a tuple is a single C-level call.
+        return bool(self.prefixes) and isinstance(name, str) and name.startswith(self.prefixes)
+    def __len__(self):
+        return len(self.names) + len(self.prefixes)
+
+def parse(text):
+    """Parse whitelist file contents into an AppMatcher."""
+    names = set()
+    prefixes = set()
+    version = None
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            if line[1:].strip().startswith('version:'):
+                version = line[1:].strip()[len('version:'):].strip()
+            continue
+        name = line.split(',')[0].strip()
+        if not name:
+            continue
+        if name.endswith('*'):
+            prefixes.add(name[:-1])
+        else:
+            names.add(name)
+    return AppMatcher(names, prefixes, version=version)
+
+
+def file_source(path=DEFAULT_PATH):
+    """Source reading the local data file."""
+    def source():
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+    source.path = path
+    return source
+
+# The current source: a callable returning the file text.  Tests can
+# replace it with set_source().
+_source = file_source()
+_lock = threading.Lock()
+_cache = { }
+# Downloaded by checked_matcher(): path -> AppMatcher, or the time of
+# the last failed download.
+_downloaded = { }
+_download_lock = threading.Lock()
+
+def set_source(source):
+    """Use a different source (callable returning text), or None for default."""
+    global _source
+    with _lock:
+        _source = source if source is not None else file_source()
+        _cache.clear()
+    _downloaded.clear()
+
+def get_matcher():
+    """Return the AppMatcher, parsed once per process.
+
+    For the default file source, the file is re-read if its mtime
+    changes (so a refresh is seen without restarting).
+    """
+    source = _source
+    path = getattr(source, 'path', None)
+    key = (id(source), os.stat(path).st_mtime if path else None)
+    matcher = _cache.get(key)
+    if matcher is None:
+        with _lock:
+            matcher = parse(source())
+            _cache.clear()
+            _cache[key] = matcher
+    return matcher
+
+def checked_matcher():
+    """get_matcher(), but raise WhitelistMissing if the list is empty.
+
+    An empty data file is first downloaded (see module docstring).
+    """
+    matcher = get_matcher()
+    if not len(matcher):
+        path = getattr(_source, 'path', None)
+        if DOWNLOAD and path is not None:
+            matcher = _download(path) or matcher
+    if not len(matcher):
+        raise WhitelistMissing("The app whitelist (version %s) is empty: run "
+                               "'manage.py update_app_whitelist'"%matcher.version)
+    return matcher
+
+def _download(path):
+    """Download the list for an empty data file, once.  Returns the
+    AppMatcher, or None."""
+    with _download_lock:
+        done = _downloaded.get(path)
+        if isinstance(done, AppMatcher):
+            return done
+        if done is not None and time.time() < done + DOWNLOAD_RETRY:
+            return None
+        try:
+            text = download()
+        except Exception as e:
+            logger.error("App whitelist is empty and downloading it failed: %s", e)
+            _downloaded[path] = time.time()
+            return None
+        try:
+            matcher = store(text, path)
+        except OSError as e:
+            logger.warning("Could not store the app whitelist in %s: %s", path, e)
+            matcher = parse(text)
+        _downloaded[path] = matcher
+        return matcher
+
+
+def download(url=DEFAULT_URL, timeout=30):
+    """Text of the list at url.  Raises on network errors or if it is
+    empty."""
+    import requests
+    r = requests.get(url, timeout=timeout)
+    r.raise_for_status()
+    text = r.text
+    if len(parse(text)) == 0:
+        raise ValueError("Downloaded app whitelist from %s is empty"%url)
+    return text
+
+def refresh(url=DEFAULT_URL, path=DEFAULT_PATH, timeout=30):
+    """Download the list from url and atomically replace the data file.
+
+    Returns the new AppMatcher.  Raises on network errors or if the
+    download is empty, leaving the current file in place.
+    """
+    return store(download(url, timeout=timeout), path, url=url)
+
+def store(text, path=DEFAULT_PATH, url=DEFAULT_URL):
+    """Atomically replace the data file with text, with a new version."""
+    matcher = parse(text)
+    version = '%s-%s'%(datetime.date.today().strftime('%Y%m%d'),
+                       hashlib.sha256(text.encode('utf-8')).hexdigest()[:8])
+    lines = [l for l in text.split('\n') if not l.strip().startswith('# version:')]
+    with open(path+'.tmp', 'w', encoding='utf-8') as f:
+        f.write('# version: %s\n# source: %s\n'%(version, url))
+        f.write('\n'.join(lines).rstrip('\n') + '\n')
+    os.rename(path+'.tmp', path)
+    matcher.version = version
+    return matcher
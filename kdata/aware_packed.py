@@ -0,0 +1,175 @@
+"""Packed columnar storage of AWARE sensor rows.
+
+AWARE's fast sensor tables (accelerometer and friends) upload lists
+of rows like
+
+    {"_id": 1, "timestamp": 1500000000123, "device_id": "...",
+     "double_values_0": 0.12, "double_values_1": ..., "accuracy": 3, "label": ""}
+
+as JSON, where the keys take most of the ~150 bytes of each sample
+and decoding them is most of the cost of exporting.  encode() stores
+the same rows as one block of columns:
+
+    b'KP', version (1 byte), flags (1 byte: 1 = zlib compressed), then
+    (compressed if so):
+    header length (uint32), header (JSON): n, keys (in row order),
+        kinds {key: kind}, const {key: value}, json {key: [values]}
+    the binary columns, in key order: n little-endian values each
+
+Column kinds: 'int' int64, delta-encoded (timestamps, _id), 'float'
+float64, 'const' the same value in every row (device_id, label),
+'json' anything else, as a JSON list in the header.  The rows come
+back exactly (same keys in the same order, same types and values),
+and verify() checks that.  Rows which can not be packed this way (not
+all with the same keys) give None, and are stored as JSON.
+
+In a Data packet, the block is stored as urlsafe base64 text in
+"data", with "encoding": "packed" (see converter.aware_rows).  This
+module does not use Django.
+"""
+
+from array import array
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from itertools import accumulate
+import json
+import struct
+import sys
+import zlib
+
+VERSION = 1
+MAGIC = b'KP'
+FLAG_ZLIB = 1
+ENCODING = 'packed'
+# Tables which are packed at ingest (if AWARE_PACKED_STORAGE is on).
+TABLES = {'accelerometer', 'gyroscope', 'linear_accelerometer', 'gravity', 'magnetometer'}
+_INT_MAX = 2**62
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+class PackError(ValueError):
+    pass
+
+
+def _kind(values):
+    first = values[0]
+    if all(type(v) is type(first) and v == first for v in values) \
+       and not isinstance(first, float):
+        # (Floats are not const: -0.0 == 0.0 and nan != nan.)
+        return 'const'
+    if all(type(v) is int and -_INT_MAX < v < _INT_MAX for v in values):
+        return 'int'
+    if all(type(v) is float for v in values):
+        return 'float'
+    return 'json'
+
+def _to_bytes(arr):
+    if _BIG_ENDIAN:
+        arr.byteswap()
+    return arr.tobytes()
+
+def _from_bytes(typecode, data):
+    arr = array(typecode)
+    arr.frombytes(data)
+    if _BIG_ENDIAN:
+        arr.byteswap()
+    return arr
+
+
+def encode_block(rows, compress=True):
+    """Pack a list of row dicts into bytes, or None if they can't be."""
+    if not rows or not all(isinstance(row, dict) for row in rows):
+        return None
+    keys = list(rows[0])
+    if not all(list(row) == keys for row in rows):
+        return None
+    n = len(rows)
+    kinds = { }
+    const = { }
+    json_columns = { }
+    binary = [ ]
+    for key in keys:
+        values = [ row[key] for row in rows ]
+        kind = kinds[key] = _kind(values)
+        if kind == 'const':
+            const[key] = values[0]
+        elif kind == 'json':
+            json_columns[key] = values
+        elif kind == 'int':
+            deltas = array('q', [values[0]])
+            deltas.extend(b-a for a, b in zip(values, values[1:]))
+            binary.append(_to_bytes(deltas))
+        else:
+            binary.append(_to_bytes(array('d', values)))
+    try:
+        header = json.dumps(dict(n=n, keys=keys, kinds=kinds, const=const, json=json_columns),
+                            separators=(',', ':')).encode('utf-8')
+    except (TypeError, ValueError):
+        return None
+    body = b''.join([struct.pack('<I', len(header)), header] + binary)
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 6)
+        flags |= FLAG_ZLIB
+    return MAGIC + bytes([VERSION, flags]) + body
+
+
+def decode_columns(block):
+    """Unpack a block: returns (n, keys, {key: list of values})."""
+    if block[:2] != MAGIC:
+        raise PackError("Not a packed block")
+    version, flags = block[2], block[3]
+    if version != VERSION:
+        raise PackError("Unknown packed block version %d"%version)
+    body = block[4:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    header_len, = struct.unpack_from('<I', body)
+    header = json.loads(body[4:4+header_len].decode('utf-8'))
+    n = header['n']
+    kinds = header['kinds']
+    pos = 4 + header_len
+    columns = { }
+    for key in header['keys']:
+        kind = kinds[key]
+        if kind == 'const':
+            columns[key] = [header['const'][key]] * n
+        elif kind == 'json':
+            columns[key] = header['json'][key]
+        else:
+            values = _from_bytes('q' if kind == 'int' else 'd', body[pos:pos+8*n])
+            pos += 8*n
+            if kind == 'int':
+                columns[key] = list(accumulate(values))   # undo the deltas
+            else:
+                columns[key] = values.tolist()
+    return n, header['keys'], columns
+
+def decode_block(block):
+    """Unpack a block into the list of row dicts."""
+    n, keys, columns = decode_columns(block)
+    return [ dict(zip(keys, values)) for values in zip(*(columns[k] for k in keys)) ]
+
+
+def encode(rows, compress=True):
+    """Rows to the text stored in a packet, or None if they can't be packed."""
+    block = encode_block(rows, compress=compress)
+    if block is None:
+        return None
+    return urlsafe_b64encode(block).decode('ascii')
+
+def decode(text):
+    """Text from encode() to the list of rows."""
+    return decode_block(urlsafe_b64decode(text))
+
+def columns(text):
+    """Text from encode() to (n, keys, {key: list of values})."""
+    return decode_columns(urlsafe_b64decode(text))
+
+
+def verify(rows, text):
+    """Does text decode to exactly rows?  (Types and key order too.)"""
+    try:
+        decoded = decode(text)
+    except (PackError, ValueError, KeyError, struct.error, zlib.error):
+        return False
+    return json.dumps(decoded) == json.dumps(rows)
@@ -0,0 +1,150 @@
+"""Storage versions of AWARE table packets.
+
+aware.insert saves each chunk of uploaded rows as one Data packet:
+
+    version 1:  {"table": ..., "data": "[{\\"_id\\": 1, ...}, ...]",
+                 "timestamp": ..., "version": 1}
+    version 2:  {"table": ..., "data": [{"_id": 1, ...}, ...],
+                 "timestamp": ..., "version": 2}
+
+In version 1 the rows are JSON text inside the JSON packet, so reading
+decodes twice and the escaped quotes make the packet 10-20% larger.
+Version 2 has them as a list.  Packed packets ("encoding": "packed",
+see kdata/aware_packed.py) are text in both.  Readers go through
+converter.aware_rows(), which handles all of these, and new packets
+are version 2 unless AWARE_STORAGE_VERSION = 1.
+
+upgrade_rows() rewrites existing version 1 packets, with "manage.py
+aware_upgrade" or as the background job "aware_upgrade" (checkpointed
+by row id).  The rows are decoded with the standard json module, so
+they come back unchanged (same keys, order and values).  The
+study_check and register packets (one POST dict, not rows) stay as
+they are.
+"""
+
+import json
+
+from django.conf import settings
+
+from . import jobs
+from . import models
+
+import logging
+logger = logging.getLogger(__name__)
+
+VERSION = getattr(settings, 'AWARE_STORAGE_VERSION', 2)
+BATCH_SIZE = 500
+# Tables whose "data" is not a list of rows.
+NOT_ROWS = {'study_check', 'register'}
+
+
+def packet(table, rows, timestamp, version=None, **extra):
+    """The text of a packet of rows (a list, or packed text)."""
+    if version is None:
+        version = VERSION
+    if version == 1 and isinstance(rows, list):
+        rows = json.dumps(rows)
+    return json.dumps(dict(table=table, data=rows, timestamp=timestamp, version=version,
+                           **extra))
+
+
+def upgrade(text):
+    """Version 1 packet text to version 2, or None if it stays as is."""
+    try:
+        p = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(p, dict) or 'table' not in p or p['table'] in NOT_ROWS \
+           or not isinstance(p.get('data'), str) or p.get('encoding'):
+        return None
+    try:
+        rows = json.loads(p['data'])
+    except ValueError:
+        return None
+    if not isinstance(rows, list):
+        return None
+    p['data'] = rows
+    p['version'] = 2
+    return json.dumps(p)
+
+
+def upgrade_row(row, live=True):
+    """Upgrade one saved models.Data row.  Returns (size before, size
+    after), or None if not upgraded."""
+    text = row.data
+    if not isinstance(text, str):
+        return None
+    new = upgrade(text)
+    if new is None:
+        return None
+    if live:
+        from . import codec
+        encoding = row.encoding
+        row.data = new
+        row.data_length = len(new)
+        if encoding:
+            from . import ingest
+            codec.encode_row(row, encoding.split(':')[0], min_size=0,
+                             device_type=ingest.device_type(row.device_id))
+        models.Data.objects.filter(id=row.id).update(data=row.__dict__['data'],
+                                                     encoding=row.encoding,
+                                                     data_z=row.data_z,
+                                                     data_length=row.data_length)
+    return len(text), len(new)
+
+def upgrade_rows(queryset, live=True, start_id=0, batch_size=BATCH_SIZE):
+    """Upgrade the version 1 packets of queryset, in batches in id order.
+
+    Yields (last row id, rows upgraded, bytes before, bytes after) per
+    batch.  Resume from start_id (the last id done).
+    """
+    last_id = start_id
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).order_by('id')
+                           .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        n = before = after = 0
+        for row in models.Data.objects.filter(id__in=ids).order_by('id'):
+            sizes = upgrade_row(row, live=live)
+            if sizes is not None:
+                n += 1
+                before += sizes[0]
+                after += sizes[1]
+        last_id = ids[-1]
+        yield last_id, n, before, after
+
+
+def device_queryset(device_ids=None):
+    """models.Data of the given devices, or of all AWARE devices
+    (including subclasses of Aware)."""
+    from . import devices
+    from .devices.aware import Aware
+    qs = models.Data.objects.all()
+    if device_ids:
+        return qs.filter(device_id__in=device_ids)
+    types = [ ]
+    for type_ in models.Device.objects.values_list('type', flat=True).distinct():
+        try:
+            if issubclass(devices.get_class(type_), Aware):
+                types.append(type_)
+        except Exception:    # unknown or unimportable device types
+            continue
+    return qs.filter(device_id__in=models.Device.objects.filter(type__in=types)
+                                         .values('device_id'))
+
+
+@jobs.register('aware_upgrade', concurrency=1, max_attempts=5)
+def upgrade_job(ctx):
+    """aware_upgrade, args {"device_ids": [...], "batch_size": ...}:
+    rewrite version 1 AWARE packets (all AWARE devices if no ids)."""
+    qs = device_queryset(ctx.args.get('device_ids'))
+    start_id = (ctx.checkpoint or { }).get('last_id', 0)
+    n_rows = before = after = 0
+    for last_id, n, b, a in upgrade_rows(qs, start_id=start_id,
+                                         batch_size=ctx.args.get('batch_size', BATCH_SIZE)):
+        n_rows += n
+        before += b
+        after += a
+        ctx.save_checkpoint(dict(last_id=last_id))
+    logger.info("aware_upgrade: %d rows, %d -> %d bytes", n_rows, before, after)
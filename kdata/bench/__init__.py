@@ -0,0 +1,10 @@
+"""Benchmarks for converters and ingest.
+
+generators.py makes deterministic synthetic packets for every device
+type, runner.py times converters over them.  Run with:
+
+    python manage.py benchmark [-k REGEX] [--format csv] [--output results.json]
+
+regress.py is the regression gate over a fixed subset of these plus
+the ingest and data views: python manage.py perfcheck [--save]
+"""
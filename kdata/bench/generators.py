@@ -0,0 +1,352 @@
+"""Deterministic synthetic data packets for benchmarks and tests.
+
+Every generator takes a random.Random (or a seed) and returns a list
+of (datetime, str) packets, exactly as the converters get them from
+the database: data is the stored text of one Data row.  The same seed
+always gives the same packets, so results can be compared between
+commits.
+"""
+
+from datetime import datetime, timedelta
+import json
+import random
+
+# All generated data starts here (2017-07-14 02:40 UTC).
+START = 1500000000
+
+PR_PREFIX = 'edu.northwestern.cbits.purple_robot_manager.probes.'
+
+_words = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+          'hotel', 'india', 'juliet', 'kilo', 'lima', 'mike', 'november']
+_packages = ['com.android.chrome', 'com.whatsapp', 'com.facebook.katana',
+             'com.google.android.gm', 'com.spotify.music', 'fi.example.app%d']
+
+
+def _rnd(rnd):
+    if isinstance(rnd, random.Random):
+        return rnd
+    return random.Random(rnd)
+
+def _packet_time(t):
+    return datetime.utcfromtimestamp(t)
+
+def _hex(rnd, n=32):
+    return '%0*x'%(n, rnd.getrandbits(4*n))
+
+def _mac(rnd):
+    return ':'.join('%02x'%rnd.randint(0, 255) for _ in range(6))
+
+def app_whitelist():
+    """Whitelist file text with the common packages of _package()."""
+    return '# version: bench\n' + '\n'.join(_packages[:-1]) + '\n'
+
+def _package(rnd):
+    if rnd.random() < .3:
+        return _packages[-1]%rnd.randint(0, 50)
+    return rnd.choice(_packages[:-1])
+
+
+
+#
+# Purple Robot
+#
+def _pr_probe(rnd, name, t):
+    probe = {'PROBE': PR_PREFIX+name, 'TIMESTAMP': t, 'GUID': _hex(rnd)}
+    if name == 'builtin.BatteryProbe':
+        probe.update(level=rnd.randint(0, 100), plugged=rnd.choice([0, 1, 2]))
+    elif name == 'builtin.ScreenProbe':
+        probe.update(SCREEN_ACTIVE=rnd.choice([True, False]))
+    elif name == 'builtin.WifiAccessPointsProbe':
+        probe.update(CURRENT_SSID='"%s"'%rnd.choice(_words), CURRENT_BSSID=_mac(rnd),
+                     CURRENT_RSSI=-rnd.randint(30, 90),
+                     ACCESS_POINTS=[dict(SSID=rnd.choice(_words), BSSID=_mac(rnd),
+                                         LEVEL=-rnd.randint(30, 90))
+                                    for _ in range(rnd.randint(1, 15))])
+    elif name == 'builtin.BluetoothDevicesProbe':
+        probe.update(DEVICES=[{'BLUETOOTH_NAME': _hex(rnd), 'BLUETOOTH_ADDRESS': _hex(rnd),
+                               'BOND_STATE': 'Not Paired',
+                               'DEVICE MAJOR CLASS': '0x00000100 Computer',
+                               'DEVICE MINOR CLASS': '0x0000010c Laptop'}
+                              for _ in range(rnd.randint(0, 5))])
+    elif name == 'builtin.LocationProbe':
+        probe.update(PROVIDER=rnd.choice(['gps', 'network']),
+                     LATITUDE=60.18+rnd.gauss(0, .01), LONGITUDE=24.83+rnd.gauss(0, .01),
+                     ACCURACY=rnd.uniform(3, 100))
+    elif name == 'builtin.AccelerometerProbe':
+        n = 50
+        probe.update(EVENT_TIMESTAMP=[t+i*.02 for i in range(n)],
+                     NORMALIZED_TIMESTAMP=[t+i*.02+.001 for i in range(n)],
+                     X=[rnd.gauss(0, 1) for _ in range(n)], Y=[rnd.gauss(0, 1) for _ in range(n)],
+                     Z=[rnd.gauss(9.8, 1) for _ in range(n)], ACCURACY=[3]*n)
+    elif name == 'builtin.LightProbe':
+        n = 10
+        probe.update(EVENT_TIMESTAMP=[t+i*.2 for i in range(n)],
+                     LUX=[rnd.uniform(0, 1000) for _ in range(n)], ACCURACY=[3]*n)
+    elif name == 'builtin.RobotHealthProbe':
+        probe.update(LAST_BOOT=(START-86400)*1000)
+    elif name == 'builtin.StepCounterProbe':
+        probe.update(STEP_COUNT=rnd.randint(0, 10000))
+    elif name == 'builtin.RunningSoftwareProbe':
+        probe.update(RUNNING_TASKS=[dict(PACKAGE_NAME=_package(rnd), TASK_STACK_INDEX=i,
+                                         PACKAGE_CATEGORY='Unknown')
+                                    for i in range(rnd.randint(1, 10))])
+    elif name == 'builtin.ApplicationLaunchProbe':
+        probe.update(CURRENT_APP_PKG=_package(rnd), CURRENT_APP_NAME=rnd.choice(_words))
+    elif name == 'builtin.CommunicationEventProbe':
+        probe.update(COMM_TIMESTAMP=int(t*1000), COMMUNICATION_DIRECTION=rnd.choice(['INCOMING', 'OUTGOING']),
+                     COMMUNICATION_TYPE=rnd.choice(['PHONE', 'SMS']), NORMALIZED_HASH=_hex(rnd),
+                     DURATION=rnd.randint(0, 600))
+    return probe
+
+PR_PROBES = ['builtin.BatteryProbe', 'builtin.ScreenProbe', 'builtin.WifiAccessPointsProbe',
+             'builtin.BluetoothDevicesProbe', 'builtin.LocationProbe',
+             'builtin.AccelerometerProbe', 'builtin.LightProbe', 'builtin.RobotHealthProbe',
+             'builtin.StepCounterProbe', 'builtin.RunningSoftwareProbe',
+             'builtin.ApplicationLaunchProbe', 'builtin.CommunicationEventProbe']
+
+def purple_robot(rnd=0, n_packets=200, probes_per_packet=30):
+    """Purple Robot packets: JSON lists of probes of all PR_PROBES types."""
+    rnd = _rnd(rnd)
+    packets = [ ]
+    t = START
+    for i in range(n_packets):
+        probes = [ ]
+        for j in range(probes_per_packet):
+            t += rnd.uniform(0, 10)
+            probes.append(_pr_probe(rnd, PR_PROBES[(i+j) % len(PR_PROBES)], t))
+        packets.append((_packet_time(t+5), json.dumps(probes)))
+    return packets
+
+
+
+#
+# AWARE
+#
+def _aware_value(rnd, field):
+    if field.startswith('double_'):
+        return rnd.uniform(-100, 100)
+    if field in ('accuracy', 'is_silent', 'is_system_app', 'is_moving', 'data_enabled'):
+        return rnd.randint(0, 3)
+    if field.startswith('axis_'):
+        return rnd.gauss(0, 1)
+    if field in ('ssid', 'bssid', 'mac_address', 'bt_address', 'trace'):
+        return _mac(rnd)
+    if field == 'rssi':
+        return -rnd.randint(30, 90)
+    if field == 'bt_rssi':
+        return str(-rnd.randint(30, 90))
+    if field in ('call_type', 'message_type'):
+        return rnd.choice(['1', '2'])
+    if field == 'package_name':
+        return _package(rnd)
+    if field == 'label':
+        return ''
+    if field.endswith(('_status', '_level', '_type', '_state', '_health', '_adaptor', 'sdk', 'duration')):
+        return rnd.randint(0, 100)
+    if field == 'esm_json':
+        return json.dumps(dict(esm_type=1, esm_title=rnd.choice(_words), esm_instructions='...',
+                               esm_submit='OK', esm_notification_timeout=300, esm_trigger='t1'))
+    return ' '.join(rnd.choice(_words) for _ in range(rnd.randint(1, 3)))
+
+# Tables needed by converters which do not list their fields.
+AWARE_EXTRA_FIELDS = {
+    'wifi': ['ssid', 'bssid', 'mac_address', 'rssi'],
+    'bluetooth': ['bt_address', 'bt_rssi', 'bt_name', 'label'],
+    'calls': ['call_type', 'call_duration', 'trace'],
+    'messages': ['message_type', 'trace'],
+    'esms': ['esm_json', 'esm_user_answer', 'double_esm_user_answer_timestamp', 'esm_status'],
+    'applications_foreground': ['package_name', 'application_name', 'is_system_app'],
+    }
+# Sensor tables are sampled fast: more rows per packet.
+AWARE_FAST_TABLES = {'accelerometer', 'gyroscope', 'linear_accelerometer', 'gravity',
+                     'magnetometer', 'rotation', 'light', 'sensor_proximity'}
+
+def aware(table, fields=(), rnd=0, n_packets=100, rows_per_packet=None, version=1):
+    """AWARE packets of one table: {"table": ..., "data": JSON list of rows}.
+
+    version=2: the rows as a list (see kdata/aware_storage.py).
+    """
+    rnd = _rnd(rnd)
+    fields = list(fields) + [f for f in AWARE_EXTRA_FIELDS.get(table, ()) if f not in fields]
+    if rows_per_packet is None:
+        rows_per_packet = 200 if table in AWARE_FAST_TABLES else 20
+    device_id = '%s-%s'%(_hex(rnd, 8), _hex(rnd, 4))
+    packets = [ ]
+    t = START * 1000
+    for i in range(n_packets):
+        rows = [ ]
+        for j in range(rows_per_packet):
+            t += rnd.randint(1, 200 if table in AWARE_FAST_TABLES else 60000)
+            row = {'_id': i*rows_per_packet+j, 'timestamp': t, 'device_id': device_id}
+            for field in fields:
+                row[field] = _aware_value(rnd, field)
+            if table == 'esms':
+                row['double_esm_user_answer_timestamp'] = t + 10000
+            rows.append(row)
+        if version == 2:
+            packet = {'table': table, 'data': rows, 'version': 2}
+        else:
+            packet = {'table': table, 'data': json.dumps(rows)}
+        packets.append((_packet_time(t/1000.+5), json.dumps(packet)))
+    return packets
+
+def aware_packed(table, fields=(), rnd=0, n_packets=100, rows_per_packet=None, compress=True):
+    """Like aware(), but stored packed (see kdata/aware_packed.py)."""
+    from .. import aware_packed as packed
+    packets = [ ]
+    for ts, data in aware(table, fields, rnd=rnd, n_packets=n_packets,
+                          rows_per_packet=rows_per_packet):
+        packet = json.loads(data)
+        packet['data'] = packed.encode(json.loads(packet['data']), compress=compress)
+        packet['encoding'] = packed.ENCODING
+        packets.append((ts, json.dumps(packet)))
+    return packets
+
+def aware_mixed(tables, rnd=0, n_packets=100, version=1):
+    """AWARE packets cycling through several (table, fields) pairs."""
+    rnd = _rnd(rnd)
+    packets = [ ]
+    for i in range(n_packets):
+        table, fields = tables[i % len(tables)]
+        packets.extend(aware(table, fields, rnd=rnd, n_packets=1, version=version))
+    return packets
+
+
+
+#
+# iOS (our app)
+#
+def ios(rnd=0, n_packets=200, rows_per_packet=30):
+    """iOS packets: JSON lists of Location and Screen rows."""
+    rnd = _rnd(rnd)
+    packets = [ ]
+    t = START
+    for i in range(n_packets):
+        rows = [ ]
+        for j in range(rows_per_packet):
+            t += rnd.uniform(0, 30)
+            if rnd.random() < .7:
+                rows.append(dict(probe='Location', timestamp=t, lat=str(60.18+rnd.gauss(0, .01)),
+                                 lon=str(24.83+rnd.gauss(0, .01)), alt=str(rnd.uniform(0, 50)),
+                                 speed=str(rnd.uniform(0, 3))))
+            else:
+                rows.append(dict(probe='Screen', timestamp=t, state=rnd.choice([0, 1])))
+        packets.append((_packet_time(t+5), json.dumps(rows)))
+    return packets
+
+
+
+#
+# Murata bed sensor
+#
+def murata_packet(rnd, t, network_id='net1', node_id='0123456789ab', n_rows=10):
+    """One BSN XML document, as text."""
+    start = datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%S')
+    rows = '\n'.join(','.join([str(i)] + [str(rnd.randint(0, 120)) for _ in range(9)])
+                     for i in range(n_rows))
+    fields = ''.join('<F%d>%d</F%d>'%(i, rnd.randint(0, 9), i) for i in range(9))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<BSN><NETWORK id="%s"><NODE id="%s"><SET>'
+            '<REC time="%s+03:00">%s<VALUES>\n%s\n</VALUES></REC></SET></NODE></NETWORK></BSN>')%(
+                network_id, node_id, start, fields, rows)
+
+def murata(rnd=0, n_packets=500, rows_per_packet=10):
+    """Murata BSN packets, stored as bytes reprs like the real ones."""
+    rnd = _rnd(rnd)
+    packets = [ ]
+    t = START
+    for i in range(n_packets):
+        doc = murata_packet(rnd, t, n_rows=rows_per_packet)
+        t += rows_per_packet
+        packets.append((_packet_time(t+1), str(doc.encode())))
+    return packets
+
+
+
+#
+# Philips Actiwatch
+#
+def actiwatch_file(rnd=0, n_epochs=500, locale='us', tz='+03:00'):
+    """A synthetic Actiwatch export (str).
+
+    locale is 'us' (m/d/Y, h:MM:SS AM), 'eu' (d.m.Y, H:MM:SS, decimal
+    commas) or 'dot' (d.m.Y, HH.MM.SS, decimal commas).
+    """
+    rnd = _rnd(rnd)
+    start = datetime(2017, 1, 1, 0, 0) + timedelta(days=rnd.randint(0, 300),
+                                                   seconds=15*rnd.randint(0, 5000))
+    def fmt(dt):
+        if locale == 'us':
+            return '%d/%d/%d'%(dt.month, dt.day, dt.year), dt.strftime('%I:%M:%S %p').lstrip('0')
+        if locale == 'dot':
+            return dt.strftime('%d.%m.%Y'), dt.strftime('%H.%M.%S')
+        return dt.strftime('%d.%m.%Y'), '%d:%02d:%02d'%(dt.hour, dt.minute, dt.second)
+    def num(x):
+        s = '%.2f'%x
+        return s if locale == 'us' else s.replace('.', ',')
+    def line(*fields):
+        return ','.join('"%s"'%f for f in fields) + ',\r\n'
+    out = ['"------------ Subject Properties------------"\r\n', line('Identity:', 'xxxxx'),
+           '"Time Zone Offset:","%s","hours:minutes"\r\n'%tz, '\r\n\r\n\r\n',
+           '"------------------------- Statistics -------------------------"\r\n', '\r\n',
+           line('Interval Type', 'Interval#', 'Start Date', 'Start Time', 'End Date', 'End Time',
+                'Duration', '%Invalid SW', 'Efficiency', 'Wake Time', '%Wake', 'Sleep Time',
+                '%Sleep', 'Exposure White', 'Avg White', 'Max White', 'TALT White', '%Invalid White')]
+    for i in range(rnd.randint(1, 6)):
+        a = start + timedelta(hours=rnd.randint(0, 100))
+        b = a + timedelta(minutes=rnd.randint(1, 600))
+        out.append(line('REST', i+1, *(fmt(a) + fmt(b) + (num(rnd.random()*500), )
+                                       + tuple(num(rnd.random()*100) for _ in range(11)))))
+    out.append(line('Rest Summary', '', 'NaN', 'NaN', 'NaN', 'NaN', num(1), *(['NaN']*11)))
+    out += ['\r\n\r\n\r\n', '"--------------------- Marker/Score List ---------------------"\r\n', '\r\n',
+            line('Line', 'Date', 'Time', 'Marker', 'Interval Status')]
+    for i in range(rnd.randint(0, 5)):
+        dt = start + timedelta(seconds=15*rnd.randint(0, n_epochs))
+        out.append(line(i+1, *(fmt(dt) + (1, 'ACTIVE'))))
+    out += ['\r\n\r\n\r\n', '"-------------------- Epoch-by-Epoch Data --------------------"\r\n', '\r\n',
+            line('Line', 'Date', 'Time', 'Activity', 'Marker', 'White Light', 'Sleep/Wake',
+                 'Interval Status')]
+    for i in range(n_epochs):
+        dt = start + timedelta(seconds=15*i)
+        out.append(line(i+1, *(fmt(dt) + (rnd.choice(['NaN', rnd.randint(0, 900)]), 0,
+                                          rnd.choice(['NaN', num(rnd.random()*1000)]),
+                                          rnd.choice(['0', '1']), 'ACTIVE'))))
+    return ''.join(out)
+
+def actiwatch(rnd=0, n_packets=3, n_epochs=40320):
+    """Actiwatch uploads (default: a week of 15 s epochs each)."""
+    rnd = _rnd(rnd)
+    return [(_packet_time(START+i*86400*7),
+             str(actiwatch_file(rnd, n_epochs=n_epochs, locale=('us', 'eu', 'dot')[i % 3]).encode()))
+            for i in range(n_packets)]
+
+
+
+#
+# Surveys
+#
+def survey(rnd=0, n_packets=500, n_questions=20):
+    """Survey answers, as saved by kdata.survey."""
+    rnd = _rnd(rnd)
+    packets = [ ]
+    t = START
+    for i in range(n_packets):
+        questions = [ ]
+        answers = { }
+        for j in range(n_questions):
+            slug = 'q%02d'%j
+            kind = j % 3
+            if kind == 0:
+                questions.append([slug, ['Char', {'label': 'Question %d'%j}]])
+                answer = rnd.choice(_words)
+            else:
+                choices = [rnd.choice(_words) for k in range(5)]
+                questions.append([slug, ['Choice' if kind == 1 else 'MultipleChoice',
+                                         {'label': 'Question %d'%j, 'choices': choices}]])
+                answer = str(rnd.randint(0, 4)) if kind == 1 else \
+                         sorted(set(str(rnd.randint(0, 4)) for _ in range(2)))
+            answers[slug] = dict(q='Question %d'%j, a=answer, order=j)
+        t += rnd.uniform(3600, 86400)
+        data = dict(survey_name='bench', access_time=t, submit_time=t+rnd.uniform(30, 600),
+                    survey_data=dict(name='bench', questions=questions), answers=answers)
+        packets.append((_packet_time(t+600), json.dumps(data)))
+    return packets
@@ -0,0 +1,333 @@
+"""Performance regression gate.
+
+A small, fixed set of micro-benchmarks over the hot paths:
+
+    convert:<Converter>        converter over synthetic packets in memory
+    export:<Converter>/<fmt>   converter + download format iterator
+    db:<name>                  ingest (views.post, aware.insert) and the
+                               device_data views, against the database
+
+Each benchmark is run several times.  Results are compared against a
+stored baseline (a JSON file, save one with --save): a benchmark is a
+regression if its median time is more than `threshold` slower than the
+baseline median *and* the bootstrap confidence interval of the ratio
+of medians lies entirely above 1, so that noise alone does not fail
+the check.  The db: benchmarks also record the number of SQL queries,
+and any increase in those is a regression (N+1 queries are caught
+even when the synthetic data is too small to show them in the time).
+
+Each benchmark first runs once untimed as a warm-up.  A fixed
+calibration workload (_calibration) is stored with the results, and
+current times are scaled by how much it changed, so that running on a
+slower or busier machine than the baseline does not fail everything.
+
+Run through "python manage.py perfcheck", which uses a fresh test
+database, so it never touches real data.
+"""
+
+from collections import OrderedDict
+import gc
+import json
+import random
+import statistics
+import time
+
+from . import generators
+from . import runner
+
+BASELINE_VERSION = 1
+
+CONVERT = ['AwareAccelerometer', 'AwareScreen', 'AwareTimestamps', 'AwareWifi',
+           'PRTimestamps', 'PRWifiSafe', 'PRAccelerometer', 'IosLocation',
+           'MurataBSN', 'ActiwatchFull', 'SurveyAnswers']
+EXPORT = [('AwareAccelerometer', 'csv'), ('AwareAccelerometer', 'json-lines'),
+          ('PRBattery', 'sqlite3dump'), ('PRWifiSafe', 'json')]
+# Smaller than the benchmark suite: this runs on every check.
+SCALE = 0.5
+CALIBRATION = '_calibration'
+
+
+class Benchmark(object):
+    """One named benchmark.  run(repeat) returns (times, n_queries)."""
+    db = False
+    def __init__(self, name):
+        self.name = name
+    def run(self, repeat):
+        raise NotImplementedError()
+
+
+class ConverterBenchmark(Benchmark):
+    def __init__(self, name, case, format, packets):
+        super(ConverterBenchmark, self).__init__(name)
+        self.case, self.format, self.packets = case, format, packets
+    def run(self, repeat):
+        times = [ ]
+        for i in range(repeat+1):
+            gc.collect()
+            result = runner.run_case(self.case, format=self.format, packets=self.packets())
+            if result['error']:
+                raise RuntimeError('%s: %s'%(self.name, result['error']))
+            if i > 0:       # first one is warm-up
+                times.extend(result['times'])
+        return times, None
+
+
+class CalibrationBenchmark(Benchmark):
+    """A fixed pure-Python workload, measuring the speed of the machine.
+
+    Comparisons divide all times by the change in this one, so that a
+    generally slower or busier machine does not show up as regressions.
+    """
+    def __init__(self):
+        super(CalibrationBenchmark, self).__init__(CALIBRATION)
+        rnd = random.Random(0)
+        self.data = [dict(timestamp=i, value=rnd.random(), name=str(rnd.random()))
+                     for i in range(20000)]
+    def run(self, repeat):
+        times = [ ]
+        for i in range(repeat+1):
+            gc.collect()
+            t1 = time.perf_counter()
+            rows = json.loads(json.dumps(self.data))
+            sorted((row['value'], row['name']) for row in rows)
+            if i > 0:
+                times.append(time.perf_counter() - t1)
+        return times, None
+
+
+class DbBenchmark(Benchmark):
+    """A benchmark against the database.
+
+    setup() runs once; each repetition of func(state) runs in its own
+    transaction which is rolled back, so all repetitions see the same
+    database.  Queries of the last repetition are counted.  The first
+    repetition is a warm-up and not timed.
+    """
+    db = True
+    def __init__(self, name, setup, func):
+        super(DbBenchmark, self).__init__(name)
+        self.setup, self.func = setup, func
+    def run(self, repeat):
+        from django.db import connection, transaction
+        from django.test.utils import CaptureQueriesContext
+        times = [ ]
+        n_queries = None
+        with transaction.atomic():
+            state = self.setup()
+            for i in range(repeat+1):
+                gc.collect()
+                with transaction.atomic():
+                    with CaptureQueriesContext(connection) as queries:
+                        t1 = time.perf_counter()
+                        self.func(state)
+                        if i > 0:       # first one is warm-up
+                            times.append(time.perf_counter() - t1)
+                    n_queries = len(queries)
+                    transaction.set_rollback(True)
+            transaction.set_rollback(True)
+        return times, n_queries
+
+
+
+#
+# Database benchmarks
+#
+def _db_fixture(device_type, packets):
+    """Create a user, a device of device_type, and store packets."""
+    from django.utils import timezone
+    from .. import models, util
+    user = models.User.objects.create_user('perfcheck-user')
+    device_id = util.add_checkdigits('%016x'%random.Random(device_type).getrandbits(64))
+    device = models.Device(user=user, name='perfcheck', type=device_type, device_id=device_id,
+                           _public_id=device_id[:6], _secret_id=device_id)
+    device.save()
+    models.Data.objects.bulk_create(
+        models.Data(device_id=device_id, ip='127.0.0.1', data=data, data_length=len(data),
+                    ts=timezone.make_aware(ts, timezone.utc))
+        for ts, data in packets)
+    return dict(user=user, device=device)
+
+def _request(method, path, **kwargs):
+    from django.test import RequestFactory
+    return getattr(RequestFactory(), method)(path, **kwargs)
+
+def db_benchmarks():
+    from ..devices import aware
+    from .. import views, views_data
+    pr_packets = generators.purple_robot(11, n_packets=100)
+    accel = generators.aware('accelerometer', ['double_values_0', 'double_values_1',
+                                               'double_values_2', 'accuracy'],
+                             rnd=12, n_packets=1, rows_per_packet=3000)
+
+    def pr_setup():
+        return _db_fixture('kdata.devices.purplerobot.PurpleRobot', pr_packets)
+    def aware_setup():
+        return _db_fixture('kdata.devices.aware.Aware', [ ])
+
+    def post(state):
+        device_id = state['device'].device_id
+        for ts, data in pr_packets[:50]:
+            r = views.post(_request('post', '/post/', data=data.encode(),
+                                    content_type='application/json', HTTP_DEVICE_ID=device_id))
+            assert r.status_code == 200, r.content
+    def aware_insert(state):
+        rows = json.loads(accel[0][1])['data']
+        r = aware.insert(_request('post', '/aware/', data=dict(data=rows)),
+                         secret_id=state['device'].secret_id, table='accelerometer')
+        assert r.status_code == 200, r.content
+    def device_data(format, converter):
+        def func(state):
+            request = _request('get', '/devices/%s/%s'%(state['device'].public_id, converter))
+            request.user = state['user']
+            r = views_data.device_data(request, state['device'].public_id, converter, format)
+            assert r.status_code == 200, r.status_code
+            if format:
+                for _ in r.streaming_content: pass
+            else:
+                r.render()
+        return func
+
+    return [
+        DbBenchmark('db:post', pr_setup, post),
+        DbBenchmark('db:aware_insert', aware_setup, aware_insert),
+        DbBenchmark('db:device_data_html', pr_setup, device_data(None, 'PRBattery')),
+        DbBenchmark('db:device_data_csv', pr_setup, device_data('csv', 'PRWifi')),
+        ]
+
+
+def get_benchmarks(db=True):
+    cases = {c.name: c for c in runner.get_cases()}
+    sources = runner.get_sources()
+    packets = { }
+    def packets_of(source):
+        def get():
+            if source not in packets:
+                packets[source] = sources[source](SCALE)
+            return packets[source]
+        return get
+    benchmarks = [CalibrationBenchmark()]
+    for name in CONVERT:
+        case = cases[name]
+        benchmarks.append(ConverterBenchmark('convert:'+name, case, 'rows', packets_of(case.source)))
+    for name, format in EXPORT:
+        case = cases[name]
+        benchmarks.append(ConverterBenchmark('export:%s/%s'%(name, format), case, format,
+                                             packets_of(case.source)))
+    if db:
+        benchmarks.extend(db_benchmarks())
+    return benchmarks
+
+
+def run_benchmarks(benchmarks, repeat=7, log=None):
+    """Run benchmarks, returning {name: dict(times, median, queries)}."""
+    results = OrderedDict()
+    for bench in benchmarks:
+        times, n_queries = bench.run(repeat)
+        results[bench.name] = OrderedDict([('median', statistics.median(times)),
+                                           ('times', times),
+                                           ('queries', n_queries)])
+        if log is not None:
+            log('%-45s %9.4f s%s'%(bench.name, results[bench.name]['median'],
+                                   '  %d queries'%n_queries if n_queries is not None else ''))
+    return results
+
+
+
+#
+# Statistics
+#
+def bootstrap_ratio_ci(baseline, current, confidence=0.95, n_boot=2000, seed=0):
+    """Bootstrap confidence interval of median(current)/median(baseline)."""
+    rnd = random.Random(seed)
+    ratios = [ ]
+    for _ in range(n_boot):
+        b = statistics.median(rnd.choice(baseline) for _ in baseline)
+        c = statistics.median(rnd.choice(current) for _ in current)
+        ratios.append(c / b if b else float('inf'))
+    ratios.sort()
+    lo = ratios[int((1-confidence)/2 * n_boot)]
+    hi = ratios[min(int((1+confidence)/2 * n_boot), n_boot-1)]
+    return lo, hi
+
+
+def compare_one(baseline, current, threshold=0.10, confidence=0.95):
+    """Compare one benchmark, returns a dict with status.
+
+    status is 'regression', 'improvement', 'ok' (within the noise
+    threshold or not significant), or 'new' (no baseline).
+    """
+    result = OrderedDict([('status', 'ok'),
+                          ('median', current['median'])])
+    if baseline is None:
+        result['status'] = 'new'
+        return result
+    ratio = current['median'] / baseline['median'] if baseline['median'] else float('inf')
+    lo, hi = bootstrap_ratio_ci(baseline['times'], current['times'], confidence=confidence)
+    result.update([('baseline_median', baseline['median']), ('ratio', ratio),
+                   ('ci', [lo, hi])])
+    if ratio > 1 + threshold and lo > 1:
+        result['status'] = 'regression'
+    elif ratio < 1 / (1 + threshold) and hi < 1:
+        result['status'] = 'improvement'
+    if current.get('queries') is not None and baseline.get('queries') is not None:
+        result['queries'] = current['queries']
+        result['baseline_queries'] = baseline['queries']
+        if current['queries'] > baseline['queries']:
+            result['status'] = 'regression'
+            result['reason'] = 'queries'
+    return result
+
+
+def machine_factor(baseline, current):
+    """How much slower this machine is now than when the baseline was made."""
+    if CALIBRATION not in baseline or CALIBRATION not in current:
+        return 1.0
+    return current[CALIBRATION]['median'] / baseline[CALIBRATION]['median']
+
+
+def compare(baseline, current, threshold=0.10, confidence=0.95, calibrate=True):
+    """Compare all benchmarks in current against baseline (both {name: result}).
+
+    With calibrate, current times are first divided by machine_factor().
+    """
+    factor = machine_factor(baseline, current) if calibrate else 1.0
+    comparison = OrderedDict()
+    for name, cur in current.items():
+        if name == CALIBRATION:
+            continue
+        if factor != 1.0:
+            cur = dict(cur, times=[t/factor for t in cur['times']],
+                       median=cur['median']/factor)
+        comparison[name] = compare_one(baseline.get(name), cur, threshold=threshold,
+                                       confidence=confidence)
+        comparison[name]['machine_factor'] = factor
+    return comparison
+
+
+def format_comparison(name, c):
+    if c['status'] == 'new':
+        return '%-45s %9.4f s  (no baseline)'%(name, c['median'])
+    line = '%-45s %9.4f s  %+6.1f%%  [%+.1f%%, %+.1f%%]'%(
+        name, c['median'], (c['ratio']-1)*100, (c['ci'][0]-1)*100, (c['ci'][1]-1)*100)
+    if 'queries' in c:
+        line += '  queries %d->%d'%(c['baseline_queries'], c['queries'])
+    if c['status'] != 'ok':
+        line += '  ' + c['status'].upper()
+    return line
+
+
+
+#
+# Baselines
+#
+def save_baseline(results, f):
+    json.dump(OrderedDict([('meta', runner.metadata()), ('version', BASELINE_VERSION),
+                           ('benchmarks', results)]),
+              f, indent=1)
+    f.write('\n')
+
+def load_baseline(f):
+    data = json.load(f)
+    if data.get('version') != BASELINE_VERSION:
+        raise ValueError("Unknown baseline version: %s"%data.get('version'))
+    return data['meta'], data['benchmarks']
@@ -0,0 +1,348 @@
+"""Converter benchmark runner.
+
+A benchmark case is one converter run over one list of synthetic
+packets (see generators.py), written through one output format:
+
+    rows         just iterate the converted rows
+    csv, json, json-lines, sqlite3dump
+                 the same util.*_iter functions as the download views
+
+For each case we measure wall time, rows/s, input MB/s (size of the
+raw stored data) and the peak RSS of the process.  Each case runs in
+a forked child process (where possible), so the peak RSS is that of
+the case alone and one case's garbage does not slow down the next.
+
+Results are plain dicts, written as JSON by write_results() so that
+runs from different commits can be compared.
+"""
+
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from . import generators
+
+RESULTS_VERSION = 1
+
+Case = namedtuple('Case', ['name', 'converter', 'source'])
+
+
+def _format_iters():
+    from .. import util
+    return OrderedDict([
+        ('csv', util.csv_iter),
+        ('json', util.json_iter),
+        ('json-lines', util.json_lines_iter),
+        ('sqlite3dump', util.sqlite3dump_iter),
+        ])
+FORMATS = ['rows', 'csv', 'json', 'json-lines', 'sqlite3dump']
+
+
+
+#
+# Cases
+#
+# Packet sources: name -> function(scale) returning the packets.
+# Sizes are chosen so that scale=1 runs each case in about a second.
+SOURCES = OrderedDict([
+    ('purple_robot', lambda scale: generators.purple_robot(1, n_packets=int(200*scale))),
+    ('ios', lambda scale: generators.ios(2, n_packets=int(300*scale))),
+    ('murata', lambda scale: generators.murata(3, n_packets=int(2000*scale))),
+    ('actiwatch', lambda scale: generators.actiwatch(4, n_packets=max(1, int(3*scale)))),
+    ('survey', lambda scale: generators.survey(5, n_packets=int(1000*scale))),
+    ])
+
+PR_CONVERTERS = ['PRProbes', 'PRTimestamps', 'PRBattery', 'PRScreen', 'PRWifi', 'PRWifiSafe',
+                 'PRBluetooth', 'PRBluetoothSafe', 'PRLocation', 'PRAccelerometer',
+                 'PRLightProbe', 'PRStepCounter', 'PRRunningSoftware',
+                 'PRApplicationLaunchesSafe', 'PRCommunicationEventProbe', 'PRDataSize',
+                 'PRStoredDataSize']
+IOS_CONVERTERS = ['IosTimestamps', 'IosLocation', 'IosScreen']
+MURATA_CONVERTERS = ['MurataBSN', 'MurataBSNDebug']
+ACTIWATCH_CONVERTERS = ['ActiwatchFull', 'ActiwatchStatistics', 'ActiwatchMarkers']
+# AWARE converters which do not have a table attribute.
+AWARE_TABLES = {'AwareCalls': 'calls', 'AwareMessages': 'messages', 'AwareESM': 'esms'}
+# AWARE converters over all tables.
+AWARE_MIXED_CONVERTERS = ['AwareTimestamps', 'AwarePacketTimeRange', 'AwareUploads',
+                          'AwareDataSize']
+
+
+def aware_converters():
+    """(converter class, table) of every table-specific AWARE converter."""
+    from .. import converter
+    found = [ ]
+    for name, cls in sorted(vars(converter).items()):
+        if not (isinstance(cls, type) and issubclass(cls, converter.BaseAwareConverter)):
+            continue
+        if cls.__name__ != name:    # aliases like AwareEsms
+            continue
+        table = getattr(cls, 'table', None) or AWARE_TABLES.get(name)
+        if table:
+            found.append((cls, table))
+    return found
+
+
+def get_sources():
+    """All packet sources, including one per AWARE table."""
+    sources = OrderedDict(SOURCES)
+    tables = OrderedDict()
+    for cls, table in aware_converters():
+        fields = tables.setdefault(table, [ ])
+        fields.extend(f for f in getattr(cls, 'fields', ()) if f not in fields)
+    for table, fields in tables.items():
+        # Fast sensor tables: fewer packets, since they have more rows.
+        n = 50 if table in generators.AWARE_FAST_TABLES else 300
+        sources['aware:'+table] = (lambda table, fields, n: lambda scale:
+                                   generators.aware(table, fields, rnd=6, n_packets=int(n*scale))
+                                   )(table, fields, n)
+    # The same sensor data, stored packed.
+    from .. import aware_packed
+    for table in sorted(aware_packed.TABLES & set(tables)):
+        sources['aware-packed:'+table] = (lambda table, fields: lambda scale:
+                                          generators.aware_packed(table, fields, rnd=6,
+                                                                  n_packets=int(50*scale))
+                                          )(table, tables[table])
+    # ... and in storage version 2.
+    for table in sorted(aware_packed.TABLES & set(tables)):
+        sources['aware-v2:'+table] = (lambda table, fields: lambda scale:
+                                      generators.aware(table, fields, rnd=6,
+                                                       n_packets=int(50*scale), version=2)
+                                      )(table, tables[table])
+    sources['aware:mixed'] = lambda scale: generators.aware_mixed(
+        list(tables.items()), rnd=7, n_packets=int(300*scale))
+    sources['aware-v2:mixed'] = lambda scale: generators.aware_mixed(
+        list(tables.items()), rnd=7, n_packets=int(300*scale), version=2)
+    return sources
+
+
+def get_cases():
+    """All benchmark cases (without format)."""
+    from .. import converter
+    from .. import survey
+    cases = [ ]
+    for names, source in ((PR_CONVERTERS, 'purple_robot'), (IOS_CONVERTERS, 'ios'),
+                          (MURATA_CONVERTERS, 'murata'), (ACTIWATCH_CONVERTERS, 'actiwatch')):
+        for name in names:
+            cases.append(Case(name, getattr(converter, name), source))
+    for cls in (survey.SurveyAnswers, survey.SurveyMeta):
+        cases.append(Case(cls.__name__, cls, 'survey'))
+    from .. import aware_packed
+    for cls, table in aware_converters():
+        cases.append(Case(cls.__name__, cls, 'aware:'+table))
+        if table in aware_packed.TABLES:
+            cases.append(Case(cls.__name__+'-packed', cls, 'aware-packed:'+table))
+            cases.append(Case(cls.__name__+'-v2', cls, 'aware-v2:'+table))
+    for name in AWARE_MIXED_CONVERTERS:
+        cases.append(Case(name, getattr(converter, name), 'aware:mixed'))
+        cases.append(Case(name+'-v2', getattr(converter, name), 'aware-v2:mixed'))
+    return cases
+
+
+def select_cases(cases, patterns):
+    """Cases whose name or source matches any of the regexes."""
+    if not patterns:
+        return cases
+    regexes = [re.compile(p) for p in patterns]
+    return [c for c in cases
+            if any(r.search(c.name) or r.search(c.source) for r in regexes)]
+
+
+
+#
+# Measuring
+#
+def _rss_kb():
+    """Current resident set size, kB (0 if unknown)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024        # bytes there, kB on Linux
+    return peak
+
+
+def iter_sqlite(packets, dirname):
+    """Store packets in a SQLite table and iterate them back from it.
+
+    This includes the cost of reading from a database (in the same
+    form as the Data table), without needing django or a server.
+    """
+    fname = os.path.join(dirname, 'bench.sqlite3')
+    conn = sqlite3.connect(fname)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS data (id INTEGER PRIMARY KEY, ts TEXT, data TEXT)')
+        conn.execute('DELETE FROM data')
+        conn.executemany('INSERT INTO data (ts, data) VALUES (?, ?)',
+                         ((ts.isoformat(' '), data) for ts, data in packets))
+        conn.commit()
+        for ts, data in conn.execute('SELECT ts, data FROM data ORDER BY id'):
+            yield datetime.fromisoformat(ts), data
+    finally:
+        conn.close()
+
+
+def run_case(case, format='rows', scale=1.0, repeat=1, db='memory', packets=None):
+    """Run one case in this process, return the result dict."""
+    if packets is None:
+        packets = get_sources()[case.source](scale)
+    bytes_in = sum(len(data) for _, data in packets)
+    rss_start = _rss_kb()
+    times = [ ]
+    error = None
+    n_rows = bytes_out = 0
+    tmpdir = tempfile.mkdtemp(prefix='koota-bench-') if db == 'sqlite' else None
+    # Without a downloaded app whitelist, safe converters refuse to run.
+    from .. import app_whitelist
+    own_whitelist = not len(app_whitelist.get_matcher())
+    if own_whitelist:
+        app_whitelist.set_source(generators.app_whitelist)
+    try:
+        for _ in range(max(repeat, 1)):
+            n_rows = bytes_out = 0
+            conv = case.converter()
+            rows = iter_sqlite(packets, tmpdir) if db == 'sqlite' else iter(packets)
+            t1 = time.perf_counter()
+            table = conv.convert(rows, time=lambda x: x)
+            if format == 'rows':
+                for _ in table:
+                    n_rows += 1
+            else:
+                def counted(table):
+                    nonlocal n_rows
+                    for row in table:
+                        n_rows += 1
+                        yield row
+                for chunk in _format_iters()[format](counted(table), converter=conv,
+                                                     header=conv.header2()):
+                    bytes_out += len(chunk)
+            times.append(time.perf_counter() - t1)
+    except Exception as e:
+        error = '%s: %s'%(e.__class__.__name__, e)
+        traceback.print_exc()
+    finally:
+        if own_whitelist:
+            app_whitelist.set_source(None)
+        if tmpdir is not None:
+            import shutil
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    seconds = min(times) if times else None
+    peak = _peak_rss_kb()
+    return OrderedDict([
+        ('name', '%s/%s'%(case.name, format)),
+        ('converter', case.name),
+        ('source', case.source),
+        ('format', format),
+        ('db', db),
+        ('scale', scale),
+        ('packets', len(packets)),
+        ('rows', n_rows),
+        ('bytes_in', bytes_in),
+        ('bytes_out', bytes_out),
+        ('seconds', seconds),
+        ('times', times),
+        ('rows_per_s', n_rows/seconds if seconds else None),
+        ('mb_per_s', bytes_in/2**20/seconds if seconds else None),
+        ('peak_rss_kb', peak),
+        ('rss_growth_kb', max(peak - rss_start, 0) if rss_start else None),
+        ('error', error),
+        ])
+
+
+def _child(conn, case, kwargs):
+    try:
+        conn.send(run_case(case, **kwargs))
+    except BaseException as e:
+        conn.send(dict(name='%s/%s'%(case.name, kwargs.get('format')), converter=case.name,
+                       error='%s: %s'%(e.__class__.__name__, e)))
+    finally:
+        conn.close()
+
+def run_isolated(case, **kwargs):
+    """Run a case in a forked child process, if fork is available."""
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return run_case(case, **kwargs)
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(child_conn, case, kwargs))
+    proc.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = dict(name='%s/%s'%(case.name, kwargs.get('format')), converter=case.name,
+                      error='benchmark process died (exit code %s)'%proc.exitcode)
+    proc.join()
+    return result
+
+
+def run(cases, formats=('rows', ), isolate=True, log=None, **kwargs):
+    """Run all cases in all formats.  Yields result dicts."""
+    for case in cases:
+        for format in formats:
+            if isolate:
+                result = run_isolated(case, format=format, **kwargs)
+            else:
+                result = run_case(case, format=format, **kwargs)
+            if log is not None:
+                log(format_result(result))
+            yield result
+
+
+
+#
+# Output
+#
+def format_result(r):
+    """One human-readable line for a result."""
+    if r.get('error') or not r.get('seconds'):
+        return '%-45s ERROR %s'%(r['name'], r.get('error'))
+    return '%-45s %10d rows %8.3f s %12.0f rows/s %8.2f MB/s %8.1f MiB peak'%(
+        r['name'], r['rows'], r['seconds'], r['rows_per_s'], r['mb_per_s'],
+        r['peak_rss_kb']/1024.)
+
+
+def metadata():
+    """Information about this run, stored with the results."""
+    commit = None
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return OrderedDict([
+        ('version', RESULTS_VERSION),
+        ('time', time.time()),
+        ('commit', commit),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('hostname', platform.node()),
+        ])
+
+
+def write_results(results, f, meta=None):
+    """Write results as JSON to file object f."""
+    json.dump(OrderedDict([('meta', meta if meta is not None else metadata()),
+                           ('results', list(results))]),
+              f, indent=1)
+    f.write('\n')
+
+def read_results(f):
+    """Read results written by write_results: returns (meta, {name: result})."""
+    data = json.load(f)
+    return data['meta'], OrderedDict((r['name'], r) for r in data['results'])
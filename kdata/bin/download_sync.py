@@ -1,19 +1,21 @@
 import argparse
 import atexit
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import glob
 import json
 import os
-import subprocess
+import re
+import sqlite3
 import sys
 import time
 try:
     # python3
     import requests
-    from urllib.request import Request, urlopen
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     import urllib.parse as parse
 except ImportError:
-    from urllib2 import Request, urlopen
     import urllib2.parse as parse
 
 usage = """\
@@ -65,78 +67,365 @@ When using --out-db there are several options:
      To ensure things are consistent, you can run one of the above
      commands:
          --out-db=data.sqlite3:incremental
+
+Days are downloaded in parallel (--workers, default 4) over one pooled
+HTTP session which retries transient failures.  Dump files are then
+loaded in-process, in one transaction per --batch files, and indexes
+are only created once all data is loaded.
 """
 
-parser = argparse.ArgumentParser(usage=usage)
-parser.add_argument("base_url", help="URL to the device (e.g. https://domain.tld/devices/abcdef) or group (e.g. https://domain.tld/group/GroupName)")
-parser.add_argument("converter", help="Converter name (e.g. AwareTimestamps)")
-parser.add_argument("output_dir", help="")
-#parser.add_argument("--session-id")
-#parser.add_argument("--device")
-parser.add_argument("-f", "--format", default='sqlite3dump', help="format to download")
-parser.add_argument("--out-db", default=None,
-                    help="if download format is sqlite3dump, location of database to create.  "
-                         "Default: db.sqlite in output_dir.  If you use another format "
-                         "(like csv), you should not use --out-db, but you will end up "
-                         "with a lot of csv files.")
-parser.add_argument("--group", default=None, action='store_true',
-                    help="If true, treate base_url as a group.  Required for group downloads.")
-parser.add_argument("-v", "--verbose", default=None, action='store_true')
-parser.add_argument("--start", default=None,
-                    help="Earliest time to download (expanded to nearest whole day)")
-parser.add_argument("--end", default=None,
-                    help="Latest time to download (expanded to nearest whole day)")
-parser.add_argument("--force-recreate", action='store_true', default=None,
-                    help="Force an update of all databases.  By default, this creates *new* "
-                         "databases (re-loading all data).  If :updateonly or :incremental")
-parser.add_argument("--unsafe", action='store_true', default=None,
-                    help="Open database in unsafe mode.  May be slightly faster, but "
-                         "could corrupt the database under certain circumstances.")
-
-args = parser.parse_args()
-
-baseurl = args.base_url
-baseurl_p = parse.urlparse(args.base_url)
-VERBOSE = args.verbose
-
-if 'session_id' not in os.environ:
-    print("You must set session_id first!")
-    exit(2)
-
-#class auth(requests.auth.AuthBase):
-#    def __call__(self, r):
-#        r.cookies = dict(sessionid=args['session_id'])
-#        import IPython ; IPython.embed()
-#        return r
-
-
-def get(url, params={}):
-    #R = Request(url, headers={'Cookie': 'sessionid='+os.environ['session_id']})
-
-    r = requests.get(url, params=params, headers={'Cookie': 'sessionid='+os.environ['session_id']})
+
+def make_parser():
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument("base_url", help="URL to the device (e.g. https://domain.tld/devices/abcdef) or group (e.g. https://domain.tld/group/GroupName)")
+    parser.add_argument("converter", help="Converter name (e.g. AwareTimestamps)")
+    parser.add_argument("output_dir", help="")
+    parser.add_argument("-f", "--format", default='sqlite3dump', help="format to download")
+    parser.add_argument("--out-db", default=None,
+                        help="if download format is sqlite3dump, location of database to create.  "
+                             "Default: db.sqlite in output_dir.  If you use another format "
+                             "(like csv), you should not use --out-db, but you will end up "
+                             "with a lot of csv files.")
+    parser.add_argument("--group", default=None, action='store_true',
+                        help="If true, treate base_url as a group.  Required for group downloads.")
+    parser.add_argument("-v", "--verbose", default=None, action='store_true')
+    parser.add_argument("--start", default=None,
+                        help="Earliest time to download (expanded to nearest whole day)")
+    parser.add_argument("--end", default=None,
+                        help="Latest time to download (expanded to nearest whole day)")
+    parser.add_argument("--force-recreate", action='store_true', default=None,
+                        help="Force an update of all databases.  By default, this creates *new* "
+                             "databases (re-loading all data).  If :updateonly or :incremental")
+    parser.add_argument("--unsafe", action='store_true', default=None,
+                        help="Open database in unsafe mode.  May be slightly faster, but "
+                             "could corrupt the database under certain circumstances.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of days to download in parallel (default 4).")
+    parser.add_argument("--retries", type=int, default=5,
+                        help="Retries (with exponential backoff) for failed requests.")
+    parser.add_argument("--batch", type=int, default=16,
+                        help="Number of files to load per database transaction.")
+    return parser
+
+
+VERBOSE = False
+
+
+def make_session(session_id, workers=4, retries=5):
+    """Session shared by all fetchers.
+
+    One connection pool (so TCP/TLS connections are reused across
+    days), sized for the number of workers, and retrying connection
+    errors and server errors with exponential backoff.
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5,
+                  status_forcelist=(500, 502, 503, 504),
+                  allowed_methods=frozenset(('GET', )))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1),
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Cookie'] = 'sessionid='+session_id
+    return session
+
+
+def get(session, url, params={}):
+    r = session.get(url, params=params)
     if 'Please login to' in r.text:
         print("session_id invalid or can't log in")
-        exit(2)
+        sys.exit(2)
     if r.status_code != 200:
         raise Exception("requests failure: %s %s (on %s %s)"%(r.status_code, r.reason, url, params))
     return r.text
 
-format = args.format
-today = datetime.date.today()
-os.makedirs(args.output_dir, exist_ok=True)
-
-#for converter in args.converter.split(','):
-
-# Get data
-if not args.group:
-    R = get(os.path.join(baseurl, 'json'))
-else:
-    print(os.path.join(baseurl, args.converter, 'json'))
-    R = get(os.path.join(baseurl, args.converter, 'json'))
-print(R)
-data = json.loads(R)
-if data['data_exists']:
-    has_new_data = False
+
+def days_to_fetch(converter, output_dir, format, earliest, latest, today=None):
+    """Return list of (day, outfile, is_partial) which need downloading.
+
+    Days already on disk are skipped, except for today which is always
+    re-downloaded into a .partial file.  Stale .partial files from
+    earlier days are removed.
+    """
+    if today is None:
+        today = datetime.date.today()
+    todo = [ ]
+    current_day = earliest - datetime.timedelta(days=1)
+    while current_day < latest:
+        # process [current_date, current_date+1)
+        current_day += datetime.timedelta(days=1)
+        is_partial = False
+        outfile = current_day.strftime(converter+'.%Y-%m-%d'+'.'+format)
+        outfile = os.path.join(output_dir, outfile)
+        if os.path.exists(outfile+'.partial') and current_day != today:
+            os.unlink(outfile+'.partial')
+        if current_day == today:
+            outfile = outfile + '.partial'
+            is_partial = True
+        redownload_today = True  # remove .partial from today, too?
+        if os.path.exists(outfile) and (current_day != today or not redownload_today):
+            if VERBOSE: print('  '+outfile)
+            continue
+        todo.append((current_day, outfile, is_partial))
+    return todo
+
+
+def fetch_day(session, url, day, outfile):
+    """Download one day to outfile (atomically, via a .tmp file)."""
+    t1 = time.time()
+    R = get(session, url,
+            params=dict(start=day.strftime('%Y-%m-%d'),
+                        end=(day+datetime.timedelta(days=1)).strftime('%Y-%m-%d')))
+    dt = time.time() - t1
+    with open(outfile+'.tmp', 'w') as f:
+        f.write(R)
+    os.rename(outfile+'.tmp', outfile)
+    # One write, so that lines from parallel fetchers do not interleave.
+    sys.stdout.write('  %s  %8d  %4.1fs   %4.1f\n'%(outfile, len(R), dt, len(R)/max(dt, 1e-6)))
+    sys.stdout.flush()
+    return outfile
+
+
+def fetch_days(session, url, todo, workers=4):
+    """Download all days in todo with a thread pool.
+
+    Returns the list of completed, non-partial files (in day order).
+    If any fetch fails, the exception is raised after the files which
+    did complete are returned through the exception's .new_files.
+    """
+    new_files = [ ]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = [(pool.submit(fetch_day, session, url, day, outfile), is_partial)
+                   for day, outfile, is_partial in todo]
+        error = None
+        for future, is_partial in futures:
+            try:
+                outfile = future.result()
+            except BaseException as e:
+                error = error or e
+                continue
+            if not is_partial:
+                new_files.append(outfile)
+    if error is not None:
+        error.new_files = new_files
+        raise error
+    return new_files
+
+
+
+# Parsing of our own sqlite3dump format (see kdata.util.sqlite3dump_iter).
+# INSERT lines are turned into parameter tuples so that a whole file
+# can go through one executemany() instead of one statement per row.
+_insert_re = re.compile(r'INSERT INTO "?([^"\s(]+)"? VALUES\((.*)\);\s*$', re.S)
+_literal_re = re.compile(r"""\s*(?:'((?:[^']|'')*)'|(NULL)|(True|False)|([-+0-9.eE]+|[-+]?inf))\s*(,|$)""")
+
+def parse_values(values):
+    """Parse the VALUES(...) list of an INSERT line into a tuple.
+
+    Returns None if the line can not be parsed, in which case the
+    caller should execute the statement as-is.
+    """
+    row = [ ]
+    pos = 0
+    end = len(values)
+    while pos < end:
+        m = _literal_re.match(values, pos)
+        if m is None:
+            return None
+        string, null, boolean, number = m.group(1, 2, 3, 4)
+        if string is not None:
+            row.append(string.replace("''", "'"))
+        elif null is not None:
+            row.append(None)
+        elif boolean is not None:
+            row.append(1 if boolean == 'True' else 0)
+        else:
+            try:
+                row.append(int(number))
+            except ValueError:
+                try:
+                    row.append(float(number))
+                except ValueError:
+                    return None
+        pos = m.end()
+        if m.group(5) == '' and pos < end:
+            return None
+    return tuple(row)
+
+
+def iter_dump(f):
+    """Iterate a dump file, yielding ('sql', stmt) or ('rows', table, rows).
+
+    Consecutive INSERTs into the same table are grouped.  Transaction
+    control statements are dropped, since the loader manages
+    transactions itself.
+    """
+    table = None
+    rows = [ ]
+    stmt = ''
+    for line in f:
+        if not stmt:
+            if line.startswith('--') or not line.strip():
+                continue
+            m = _insert_re.match(line)
+            if m:
+                row = parse_values(m.group(2))
+                if row is not None:
+                    if m.group(1) != table or (rows and len(rows[0]) != len(row)):
+                        if rows:
+                            yield ('rows', table, rows)
+                        table, rows = m.group(1), [ ]
+                    rows.append(row)
+                    continue
+        # Any other statement (may span lines if strings contain newlines)
+        stmt += line
+        if not sqlite3.complete_statement(stmt):
+            continue
+        if rows:
+            yield ('rows', table, rows)
+            table, rows = None, [ ]
+        if stmt.strip().upper().rstrip(';').strip() not in ('BEGIN TRANSACTION', 'BEGIN', 'COMMIT', 'END'):
+            yield ('sql', stmt)
+        stmt = ''
+    if rows:
+        yield ('rows', table, rows)
+
+
+def load_file(conn, filename):
+    """Apply one dump file to conn, without committing."""
+    n = 0
+    with open(filename) as f:
+        for item in iter_dump(f):
+            if item[0] == 'sql':
+                conn.execute(item[1])
+                continue
+            _, table, rows = item
+            conn.executemany('INSERT INTO "%s" VALUES (%s)'%(table, ','.join('?'*len(rows[0]))),
+                             rows)
+            n += len(rows)
+    return n
+
+
+def create_indexes(conn, table):
+    """Create the (user, time) index, or (user) and (time) if not possible."""
+    def index(columns):
+        conn.execute('CREATE INDEX IF NOT EXISTS "{table}_{idxid}" ON "{table}" ({columns})'.format(
+            table=table, idxid='_'.join(columns), columns=', '.join(columns)))
+    try:
+        index(('user', 'time'))
+    except sqlite3.OperationalError:
+        # Can't make user,time: do (user) only and (time) only if possible.
+        for columns in (('user', ), ('time', )):
+            try:
+                index(columns)
+            except sqlite3.OperationalError:
+                pass
+
+
+def load_files(dbfile, files, table, batch=16, unsafe=False):
+    """Load dump files into dbfile.
+
+    Files are applied in one transaction per `batch` files and indexes
+    are created only after all data is in, so that they are built once
+    instead of maintained row-by-row.  (With :incremental, existing
+    indexes are kept: rebuilding them would cost more than the few new
+    days being loaded.)  Returns the number of rows inserted.
+    """
+    conn = sqlite3.connect(dbfile, isolation_level=None)
+    try:
+        if unsafe:
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+        n = 0
+        for i in range(0, len(files), max(batch, 1)):
+            conn.execute('BEGIN')
+            try:
+                for filename in files[i:i+max(batch, 1)]:
+                    if VERBOSE: print('  load %s'%filename)
+                    n += load_file(conn, filename)
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        create_indexes(conn, table)
+        if unsafe:
+            conn.execute('PRAGMA synchronous = NORMAL')
+    finally:
+        conn.close()
+    return n
+
+
+def import_db(dbfile, args, all_files, new_files):
+    """Import into one --out-db target, honoring :updateonly and :incremental."""
+    print("Importing to DB:", dbfile)
+    dbfile, *dbfile_args = dbfile.split(':')
+    # new_db: Creates a new and and moves it.  DANGER: loses
+    # data if multiple datasets loaded!  ':updateonly'
+    # disables *ever* making a new database.
+    new_db = 'updateonly' not in dbfile_args
+    # :incremental causes it to only load the files which were
+    # just downloaded now.  It also turns off new_db.  If
+    # :incremental=FALSE and new_db=FALSE, then it will DROP
+    # TABLE the existing data.
+    incremental_update = 'incremental' in dbfile_args and not args.force_recreate
+    if incremental_update:
+        new_db = False
+    print("  new_db=%s"%new_db)
+
+    dbfile_new = dbfile
+    if new_db:
+        dbfile_new = dbfile+'.new'
+        if os.path.exists(dbfile_new): os.unlink(dbfile_new)
+    elif incremental_update:
+        pass
+    else:
+        # Delete the existing table
+        cmd = 'DROP TABLE IF EXISTS "%s";'%args.converter
+        print('  '+cmd)
+        conn = sqlite3.connect(dbfile)
+        conn.execute(cmd)
+        conn.commit()
+        conn.close()
+
+    t1 = time.time()
+    # Do we load all files into the database
+    if incremental_update:
+        files = new_files
+    else:
+        files = all_files
+    n = load_files(dbfile_new, files, args.converter, batch=args.batch,
+                   unsafe=args.unsafe)
+    dt = time.time() - t1
+    if new_db:
+        os.rename(dbfile_new, dbfile)
+    print('Import done: %12d  %8d rows  %4.1fs'%(os.stat(dbfile).st_size, n, dt))
+
+
+def main(argv=None):
+    global VERBOSE
+    args = make_parser().parse_args(argv)
+    baseurl = args.base_url
+    VERBOSE = args.verbose
+
+    if 'session_id' not in os.environ:
+        print("You must set session_id first!")
+        sys.exit(2)
+    session = make_session(os.environ['session_id'], workers=args.workers,
+                           retries=args.retries)
+
+    format = args.format
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Get data
+    if not args.group:
+        R = get(session, os.path.join(baseurl, 'json'))
+    else:
+        print(os.path.join(baseurl, args.converter, 'json'))
+        R = get(session, os.path.join(baseurl, args.converter, 'json'))
+    print(R)
+    data = json.loads(R)
+    if not data['data_exists']:
+        return
     earliest_ts = data['data_earliest']
     latest_ts = data['data_latest']
     if args.start:
@@ -149,50 +438,24 @@ if data['data_exists']:
         latest_ts = min(latest_ts, end)
     earliest = datetime.datetime.fromtimestamp(earliest_ts)
     latest = datetime.datetime.fromtimestamp(latest_ts)
-    current_day = earliest.date() - datetime.timedelta(days=1)
 
+    # Files downloaded during this run are removed if we do not
+    # finish, so that they are loaded next time.
     new_files = [ ]
     def cleanup_files(files):
         for file_ in files:
             os.unlink(file_)
     atexit.register(cleanup_files, new_files)
 
-    while current_day < latest.date():
-        # process [current_date, current_date+1)
-        current_day += datetime.timedelta(days=1)
-
-        is_partial = False
-        outfile = current_day.strftime(args.converter+'.%Y-%m-%d'+'.'+format)
-        outfile = os.path.join(args.output_dir, outfile)
-        if os.path.exists(outfile+'.partial') and current_day != today:
-            os.unlink(outfile+'.partial')
-        if current_day == today:
-            outfile = outfile + '.partial'
-            is_partial = True
-
-        #print('  '+outfile, end='  ', flush=True)
-
-        redownload_today = True  # remove .partial from today, too?
-        if os.path.exists(outfile) and (current_day != today or not redownload_today):
-            #print()
-            if VERBOSE: print('  '+outfile)
-            continue
-
-        # download data
-        has_new_data = True
-        print('  '+outfile, end='  ', flush=True)
-        t1 = time.time()
-        R = get(os.path.join(baseurl, args.converter)+'.'+format,
-                             params=dict(start=current_day.strftime('%Y-%m-%d'),
-                                         end=(current_day+datetime.timedelta(days=1)).strftime('%Y-%m-%d')
-                                        ))
-        dt = time.time() - t1
-        print('%8d  %4.1fs   %4.1f'%(len(R), dt, len(R)/dt))
-        f = open(outfile+'.tmp', 'w')
-        f.write(R) ; f.close()
-        os.rename(outfile+'.tmp', outfile)
-        if not is_partial:
-            new_files.append(outfile)
+    todo = days_to_fetch(args.converter, args.output_dir, format,
+                         earliest.date(), latest.date())
+    has_new_data = bool(todo)
+    url = os.path.join(baseurl, args.converter)+'.'+format
+    try:
+        new_files.extend(fetch_days(session, url, todo, workers=args.workers))
+    except BaseException as e:
+        new_files.extend(getattr(e, 'new_files', ()))
+        raise
 
     if (has_new_data or args.force_recreate) and format == 'sqlite3dump':
         all_files = glob.glob(os.path.join(args.output_dir, args.converter+'.*.sqlite3dump'))
@@ -203,79 +466,11 @@ if data['data_exists']:
         else:
             dbfiles = args.out_db.split(',')
         for dbfile in dbfiles:
-            print("Importing to DB:", dbfile)
-            dbfile, *dbfile_args = dbfile.split(':')
-            # new_db: Creates a new and and moves it.  DANGER: loses
-            # data if multiple datasets loaded!  ':updateonly'
-            # disables *ever* making a new database.
-            new_db = 'updateonly' not in dbfile_args
-            # :incremental causes it to only load the files which were
-            # just downloaded now.  It also turns off new_db.  If
-            # :incremental=FALSE and new_db=FALSE, then it will DROP
-            # TABLE the existing data.
-            incremental_update = 'incremental' in dbfile_args and not args.force_recreate
-            if incremental_update:
-                new_db = False
-            print("  new_db=%s"%new_db)
-
-            dbfile_new = dbfile
-            if new_db:
-                dbfile_new = dbfile+'.new'
-                if os.path.exists(dbfile_new): os.unlink(dbfile_new)
-            elif incremental_update:
-                pass
-            else:
-                # Delete the existing table
-                cmd = 'DROP TABLE IF EXISTS %s;'%args.converter
-                print('  '+cmd)
-                subprocess.check_call(['sqlite3', dbfile, cmd])
-
-            t1 = time.time()
-            # Import the database
-            sql_proc = subprocess.Popen(['sqlite3', dbfile_new, '-batch'], stdin=subprocess.PIPE)
-            sql_proc.stdin.write(b'.bail ON\n')
-            #sql_proc.stdin.write(b'.echo ON\n')
-            if args.unsafe:
-                sql_proc.stdin.write(b'PRAGMA journal_mode = OFF;\n')
-                sql_proc.stdin.write(b'PRAGMA synchronous = OFF;\n')
-            # Do we load all files into the database
-            if incremental_update:
-                files = new_files
-            else:
-                files = all_files
-            for filename in files:
-                cmd = '.read %s'%filename
-                if VERBOSE: print('  '+cmd)
-                sql_proc.stdin.write(cmd.encode()+b'\n')
-                sql_proc.stdin.flush()
-                time.sleep(1)
-            if args.unsafe:
-                sql_proc.stdin.write(b'PRAGMA synchronous = NORMAL;\n')
-            sql_proc.stdin.close()
-            sql_proc.wait()
-            # Make indexes as needed
-            import sqlite3
-            conn = sqlite3.connect(dbfile_new)
-            try:
-                idxsql = ('user', 'time')
-                conn.execute('CREATE INDEX {table}_{idxid} ON {table} ({columns})'.format(table=args.converter, idxid='_'.join(idxsql), columns=', '.join(idxsql)))
-            except sqlite3.OperationalError:
-                # Can't make user,time: do (user) only and (time) only if possible.
-                try:
-                    idxsql = ('user', )
-                    conn.execute('CREATE INDEX {table}_{idxid} ON {table} ({columns})'.format(table=args.converter, idxid='_'.join(idxsql), columns=', '.join(idxsql)))
-                except sqlite3.OperationalError: pass
-                try:
-                    idxsql = ('time', )
-                    conn.execute('CREATE INDEX {table}_{idxid} ON {table} ({columns})'.format(table=args.converter, idxid='_'.join(idxsql), columns=', '.join(idxsql)))
-                except sqlite3.OperationalError: pass
-            #for idxsql in [('user', ), ('user', 'time', )]:
-            #    sql_proc.stdin.write('CREATE INDEX {table}_{idxid} ON {table} ({columns}) ;\n'.format(table=args.converter, idxid='_'.join(idxsql), columns=', '.join(idxsql)).encode())
-            dt = time.time() - t1
-            if new_db:
-                os.rename(dbfile_new, dbfile)
-            print('Import done: %12d  %4.1fs'%(os.stat(dbfile).st_size, dt))
+            import_db(dbfile, args, all_files, new_files)
 
     # Commit files, unmark them as pending
-    for file_ in reversed(list(new_files)):
-       new_files.remove(file_)
+    del new_files[:]
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,22 @@ Python.
 Usage:
     $ python upload.py device_id data_file
 
-Data packets should be split into smaller chuckns (ideally ~100 kb),
-and then uploaded separately.  This script should be modified to do
-that, and then upload each chuck in sequence.  Be careful to consider
-the case of errors, so that each chuck will be uploaded once but no
-more than once.
+Small files are sent as one POST.  Files larger than --chunk-size (or
+any file, with --chunked) use an upload session (see
+kdata/upload_session.py): the file is sent as numbered chunks, several
+in parallel (--workers), each verified by its sha256, and then
+committed, at which point the server assembles them and stores the data
+as one packet.  Data is stored once and no more than once.
+
+If a chunked upload is interrupted, just re-run the same command: the
+session is remembered in DATA_FILE.upload-state, and only the chunks
+the server does not have yet are sent.  --compress gzips each chunk
+before sending (the server decompresses it).
+
+A file larger than the server allows for one session (it is stored as
+one packet) is uploaded in parts, cut at line ends, each part in its
+own session (state in DATA_FILE.upload-state.OFFSET) and stored as its
+own packet.
 
 TODO: verify SSL certificates and use the pinned endpoint.  (two
 complexities: may need another dependency, may need actual other files
@@ -23,13 +34,17 @@ from __future__ import print_function
 
 DEFAULT_URL = 'https://data.koota.cs.aalto.fi/post/'
 
+import gzip
 import hashlib
 import json
+import os
+import sys
+import time
 try:
     from urllib.request import Request, urlopen
-    from urllib.error import HTTPError
+    from urllib.error import HTTPError, URLError
 except ImportError:
-    from urllib2 import Request, urlopen, HTTPError
+    from urllib2 import Request, urlopen, HTTPError, URLError
 
 def post_data(device_id, data, url):
     data_sha256 = hashlib.sha256(data).hexdigest()
@@ -59,6 +74,178 @@ def post_data(device_id, data, url):
 
 
 
+def request_json(url, data=None, method=None, headers={}, retries=5):
+    """Make one request and return the decoded JSON response.
+
+    Connection errors and 5xx responses are retried with exponential
+    backoff.  Other HTTP errors raise HTTPError.
+    """
+    for attempt in range(retries+1):
+        _r = Request(url=url, data=data, headers=headers)
+        if method is not None:
+            _r.get_method = lambda: method
+        try:
+            r = urlopen(_r)
+            try:
+                return json.loads(r.read().decode('utf-8'))
+            finally:
+                r.close()
+        except HTTPError as e:
+            if e.getcode() < 500 or attempt == retries:
+                raise
+        except URLError:
+            if attempt == retries:
+                raise
+        time.sleep(min(0.5 * 2**attempt, 30))
+
+
+def file_sha256(filename, offset=0, length=None):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while length is None or length > 0:
+            block = f.read(2**20 if length is None else min(2**20, length))
+            if not block:
+                break
+            h.update(block)
+            if length is not None:
+                length -= len(block)
+    return h.hexdigest()
+
+
+def split_file(filename, max_size, read_size=2**16):
+    """(offset, length) of parts of at most max_size bytes, cut after
+    the last line end in each part (if there is one)."""
+    size = os.stat(filename).st_size
+    parts = [ ]
+    start = 0
+    with open(filename, 'rb') as f:
+        while size - start > max_size:
+            end = pos = start + max_size
+            while pos > start:
+                n = min(read_size, pos - start)
+                f.seek(pos - n)
+                i = f.read(n).rfind(b'\n')
+                if i >= 0:
+                    end = pos - n + i + 1
+                    break
+                pos -= n
+            parts.append((start, end - start))
+            start = end
+    parts.append((start, size - start))
+    return parts
+
+
+def upload_file(device_id, filename, url, retries=5, **kwargs):
+    """Upload a file through upload sessions, in parts if it is larger
+    than the server allows for one session.
+
+    Returns the commit response, or for parts dict(ok, parts=[commit
+    responses]).
+    """
+    try:
+        return upload_chunked(device_id, filename, url, retries=retries, **kwargs)
+    except HTTPError as e:
+        if e.getcode() != 413:
+            raise
+        max_size = json.loads(e.read().decode('utf-8'))['max_size']
+    parts = split_file(filename, max_size)
+    print('  File is larger than %d bytes, uploading in %d parts'%(max_size, len(parts)))
+    responses = [ ]
+    for offset, length in parts:
+        responses.append(upload_chunked(device_id, filename, url, offset=offset,
+                                        length=length, retries=retries,
+                                        state_file='%s.upload-state.%d'%(filename, offset),
+                                        **kwargs))
+        if not responses[-1].get('ok'):
+            break
+    return dict(ok=all(r.get('ok') for r in responses) and len(responses) == len(parts),
+                parts=responses)
+
+
+def upload_chunked(device_id, filename, url, chunk_size=4*2**20, workers=4,
+                   compress=False, state_file=None, retries=5, offset=0, length=None):
+    """Upload a file (or length bytes of it from offset) through an
+    upload session, resuming if possible.
+
+    Returns the server's commit response (a dict with ok, rowid, ...).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    session_url = url.rstrip('/') + '/session/'
+    if state_file is None:
+        state_file = filename + '.upload-state'
+    size = os.stat(filename).st_size - offset if length is None else length
+    data_sha256 = file_sha256(filename, offset, size)
+    n_chunks = max(1, (size + chunk_size - 1) // chunk_size)
+    compression = 'gzip' if compress else None
+
+    # Resume an earlier session for this same file, if there is one.
+    state = None
+    received = set()
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+        if (state.get('sha256') != data_sha256 or state.get('url') != session_url
+              or state.get('device_id') != device_id):
+            state = None
+        else:
+            chunk_size, n_chunks = state['chunk_size'], state['chunks']
+            compression = state['compression']
+            try:
+                status = request_json(session_url+state['session_id'], retries=retries)
+            except HTTPError as e:
+                if e.getcode() != 404:
+                    raise
+                state = None    # expired on the server, start over
+            else:
+                if status.get('committed'):
+                    print('  Already committed:', status)
+                    os.unlink(state_file)
+                    return status
+                received = set(status['received'])
+                print('  Resuming session %s: %d/%d chunks already received'%(
+                    state['session_id'], len(received), n_chunks))
+    if state is None:
+        params = dict(size=size, sha256=data_sha256, chunks=n_chunks,
+                      compression=compression)
+        response = request_json(session_url, data=json.dumps(params).encode('utf-8'),
+                                headers={'Device-ID': device_id,
+                                         'Content-Type': 'application/json'},
+                                retries=retries)
+        state = dict(session_id=response['session_id'], url=session_url,
+                     device_id=device_id, sha256=data_sha256, size=size,
+                     chunk_size=chunk_size, chunks=n_chunks, compression=compression)
+        with open(state_file, 'w') as f:
+            json.dump(state, f)
+    base = session_url + state['session_id']
+
+    def send_chunk(index):
+        with open(filename, 'rb') as f:
+            f.seek(offset + index * chunk_size)
+            chunk = f.read(min(chunk_size, size - index * chunk_size))
+        if compression == 'gzip':
+            chunk = gzip.compress(chunk)
+        request_json('%s/%d'%(base, index), data=chunk, method='PUT',
+                     headers={'X-Sha256': hashlib.sha256(chunk).hexdigest(),
+                              'Content-Type': 'application/octet-stream'},
+                     retries=retries)
+        return index, len(chunk)
+
+    todo = [i for i in range(n_chunks) if i not in received]
+    t1 = time.time()
+    sent = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for index, n in pool.map(send_chunk, todo):
+            sent += n
+            print('  chunk %d/%d  %d bytes  %.1f MB/s'%(
+                index+1, n_chunks, n, sent/2**20/max(time.time()-t1, 1e-6)))
+    response = request_json(base+'/commit', data=b'', method='POST', retries=retries)
+    print('  Response:', response)
+    if response.get('ok'):
+        os.unlink(state_file)
+    return response
+
+
 
 if __name__ == "__main__":
     import argparse
@@ -67,37 +254,26 @@ if __name__ == "__main__":
     parser.add_argument('data_filename', help='Data to device id to upload to')
     parser.add_argument('--url', help='URL to post to',
                         default=DEFAULT_URL)
+    parser.add_argument('--chunked', action='store_true',
+                        help='Always use a chunked upload session.')
+    parser.add_argument('--chunk-size', type=int, default=4*2**20,
+                        help='Chunk size in bytes (default 4 MiB).')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of chunks to send in parallel.')
+    parser.add_argument('--compress', action='store_true',
+                        help='gzip chunks before sending.')
     args = parser.parse_args()
 
     device_id = args.device_id
-    data = open(args.data_filename, 'rb').read()
 
-    # Test the stuff
-    #print(device_id)
-    #print(data)
-
-    # Do any re-processing of the data here.
-    data_packets = [ data ]
-
-    # Upload each packet in sequence.  We have to be careful to make
-    # sure that each packet is recorded, and also to send each packet
-    # only once.  We do this in a loop.  If there were problems, you
-    # would have to manully adjust the program to start from the first
-    # broken packet.
-    for i, packet in enumerate(data_packets):
-        #if i <= ...:
-        #    continue
-        print("Packet:", i)
-
-        # The following line will post a single data packet.
-        status = post_data(args.device_id, data, url=args.url)
-        if status:
-            print('Packet %s failed'%i)
-            exit(1)
-            # Abort here.  You should rerun remembering to not upload
-            # old packets again.
-
-        print("Packet done:", i)
+    if args.chunked or os.stat(args.data_filename).st_size > args.chunk_size:
+        response = upload_file(device_id, args.data_filename, url=args.url,
+                               chunk_size=args.chunk_size, workers=args.workers,
+                               compress=args.compress)
+        exit(0 if response.get('ok') else 1)
 
+    data = open(args.data_filename, 'rb').read()
+    status = post_data(args.device_id, data, url=args.url)
+    if status:
+        print('Upload failed')
     exit(status)
-
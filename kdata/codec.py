@@ -0,0 +1,241 @@
+"""Compression of stored data packets.
+
+Data.data is mostly JSON text, which compresses 5-20 times.  A row
+can be stored compressed: data='' and the payload in data_z, with
+the codec in encoding:
+
+    ''            plain text in data (all old rows)
+    'zlib'        zlib
+    'zstd'        zstd
+    'zstd:<id>'   zstd with the trained PayloadDictionary <id>
+
+Reading row.data decodes transparently (models.PayloadAttribute), and
+only when data is used, so querysets which defer('data') or only read
+metadata don't pay for it.  data_length stays the length of the
+uncompressed data.
+
+New packets are compressed by views.save_data and save_data_many if
+DATA_COMPRESSION is set ('zlib', 'zstd', or 'auto': zstd if the
+zstandard module is installed, else zlib).  Existing rows are
+compressed by recompress_rows(), with "manage.py recompress" or as the
+background job "recompress" (checkpointed by row id).  zstd
+dictionaries are trained per device type from stored packets
+(train_dictionary), and used for new packets of that type when they
+exist.  Small packets benefit most from them.
+"""
+
+import zlib
+
+from django.conf import settings
+from django.db.models import Q
+
+from . import jobs
+from . import models
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION = getattr(settings, 'DATA_COMPRESSION', None)
+MIN_SIZE = getattr(settings, 'DATA_COMPRESSION_MIN_SIZE', 256)
+ZLIB_LEVEL = getattr(settings, 'DATA_COMPRESSION_ZLIB_LEVEL', 6)
+ZSTD_LEVEL = getattr(settings, 'DATA_COMPRESSION_ZSTD_LEVEL', 9)
+DICT_SIZE = getattr(settings, 'DATA_COMPRESSION_DICT_SIZE', 2**16)
+BATCH_SIZE = 500
+CODECS = ('zlib', 'zstd')
+
+
+class CodecError(ValueError):
+    pass
+
+
+def available():
+    """The codecs which can be used here."""
+    return [ c for c in CODECS if c != 'zstd' or zstandard is not None ]
+
+def resolve(codec):
+    """Codec name from a setting ('auto', 'none', None...) to a codec or None."""
+    if codec in (None, '', 'none', 'plain'):
+        return None
+    if codec == 'auto':
+        return 'zstd' if zstandard is not None else 'zlib'
+    if codec not in CODECS:
+        raise CodecError("Unknown codec: %s"%codec)
+    if codec == 'zstd' and zstandard is None:
+        raise CodecError("zstd needs the zstandard module")
+    return codec
+
+
+# zstd dictionaries, by id (they never change once saved).
+_dicts = { }
+_latest_dict = { }
+
+def get_dictionary(dict_id):
+    if dict_id not in _dicts:
+        d = models.PayloadDictionary.objects.get(id=dict_id)
+        _dicts[dict_id] = zstandard.ZstdCompressionDict(bytes(d.data))
+    return _dicts[dict_id]
+
+def latest_dictionary(device_type):
+    """Id of the newest dictionary of device_type, or None."""
+    if device_type not in _latest_dict:
+        _latest_dict[device_type] = models.PayloadDictionary.objects \
+            .filter(device_type=device_type, codec='zstd') \
+            .order_by('-id').values_list('id', flat=True).first()
+    return _latest_dict[device_type]
+
+def clear_cache():
+    _dicts.clear()
+    _latest_dict.clear()
+
+
+def compress(text, codec, dict_id=None):
+    """Text to (bytes, encoding)."""
+    raw = text.encode('utf-8')
+    if codec == 'zlib':
+        return zlib.compress(raw, ZLIB_LEVEL), 'zlib'
+    if codec == 'zstd':
+        if dict_id is not None:
+            c = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=get_dictionary(dict_id))
+            return c.compress(raw), 'zstd:%d'%dict_id
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw), 'zstd'
+    raise CodecError("Unknown codec: %s"%codec)
+
+def decode(data_z, encoding):
+    """data_z and encoding of a row to its text."""
+    if data_z is None:
+        raise CodecError("No compressed data")
+    data_z = bytes(data_z)    # memoryview from some databases
+    if encoding == 'zlib':
+        return zlib.decompress(data_z).decode('utf-8')
+    codec, _, dict_id = encoding.partition(':')
+    if codec == 'zstd':
+        if zstandard is None:
+            raise CodecError("zstd needs the zstandard module")
+        if dict_id:
+            d = zstandard.ZstdDecompressor(dict_data=get_dictionary(int(dict_id)))
+        else:
+            d = zstandard.ZstdDecompressor()
+        return d.decompress(data_z).decode('utf-8')
+    raise CodecError("Unknown encoding: %s"%encoding)
+
+
+def encode_row(row, codec=None, device_type=None, min_size=None):
+    """Compress a models.Data row in place (not saved).
+
+    Returns True if it was compressed.  The text is what the row would
+    store (str() of bytes, like TextField does).  device_type: use its
+    zstd dictionary, if there is one.
+    """
+    codec = resolve(COMPRESSION if codec is None else codec)
+    if codec is None:
+        return False
+    if min_size is None:
+        min_size = MIN_SIZE
+    text = row.data
+    if not isinstance(text, str):
+        text = str(text)
+    if len(text) < min_size:
+        return False
+    dict_id = None
+    if codec == 'zstd' and device_type is not None:
+        dict_id = latest_dictionary(device_type)
+    data_z, encoding = compress(text, codec, dict_id)
+    if len(data_z) >= len(text):
+        return False
+    row.data = ''
+    row.encoding = encoding
+    row.data_z = data_z
+    return True
+
+def decode_row(row):
+    """Make a compressed row plain again (not saved)."""
+    if not row.encoding:
+        return False
+    text = decode(row.data_z, row.encoding)
+    row.data = text
+    row.encoding = ''
+    row.data_z = None
+    return True
+
+
+def recompress_rows(queryset, codec, start_id=0, batch_size=BATCH_SIZE, device_type=None):
+    """(Re)compress the rows of queryset with codec (None: decompress).
+
+    In batches in id order, rows already in the target encoding are
+    skipped.  Yields (last row id, rows changed, bytes before, bytes
+    after) per batch.  Resume from start_id (the last id done).
+    """
+    codec = resolve(codec)
+    if codec is None:
+        qs = queryset.exclude(encoding='')
+    elif codec == 'zstd' and device_type is not None and latest_dictionary(device_type):
+        qs = queryset.exclude(encoding='zstd:%d'%latest_dictionary(device_type))
+    else:
+        qs = queryset.filter(~Q(encoding=codec))
+    last_id = start_id
+    while True:
+        ids = list(qs.filter(id__gt=last_id).order_by('id')
+                     .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        n = before = after = 0
+        for row in models.Data.objects.filter(id__in=ids).order_by('id'):
+            size = len(row.data_z) if row.encoding else len(row.data)
+            decode_row(row)
+            if codec is not None:
+                encode_row(row, codec, device_type, min_size=0)
+            new_size = len(row.data_z) if row.encoding else len(row.data)
+            models.Data.objects.filter(id=row.id).update(data=row.__dict__['data'],
+                                                         encoding=row.encoding,
+                                                         data_z=row.data_z)
+            n += 1
+            before += size
+            after += new_size
+        last_id = ids[-1]
+        yield last_id, n, before, after
+
+
+def train_dictionary(queryset, device_type, n_samples=2000, dict_size=None):
+    """Train and save a zstd dictionary from the newest rows of queryset."""
+    if zstandard is None:
+        raise CodecError("zstd needs the zstandard module")
+    samples = [ ]
+    for row in queryset.order_by('-id')[:n_samples]:
+        text = row.data
+        if not isinstance(text, str):
+            text = str(text)
+        samples.append(text.encode('utf-8'))
+    if len(samples) < 10:
+        raise CodecError("Too few packets to train a dictionary (%d)"%len(samples))
+    d = zstandard.train_dictionary(dict_size or DICT_SIZE, samples)
+    obj = models.PayloadDictionary.objects.create(device_type=device_type, codec='zstd',
+                                                  n_samples=len(samples), data=d.as_bytes())
+    _latest_dict.pop(device_type, None)
+    return obj
+
+
+@jobs.register('recompress', concurrency=1, max_attempts=5)
+def recompress_job(ctx):
+    """recompress, args {"codec": ..., "device_type": ..., "device_ids":
+    [...], "batch_size": ...}: compress existing rows."""
+    from . import rechunk
+    device_type = ctx.args.get('device_type')
+    qs = rechunk.device_queryset(device_type, ctx.args.get('device_ids'))
+    if device_type:
+        from . import devices
+        device_type = devices.get_class(device_type).pyclass_name()
+    start_id = (ctx.checkpoint or { }).get('last_id', 0)
+    n_rows = before = after = 0
+    for last_id, n, b, a in recompress_rows(qs, ctx.args.get('codec', 'auto'), start_id=start_id,
+                                            batch_size=ctx.args.get('batch_size', BATCH_SIZE),
+                                            device_type=device_type):
+        n_rows += n
+        before += b
+        after += a
+        ctx.save_checkpoint(dict(last_id=last_id))
+    logger.info("recompress: %d rows, %d -> %d bytes", n_rows, before, after)
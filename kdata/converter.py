@@ -106,9 +106,11 @@ logger = logging.getLogger(__name__)
 # This currently uses sha256 + a random secret salt for security.  We
 # go through thees steps to a) ensure that we never use a hard-coded
 # salt, and b) not depend on django.
+PSEUDONYM_SCHEME = 'legacy'
 try:
     from django.conf import settings
     SALT_KEY = settings.SALT_KEY
+    PSEUDONYM_SCHEME = getattr(settings, 'PSEUDONYM_SCHEME', PSEUDONYM_SCHEME)
     del settings
 except:
     # Make a random salt that changes on every invocation.  This is
@@ -118,13 +120,23 @@ except:
     # important.
     import random
     SALT_KEY = bytes(bytearray((random.randint(0, 255) for _ in range(32))))
+try:
+    from . import jsonpick
+    from . import murata_decode
+    from . import pseudonym
+except (ImportError, ValueError):  # running as a script
+    import jsonpick
+    import murata_decode
+    import pseudonym
 def _safe_hash(data, hash_seed=None):
-    """Make a safe hash function for identifiers."""
-    if not isinstance(data, bytes):
-        data = data.encode('utf8')
-    if hash_seed:
-        return urlsafe_b64encode(sha256(hash_seed+data).digest()[:9]).decode('ascii')
-    return urlsafe_b64encode(sha256(SALT_KEY+data).digest()[:9]).decode('ascii')
+    """Make a safe hash function for identifiers.
+
+    Memoized per (salt, value), see kdata/pseudonym.py."""
+    return pseudonym.hash_value(hash_seed or SALT_KEY, data, scheme=PSEUDONYM_SCHEME)
+def _hash_column(values, hash_seed=None, skip_empty=False):
+    """_safe_hash of a whole column of values, as a list."""
+    return pseudonym.hash_column(hash_seed or SALT_KEY, values, scheme=PSEUDONYM_SCHEME,
+                                 skip_empty=skip_empty)
 
 
 
@@ -143,6 +155,10 @@ class _Converter(object):
     per_page = 25
     header = [ ]
     desc = ""
+    # What convert() uses of each packet, as a jsonpick spec (see
+    # kdata/jsonpick.py), or None for everything.  self.loads() then
+    # decodes only that.
+    json_fields = None
     @classmethod
     def name(cls):
         """Shortcut to return class name on either object or instance"""
@@ -168,8 +184,19 @@ class _Converter(object):
         self.errors = [ ]
         self.errors_dict = collections.defaultdict(int)
         self.safe_hash = _safe_hash
+        self.hash_column = _hash_column
         if hash_seed is not None:
             self.safe_hash = partial(_safe_hash, hash_seed=hash_seed)
+            self.hash_column = partial(_hash_column, hash_seed=hash_seed)
+    def hash_field(self, rows, key):
+        """Values of key in rows (dicts) hashed, '' where a row does not have it."""
+        hashed = iter(self.hash_column([row[key] for row in rows if key in row]))
+        return [next(hashed) if key in row else '' for row in rows]
+    def loads(self, data):
+        """Decode a data packet (only json_fields of it, if given)."""
+        if self.json_fields is None:
+            return loads(data)
+        return jsonpick.pick(data, self.json_fields)
     def run(self):
         """Run through the conversion.
 
@@ -186,11 +213,19 @@ class _Converter(object):
         # making the iterator here, each repitition in the loop below
         # starts where the previous left off.
         rows = iter(self.rows)
+        # Rows taken by convert(): if it fails without taking any, a
+        # restart would fail the same way forever, so stop.
+        consumed = [0]
+        def counted(rows):
+            for row in rows:
+                consumed[0] += 1
+                yield row
         # Until we are exhausted (we get to the break)
         while True:
+            start = consumed[0]
             try:
                 # Iterate through yielding everything.
-                for x in self.convert(rows, self.time):
+                for x in self.convert(counted(rows), self.time):
                     yield x
                 # If we manage to finish, break loop and we are done.
                 # Everything is simple.
@@ -210,6 +245,8 @@ class _Converter(object):
                 # Possibly we need to prevent each next traceback from
                 # storing the previous traceback, too.
                 del e
+                if consumed[0] == start:
+                    break
     def run_queryset(self, queryset, device,
                      time_converter=lambda x: x,
                      catch_errors=False):
@@ -419,59 +456,50 @@ class MurataBSN(_Converter):
     safe = False
     def convert(self, rows, time=lambda x:x):
         from defusedxml.ElementTree import fromstring as xml_fromstring
-        from dateutil import parser as date_parser
         count = 0
         # If given, only return devices with this network ID.
         only_network_id = self.params.get('network_id', None)
         for ts_packet, data in rows:
-            if data.startswith("b'") and data.endswith("'"):
-                data = ast.literal_eval(data).decode()
+            data = murata_decode.decode_stored(data)
             #print(data)
             #print(data[0])
             if not data.startswith('<'):
                 continue
             unixtime_packet = timegm(ts_packet.timetuple())
-            # Do various XML parsing
-            doc = xml_fromstring(data)
-            node = doc[0][0]
-            network_id = doc[0].attrib['id']
+            # Find the fields we need with the fast scanner, and only
+            # do full XML parsing if it can not handle the packet.
+            extracted = murata_decode.extract(data)
+            if extracted is None:
+                doc = xml_fromstring(data)
+                extracted = (doc[0].attrib['id'], doc[0][0].attrib['id'],
+                             doc[0][0][0][0].attrib['time'], doc[0][0][0][0][9].text)
+            network_id, device_id, start_time, values = extracted
             if only_network_id and network_id != only_network_id:
                 continue
-            device_id = node.attrib['id']
-            start_time = doc[0][0][0][0].attrib['time']
-            ts = date_parser.parse(start_time)
-            values = doc[0][0][0][0][9]
             # This is O(n_rows) in memory here.  n_rows is supposed to
             # be always small (~90 max).  Should this assumption be
             # violated, we need a two-pass method.  Just save
             # last_row_i on the first pass, then do second pass.
-            rows = [ ]
-            reader = csv.reader(values.text.split('\n'))
-            for row in reader:
-                if not row: continue
-                rows.append(row)
-            last_time_i = int(rows[-1][0])
-            for row in rows:
-                if len(row) != 10 or not row[0]: continue
+            for row_i, last_time_i, start_unixtime, data_values in \
+                    murata_decode.iter_packet_rows(extracted):
                 #count += 1 ; print count
-                unixtime = timegm(ts.timetuple()) + int(row[0])
+                unixtime = start_unixtime + row_i
                 # The actual data.  In safe mode, replace everything
                 # with null strings.
-                data_values = tuple(int(x) if x else '' for x in row[1:])
                 if self.safe:
                     data_values = tuple( "" for _ in data_values )
                 # These values are used for debuging.  In debug mode,
                 # include a bunch of extra data.  In normal mode,
                 # include the field time2, which is the time as
                 # calcultaed from the packet.
-                unixtime_from_packet = unixtime_packet - ( last_time_i - int(row[0]))
+                unixtime_from_packet = unixtime_packet - ( last_time_i - row_i)
                 if not self.debug:
                     extra_data = (time(unixtime_from_packet), )
                 else:
                     extra_data = (
                         time(unixtime_from_packet),
-                        int(row[0]),
-                        last_time_i - int(row[0]),
+                        row_i,
+                        last_time_i - row_i,
                         time(unixtime_packet),
                         unixtime_from_packet-unixtime,
                         start_time,
@@ -541,12 +569,17 @@ class PRWifi(_Converter):
     safe = False
     def convert(self, queryset, time=lambda x:x):
         safe = self.safe
-        safe_hash = self.safe_hash
+        hash_column = self.hash_column
         for ts, data in queryset:
             data = loads(data)
             for probe in data:
                 if probe['PROBE'] == 'edu.northwestern.cbits.purple_robot_manager.probes.builtin.WifiAccessPointsProbe':
                     ts = time(probe['TIMESTAMP'])
+                    # Columns of the rows of this scan, current first.
+                    ssids = [ ]
+                    bssids = [ ]
+                    current = [ ]
+                    levels = [ ]
                     # Emit a special row for CURRENT_SSID
                     if 'CURRENT_BSSID' in probe \
                        and probe['CURRENT_BSSID'] != '00:00:00:00:00:00':
@@ -555,35 +588,25 @@ class PRWifi(_Converter):
                         # Json decode it in that case.
                         if current_ssid.startswith('"'):
                             current_ssid = loads(current_ssid)
-                        # Handle hashing if we are in safe mode.  In
-                        # safe mode, hash the things, but *only* if it
-                        # is non-null.  So, this is actually two
-                        # levels of conditional.
-                        if safe:
-                            current_ssid = (safe_hash(current_ssid)
-                                            if current_ssid else current_ssid)
-                            current_bssid = (safe_hash(probe['CURRENT_BSSID'])
-                                             if safe else probe['CURRENT_BSSID'])
-                        yield (ts,
-                               current_ssid,
-                               current_bssid,
-                               1,
-                               probe['CURRENT_RSSI'],
-                           )
+                        ssids.append(current_ssid)
+                        bssids.append(probe['CURRENT_BSSID'])
+                        current.append(1)
+                        levels.append(probe['CURRENT_RSSI'])
                     for ap_info in probe['ACCESS_POINTS']:
-                        # Again, two layers of conditionals because we
-                        # only hash if non-null.
-                        ssid = ap_info['SSID']
-                        bssid = ap_info['BSSID']
-                        if safe:
-                            ssid  = safe_hash(ssid)  if ssid else ssid
-                            bssid = safe_hash(bssid) if bssid else bssid
-                        yield (ts,
-                               ssid,
-                               bssid,
-                               0,
-                               ap_info['LEVEL'],
-                               )
+                        ssids.append(ap_info['SSID'])
+                        bssids.append(ap_info['BSSID'])
+                        current.append(0)
+                        levels.append(ap_info['LEVEL'])
+                    # Handle hashing if we are in safe mode.  In safe
+                    # mode, hash the things, but *only* if non-null,
+                    # except the current BSSID, which is always hashed.
+                    if safe:
+                        ssids = hash_column(ssids, skip_empty=True)
+                        n_current = len(current) - len(probe['ACCESS_POINTS'])
+                        bssids = (hash_column(bssids[:n_current])
+                                  + hash_column(bssids[n_current:], skip_empty=True))
+                    for row in zip(ssids, bssids, current, levels):
+                        yield (ts, ) + row
 class PRWifiSafe(PRWifi):
     safe = True
 class PRBluetooth(_Converter):
@@ -598,24 +621,25 @@ class PRBluetooth(_Converter):
     safe = False
     def convert(self, queryset, time=lambda x:x):
         safe = self.safe
-        safe_hash = self.safe_hash
+        hash_column = self.hash_column
         for ts, data in queryset:
             data = loads(data)
             for probe in data:
                 if probe['PROBE'] == 'edu.northwestern.cbits.purple_robot_manager.probes.builtin.BluetoothDevicesProbe':
                     ts = time(probe['TIMESTAMP'])
-                    for dev_info in probe['DEVICES']:
-                        # available keys:
-                        # {"BLUETOOTH_NAME":"2a1327a019948590cccc3ff20fe3dbdb",
-                        #  "BOND_STATE":"Not Paired",
-                        #  "DEVICE MAJOR CLASS":"0x00000100 Computer",
-                        #  "BLUETOOTH_ADDRESS":"6841398ddc6f2cee644a3bcf39b894d2",
-                        #  "DEVICE MINOR CLASS":"0x0000010c Laptop"}
-                        name = dev_info.get('BLUETOOTH_NAME', '')
-                        address = dev_info.get('BLUETOOTH_ADDRESS', '')
-                        if safe:
-                            name = safe_hash(name)
-                            address = safe_hash(address)
+                    # available keys:
+                    # {"BLUETOOTH_NAME":"2a1327a019948590cccc3ff20fe3dbdb",
+                    #  "BOND_STATE":"Not Paired",
+                    #  "DEVICE MAJOR CLASS":"0x00000100 Computer",
+                    #  "BLUETOOTH_ADDRESS":"6841398ddc6f2cee644a3bcf39b894d2",
+                    #  "DEVICE MINOR CLASS":"0x0000010c Laptop"}
+                    devices = probe['DEVICES']
+                    names = [ dev_info.get('BLUETOOTH_NAME', '') for dev_info in devices ]
+                    addresses = [ dev_info.get('BLUETOOTH_ADDRESS', '') for dev_info in devices ]
+                    if safe:
+                        names = hash_column(names)
+                        addresses = hash_column(addresses)
+                    for dev_info, name, address in zip(devices, names, addresses):
                         yield (ts,
                                name,
                                address,
@@ -706,9 +730,10 @@ class PRTimestamps(_Converter):
               'packet_time',
               'probe',]
     device_class = 'PurpleRobot'
+    json_fields = {'TIMESTAMP': None, 'PROBE': None}
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
-            data = loads(data)
+            data = self.loads(data)
             for probe in data:
                 yield (time(probe['TIMESTAMP']),
                        time(timegm(ts.utctimetuple())),
@@ -829,19 +854,18 @@ class PRCommunicationEventProbe(_Converter):
 class PRCommunicationEventProbeNoNumber(PRCommunicationEventProbe):
     no_number = True
 
-import requests
+try:
+    from . import app_whitelist
+except (ImportError, ValueError):  # running as a script
+    import app_whitelist
 class PRApplicationLaunchesSafe(_Converter):
     """ApplicationLaunchEvents - only top apps, others hashed."""
     header = ['time', 'current_app_pkg']
     desc = "ApplicationLaunchProbe, when software is started"
     device_class = 'PurpleRobot'
     def convert(self, queryset, time=lambda x:x):
-        # TODO: make this configurable
-        link = "https://koota.cs.aalto.fi/static/softinfo.txt"
-        f = requests.get(link).text
-        AppList = f.split('\n')
-        AppList = [k.split(',')[0] for k in AppList]
-        AppList = set(AppList)
+        # Local list, see kdata/app_whitelist.py.
+        AppList = app_whitelist.checked_matcher()
         safe_hash = self.safe_hash
 
         for ts, data in queryset:
@@ -1549,6 +1573,23 @@ class PRDataSize(BaseDataSize):
                 counts[probe['PROBE']] += 1
         return total_days
 
+class PRStoredDataSize(PRDataSize):
+    """Bytes of each probe as stored (its text in the packet).
+
+    Unlike PRDataSize, which counts each probe re-encoded, this needs
+    only PROBE of each probe decoded, so it is much faster.
+    """
+    desc = "Total bytes of the stored text of each separate probe"
+    json_fields = {'PROBE': None}
+    def do_queryset_iteration(self, queryset, sizes, counts, total_days):
+        for ts, data in queryset:
+            for probe, size in jsonpick.items(data, self.json_fields):
+                if total_days is None:
+                    total_days = self.figure_total_days(ts)
+                sizes[probe['PROBE']] += size
+                counts[probe['PROBE']] += 1
+        return total_days
+
 class PRDataSize1Day(PRDataSize):
     desc = "Like PRDataSize, but limited to 1 day.  Use this for most testing."
     days_ago = 1
@@ -1695,24 +1736,21 @@ class IosScreen(_IosGeneric):
 
 
 
-import io
-from dateutil.parser import parse as dateutil_parse
-def actiwatch_find_tzoffset(data):
-    """Find timezone offset and return as a string"""
-    tzoffset = re.search(r'"Time Zone Offset:","([-+\d:.]+)","hours:minutes"', data).group(1)
-    assert 4 <= len(tzoffset) <= 6
-    # Python 3.6 needs no separator in the time offset
-    tzoffset = tzoffset.replace(':', '').replace('.', '')
-    return tzoffset
-def actiwatch_parse_date(a, b, tzoffset, dayfirst):
-    try:
-        return dateutil_parse("%s %s %s"%(a, b, tzoffset), dayfirst=dayfirst)
-    except ValueError:
-        pass
-    return datetime.strptime("%s %s %s"%(a, b, tzoffset.replace('.', ':')), '%d.%m.%Y %H.%M.%S %z')
+try:
+    from . import actiwatch_parse
+except (ImportError, ValueError):  # running as a script
+    import actiwatch_parse
+# Parsing is shared between the three converters, see kdata/actiwatch_parse.py.
+actiwatch_find_tzoffset = actiwatch_parse.find_tzoffset
+actiwatch_parse_date = actiwatch_parse.parse_date
 def actiwatch_detect_dayfirst(line):
     dayfirst = ',' in line[5]
     return dayfirst
+def actiwatch_section(parsed, key):
+    rows = parsed.rows(key)
+    if rows is None:
+        raise ValueError("Actiwatch file has no %s section"%actiwatch_parse.SECTIONS[key][0])
+    return rows
 class ActiwatchFull(_Converter):
     device_class = 'kdata.devices.actiwatch.Actiwatch'
     desc = "Actiwatch full data"
@@ -1735,18 +1773,12 @@ class ActiwatchFull(_Converter):
             return x
 
         for ts, data in queryset:
-            if data.startswith("b'") and data.endswith("'"):
-                data = ast.literal_eval(data).decode()
-            if '---- Subject Properties------' not in data:
+            parsed = actiwatch_parse.parse(data)
+            if parsed is None:
                 continue
+            tzoffset = parsed.tzoffset
 
-            tzoffset = actiwatch_find_tzoffset(data)
-            m = re.search(r'--- Epoch-by-Epoch Data -+"\s+.*?("Line",.*)',
-                          data, re.DOTALL)
-            f = io.StringIO(m.group(1))
-            reader = csv.reader(f)
-
-            for line in reader:
+            for line in actiwatch_section(parsed, 'epochs'):
                 if not line: continue
                 if line[0] == 'Line': continue
 
@@ -1790,18 +1822,12 @@ class ActiwatchStatistics(_Converter):
               'percent_invalid_white']
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
-            if data.startswith("b'") and data.endswith("'"):
-                data = ast.literal_eval(data).decode()
-            if '---- Subject Properties------' not in data:
+            parsed = actiwatch_parse.parse(data)
+            if parsed is None:
                 continue
+            tzoffset = parsed.tzoffset
 
-            tzoffset = actiwatch_find_tzoffset(data)
-            m = re.search(r'--- Statistics -+"\s+.*?("Interval Type",.*?)\r\n\r\n\r\n',
-                          data, re.DOTALL)
-            f = io.StringIO(m.group(1))
-            reader = csv.reader(f)
-
-            for line in reader:
+            for line in actiwatch_section(parsed, 'statistics'):
                 if not line: continue
                 if line[0] == 'Interval Type': continue
                 #if line[0] == 'Rest Summary': continue
@@ -1832,18 +1858,12 @@ class ActiwatchMarkers(_Converter):
 
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
-            if data.startswith("b'") and data.endswith("'"):
-                data = ast.literal_eval(data).decode()
-            if '---- Subject Properties------' not in data:
+            parsed = actiwatch_parse.parse(data)
+            if parsed is None:
                 continue
+            tzoffset = parsed.tzoffset
 
-            tzoffset = actiwatch_find_tzoffset(data)
-            m = re.search(r'--- Marker/Score List -+"\s+.*?("Line","Date",.*?)\r\n\r\n\r\n',
-                          data, re.DOTALL)
-            f = io.StringIO(m.group(1))
-            reader = csv.reader(f)
-
-            for line in reader:
+            for line in actiwatch_section(parsed, 'markers'):
                 if not line: continue
                 if line[0] == 'Line': continue
                 if line[0] == '': continue
@@ -1855,6 +1875,63 @@ class ActiwatchMarkers(_Converter):
 
 
 
+try:
+    from . import aware_packed
+except (ImportError, ValueError):  # running as a script
+    import aware_packed
+def aware_rows(packet):
+    """The rows of a (decoded) AWARE packet, whatever the storage.
+
+    Version 1 packets have the rows as JSON text, version 2 as a list
+    (see kdata/aware_storage.py), and packed ones as packed text.
+    """
+    rows = packet['data']
+    if packet.get('encoding') == aware_packed.ENCODING:
+        return aware_packed.decode(rows)
+    if isinstance(rows, str):
+        return loads(rows)
+    return rows
+def aware_columns(packet, keys):
+    """Columns of an AWARE packet: (n, [list of values of each key]).
+
+    Missing keys are ''.  Packed packets are decoded straight to
+    columns, without making row dicts.
+    """
+    if packet.get('encoding') == aware_packed.ENCODING:
+        n, _, columns = aware_packed.columns(packet['data'])
+        return n, [ columns[key] if key in columns else ['']*n for key in keys ]
+    rows = aware_rows(packet)
+    return len(rows), [ [ row.get(key, '') for row in rows ] for key in keys ]
+def aware_data_text(packet):
+    """The "data" of an AWARE packet as text (as in version 1)."""
+    if isinstance(packet['data'], str):
+        return packet['data']
+    return json.dumps(packet['data'])
+def aware_data_length(packet, text):
+    """Length of the "data" text of packet (decoded from text).
+
+    For version 2 packets, the length of the rows' JSON in the packet
+    text, without encoding them again.
+    """
+    if isinstance(packet['data'], str):
+        return len(packet['data'])
+    return len(text) - len(json.dumps(dict(packet, data=[]))) + 2
+def aware_text_length(text):
+    """aware_data_length() from the packet text alone.
+
+    Version 1 data is decoded by itself; version 2 rows are measured in
+    the text, not decoded: they are the last array or object in the
+    packet (see kdata/aware_storage.py and jsonpick.last_end()).
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    i = jsonpick.find(text, 'data')
+    if i is None:
+        raise KeyError('data')
+    if text[i] == '"':
+        return len(json.decoder.scanstring(text, i+1)[0])
+    return jsonpick.last_end(text) - i
+
 class BaseAwareConverter(_Converter):
     device_class = {'Aware', 'AwareValidCert', 'koota_hyks_2016.AwareHyks', 'kdata.devices.aware.Aware', 'koota_hyks_2018.AwareMMM1'}
     ts_column = 'timestamp'
@@ -1878,7 +1955,12 @@ class BaseAwareConverter(_Converter):
             if not isinstance(data, dict): continue
             if data['table'] != table:
                 continue
-            table_data = loads(data['data'])
+            if data.get('encoding') == aware_packed.ENCODING:
+                n, columns = aware_columns(data, [ts_column] + list(fields))
+                for row in zip(*columns):
+                    yield (time(row[0]/1000.), ) + row[1:]
+                continue
+            table_data = aware_rows(data)
             for row in table_data:
                 yield (time(row[ts_column]/1000.),
                        ) + tuple(row.get(colname,'') for colname in fields)
@@ -1892,7 +1974,7 @@ class AwareDayAggregator(DayAggregator, BaseAwareConverter):
     def iter_row(self, packet_ts, data):
         data = loads(data)
         if data['table'] != self.probe_type: return
-        data2 = loads(data['data'])
+        data2 = aware_rows(data)
         for row in data2:
             ts = row['timestamp']/1000
             yield ts, self.ts_bin_func(ts), row
@@ -1903,7 +1985,7 @@ class AwareLocationDay(LocationDayAggregator, AwareDayAggregator):
         if not isinstance(data, dict): return []
         if data['table'] != 'locations': return
         #print(data)
-        data2 = loads(data['data'])
+        data2 = aware_rows(data)
         for row in data2:
             ts = row['timestamp']/1000
             yield ts, self.ts_bin_func(ts), row
@@ -1933,7 +2015,7 @@ class AwareAuto(BaseAwareConverter):
             if not isinstance(data, dict): continue
             if data['table'] != table:
                 continue
-            table_data = loads(data['data'])
+            table_data = aware_rows(data)
             for row in table_data:
                 ts = time(row[ts_column]/1000.)
                 row.pop('device_id')
@@ -1942,19 +2024,21 @@ class AwareAuto(BaseAwareConverter):
 class AwareUploads(BaseAwareConverter):
     header = ['packet_time', 'table', 'len_data']
     desc = "Uploaded tables and times"
+    json_fields = {'table': None}
     def convert(self, queryset, time=lambda x:x):
-        for ts, data in queryset:
-            data = loads(data)
+        for ts, text in queryset:
+            data = self.loads(text)
             yield (time(timegm(ts.utctimetuple())),
                    data['table'],
-                   len(data['data']),
+                   aware_text_length(text),
                    )
 class AwareTimestamps(BaseAwareConverter):
     header = ['time', 'packet_time', 'table']
     desc = "Timestamps of each collected data point"
+    json_fields = {'table': None, 'encoding': None, 'data': {'timestamp': None}}
     def convert(self, queryset, time=lambda x:x):
         for ts, data in queryset:
-            data = loads(data)
+            data = self.loads(data)
             if not isinstance(data, dict): continue
             #if ('study_check' in data):
             #    continue
@@ -1964,7 +2048,7 @@ class AwareTimestamps(BaseAwareConverter):
                        time(timegm(ts.utctimetuple())),
                        data['table'])
                 continue
-            table_data = loads(data['data'])
+            table_data = aware_rows(data)
             for row in table_data:
                 yield (time(row['timestamp']/1000.),
                        time(timegm(ts.utctimetuple())),
@@ -1978,17 +2062,17 @@ class AwareTableData(BaseAwareConverter):
             data = loads(data)
             yield (time(timegm(ts.utctimetuple())),
                    data['table'],
-                   data['data'],
+                   aware_data_text(data),
                    )
 class AwarePacketTimeRange(BaseAwareConverter):
     header = ['packet_time', 'table', 'start_time', 'end_time', 'n_rows',
               'packet_size', 'rows_per_s']
     desc = "Time ranges covered by each data packet."
     def convert(self, queryset, time=lambda x:x):
-        for ts, data in queryset:
-            data = loads(data)
+        for ts, text in queryset:
+            data = loads(text)
             if not isinstance(data, dict): continue
-            data_decoded = loads(data['data'])
+            data_decoded = aware_rows(data)
             try:
                 time_range = (data_decoded[-1]['timestamp']
                                 -data_decoded[0]['timestamp']) / 1000
@@ -1999,14 +2083,15 @@ class AwarePacketTimeRange(BaseAwareConverter):
                    time(data_decoded[ 0]['timestamp']/1000) if time_range else '',
                    time(data_decoded[-1]['timestamp']/1000) if time_range else '',
                    len(data_decoded),
-                   len(data['data']),
+                   aware_data_length(data, text),
                    len(data_decoded)/float(time_range) if time_range else '',
                    )
 class AwareDataSize(BaseDataSize, BaseAwareConverter):
     per_page = None
+    json_fields = {'table': None}
     def do_queryset_iteration(self, queryset, sizes, counts, total_days):
         for ts, data in queryset:
-            data_decoded = loads(data)
+            data_decoded = self.loads(data)
             if isinstance(data_decoded, list):
                 table = 'unknown'
             else:
@@ -2052,17 +2137,20 @@ class AwareWifi(BaseAwareConverter):
     table = 'wifi'
     header = ['time', 'ssid', 'bssid', 'mac_address', 'rssi']
     def convert(self, queryset, time=lambda x:x):
-        safe_hash = self.safe_hash
+        hash_field = self.hash_field
         for ts, data in queryset:
             data = loads(data)
             if not isinstance(data, dict): continue
             if data['table'] != 'wifi': continue
-            table_data = loads(data['data'])
-            for row in table_data:
+            table_data = aware_rows(data)
+            columns = zip(hash_field(table_data, 'ssid'),
+                          hash_field(table_data, 'bssid'),
+                          hash_field(table_data, 'mac_address'))
+            for row, (ssid, bssid, mac_address) in zip(table_data, columns):
                 yield (time(row['timestamp']/1000.),
-                       safe_hash(row['ssid']) if 'ssid' in row else '',
-                       safe_hash(row['bssid']) if 'bssid' in row else '',
-                       safe_hash(row['mac_address']) if 'mac_address' in row else '',
+                       ssid,
+                       bssid,
+                       mac_address,
                        row['rssi'],
                        )
 class AwareSensorWifi(BaseAwareConverter):
@@ -2077,16 +2165,18 @@ class AwareBluetooth(BaseAwareConverter):
     table = 'bluetooth'
     header = ['time', 'bt_address', 'bt_rssi', 'label']
     def convert(self, queryset, time=lambda x:x):
-        safe_hash = self.safe_hash
+        hash_field = self.hash_field
         for ts, data in queryset:
             data = loads(data)
             if not isinstance(data, dict): continue
             if data['table'] != 'bluetooth': continue
-            table_data = loads(data['data'])
-            for row in table_data:
+            table_data = aware_rows(data)
+            columns = zip(hash_field(table_data, 'bt_address'),
+                          hash_field(table_data, 'bt_rssi'))
+            for row, (bt_address, bt_rssi) in zip(table_data, columns):
                 yield (time(row['timestamp']/1000.),
-                       safe_hash(row['bt_address']) if 'bt_address' in row else '',
-                       safe_hash(row['bt_rssi']) if 'bt_rssi' in row else '',
+                       bt_address,
+                       bt_rssi,
                        int(row['label'])/1000 if row['label'] not in {'disabled', ''} else '',
                        )
 class AwareLocation(BaseAwareConverter):
@@ -2128,11 +2218,11 @@ class AwareApplicationForeground(BaseAwareConverter):
         return package_name
     def convert(self, queryset, time=lambda x: x):
         filter_package_name = self.filter_package_name
-        for ts, data in queryset():
+        for ts, data in queryset:
             data = loads(data)
             if not isinstance(data, dict): continue
             if data['table'] != 'applications_foreground': continue
-            table_data = loads(data['data'])
+            table_data = aware_rows(data)
             for row in table_data:
                 package_name = filter_package_name(row['package_name'])
                 if package_name is None: continue
@@ -2258,34 +2348,34 @@ class AwareCalls(BaseAwareConverter):
     desc = "Calls (incoming=1, outgoing=2, missed=3)"
     header = ['time', 'call_type', 'call_duration', 'trace', ]
     def convert(self, queryset, time=lambda x:x):
-        safe_hash = self.safe_hash
+        hash_field = self.hash_field
         types = {"1": "incoming", "2":"outgoing", "3":"missed"}
         for ts, data in queryset:
             data = loads(data)
             if not isinstance(data, dict): continue
             if data['table'] != 'calls': continue
-            table_data = loads(data['data'])
-            for row in table_data:
+            table_data = aware_rows(data)
+            for row, trace in zip(table_data, hash_field(table_data, 'trace')):
                 yield (time(row['timestamp']/1000.),
                        types[row.get('call_type', '')],
                        row.get('call_duration', ''),
-                       safe_hash(row['trace']) if 'trace' in row else '',
+                       trace,
                        )
 class AwareMessages(BaseAwareConverter):
     desc = "Text messages"
     header = ['time', 'message_type', 'trace', ]
     def convert(self, queryset, time=lambda x:x):
-        safe_hash = self.safe_hash
+        hash_field = self.hash_field
         types = {"1": "incoming", "2":"outgoing"}
         for ts, data in queryset:
             data = loads(data)
             if not isinstance(data, dict): continue
             if data['table'] != 'messages': continue
-            table_data = loads(data['data'])
-            for row in table_data:
+            table_data = aware_rows(data)
+            for row, trace in zip(table_data, hash_field(table_data, 'trace')):
                 yield (time(row['timestamp']/1000.),
                        types[row.get('message_type', '')],
-                       safe_hash(row['trace']) if 'trace' in row else '',
+                       trace,
                        )
 class AwareRecentDataCounts(BaseDataCounts, BaseAwareConverter):
     timestamp_converter = AwareTimestamps
@@ -2298,7 +2388,7 @@ class AwareESM(BaseAwareConverter):
             data = loads(data)
             if not isinstance(data, dict): continue
             if data['table'] != 'esms': continue
-            table_data = loads(data['data'])
+            table_data = aware_rows(data)
             for row in table_data:
                 esm_json = loads(row['esm_json'])
                 yield (time(row['double_esm_user_answer_timestamp']/1000.),
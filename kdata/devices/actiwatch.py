@@ -1,5 +1,6 @@
 """Philips Actiwatch
 """
+import io
 import textwrap
 import re
 
@@ -55,3 +56,23 @@ class Actiwatch(BaseDevice):
         """
         data, n_replacements = strip_re.subn(rb"\1xxxxx\3", data)
         return data
+
+    def process_upload_file(self, f):
+        """process_upload, reading the (spooled) upload from a file.
+
+        strip_re can match over line ends, but not over a quote which
+        is not part of a ',"' before the value.  So the file is
+        stripped in pieces which end in such a quote and a line end:
+        the same result as stripping all of it at once, without a
+        second copy of the data in memory.
+        """
+        out = io.BytesIO()
+        piece = [ ]
+        for line in f:
+            piece.append(line)
+            end = line.rstrip(b'\r\n')
+            if end.endswith(b'"') and not end.endswith(b',"') and end != line:
+                out.write(strip_re.sub(rb"\1xxxxx\3", b''.join(piece)))
+                piece = [ ]
+        out.write(strip_re.sub(rb"\1xxxxx\3", b''.join(piece)))
+        return out.getvalue()
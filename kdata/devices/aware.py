@@ -22,13 +22,18 @@ from django.http import HttpResponse, JsonResponse, UnreadablePostError
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 
+from .. import aware_packed
+from .. import aware_storage
 from .. import devices
 from .. import converter
 from .. import exceptions
 from .. import group
+from .. import ingest
 from .. import logs
 from .. import models
 from .. import permissions
+from .. import ratelimit
+from .. import timing
 from .. import util
 from .. import views as kviews
 from . import aware_esm
@@ -42,6 +47,10 @@ AWARE_CRT_URL = getattr(settings, 'AWARE_CRT_URL', "https://data.koota.cs.aalto.
 AWARE_CRT_PATH = getattr(settings, 'AWARE_CRT_PATH', "/srv/koota/static/server.crt")
 
 PACKET_CHUNK_SIZE = 1000
+# Store the fast sensor tables packed (see kdata/aware_packed.py).
+PACKED_STORAGE = getattr(settings, 'AWARE_PACKED_STORAGE', False)
+PACKED_COMPRESS = getattr(settings, 'AWARE_PACKED_COMPRESS', True)
+PACKED_VERIFY = getattr(settings, 'AWARE_PACKED_VERIFY', False)
 
 # This is a null schedule, that should have no effect in Aware.
 NULL_SCHEDULE = yaml.safe_load("""\
@@ -78,6 +87,37 @@ from django.utils.safestring import mark_safe
 class Aware(devices.BaseDevice):
     """Basic Python class handling Aware devices"""
     desc = 'Aware device'
+    data_format = 'json'
+    json_kinds = '{'
+    @classmethod
+    def split_packet(cls, data, max_bytes):
+        """Split the table rows, each piece with the same table,
+        timestamp and version."""
+        from .. import rechunk
+        try:
+            packet = loads(data)
+            rows = packet['data']
+            if isinstance(rows, str):
+                rows = loads(rows)
+        except (ValueError, TypeError, KeyError):
+            return None
+        if not isinstance(rows, list) or packet.get('encoding'):
+            return None
+        if isinstance(packet['data'], list):
+            # Version 2: the rows are in the packet as they are.
+            overhead = len(dumps(dict(packet, data=[]))) - 2
+            chunks = rechunk.chunk_list(rows, max_bytes - overhead)
+            if len(chunks) < 2:
+                return None
+            return [ dumps(dict(packet, data=loads(chunk))) for chunk in chunks ]
+        # Version 1: rows are a JSON string inside the packet, so count
+        # them escaped.
+        overhead = len(dumps(dict(packet, data='')))
+        chunks = rechunk.chunk_list(rows, max_bytes - overhead,
+                                    size=lambda text: len(dumps(text)) - 2)
+        if len(chunks) < 2:
+            return None
+        return [ dumps(dict(packet, data=chunk)) for chunk in chunks ]
     AWARE_DOMAIN = AWARE_DOMAIN
     AWARE_CRT_URL = AWARE_CRT_URL
     AWARE_CRT_PATH = AWARE_CRT_PATH
@@ -693,20 +733,37 @@ def insert(request, secret_id, table, indexphp=None):
     # and no data can come out.  Unlike most devices, we must update
     # some internal state on POSTing, thus an unauthenticated getting
     # of a device class.
+    limited = ratelimit.check_request(request, device.device_id, device.type)
+    if limited is not None:
+        return limited
 
     #device_uuid = request.POST['device_id']
     try:
-        POST = request.POST
+        with timing.span('read'):
+            POST = request.POST
     except UnreadablePostError:
         return JsonResponse(dict(error="Data not received"),
                             status=400, reason="Data not received")
     data = POST['data']
+    reason = None
     try:
-        data_decoded = loads(data)
+        with timing.span('decode'):
+            data_decoded = loads(data)
     except JSONDecodeError as e:
         LOGGER.error("Aware JsonDecodeError 1: (%s) (%s): %s %s",
                      str(e), len(data), device.public_id, data[-10:])
-        raise
+        reason = 'invalid JSON: %s'%e
+    else:
+        if not (isinstance(data_decoded, list) and data_decoded
+                and all(isinstance(row, dict) for row in data_decoded)):
+            reason = 'not a list of rows'
+    if reason is not None:
+        # Kept in the form of saved packets, so that it can be
+        # reprocessed.  No timestamp, so that retries are stored once.
+        ingest.quarantine(dumps(dict(table=table, data=data, version=1)),
+                          device.device_id, reason, ip=request.META.get('REMOTE_ADDR'),
+                          device_class_=Aware)
+        return JsonResponse(dict(error=reason), status=400, reason="Invalid data")
 
     #body = request.body.decode().encode().decode() # bytes->str
     #pairs = FIELDS_MATCH.split(body)
@@ -721,7 +778,8 @@ def insert(request, secret_id, table, indexphp=None):
     #    value = re.sub('%[0-9A-Fa-f]{2}', lambda x: _hextostr[x.group()], value)
     #    POST[name] = value
 
-    data_sha256 = sha256(data.encode('utf8')).hexdigest()
+    with timing.span('hash'):
+        data_sha256 = sha256(data.encode('utf8')).hexdigest()
 
     timestamp_column_name = 'timestamp'
     if 'double_end_timestamp' in data_decoded[0]:
@@ -741,14 +799,22 @@ def insert(request, secret_id, table, indexphp=None):
                        for x in range(0, len(data_decoded), chunk_size) )
     with transaction.atomic():
         for data_chunk in data_separated:
-            max_ts = max(float(row[timestamp_column_name]) for row in data_chunk)
-            data_chunk = dumps(data_chunk)
-            # pylint: disable=redefined-variable-type
-            data_to_save = dict(table=table,
-                                data=data_chunk,
-                                timestamp=time.time(),
-                                version=1)
-            data_to_save = dumps(data_to_save)
+            with timing.span('encode'):
+                max_ts = max(float(row[timestamp_column_name]) for row in data_chunk)
+                packed = None
+                if PACKED_STORAGE and table in aware_packed.TABLES:
+                    packed = aware_packed.encode(data_chunk, compress=PACKED_COMPRESS)
+                    if packed is not None and PACKED_VERIFY \
+                           and not aware_packed.verify(data_chunk, packed):
+                        LOGGER.error("Aware packed storage failed verification: %s %s",
+                                     device.public_id, table)
+                        packed = None
+                # See kdata/aware_storage.py for the versions.
+                if packed is not None:
+                    data_to_save = aware_storage.packet(table, packed, time.time(),
+                                                        encoding=aware_packed.ENCODING)
+                else:
+                    data_to_save = aware_storage.packet(table, data_chunk, time.time())
             #max_ts = max(float(row[timestamp_column_name]) for row in data_chunk)
             kviews.save_data(data_to_save, device_id=device.device_id, request=request)
             device.attrs['aware-last-ts-%s'%table] = max_ts
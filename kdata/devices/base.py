@@ -164,6 +164,12 @@ class BaseDevice(object):
     config_instructions_template = None
     # Like above, but a django template filename loaded using the normal means.
     config_instructions_template_file = None
+    # Checks of incoming packets (see kdata/ingest.py).  data_format:
+    # 'json' or None (not checked), json_kinds: the allowed opening
+    # brackets, max_packet_size: None = INGEST_MAX_PACKET_SIZE.
+    data_format = None
+    json_kinds = '[{'
+    max_packet_size = None
 
     def __init__(self, dbrow):
         """Bind a DB row to this"""
@@ -196,6 +202,32 @@ class BaseDevice(object):
         """
         return (cls.pyclass_name(), getattr(cls, 'desc', cls.name()))
 
+    @classmethod
+    def validate_packet(cls, data):
+        """Check an incoming packet before it is saved.
+
+        Returns None if it may be saved, otherwise the reason why not
+        (the packet is then quarantined).  This runs on every upload,
+        so only cheap checks belong here.
+        """
+        from .. import ingest
+        max_size = cls.max_packet_size or ingest.MAX_PACKET_SIZE
+        if len(data) > max_size:
+            return 'too large: %d > %d bytes'%(len(data), max_size)
+        if cls.data_format == 'json':
+            return ingest.check_json(data, cls.json_kinds)
+        return None
+
+    @classmethod
+    def split_packet(cls, data, max_bytes):
+        """Split a large packet (str) into packets of about max_bytes.
+
+        Returns the list of new packets, or None to keep it as is.
+        The items must stay in order and unchanged (see
+        kdata/rechunk.py).  By default packets are not split.
+        """
+        return None
+
     @classmethod
     def create_hook(cls, instance, user):
         """Do initial device set-up.
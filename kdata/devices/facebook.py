@@ -11,7 +11,7 @@ TODO:
 """
 
 import base64
-from datetime import timedelta
+from datetime import datetime, timedelta
 import hmac
 from json import dumps, loads
 import os
@@ -36,6 +36,7 @@ from .. import exceptions
 from .. import logs
 from .. import models
 from .. import permissions
+from .. import scrape
 from .. import views
 
 
@@ -62,6 +63,8 @@ API_BASE = 'https://graph.facebook.com/v2.7/%s'
 @devices.register_device(default=False, aliases=['kdata.facebook.Facebook'])
 class Facebook(devices.BaseDevice):
     dbmodel = models.OauthDevice
+    data_format = 'json'
+    json_kinds = '{'
     converters = devices.BaseDevice.converters + [
         converter.JsonPrettyHtmlData,
                  ]
@@ -307,25 +310,49 @@ def unlink(request, public_id):
 
 
 
+def next_page(r, j, url, params):
+    if isinstance(j, dict) and 'paging' in j and 'next' in j['paging']:
+        # The next URL has all parameters.
+        return j['paging']['next'], None
+    return None
+
+# Error codes of rate limits, which do not come as 429.
+# https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling
+RATE_LIMIT_CODES = {4, 17, 32, 613}
+def rate_limited(r):
+    if r.status_code == 429:
+        return True
+    try:
+        return r.json()['error']['code'] in RATE_LIMIT_CODES
+    except (ValueError, KeyError, TypeError):
+        return False
+
+def last_created_time(pages):
+    """Unix time of the newest item, for the since= parameter."""
+    times = [ datetime.strptime(item['created_time'], '%Y-%m-%dT%H:%M:%S%z').timestamp()
+              for j in pages if isinstance(j, dict)
+              for item in j.get('data', ()) if 'created_time' in item ]
+    return int(max(times)) if times else None
+
 def scrape_device(device_id, save_data=False, debug=False):
     # Get basic parameters
-    device = models.OauthDevice.get_by_id(device_id)
+    device = scrape.get_device(device_id)
     # Check token expiry
     if device.ts_refresh < timezone.now() + timedelta(seconds=60):
         logger.error('Facebook token expired')
         return
     # Avoid scraping again if already done, and if we are in save_data mode.
     if save_data:
-        if (device.ts_last_fetch
-            and (timezone.now() - device.ts_last_fetch < timedelta(hours=1))):
+        if not scrape.claim(device):
             return
-        device.ts_last_fetch = timezone.now()
-        device.save()
     access_token = device.resource_secret
 
     # Create base OAuth session to use for everything
     session = requests.Session()
     session.auth = FacebookAuth(access_token)
+    scraper = scrape.Scraper('facebook', device, session, token=access_token,
+                             next_page=next_page, rate_limited=rate_limited,
+                             save_data=save_data, debug=debug)
 
     # Get the permissions we have:
     #r = requests.get(API_BASE%'debug_token', {'input_token':access_token},
@@ -337,7 +364,7 @@ def scrape_device(device_id, save_data=False, debug=False):
     #     Dev Server', 'is_valid': True, 'expires_at': 1474807396}}
     #fb_permissions = r.json()['data']['scopes']
     # Method 2
-    r = session.get(API_BASE%'me/permissions')
+    r = scraper.get(API_BASE%'me/permissions')
     # { "data": [ { "permission": "user_likes", "status": "granted" },
     #          { "permission": "user_events", "status": "granted" }, {
     #          "permission": "user_posts", "status": "granted" }, {
@@ -351,7 +378,8 @@ def scrape_device(device_id, save_data=False, debug=False):
     def get_facebook(endpoint, params={},
                      allowed_fields=None,
                      removed_fields=None,
-                     filter_json=lambda j: j):
+                     filter_json=lambda j: j,
+                     since_id_key=None):
         """Function to get and save data from one API call.
 
         - This handles paging, saving multiple data packets in that
@@ -362,67 +390,27 @@ def scrape_device(device_id, save_data=False, debug=False):
           data.
 
         - `allowed_keys`: If given, should be an iterable of keys.
-          Only these keys will be saved from the data.
+          Only these keys will be requested.
 
         - `remove_keys`: If given, should be an iterable of keys.
           These will be removed from the data.
 
+        - `since_id_key`: only get items created after the newest one
+          of the last run.
+
         - TODO: if paged, data is in data[]
 
         """
-        url = API_BASE%endpoint
-        all_data = [ ]
-        count = 0
         if allowed_fields is not None:
             params = params.copy()
             params['fields'] = ','.join(allowed_fields)
         #params['debug'] = 'all' # j['__debug__'] in response
         #params['debug'] = 'warning'
-        # Loop is to handle paging
-        while True:
-            count += 1
-            if debug: print("GET", url, params if params else '')
-            if debug and count > 1: print("  request index: %s"%count)
-            # Get the data
-            r = session.get(url, params=params)
-            body = r.text
-            j = r.json()
-            if debug:
-                print("{} {} len={}".format(r.status_code, r.reason, len(r.content)))
-                print(dumps(j, indent=4, sort_keys=True, separators=(',', ': ')))
-            # Rate limit?
-            if 'X-App-Usage' in r.headers:
-                print(r.headers['X-App-Usage'])
-            # Handle error cases
-            if not r.ok or 'error' in j:
-                print("Error: {}".format(j['error']))
-            # Handle privacy-preserving functions.
-            j = filter_json(j)
-            all_data.append(j)
-            if removed_fields is not None:
-                for field in removed_fields:
-                    j.pop(j, None)
-            # Create our data storage object and do the storage.
-            data = dict(endpoint=endpoint,
-                        url=url,
-                        data=dumps(j),
-                        params=params,
-                        status_code=r.status_code,
-                        reason=r.reason,
-                        timestamp=time.time(),
-                        version=1,
-                    )
-            #if debug:
-            #    print(dumps(data, indent=4, sort_keys=True, separators=',:'))
-            if save_data:
-                views.save_data(dumps(data), device.device_id, )
-            # Page (start the loop again) if necessary.
-            if 'paging' in j and 'next' in j['paging']:
-                url = j['paging']['next']
-                # explicit continue here, break by default for safety
-                continue
-            break
-        return all_data
+        return scraper.fetch(endpoint, API_BASE%endpoint, params,
+                             filter_json=filter_json,
+                             removed_fields=removed_fields,
+                             since_id_key=since_id_key, since_param='since',
+                             last_id=last_created_time)
 
 
     get_facebook('me',
@@ -442,7 +430,7 @@ def scrape_device(device_id, save_data=False, debug=False):
     get_facebook('me/friendlists', params={},
                     allowed_fields=('id', 'list_type', 'name')) #This could be omitted
     get_facebook('me/feed', params={},
-                    # TODO: since
+                    since_id_key='me-feed',
                     allowed_fields=('created_time',
                                     'id',
                                     'status_type',
@@ -481,11 +469,8 @@ def scrape_device(device_id, save_data=False, debug=False):
 
 
 def scrape_all(save_data=False, debug=False):
-    devices = Facebook.dbmodel.objects.filter(type=Facebook.pyclass_name(),
-                                              state='linked')
-    for device in devices:
-        print(device)
-        scrape_device(device.device_id, save_data=save_data, debug=debug)
+    """Scrape all linked devices, concurrently (see kdata/scrape.py)."""
+    return scrape.scrape_all(Facebook, scrape_device, save_data=save_data, debug=debug)
 
 Facebook.scrape_one_function = staticmethod(scrape_device)
 Facebook.scrape_all_function = staticmethod(scrape_all)
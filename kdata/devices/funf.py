@@ -31,6 +31,8 @@ POST_DOMAIN = settings.POST_DOMAIN
 class FunfJournal(devices.BaseDevice):
     desc = 'Funf-journal device'
     converters = devices.BaseDevice.converters + [ ]
+    data_format = 'json'
+    json_kinds = '{'
     @classmethod
     def post(self, request):
         data = process_post(request)
@@ -58,36 +60,78 @@ class FunfJournal(devices.BaseDevice):
 @csrf_exempt
 def log(request, device_id=None, device_class=None):
     return JsonResponse(dict(status='success'))
+
+FUNF_PASSWORD = b'changeme'
+
+def read_funf_db(conn, upload_data):
+    """Read the tables of a funf database into upload_data."""
+    upload_data['data'] = conn.execute('select * from data').fetchall()
+    upload_data['android_metadata'] = conn.execute('select * from android_metadata').fetchall()
+    upload_data['file_info'] = conn.execute('select * from file_info').fetchall()
+    upload_data['ts_received'] = time.time()
+
+def open_funf_db(data):
+    """Open database bytes as an sqlite3 connection, without a temp file.
+
+    Uses Connection.deserialize (Python 3.11+) to load the bytes into
+    an in-memory database.  Older Pythons copy it into :memory: from a
+    temporary file via the backup API, so the file only lives for the
+    duration of the copy.
+    """
+    conn = sqlite3.connect(':memory:')
+    if hasattr(conn, 'deserialize'):
+        conn.deserialize(data)
+        return conn
+    with tempfile.NamedTemporaryFile(prefix='tmp-funf-db-') as tfile:
+        tfile.write(data)
+        tfile.flush()
+        src = sqlite3.connect(tfile.name)
+        src.backup(conn)
+        src.close()
+    return conn
+
+def decode_upload(data, password=FUNF_PASSWORD):
+    """Return the plain database bytes of an uploaded funf archive.
+
+    Archives are either plain sqlite or DES encrypted as a whole.  The
+    key derivation is cached per password (see funf_decrypt.cached_key)
+    and the file is decrypted in one call.
+    """
+    if b'SQLite' in data[:20]:
+        return data
+    return funf_decrypt.decrypt_bytes(data, funf_decrypt.cached_key(password))
+
 @csrf_exempt
 def process_post(request, device_id=None, device_class=None):
     #logger.info('funf data: %r'%request.FILES)
     upload = request.FILES['uploadedfile']
-    import os
-    #logger.info(os.getcwd())
-    #f = open('funf-data/%s'%upload.name, 'wb')
-    #f.write(repr(request.body))
-    #f.write(upload.read())
-    #f.close()
-    #logger.info('file size: %s'%upload.size)
     upload_data = { }
-    with tempfile.NamedTemporaryFile(dir='/tmp', prefix='tmp-funf-db-', delete=False) as tfile:
-        #logger.info(tfile.name)
-        data = upload.read()
-        if b'SQLite' not in data[:20]:
-            data = funf_decrypt.decrypt2(data, '', b'changeme')
-        #logger.info(data[:80])
-        tfile.write(data)
-        tfile.flush()
-        conn = sqlite3.connect(tfile.name)
-        upload_data['data'] = conn.execute('select * from data').fetchall()
-        upload_data['android_metadata'] = conn.execute('select * from android_metadata').fetchall()
-        upload_data['file_info'] = conn.execute('select * from file_info').fetchall()
-        upload_data['ts_received'] = time.time()
-        upload_data['filename'] = upload.name
-    conn.close()
-
+    if hasattr(upload, 'temporary_file_path'):
+        # Large uploads are already spooled to disk by Django: a plain
+        # database is opened in place, an encrypted one is decrypted
+        # piece by piece to another file, so it is never all in memory.
+        with tempfile.NamedTemporaryFile(prefix='tmp-funf-db-') as tfile:
+            if b'SQLite' in upload.read(20):
+                fname = upload.temporary_file_path()
+            else:
+                upload.seek(0)
+                funf_decrypt.decrypt_file(upload, tfile,
+                                          funf_decrypt.cached_key(FUNF_PASSWORD))
+                tfile.flush()
+                fname = tfile.name
+            conn = sqlite3.connect(fname)
+            try:
+                read_funf_db(conn, upload_data)
+            finally:
+                conn.close()
+    else:
+        conn = open_funf_db(decode_upload(upload.read()))
+        try:
+            read_funf_db(conn, upload_data)
+        finally:
+            conn.close()
+    upload_data['filename'] = upload.name
     return dumps(upload_data)
-    return JsonResponse(dict(status='success'))
 
 config_v1 = """\
         {"@type":"edu.mit.media.funf.pipeline.BasicPipeline",
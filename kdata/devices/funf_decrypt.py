@@ -23,6 +23,7 @@
 
 '''Decrypt one or more files using the provided key
 '''
+import functools
 from optparse import OptionParser
 import shutil
 import os.path
@@ -54,7 +55,6 @@ def key_from_password(password, salt=_salt, iterations=_iterations):
         #print test
 
     key = result[:8]
-    print(repr(key))
 
     # TODO: Not likely, but may need to adjust for twos complement in java
 
@@ -95,7 +95,7 @@ def iter_has_next(iterable):
 
 def decrypt(file_names, key, extension=None):
     assert key != None
-    decryptor = DES.new(key)
+    decryptor = DES.new(key, DES.MODE_ECB)
     for file_name in file_names:
         
         # Iteratively read 8 byte blocks, decrypt, and write to temp file
@@ -113,13 +113,44 @@ def decrypt(file_names, key, extension=None):
             shutil.move(file_name, backup_file_name);
         shutil.move(output_file.name, file_name);
 
+@functools.lru_cache(maxsize=64)
+def cached_key(password, salt=_salt, iterations=_iterations):
+    '''key_from_password, but remembered: the derivation is 135 MD5
+    rounds and the password is the same for every upload of a device.'''
+    return key_from_password(password, salt=salt, iterations=iterations)
+
+def decrypt_bytes(data, key):
+    '''Decrypt a whole encrypted file in one call and strip the padding.'''
+    decryptor = DES.new(key, DES.MODE_ECB)
+    # ECB works on whole blocks: ignore any truncated trailing block.
+    data = data[:len(data) - len(data) % _block_size]
+    return remove_padding(decryptor.decrypt(data))
+
+def decrypt_file(src, dst, key, read_size=2**16):
+    '''decrypt_bytes from file object src to file object dst, a piece at
+    a time.'''
+    decryptor = DES.new(key, DES.MODE_ECB)
+    read_size -= read_size % _block_size
+    rest = last = b''
+    while True:
+        data = src.read(read_size)
+        if not data:
+            break
+        data = rest + data
+        n = len(data) - len(data) % _block_size
+        rest = data[n:]
+        if n:
+            # The padding is in the last piece: hold it back until known.
+            dst.write(last)
+            last = decryptor.decrypt(data[:n])
+    dst.write(remove_padding(last))
+
 import io
 def decrypt2(data, key, password=None):
     if password is not None:
-        key = key_from_password(password)
-    print(repr(key))
+        key = cached_key(password)
     assert key != None
-    decryptor = DES.new(key)
+    decryptor = DES.new(key, DES.MODE_ECB)
 
     #output = [ ]
     #encrypted_file = io.BytesIO(data)
@@ -28,6 +28,7 @@ from .. import exceptions
 from .. import logs
 from .. import models
 from .. import permissions
+from .. import scrape
 from .. import util
 from .. import views
 
@@ -50,6 +51,8 @@ API_BASE = 'https://api.instagram.com/v1/%s'
 @devices.register_device(default=False, aliases=['kdata.instagram.Instagram'])
 class Instagram(devices.BaseDevice):
     dbmodel = models.OauthDevice
+    data_format = 'json'
+    json_kinds = '{'
     converters = devices.BaseDevice.converters + [
         converter.JsonPrettyHtmlData,
                  ]
@@ -259,9 +262,15 @@ def unlink(request, public_id):
 
 
 
+def next_page(r, j, url, params):
+    if isinstance(j, dict) and 'next_url' in j.get('pagination', ()):
+        # The next URL has all parameters.
+        return j['pagination']['next_url'], None
+    return None
+
 def scrape_device(device_id, save_data=False, debug=False):
     # Get basic parameters
-    device = models.OauthDevice.get_by_id(device_id)
+    device = scrape.get_device(device_id)
     # Check token expiry
     if device.ts_refresh and device.ts_refresh < timezone.now() + timedelta(seconds=60):
         logger.error('Instagram token expired')
@@ -269,123 +278,70 @@ def scrape_device(device_id, save_data=False, debug=False):
     # Avoid scraping again if already done, and if we are in save_data
     # mode.
     if save_data:
-        if (device.ts_last_fetch
-            and (timezone.now() - device.ts_last_fetch < timedelta(hours=1))):
+        if not scrape.claim(device):
             return
-        device.ts_last_fetch = timezone.now()
-        device.save()
     access_token = device.resource_secret
 
     # Create base OAuth session to use for everything
     session = requests.Session()
     session.auth = InstagramAuth(access_token)
+    scraper = scrape.Scraper('instagram', device, session, token=access_token,
+                             next_page=next_page, save_data=save_data, debug=debug)
 
     def get_instagram(endpoint, params={},
                       allowed_fields=None,
                       removed_fields=None,
                       filter_json=lambda j: j):
-        url = API_BASE%endpoint
-        all_data = [ ]
-        count = 0
-        # Loop is to handle paging
-        while True:
-            count += 1
-            r = session.get(url, params=params)
-            if debug:
-                print("="*10)
-                print("GET {} {}".format(url, params))
-                print("{} {} len={}".format(r.status_code, r.reason, len(r.content)))
-            if debug and count > 1: print("  request index: %s"%count)
-            # Get the data
-            r = session.get(url, params=params)
-            if debug:
-                print("{} {} len={}".format(r.status_code, r.reason, len(r.content)))
-                #print(dumps(j, indent=4, sort_keys=True, separators=(',', ': ')))
-                print(r.text)
-            j = r.json()
-            # Rate limit?
-            if r.status_code == 429:
-                print(r.text)
-            # Handle error cases
-            # Example error message: {"meta": {"error_type":
-            #   "OAuthPermissionsException", "code": 400,
-            #   "error_message": "This request requires
-            #   scope=public_content, but this access token is not
-            #   authorized with this scope. The user must re-authorize
-            #   your application with scope=public_content to be granted
-            #   this permissions."}}
-            if not r.ok:
-                print(r.text)
-                raise RuntimeError("Instagram unhandled failure")
-                # FIXME: do something
-            # Handle privacy-preserving functions.
+        # Error example: {"meta": {"error_type":
+        #   "OAuthPermissionsException", "code": 400,
+        #   "error_message": "This request requires
+        #   scope=public_content, but this access token is not
+        #   authorized with this scope. The user must re-authorize
+        #   your application with scope=public_content to be granted
+        #   this permissions."}}
+        # These are logged and the endpoint skipped.
+        def filter_data(j):
+            # The payload is in j['data'], a dict or list of dicts.
             j = filter_json(j)
-            util.filter_allowed(j, allowed_fields)
-            util.filter_removed(j, removed_fields)
-            all_data.append(j)
-            # Create our data storage object and do the storage.
-            data = dict(endpoint=endpoint,
-                        url=url,
-                        data=dumps(j),
-                        params=params,
-                        status_code=r.status_code,
-                        reason=r.reason,
-                        timestamp=time.time(),
-                        version=1,
-                    )
-            #if debug:
-            #    print(dumps(data, indent=4, sort_keys=True, separators=',:'))
-            if save_data:
-                views.save_data(dumps(data), device.device_id, )
-            # Page (start the loop again) if necessary.
-            if 'pagination' in j and 'next_url' in j['pagination']:
-                url = j['pagination']['next_url']
-                # explicit continue here, break by default for safety
-                continue
-            break
-
-        return all_data
+            if 'data' in j:
+                util.filter_allowed(j['data'], allowed_fields)
+                util.filter_removed(j['data'], removed_fields)
+            return j
+        return scraper.fetch(endpoint, API_BASE%endpoint, params,
+                             filter_json=filter_data)
 
 
     # permission: none
     ret = get_instagram('users/self',params={},
                       allowed_fields=("id","counts"),
                       removed_fields=("username","full_name","profile_picture","bio", "website"))
-    print(ret, '\n')
 
     # permission: public_content
     ret = get_instagram('users/self/media/liked',params={},
                       allowed_fields=("comments","likes","created_time"),
                       removed_fields=("location","caption","null","link","images","type","users_in_photo","filter","tags","user","videos"))
-    print(ret, '\n')
 
     # permission: follower_list
     ret = get_instagram('users/self/follows',params={},
                       allowed_fields=("id",),
                       removed_fields=("username","profile_picture","full_name"))
-    print(ret, '\n')
 
     # permission: follower_list
     ret = get_instagram('users/self/followed-by',params={},
                       allowed_fields=("id",),
                       removed_fields=("username","profile_picture","full_name"))
-    print(ret, '\n')
 
     # permission: follower_list
     ret = get_instagram('users/self/requested-by',params={},
                       allowed_fields=("id", ),
                       removed_fields=("username","profile_picture"))
-    print(ret, '\n')
 
     #import IPython ; IPython.embed()
 
 
-def scrape_all():
-    devices_ = Instagram.dbmodel.objects.filter(type=Instagram.pyclass_name(),
-                                               state='linked')
-    for device in devices_:
-        print(device)
-        scrape_device(device.device_id, True)
+def scrape_all(save_data=False, debug=False):
+    """Scrape all linked devices, concurrently (see kdata/scrape.py)."""
+    return scrape.scrape_all(Instagram, scrape_device, save_data=save_data, debug=debug)
 
 Instagram.scrape_one_function = staticmethod(scrape_device)
 Instagram.scrape_all_function = staticmethod(scrape_all)
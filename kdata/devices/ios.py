@@ -7,6 +7,12 @@ from ..devices import BaseDevice, register_device
 @register_device(default=False, alias='Ios')
 class Ios(BaseDevice):
     desc = "iOS (our app)"
+    data_format = 'json'
+    json_kinds = '['
+    @classmethod
+    def split_packet(cls, data, max_bytes):
+        from .. import rechunk
+        return rechunk.split_json_list(data, max_bytes)
     converters = BaseDevice.converters + [
                   converter.IosProbes,
                   converter.IosTimestamps,
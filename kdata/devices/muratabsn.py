@@ -16,6 +16,8 @@ from django.views.decorators.http import require_http_methods
 from .. import converter
 from ..devices import BaseDevice, register_device
 from .. import models
+from .. import murata_decode
+from .. import util
 from ..views import save_data
 
 LOGGER = logging.getLogger('kdata.devices.muratabsn')
@@ -28,7 +30,7 @@ class MurataBSNCalibrationReceivedForm(forms.Form):
     calibration_time = forms.CharField(help_text="Time of most recent received calibration parameters.  Do not edit.")
 
 
-from defusedxml.ElementTree import fromstring as xml_fromstring
+from defusedxml.ElementTree import iterparse as xml_iterparse
 @register_device(default=True, alias='MurataBSN')
 class MurataBSN(BaseDevice):
     desc = 'Murata bed sensor'
@@ -47,9 +49,29 @@ class MurataBSN(BaseDevice):
     """)
     @classmethod
     def post(cls, request):
-        doc = xml_fromstring(request.body)
-        node = doc[0][0]
-        device_id = node.attrib['id']
+        # Only the node id (doc[0][0].attrib['id']) is needed here, so
+        # parse incrementally from the spooled body and stop there.
+        # kdata.views.post then reuses the same spooled body.
+        body = util.request_body(request)
+        device_id = None
+        if body.in_memory:
+            try:
+                extracted = murata_decode.extract(body.file.read().decode())
+            except UnicodeDecodeError:
+                extracted = None
+            if extracted is not None:
+                return dict(device_id=extracted[1])
+        depth = -1
+        for event, elem in xml_iterparse(body.file, events=('start', 'end')):
+            if event == 'end':
+                depth -= 1
+                continue
+            depth += 1
+            if depth == 2:
+                device_id = elem.attrib['id']
+                break
+        if device_id is None:
+            raise KeyError('id')
 
         return dict(device_id=device_id,
                     )
@@ -5,8 +5,11 @@ https://github.com/cbitstech/Purple-Robot
 """
 import hashlib
 import json
+import re
 import textwrap
+from urllib.parse import unquote_to_bytes
 
+from django.conf import settings
 from django.http import HttpResponseBadRequest, JsonResponse, UnreadablePostError
 from django.urls import reverse_lazy
 
@@ -14,10 +17,94 @@ from .. import converter
 from ..devices import BaseDevice, register_device
 
 
+# If true, every upload is fully JSON-decoded and checked (the
+# original, slower method).  Otherwise only the outer envelope is
+# scanned, see fast_payload().
+VALIDATE = getattr(settings, 'PURPLEROBOT_VALIDATE', False)
+
+_field_re = re.compile(rb'"(Operation|UserHash|Checksum)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_payload_re = re.compile(rb'"Payload"\s*:\s*"')
+
+def _json_str(raw):
+    """Value of a JSON string literal body (without the quotes), as bytes."""
+    if b'\\' not in raw:
+        return raw
+    return json.loads(b'"' + raw + b'"').encode('utf-8')
+
+def fast_payload(request):
+    """Return the verified Payload of a PR upload as utf-8 bytes, or None.
+
+    PR posts a urlencoded form with one field, json, whose value is
+    {"Operation":..., "UserHash":..., "Payload": "<escaped JSON>",
+    "Checksum": md5(UserHash+Operation+Payload)}.  Instead of decoding
+    the form to str, parsing the envelope, and re-encoding the payload
+    to hash it, find the Payload string literal in the raw bytes and
+    hash that.  If it has no escapes (the usual case), it is stored
+    verbatim without ever being decoded.
+
+    None is returned if anything is unusual (not urlencoded, fields
+    not found, checksum mismatch...), and the caller then falls back
+    to the full method, which makes all error decisions.
+    """
+    if request.content_type != 'application/x-www-form-urlencoded':
+        return None
+    body = request.body
+    raw = None
+    for field in body.split(b'&'):
+        if field.startswith(b'json='):
+            if raw is not None:
+                return None
+            raw = unquote_to_bytes(field[5:].replace(b'+', b' '))
+    if raw is None:
+        return None
+    m = _payload_re.search(raw)
+    if m is None or raw[m.start()-1:m.start()] == b'\\':
+        return None
+    # Find the closing quote: the first one not escaped by an odd
+    # number of backslashes.
+    start = end = m.end()
+    while True:
+        end = raw.find(b'"', end)
+        if end == -1:
+            return None
+        n = 0
+        while raw[end-1-n] == 0x5c:  # backslash
+            n += 1
+        if n % 2 == 0:
+            break
+        end += 1
+    if _payload_re.search(raw, end+1) is not None:
+        return None
+    try:
+        payload = _json_str(raw[start:end])
+        fields = { }
+        for name, value in _field_re.findall(raw[:m.start()] + raw[end+1:]):
+            if name in fields:
+                return None
+            fields[name] = _json_str(value)
+        if len(fields) != 3:
+            return None
+        checksum = hashlib.md5()
+        checksum.update(fields[b'UserHash'])
+        checksum.update(fields[b'Operation'])
+        checksum.update(payload)
+        if checksum.hexdigest() != fields[b'Checksum'].decode('ascii'):
+            return None
+    except (ValueError, UnicodeError):
+        return None
+    return payload
+
+
 @register_device(default=True, alias='PurpleRobot')
 class PurpleRobot(BaseDevice):
     post_url = reverse_lazy('post-purple')
     config_url = reverse_lazy('config-purple')
+    data_format = 'json'
+    json_kinds = '['
+    @classmethod
+    def split_packet(cls, data, max_bytes):
+        from .. import rechunk
+        return rechunk.split_json_list(data, max_bytes)
     converters = BaseDevice.converters + [
                   converter.JsonPrettyHtml,
                   converter.PRProbes,
@@ -51,6 +138,7 @@ class PurpleRobot(BaseDevice):
                   converter.PRDataSize1Day,
                   converter.PRDataSize1Week,
                   converter.PRDataSize,
+                  converter.PRStoredDataSize,
                   converter.PRMissingData7Days,
                   converter.PRMissingData,
                   converter.PRRecentDataCounts,
@@ -106,6 +194,18 @@ class PurpleRobot(BaseDevice):
         pass
     @classmethod
     def post(cls, request):
+        if not VALIDATE:
+            try:
+                payload = fast_payload(request)
+            except UnreadablePostError:
+                return JsonResponse(dict(error="Data not received"),
+                                    status=400, reason="Data not received")
+            if payload is not None:
+                return cls._post_response(payload)
+        return cls.post_full(request)
+    @classmethod
+    def post_full(cls, request):
+        """Parse the whole upload and verify it (the original method)."""
         request.encoding = ''
         try:
             data = json.loads(request.POST['json'])
@@ -129,8 +229,9 @@ class PurpleRobot(BaseDevice):
         #
         #device_id = UserHash
         #data = json.loads(Payload)
-        data = Payload
-
+        return cls._post_response(Payload)
+    @classmethod
+    def _post_response(cls, data):
         # Construct HTTP response that will allow PR to recoginze success.
         status = 'success'
         payload = '{ }'
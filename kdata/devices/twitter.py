@@ -30,6 +30,7 @@ from .. import exceptions
 from .. import logs
 from .. import models
 from .. import permissions
+from .. import scrape
 from .. import util
 from .. import views
 
@@ -50,6 +51,8 @@ API_BASE = 'https://api.twitter.com/1.1/%s.json'
 @devices.register_device(default=False, aliases=['kdata.twitter.Twitter'])
 class Twitter(devices.BaseDevice):
     dbmodel = models.OauthDevice
+    data_format = 'json'
+    json_kinds = '{'
     converters = devices.BaseDevice.converters + [
         converter.JsonPrettyHtmlData,
                  ]
@@ -214,22 +217,26 @@ def cursor_get(func, params):
 
 
 
+def next_page(r, j, url, params):
+    """Twitter cursor paging (the */ids endpoints)."""
+    if isinstance(j, dict) and j.get('next_cursor'):
+        params['cursor'] = j['next_cursor']
+        return url, params
+    return None
+
 def scrape_device(device_id, save_data=False, debug=False):
     use_last_id = True    # check the last_id, if False then get all data
     use_ratelimit = True  # check the last fetched ts, if False then always proceed
     # Get basic parameters
-    device = models.OauthDevice.get_by_id(device_id)
+    device = scrape.get_device(device_id)
     # Check token expiry
     if device.ts_refresh and device.ts_refresh < timezone.now() + timedelta(seconds=60):
-        logger.error('Facebook token expired')
+        logger.error('Twitter token expired')
         return
     # Avoid scraping again if already done, and if we are in save_data mode.
     if save_data and use_ratelimit:
-        if (device.ts_last_fetch
-             and (timezone.now() - device.ts_last_fetch < timedelta(hours=1))):
+        if not scrape.claim(device):
             return
-        device.ts_last_fetch = timezone.now()
-        device.save()
     resource_owner_key = device.resource_key
     resource_owner_secret = device.resource_secret
 
@@ -238,73 +245,20 @@ def scrape_device(device_id, save_data=False, debug=False):
                             client_secret=client_secret,
                             resource_owner_key=resource_owner_key,
                             resource_owner_secret=resource_owner_secret)
+    scraper = scrape.Scraper('twitter', device, session, token=resource_owner_key,
+                             next_page=next_page, save_data=save_data, debug=debug)
 
     def get_twitter(endpoint, params={}, filter_json=lambda j: j,
                     removed_fields=None, allowed_fields=None,
                     since_id_key=None):
-        url = API_BASE%endpoint
-        all_data = [ ]
-        params = { k:v for k,v in params.items() if v is not None }
-        # Handle since_id.  If given since_id_key, use this to get the
-        # most recent id on the last data-saving run, and save this
-        # for use next time.
-        if save_data and since_id_key is not None and use_last_id:
-            since_id = device.attrs.get('last-id-'+since_id_key)
-            if debug:
-                print('since_id:', since_id)
-            if since_id is not None:
-                params['since_id'] = int(since_id)
-        # Loop for paging
-        while True:
-            r = session.get(url, params=params)
-            body = r.text
-            j = r.json()
-            if debug:
-                print("="*10)
-                print("GET {} {}".format(url, params))
-                print("{} {} len={}".format(r.status_code, r.reason, len(r.content)))
-                print('  Rate limit:', r.headers['X-Rate-Limit-Limit'],
-                      r.headers['X-Rate-Limit-Remaining'])
-            # Rate limiting?
-            if r.status_code == 429:
-                print('RATE LIMIT EXCEEDED: %s: twitter %s: %s'%(r.status_code, endpoint, body))
-                raise RuntimeError('Twitter rate limit exceeded')
-            # Other errors
-            if not r.ok:
-                print("Error: {}".format(j['error']))
-                print('%s: twitter %s: %s'%(r.status_code, endpoint, body))
-                return
-
-            # Handle privacy-preserving functions
-            j = filter_json(j)
-            util.filter_allowed(j, allowed_fields)
-            util.filter_removed(j, removed_fields)
-            all_data.append(j)
-            if debug:
-                print(dumps(j, indent=4, sort_keys=True, separators=(',', ': ')))
-
-            # Create our data storage object and do the storage
-            data = dict(endpoint=endpoint,
-                        url=url,
-                        data=dumps(j),
-                        params=params,
-                        status_code=r.status_code,
-                        reason=r.reason,
-                        timestamp=time.time(),
-                        version=1,
-                    )
-            if save_data:
-                views.save_data(dumps(data), device.device_id, )
-            # Page (start the loop again) if necessary.
-            if 'next_cursor' in j and j['next_cursor'] != 0:
-                params['cursor'] = j['next_cursor']
-                continue
-            break
-        # Store our most recent tweet, for use in filtering the next
-        # time around.
-        if save_data and since_id_key is not None and all_data[-1] and use_last_id:
-            device.attrs['last-id-'+since_id_key] = max(x['id'] for x in all_data[-1])
-        return all_data
+        # Handle since_id.  If given since_id_key, the most recent id
+        # of the last data-saving run is used, and saved for use next
+        # time.
+        return scraper.fetch(endpoint, API_BASE%endpoint, params,
+                             filter_json=filter_json,
+                             allowed_fields=allowed_fields,
+                             removed_fields=removed_fields,
+                             since_id_key=since_id_key if use_last_id else None)
 
     def filter_json(j):
         if not isinstance(j, list):
@@ -323,6 +277,9 @@ def scrape_device(device_id, save_data=False, debug=False):
                       filter_json=filter_json,
                       #removed_fields={'description'}
                           )
+    if not ret:
+        logger.error('Twitter: could not get account of %s', device.public_id)
+        return
     #print(ret, '\n')
     screen_name = ret[0]['screen_name']
     #user_id = ret[0]['id']
@@ -428,11 +385,8 @@ def scrape_device(device_id, save_data=False, debug=False):
 
 
 def scrape_all(save_data=False, debug=False):
-    devices_ = Twitter.dbmodel.objects.filter(type=Twitter.pyclass_name(),
-                                             state='linked')
-    for device in devices_:
-        print(device)
-        scrape_device(device.device_id, save_data=save_data, debug=debug)
+    """Scrape all linked devices, concurrently (see kdata/scrape.py)."""
+    return scrape.scrape_all(Twitter, scrape_device, save_data=save_data, debug=debug)
 
 Twitter.scrape_one_function = staticmethod(scrape_device)
 Twitter.scrape_all_function = staticmethod(scrape_all)
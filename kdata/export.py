@@ -0,0 +1,456 @@
+"""Background export jobs.
+
+Big downloads of device_data and group_data can take hours.  Instead
+of streaming them from a web worker, a request can create an
+ExportJob (export_create), which is run by the job queue
+(kdata/jobs.py, job type 'export', "manage.py worker").  The result
+is written to a file in EXPORT_DIR and served as a file, with Range
+support, so a broken download can be continued.  Workers on other
+hosts need the same EXPORT_DIR.
+
+Progress: the export is split into units, one per (subject, device).
+After each unit the partial file is synced and the checkpoint (units,
+file offset, converter errors) saved with the export.  If the worker
+dies or the export fails, the queue runs it again: it truncates the
+file to the last checkpoint and continues from the next unit.
+
+Old results are deleted by the 'export_expire' job (enqueue it from
+cron).
+
+Only formats that can be appended to are supported: csv, json-lines
+and json.
+"""
+
+import csv
+from datetime import timedelta
+import json
+import os
+import re
+
+from django import forms
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse, HttpResponseRedirect, FileResponse, Http404
+from django.http import StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.utils import timezone
+from django.views.decorators.http import require_POST
+
+from . import exceptions
+from . import group as kgroup
+from . import jobs
+from . import logs
+from . import models
+from . import permissions
+from . import util
+
+import logging
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = getattr(settings, 'EXPORT_DIR', os.path.join(settings.BASE_DIR, 'exports'))
+CONCURRENCY = getattr(settings, 'EXPORT_CONCURRENCY', 2)   # running exports
+MAX_AGE = getattr(settings, 'EXPORT_MAX_AGE', 7*24*3600)  # result files (s)
+# Serve results by the web server: header name ('X-Accel-Redirect'
+# for nginx, 'X-Sendfile' for uwsgi/apache) and, for nginx, the
+# internal location EXPORT_DIR is mapped to.
+SENDFILE_HEADER = getattr(settings, 'EXPORT_SENDFILE_HEADER', None)
+SENDFILE_PREFIX = getattr(settings, 'EXPORT_SENDFILE_PREFIX', '/exports/')
+READ_SIZE = 2**16
+
+
+
+#
+# Formats
+#
+class _Format(object):
+    """Writer of one export format: head, rows, tail.
+
+    Rows are written per unit, the only state kept between units
+    (in the checkpoint) is the number of rows written so far.
+    """
+    ext = None
+    content_type = 'text/plain'
+    def head(self, f, header):
+        pass
+    def rows(self, f, rows, n_before):
+        raise NotImplementedError
+    def tail(self, f, errors):
+        if errors:
+            f.write('---\n')
+            f.write('The following errors were found at unspecified points in processing:\n')
+            for error in errors:
+                f.write(str(error)+'\n')
+
+class _Csv(_Format):
+    ext = 'csv'
+    content_type = 'text/csv'
+    def head(self, f, header):
+        csv.writer(f).writerow(header)
+    def rows(self, f, rows, n_before):
+        writer = csv.writer(f)
+        n = 0
+        for row in rows:
+            writer.writerow(row)
+            n += 1
+            yield n
+
+class _JsonLines(_Format):
+    ext = 'json-lines'
+    def rows(self, f, rows, n_before):
+        n = 0
+        for row in rows:
+            f.write(json.dumps(row)+'\n')
+            n += 1
+            yield n
+
+class _Json(_Format):
+    ext = 'json'
+    content_type = 'application/json'
+    def head(self, f, header):
+        f.write('[\n')
+    def rows(self, f, rows, n_before):
+        n = 0
+        for row in rows:
+            if n_before or n:
+                f.write(',\n')
+            f.write(json.dumps(row))
+            n += 1
+            yield n
+    def tail(self, f, errors):
+        f.write('\n]\n')
+        super().tail(f, errors)
+
+FORMATS = {'csv': _Csv(), 'json-lines': _JsonLines(), 'json': _Json()}
+
+def get_format(name):
+    """Format by name, accepting the download names ('csv2' etc.)."""
+    if name.endswith('2'):
+        name = name[:-1]
+    return FORMATS.get(name)
+
+
+
+def cancel(job):
+    models.ExportJob.objects.filter(id=job.id, state__in=('queued', 'running')) \
+                            .update(state='cancelled', ts_finish=timezone.now())
+    if job.job_id:
+        jobs.cancel(job.job)
+
+
+
+#
+# Running
+#
+def job_dir(job):
+    return os.path.join(EXPORT_DIR, str(job.id))
+
+def result_filename(job):
+    """Download name of the result."""
+    if job.device_id:
+        what = job.device.public_id
+    else:
+        what = job.group.slug + ('_subj%s'%job.gs_id if job.gs_id else '')
+    return '%s_%s_%s-%s.%s'%(
+        what, job.converter,
+        job.ts_data_start.strftime('%Y-%m-%d-%H:%M:%S') if job.ts_data_start else '',
+        job.ts_data_end.strftime('%Y-%m-%d-%H:%M:%S') if job.ts_data_end else '',
+        get_format(job.format).ext)
+
+def result_path(job):
+    return os.path.join(job_dir(job), 'result.'+get_format(job.format).ext)
+
+def _filter(job):
+    def filter_queryset(queryset):
+        if job.ts_data_start: queryset = queryset.filter(ts__gte=job.ts_data_start)
+        if job.ts_data_end:   queryset = queryset.filter(ts__lte=job.ts_data_end)
+        return queryset
+    return filter_queryset
+
+class _DeviceExport(object):
+    """Units and rows of a device_data export (one unit)."""
+    def __init__(self, job):
+        self.job = job
+        self.device = job.device
+        converter_class = [ x for x in self.device.get_class().converters
+                            if x.name() == job.converter ]
+        if not converter_class:
+            raise ValueError("No converter %s"%job.converter)
+        self.converter_class = converter_class[0]
+        self.converter_for_errors = self.converter_class(rows=None)
+        self.header = self.converter_class.header2()
+    def units(self):
+        return [[None, self.device.device_id]]
+    def rows(self, unit):
+        queryset = models.Data.objects.filter(device_id=self.device.device_id).order_by('ts')
+        if hasattr(self.converter_class, 'query'):
+            queryset = self.converter_class.query(queryset)
+        queryset = _filter(self.job)(queryset)
+        data = util.optimized_queryset_iterator(queryset)
+        converter = self.converter_class(((x.ts, x.data) for x in data), device=self.device)
+        converter.errors = self.converter_for_errors.errors
+        converter.errors_dict = self.converter_for_errors.errors_dict
+        return converter.run()
+
+class _GroupExport(object):
+    """Units and rows of a group_data export, one unit per (subject, device)."""
+    def __init__(self, job):
+        self.job = job
+        self.group = job.group
+        self.group_class = self.group.get_class()
+        group_converter_class = [ x for x in self.group_class.converters
+                                  if x.name() == job.converter ]
+        if not group_converter_class:
+            raise ValueError("No converter %s"%job.converter)
+        self.group_converter_class = kgroup.get_group_converter(group_converter_class[0])
+        self.converter_class = self.group_converter_class.converter
+        self.converter_for_errors = self.converter_class(rows=None)
+        self.header = ['user', 'device', ] + self.converter_class.header2()
+        self.group_config = kgroup.get_group_config(self.group)
+    def units(self):
+        # The order is random for anonymous groups, so it is decided
+        # once and stored in the checkpoint.
+        return [[subject.id, device.device_id] for subject, device
+                in kgroup.iter_users_devices(self.group, self.group_class,
+                                             self.group_converter_class)
+                if self.job.gs_id is None or subject.id == self.job.gs_id]
+    def rows(self, unit):
+        subject = models.GroupSubject.objects.get(id=unit[0], group=self.group)
+        device = models.Device.objects.get(device_id=unit[1])
+        return kgroup.iter_device_rows(self.group, self.group_config, subject, device,
+                                       self.converter_class, self.converter_for_errors,
+                                       filter_queryset=_filter(self.job))
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def _update(job, ctx, **fields):
+    """Update the export, if it still runs and ctx holds the lease."""
+    ctx.check()
+    n = models.ExportJob.objects.filter(id=job.id, state='running').update(**fields)
+    if not n:
+        raise jobs.LeaseLost(ctx.job.id)
+
+def run(job, ctx):
+    """Run (or continue) an export until done.
+
+    ctx is the jobs.Context of the queue job running it.  Raises
+    jobs.LeaseLost if the export is cancelled or the lease is lost.
+    """
+    export = _DeviceExport(job) if job.device_id else _GroupExport(job)
+    fmt = get_format(job.format)
+    checkpoint = json.loads(job.checkpoint) if job.checkpoint else None
+    if checkpoint is None:
+        checkpoint = dict(units=export.units(), done=0, offset=0, rows=0,
+                          errors=[ ], errors_dict={ })
+        _update(job, ctx, n_units=len(checkpoint['units']), checkpoint=json.dumps(checkpoint))
+    export.converter_for_errors.errors.extend(checkpoint['errors'])
+    export.converter_for_errors.errors_dict.update(checkpoint['errors_dict'])
+
+    os.makedirs(job_dir(job), exist_ok=True)
+    path = result_path(job)
+    partial = path + '.partial'
+    # Everything after the last checkpoint is redone.
+    with open(partial, 'a', newline='', encoding='utf-8') as f:
+        f.truncate(checkpoint['offset'])
+    with open(partial, 'a', newline='', encoding='utf-8') as f:
+        if checkpoint['offset'] == 0:
+            fmt.head(f, export.header)
+        for i in range(checkpoint['done'], len(checkpoint['units'])):
+            n = 0
+            for n in fmt.rows(f, export.rows(checkpoint['units'][i]), checkpoint['rows']):
+                if n % 1000 == 0:
+                    ctx.check()
+            _sync(f)
+            checkpoint['done'] = i + 1
+            checkpoint['rows'] += n
+            checkpoint['offset'] = f.tell()
+            checkpoint['errors'] = export.converter_for_errors.errors[:100]
+            checkpoint['errors_dict'] = export.converter_for_errors.errors_dict
+            _update(job, ctx, n_units_done=i+1, n_rows=checkpoint['rows'],
+                    checkpoint=json.dumps(checkpoint))
+        fmt.tail(f, export.converter_for_errors.errors)
+        _sync(f)
+        size = f.tell()
+    os.replace(partial, path)
+    _update(job, ctx, state='done', ts_finish=timezone.now(), result_size=size, error='')
+
+def _export_failed(queue_job, error, final):
+    fields = dict(error=error.split('\n', 1)[0])
+    if final:
+        fields.update(state='failed', ts_finish=timezone.now())
+    models.ExportJob.objects.filter(id=json.loads(queue_job.args)['id'],
+                                    state__in=('queued', 'running')).update(**fields)
+
+@jobs.register('export', concurrency=CONCURRENCY, max_attempts=3, on_failure=_export_failed)
+def run_export(ctx):
+    job = models.ExportJob.objects.select_related('device', 'group').get(id=ctx.args['id'])
+    if job.state not in ('queued', 'running'):
+        return
+    if job.state == 'queued':
+        models.ExportJob.objects.filter(id=job.id, state='queued').update(
+            state='running', ts_start=timezone.now())
+        job.state = 'running'
+    run(job, ctx)
+
+@jobs.register('export_expire', concurrency=1)
+def run_expire(ctx):
+    expire_results()
+
+def expire_results(max_age=None):
+    """Delete results and jobs older than max_age seconds."""
+    max_age = MAX_AGE if max_age is None else max_age
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    for job in models.ExportJob.objects.filter(ts_finish__lt=cutoff):
+        delete(job)
+
+def delete(job):
+    dir_ = job_dir(job)
+    if os.path.isdir(dir_):
+        for fname in os.listdir(dir_):
+            os.unlink(os.path.join(dir_, fname))
+        os.rmdir(dir_)
+    job.delete()
+
+
+
+#
+# Views
+#
+class ExportForm(forms.Form):
+    """Parameters of a new export.  All but format are hidden fields
+    filled in by the data views."""
+    device = forms.CharField(required=False, widget=forms.HiddenInput)
+    group = forms.CharField(required=False, widget=forms.HiddenInput)
+    gs_id = forms.IntegerField(required=False, widget=forms.HiddenInput)
+    converter = forms.CharField(widget=forms.HiddenInput)
+    start = forms.DateTimeField(required=False, widget=forms.HiddenInput)
+    end = forms.DateTimeField(required=False, widget=forms.HiddenInput)
+    format = forms.ChoiceField(choices=[(x, x) for x in sorted(FORMATS)])
+
+def _check_job_permission(request, job):
+    if request.user.is_anonymous:
+        raise exceptions.LoginRequired()
+    if job.user_id != request.user.id and not permissions.has_admin_permission(request):
+        raise exceptions.BaseMessageKootaException(message="Not your export", status=403)
+
+@login_required
+@require_POST
+def export_create(request):
+    form = ExportForm(request.POST)
+    if not form.is_valid():
+        raise exceptions.BaseMessageKootaException(message="Invalid export: %s"%form.errors.as_text())
+    d = form.cleaned_data
+    job = models.ExportJob(user=request.user, converter=d['converter'], format=d['format'],
+                           ts_data_start=d['start'], ts_data_end=d['end'])
+    if d['device']:
+        device = models.Device.get_by_id(public_id=d['device'])
+        if not permissions.has_device_permission(request, device):
+            logs.log(request, 'export denied', obj=device.public_id, op='denied_export_create',
+                     data_of=device.user)
+            raise exceptions.NoDevicePermission("No permission for device")
+        if not any(x.name() == d['converter'] for x in device.get_class().converters):
+            raise Http404("No converter '%s' found."%d['converter'])
+        job.device = device
+        logs.log(request, 'export create', obj=device.public_id, op='export_create',
+                 data_of=device.user)
+    elif d['group']:
+        group = models.Group.objects.get(slug=d['group'])
+        if not permissions.has_group_researcher_permission(request, group):
+            logs.log(request, 'export denied', obj='group='+group.slug,
+                     op='denied_export_create')
+            raise exceptions.NoGroupPermission()
+        if not any(x.name() == d['converter'] for x in group.get_class().converters):
+            raise Http404("No converter '%s' found."%d['converter'])
+        job.group = group
+        job.gs_id = d['gs_id']
+        logs.log(request, 'export create', obj='group='+group.slug, op='export_create')
+    else:
+        raise exceptions.BaseMessageKootaException(message="Give a device or group")
+    job.save()
+    job.job = jobs.enqueue('export', dict(id=job.id))
+    job.save(update_fields=['job'])
+    return HttpResponseRedirect(job.get_absolute_url())
+
+@login_required
+def export_list(request):
+    context = c = { }
+    c['jobs'] = models.ExportJob.objects.filter(user=request.user).order_by('-id') \
+                      .select_related('device', 'group')
+    return TemplateResponse(request, 'koota/export_list.html', context)
+
+@login_required
+def export_detail(request, id):
+    context = c = { }
+    job = c['job'] = models.ExportJob.objects.select_related('device', 'group').get(id=id)
+    _check_job_permission(request, job)
+    if request.method == 'POST' and 'cancel' in request.POST:
+        cancel(job)
+        return HttpResponseRedirect(job.get_absolute_url())
+    if job.state == 'done':
+        c['filename'] = result_filename(job)
+    return TemplateResponse(request, 'koota/export_detail.html', context)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+def _read_range(f, length):
+    with f:
+        while length > 0:
+            data = f.read(min(READ_SIZE, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+
+def file_response(request, path, filename, content_type):
+    """Serve a file for download, with single byte ranges.
+
+    With EXPORT_SENDFILE_HEADER set, the web server sends the file
+    (and handles ranges) and the worker is free immediately.
+    """
+    if SENDFILE_HEADER:
+        response = HttpResponse(content_type=content_type)
+        if SENDFILE_HEADER.lower() == 'x-accel-redirect':
+            response[SENDFILE_HEADER] = SENDFILE_PREFIX + os.path.relpath(path, EXPORT_DIR)
+        else:
+            response[SENDFILE_HEADER] = path
+    else:
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = '"%x-%x"'%(int(stat.st_mtime), size)
+        m = RANGE_RE.match(request.META.get('HTTP_RANGE', ''))
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if m and (m.group(1) or m.group(2)) and (not if_range or if_range == etag):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size-1) if m.group(2) else size-1
+            else:
+                start = max(size - int(m.group(2)), 0)
+                end = size - 1
+            if start >= size or end < start:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d'%size
+                return response
+            f = open(path, 'rb')
+            f.seek(start)
+            response = StreamingHttpResponse(_read_range(f, end - start + 1),
+                                             content_type=content_type, status=206)
+            response['Content-Range'] = 'bytes %d-%d/%d'%(start, end, size)
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+            response['Content-Length'] = str(size)
+        response['ETag'] = etag
+        response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = 'attachment; filename="%s"'%filename
+    return response
+
+@login_required
+def export_download(request, id):
+    job = models.ExportJob.objects.select_related('device', 'group').get(id=id)
+    _check_job_permission(request, job)
+    if job.state != 'done' or not os.path.exists(result_path(job)):
+        raise Http404("Export not ready")
+    logs.log(request, 'export download', obj='export=%s'%job.id, op='export_download',
+             data_of=job.device.user if job.device_id else None)
+    return file_response(request, result_path(job), result_filename(job),
+                         get_format(job.format).content_type)
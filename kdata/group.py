@@ -18,9 +18,11 @@ from django.template.response import TemplateResponse
 from . import converter
 from . import devices
 from . import exceptions
+from . import export
 from . import logs
 from . import models
 from . import permissions
+from . import timing
 from . import util
 from . import views
 from . import views_data
@@ -261,77 +263,122 @@ def iter_group_data(group,
     """
     #hash_subject = util.IntegerMap()
     #hash_device  = util.IntegerMap()
+    group_config = get_group_config(group)
+
+    # We can request group data from only one subject.  In that
+    # case, ignore anyone except that subject.  Subjects are
+    # speciffied by the GroupSubject.id, abbreviated gs_id.
+    pairs = [ (subject, device) for subject, device
+              in iter_users_devices(group, group_class, group_converter_class)
+              if gs_id is None or subject.id == int(gs_id) ]
+    with timing.span('hash'):
+        hashes = device_hashes(group, group_config, pairs, hash_seed=hash_seed)
+    for (subject, device), pair_hashes in zip(pairs, hashes):
+        yield from iter_device_rows(group, group_config, subject, device,
+                                    converter_class, converter_for_errors,
+                                    filter_queryset=filter_queryset,
+                                    row_limit=row_limit,
+                                    time_converter=time_converter,
+                                    handle_errors=handle_errors,
+                                    reverse_html_order=reverse_html_order,
+                                    hash_seed=hash_seed,
+                                    hashes=pair_hashes)
+
+
+def get_group_config(group):
+    """The group's JSON config (Group.config) as a dict."""
     if group.config:
         group_config = loads(group.config)
         if group_config is None:
             group_config = { }
     else:
         group_config = { }
+    return group_config
 
-    for subject, device in iter_users_devices(group, group_class, group_converter_class):
-        # We can request group data from only one subject.  In that
-        # case, ignore anyone except that subject.  Subjects are
-        # speciffied by the GroupSubject.id, abbreviated gs_id.
-        if gs_id is not None:
-            if subject.id != int(gs_id):
-                continue
-
-        # TODO: use subject_hash.  TODO: this duplicates code from
-        # GroupSubject.hash(), unify (by getting the GroupSubject
-        # object from above) if logic becomes complex.
-        if group_config.get('data_has_raw_usernames', False):
-            subject_hash = subject.user.username
-            device_hash = device.public_id
-        else:
-            subject_hash = subject.hash(hash_seed=hash_seed)
-            device_hash  = group.hash_do(device.public_id, hash_seed=hash_seed)
-
-        # Fetch all relevant data
-        queryset = models.Data.objects.filter(device_id=device.device_id, ).order_by('ts')
-        # If row_limit, we are looking on HTML page and we reverse
-        # things because this is more useful.
-        if row_limit and reverse_html_order:
-            queryset = queryset.reverse()
-        # Filter the queryset however needed.  Two parts: group
-        # limitations (left here), other user filtering (done via
-        # filter_queryset callback.)
-        if hasattr(converter_class, 'query'):
-            queryset = converter_class.query(queryset)
-        if group.ts_start: queryset = queryset.filter(ts__gte=group.ts_start)
-        if group.ts_end:   queryset = queryset.filter(ts__lt=group.ts_end)
-        if filter_queryset:
-            queryset = filter_queryset(queryset)
-
-        # Apply the converter.
+def device_hashes(group, group_config, pairs, hash_seed=None):
+    """(subject_hash, device_hash) of each (GroupSubject, device) pair.
 
-        # If row_limit, we are looking at the HTML pages, and display
-        # is reversed (see above).  In this case, we have to use
-        # optimized_queryset_iterator_1.  It is slower, but it doesn't
-        # matter since we have fewer rows.
-        if row_limit and reverse_html_order:
-            queryset = util.optimized_queryset_iterator_1(queryset)
-        else:
-            queryset = util.optimized_queryset_iterator(queryset)
-        rows = ((x.ts, x.data) for x in queryset)
-        converter = converter_class(rows=rows,
-                                    time=time_converter,
-                                    hash_seed=hash_seed,
-                                    device=device,
-                                    group=group,
-                                    groupsubject=subject)
-        converter.errors = converter_for_errors.errors
-        converter.errors_dict = converter_for_errors.errors_dict
-        if handle_errors:
-            rows = converter.run()
-        else:
-            rows = converter.convert(rows, time=time_converter)
-        # Possibility to limit total data output (for testing purposes).
-        if row_limit:
-            fast_row_limit = getattr(converter, 'fast_row_limit', 500)
-            #rows = util.time_slice_iterator(rows, 10)
-            rows = itertools.islice(rows, min(row_limit, fast_row_limit))
-        for row in rows:
-            yield (subject_hash, device_hash) + row
+    Both are hashed as whole columns (see kdata/pseudonym.py).
+    """
+    # TODO: this duplicates code from GroupSubject.hash() and
+    # Group.hash_do(), unify if logic becomes complex.
+    if group_config.get('data_has_raw_usernames', False):
+        return [ (subject.user.username, device.public_id) for subject, device in pairs ]
+    subject_column = util.hash_column([ group.salt+subject.user.username
+                                        for subject, device in pairs ], hash_seed=hash_seed)
+    device_column = util.hash_column([ group.salt+device.public_id
+                                       for subject, device in pairs ], hash_seed=hash_seed)
+    return list(zip(subject_column, device_column))
+
+def iter_device_rows(group, group_config, subject, device,
+                     converter_class,
+                     converter_for_errors,
+                     filter_queryset=None,
+                     row_limit=None,
+                     time_converter=lambda x: x,
+                     handle_errors=True,
+                     reverse_html_order=True,
+                     hash_seed=None,
+                     hashes=None):
+    """Rows of one (subject, device) of iter_group_data.
+
+    Arguments are as in iter_group_data, group_config is the dict from
+    get_group_config.  hashes: (subject_hash, device_hash) if already
+    made with device_hashes().  Exports (kdata/export.py) use this
+    directly to checkpoint after each device.
+    """
+    if hashes is None:
+        with timing.span('hash'):
+            hashes = device_hashes(group, group_config, [(subject, device)],
+                                   hash_seed=hash_seed)[0]
+    subject_hash, device_hash = hashes
+
+    # Fetch all relevant data
+    queryset = models.Data.objects.filter(device_id=device.device_id, ).order_by('ts')
+    # If row_limit, we are looking on HTML page and we reverse
+    # things because this is more useful.
+    if row_limit and reverse_html_order:
+        queryset = queryset.reverse()
+    # Filter the queryset however needed.  Two parts: group
+    # limitations (left here), other user filtering (done via
+    # filter_queryset callback.)
+    if hasattr(converter_class, 'query'):
+        queryset = converter_class.query(queryset)
+    if group.ts_start: queryset = queryset.filter(ts__gte=group.ts_start)
+    if group.ts_end:   queryset = queryset.filter(ts__lt=group.ts_end)
+    if filter_queryset:
+        queryset = filter_queryset(queryset)
+
+    # Apply the converter.
+
+    # If row_limit, we are looking at the HTML pages, and display
+    # is reversed (see above).  In this case, we have to use
+    # optimized_queryset_iterator_1.  It is slower, but it doesn't
+    # matter since we have fewer rows.
+    if row_limit and reverse_html_order:
+        queryset = util.optimized_queryset_iterator_1(queryset)
+    else:
+        queryset = util.optimized_queryset_iterator(queryset)
+    rows = timing.timed_iter('db', ((x.ts, x.data) for x in queryset))
+    converter = converter_class(rows=rows,
+                                time=time_converter,
+                                hash_seed=hash_seed,
+                                device=device,
+                                group=group,
+                                groupsubject=subject)
+    converter.errors = converter_for_errors.errors
+    converter.errors_dict = converter_for_errors.errors_dict
+    if handle_errors:
+        rows = converter.run()
+    else:
+        rows = converter.convert(rows, time=time_converter)
+    # Possibility to limit total data output (for testing purposes).
+    if row_limit:
+        fast_row_limit = getattr(converter, 'fast_row_limit', 500)
+        #rows = util.time_slice_iterator(rows, 10)
+        rows = itertools.islice(rows, min(row_limit, fast_row_limit))
+    for row in rows:
+        yield (subject_hash, device_hash) + row
 
 
 @login_required
@@ -400,10 +447,16 @@ def group_data(request, group_name, converter, format=None, gs_id=None):
                             )
     #if not format:
     #    table = itertools.islice(table, 1000)
+    if not format:
+        # Downloads are timed by the util.*_iter writers.
+        table = timing.timed_rows('convert', table)
     c['table'] = table
 
 
     context['download_formats'] = views_data.DOWNLOAD_FORMATS
+    context['export_form'] = export.ExportForm(initial=dict(
+        group=group.slug, gs_id=gs_id, converter=converter,
+        start=form.cleaned_data['start'], end=form.cleaned_data['end']))
     filename_base = '%s_%s_%s-%s'%(
         group.slug,
         converter_class.name(),
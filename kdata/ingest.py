@@ -0,0 +1,186 @@
+"""Checks of incoming data packets, and the quarantine.
+
+views.save_data checks every packet with validate_packet() of its
+device class before it is stored.  Packets which fail (truncated JSON
+of a crashed upload, binary garbage, packets over the size limit) are
+stored in models.QuarantinedData with the reason instead of in
+models.Data, so converters and exports never see them.
+
+The checks run on every upload, so they are cheap: the size, and for
+device classes with data_format = 'json', a look at both ends of the
+packet (text, an opening bracket of the expected kind and the
+matching closing one).  Classes add their own sniffing of the first
+bytes.  With INGEST_VALIDATE_JSON = True, JSON packets are also fully
+decoded.
+
+Tools: reprocess() checks a packet again (for example after a limit
+was raised) and moves it to models.Data if it passes, or always with
+force=True.  discard() marks it as handled.  scan() checks packets
+already in models.Data and can move the invalid ones here.  These are
+used by the admin and by "manage.py quarantine".
+"""
+
+import codecs
+from hashlib import sha256
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import models
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAX_PACKET_SIZE = getattr(settings, 'INGEST_MAX_PACKET_SIZE', 64 * 2**20)
+VALIDATE_JSON = getattr(settings, 'INGEST_VALIDATE_JSON', False)
+SNIFF_SIZE = 4096
+MAX_KEYS = 10000
+_CLOSING = {'[': ']', '{': '}'}
+
+
+def head_tail(data, size=SNIFF_SIZE):
+    """First and last `size` characters of data, as str.
+
+    Raises UnicodeDecodeError if bytes are not UTF-8.
+    """
+    head, tail = data[:size], data[-size:]
+    if isinstance(data, bytes):
+        # The cuts may be inside a multi-byte character.
+        head = codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        tail = tail.lstrip(bytes(range(0x80, 0xc0))) if len(data) > size else tail
+        tail = tail.decode('utf-8')
+    return head, tail
+
+def check_json(data, kinds='[{'):
+    """Why data does not look like JSON (a str), or None.
+
+    kinds: the allowed opening brackets.
+    """
+    try:
+        head, tail = head_tail(data)
+    except UnicodeDecodeError:
+        return 'binary data (not UTF-8)'
+    if '\x00' in head or '\x00' in tail:
+        return 'binary data (NUL bytes)'
+    head, tail = head.lstrip(), tail.rstrip()
+    if not head:
+        return 'empty'
+    if head[0] not in kinds:
+        return 'not JSON: starts with %r'%head[:8]
+    if tail[-1] != _CLOSING.get(head[0]):
+        return 'truncated JSON: ends with %r'%tail[-8:]
+    if VALIDATE_JSON:
+        try:
+            json.loads(data)
+        except ValueError as e:
+            return 'invalid JSON: %s'%(str(e)[:200], )
+    return None
+
+
+_device_types = { }
+def device_type(device_id):
+    """Device.type of a (secret) device_id, cached in the process."""
+    if device_id not in _device_types:
+        if len(_device_types) > MAX_KEYS:
+            _device_types.clear()
+        _device_types[device_id] = models.Device.objects.filter(
+            device_id=device_id).values_list('type', flat=True).first()
+    return _device_types[device_id]
+
+def device_class(device_id):
+    """Device class of device_id, BaseDevice if unknown."""
+    from . import devices
+    type_ = device_type(device_id)
+    if type_ is None:
+        return devices.BaseDevice
+    return devices.get_class(type_)
+
+
+def check(data, device_id, device_class_=None):
+    """Why this packet may not be saved, or None."""
+    if device_class_ is None:
+        device_class_ = device_class(device_id)
+    return device_class_.validate_packet(data)
+
+
+def quarantine(data, device_id, reason, ip=None, device_class_=None, ts=None, data_id=None):
+    """Store a packet in the quarantine.
+
+    The same packet of the same device is stored only once, so that
+    clients retrying it do not fill the quarantine.
+    """
+    if isinstance(data, bytes):
+        try:
+            data = data.decode('utf-8')
+        except UnicodeDecodeError:
+            data = str(data)
+    digest = sha256(data.encode('utf-8', 'surrogatepass')).hexdigest()
+    existing = models.QuarantinedData.objects.filter(
+        device_id=device_id, sha256=digest, state='new').first()
+    if existing is not None:
+        return existing
+    if device_class_ is None:
+        device_class_ = device_class(device_id)
+    logger.warning("Quarantined a packet of %s (%d bytes): %s", device_id, len(data), reason)
+    return models.QuarantinedData.objects.create(
+        device_id=device_id, device_type=device_class_.pyclass_name(), ip=ip, ts=ts,
+        data=data, data_length=len(data), sha256=digest, reason=reason[:256],
+        data_id=data_id)
+
+
+def reprocess(q, force=False):
+    """Check a quarantined packet again, save it as data if it passes.
+
+    Returns None if it was saved, otherwise the reason why not.
+    """
+    if q.state != 'new':
+        return 'already %s'%q.state
+    if not force:
+        reason = check(q.data, q.device_id)
+        if reason is not None:
+            if reason != q.reason:
+                q.reason = reason[:256]
+                q.save(update_fields=['reason'])
+            return reason
+    from . import rechunk
+    with transaction.atomic():
+        row = rechunk.make_row(q.data, q.device_id, q.ip or '127.0.0.1',
+                               device_type(q.device_id))
+        row.save()
+        models.Data.objects.filter(id=row.id).update(ts=q.ts or q.ts_received,
+                                                    ts_received=q.ts_received)
+        q.state = 'reprocessed'
+        q.data_id = row.id
+        q.ts_processed = timezone.now()
+        q.save()
+    return None
+
+def discard(q):
+    q.state = 'discarded'
+    q.ts_processed = timezone.now()
+    q.save(update_fields=['state', 'ts_processed'])
+
+
+def scan(queryset, move=False, batch_size=500):
+    """Check existing models.Data rows, yield (row id, device_id, reason)
+    of the invalid ones.  With move=True, they are moved to the
+    quarantine.
+    """
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id')[:batch_size])
+        if not rows:
+            return
+        last_id = rows[-1].id
+        for row in rows:
+            reason = check(row.data, row.device_id)
+            if reason is None:
+                continue
+            if move:
+                with transaction.atomic():
+                    quarantine(row.data, row.device_id, reason, ip=row.ip, ts=row.ts,
+                               data_id=row.id)
+                    row.delete()
+            yield row.id, row.device_id, reason
@@ -0,0 +1,374 @@
+"""Job queue in the database.
+
+Slow batch work (scraping, conversions, exports, maintenance commands)
+is queued as rows of models.Job and run by worker processes
+("manage.py worker"), any number of them on any host using the same
+database.  Cron only needs to enqueue ("manage.py enqueue").
+
+Job types are registered with a handler function:
+
+    @jobs.register('scrape_device', concurrency=4, max_attempts=5)
+    def scrape_device(ctx):
+        ...ctx.args...
+
+A type "name:detail" without a handler of its own uses the handler of
+"name" (for example "command:PR_missingdata"), but has its own
+concurrency limit.
+
+Leasing: a worker takes the runnable job with the highest priority
+(then the oldest) with SELECT ... FOR UPDATE SKIP LOCKED, so workers
+never wait for each other.  Databases without SKIP LOCKED (SQLite)
+take a lock instead (a process lock and a lock file, so this works
+across the processes of one host).  Either way, the final conditional
+UPDATE makes sure a job is leased only once.  Running jobs count
+against the concurrency limit of their type (settings.JOB_CONCURRENCY
+overrides the registered ones).
+
+While a job runs, a heartbeat thread renews its lease.  If a worker
+dies, the lease expires and the job is run again by another worker
+(the attempt counts).  Handlers can save progress with
+ctx.save_checkpoint() and find it in ctx.checkpoint on the next
+attempt.  Failed jobs are retried with exponential backoff until
+max_attempts.
+"""
+
+from contextlib import contextmanager
+from datetime import timedelta
+import fcntl
+import importlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import models
+
+import logging
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = getattr(settings, 'JOB_LEASE_SECONDS', 300)
+BACKOFF = 60            # first retry delay (s), doubled for each attempt
+MAX_BACKOFF = 6*3600
+CONCURRENCY = getattr(settings, 'JOB_CONCURRENCY', { })   # type -> limit
+LOCK_FILE = getattr(settings, 'JOB_LOCK_FILE',
+                    os.path.join(tempfile.gettempdir(), 'koota-jobs.lock'))
+# Modules which register job types.
+JOB_MODULES = getattr(settings, 'JOB_MODULES', ['kdata.export', 'kdata.rechunk', 'kdata.codec',
+                                               'kdata.aware_storage'])
+
+_types = { }
+_loaded = False
+
+
+
+#
+# Job types
+#
+class JobType(object):
+    def __init__(self, name, func, concurrency=None, max_attempts=3,
+                 lease_seconds=LEASE_SECONDS, backoff=BACKOFF, on_failure=None):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.backoff = backoff
+        self.on_failure = on_failure
+
+def register(name, **kwargs):
+    """Decorator registering a handler for a job type (see JobType)."""
+    def decorator(func):
+        _types[name] = JobType(name, func, **kwargs)
+        return func
+    return decorator
+
+def load_types():
+    global _loaded
+    for name in JOB_MODULES:
+        importlib.import_module(name)
+    _loaded = True
+
+def get_type(type_):
+    """JobType for a job type, or None."""
+    if not _loaded:
+        load_types()
+    if type_ in _types:
+        return _types[type_]
+    return _types.get(type_.split(':', 1)[0])
+
+def concurrency(type_):
+    """Maximum number of running jobs of a type, or None."""
+    if type_ in CONCURRENCY:
+        return CONCURRENCY[type_]
+    jobtype = get_type(type_)
+    return jobtype.concurrency if jobtype else None
+
+def enqueue(type_, args=None, priority=0, delay=None, unique=False, max_attempts=None):
+    """Add a job.
+
+    unique: if a job of the same type and args is already queued or
+    running, return that one instead (for cron).
+    """
+    jobtype = get_type(type_)
+    if jobtype is None:
+        raise ValueError("Unknown job type: %s"%type_)
+    args = json.dumps(args if args is not None else { }, sort_keys=True)
+    if unique:
+        existing = models.Job.objects.filter(type=type_, args=args,
+                                             state__in=('queued', 'running')).first()
+        if existing is not None:
+            return existing
+    run_after = timezone.now() + timedelta(seconds=delay or 0)
+    return models.Job.objects.create(
+        type=type_, args=args, priority=priority, run_after=run_after,
+        max_attempts=max_attempts or jobtype.max_attempts)
+
+def cancel(job):
+    """Cancel a job.  A running one notices at its next heartbeat."""
+    models.Job.objects.filter(id=job.id, state__in=('queued', 'running')) \
+                      .update(state='cancelled', ts_finish=timezone.now())
+
+
+
+#
+# Leasing
+#
+def default_owner():
+    return '%s:%d'%(socket.gethostname(), os.getpid())
+
+_claim_thread_lock = threading.Lock()
+@contextmanager
+def _claim_lock():
+    """Serialize leasing where SKIP LOCKED is not available."""
+    if connection.features.has_select_for_update_skip_locked:
+        yield
+        return
+    with _claim_thread_lock:
+        with open(LOCK_FILE, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _type_lock(type_):
+    """Lock a type until the end of the transaction (PostgreSQL), for
+    counting its running jobs.  Otherwise _claim_lock does this."""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as c:
+            c.execute('SELECT pg_advisory_xact_lock(%s)',
+                      [zlib.crc32(('kdata_job:'+type_).encode()) - 2**31])
+
+def _leasable(now):
+    return (Q(state='queued', run_after__lte=now)
+            | Q(state='running', lease_expires__lt=now))
+
+def _running(type_, now):
+    return models.Job.objects.filter(type=type_, state='running', lease_expires__gte=now).count()
+
+def lease(owner, types=None):
+    """Lease the next runnable job for owner, or None.
+
+    types: only job types in this list (or their "name:" variants).
+    """
+    now = timezone.now()
+    with _claim_lock(), transaction.atomic():
+        qs = models.Job.objects.filter(_leasable(now)).order_by('-priority', 'id')
+        if types:
+            q = Q()
+            for t in types:
+                q |= Q(type=t) | Q(type__startswith=t+':')
+            qs = qs.filter(q)
+        if connection.features.has_select_for_update_skip_locked:
+            qs = qs.select_for_update(skip_locked=True)
+        full = set()
+        for job in qs[:20]:
+            if job.type in full:
+                continue
+            jobtype = get_type(job.type)
+            if jobtype is None:
+                continue
+            limit = concurrency(job.type)
+            if limit is not None:
+                _type_lock(job.type)
+                if _running(job.type, now) >= limit:
+                    full.add(job.type)
+                    continue
+            if job.state == 'running' and job.attempts >= job.max_attempts:
+                # Its worker died too many times.
+                models.Job.objects.filter(id=job.id).update(
+                    state='failed', ts_finish=now, lease_owner='',
+                    error=job.error or 'Lease expired %d times'%job.attempts)
+                _failed(job, 'Lease expired', final=True)
+                continue
+            n = models.Job.objects.filter(_leasable(now), id=job.id).update(
+                state='running', lease_owner=owner, attempts=F('attempts') + 1,
+                lease_expires=now + timedelta(seconds=jobtype.lease_seconds),
+                heartbeat=now, ts_start=now)
+            if n:
+                job.refresh_from_db()
+                return job
+    return None
+
+
+
+#
+# Running
+#
+class LeaseLost(Exception):
+    """The job was cancelled or taken over by another worker."""
+
+class Context(object):
+    """What a handler gets: the job, its arguments and checkpoint."""
+    def __init__(self, job, owner):
+        self.job = job
+        self.owner = owner
+        self.args = json.loads(job.args) if job.args else { }
+        self.checkpoint = json.loads(job.checkpoint) if job.checkpoint else None
+        self.lease_seconds = get_type(job.type).lease_seconds
+        self.lost = threading.Event()
+    def heartbeat(self):
+        """Renew the lease.  Raises LeaseLost if it is not ours anymore."""
+        now = timezone.now()
+        n = models.Job.objects.filter(id=self.job.id, state='running',
+                                      lease_owner=self.owner).update(
+            lease_expires=now + timedelta(seconds=self.lease_seconds), heartbeat=now)
+        if not n:
+            self.lost.set()
+        self.check()
+    def check(self):
+        """Raise LeaseLost if the heartbeat found the lease lost."""
+        if self.lost.is_set():
+            raise LeaseLost(self.job.id)
+    def save_checkpoint(self, data):
+        """Save progress (JSON-able), and renew the lease."""
+        self.checkpoint = data
+        n = models.Job.objects.filter(id=self.job.id, state='running',
+                                      lease_owner=self.owner).update(
+            checkpoint=json.dumps(data),
+            lease_expires=timezone.now() + timedelta(seconds=self.lease_seconds))
+        if not n:
+            self.lost.set()
+        self.check()
+
+def _heartbeat_thread(ctx, stop):
+    interval = ctx.lease_seconds / 3
+    try:
+        while not stop.wait(interval):
+            try:
+                ctx.heartbeat()
+            except LeaseLost:
+                logger.warning("job %s: lease lost", ctx.job.id)
+                return
+            except Exception:
+                logger.exception("job %s: heartbeat failed", ctx.job.id)
+    finally:
+        connection.close()
+
+def _failed(job, error, final):
+    jobtype = get_type(job.type)
+    if jobtype is not None and jobtype.on_failure is not None:
+        try:
+            jobtype.on_failure(job, error, final)
+        except Exception:
+            logger.exception("job %s: on_failure", job.id)
+
+def run(job, owner):
+    """Run a leased job and record the result."""
+    jobtype = get_type(job.type)
+    ctx = Context(job, owner)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat_thread, args=(ctx, stop),
+                                 name='koota-job-heartbeat', daemon=True)
+    heartbeat.start()
+    mine = models.Job.objects.filter(id=job.id, state='running', lease_owner=owner)
+    try:
+        jobtype.func(ctx)
+    except LeaseLost:
+        logger.info("job %s lost its lease", job.id)
+    except Exception as e:
+        error = '%s: %s\n%s'%(e.__class__.__name__, e, traceback.format_exc())
+        now = timezone.now()
+        if job.attempts < job.max_attempts:
+            delay = min(jobtype.backoff * 2**(job.attempts-1), MAX_BACKOFF)
+            logger.warning("job %s failed (attempt %d), retry in %ds: %s", job.id,
+                           job.attempts, delay, e)
+            if mine.update(state='queued', lease_owner='', lease_expires=None, error=error,
+                           run_after=now + timedelta(seconds=delay)):
+                _failed(job, error, final=False)
+        else:
+            logger.exception("job %s failed", job.id)
+            if mine.update(state='failed', lease_owner='', ts_finish=now, error=error):
+                _failed(job, error, final=True)
+    else:
+        mine.update(state='done', lease_owner='', ts_finish=timezone.now())
+    finally:
+        stop.set()
+        heartbeat.join()
+
+def run_one(owner=None, types=None):
+    """Lease and run one job.  Returns it, or None if none was runnable."""
+    owner = owner or default_owner()
+    job = lease(owner, types=types)
+    if job is None:
+        return None
+    logger.info("job %s (%s) started by %s, attempt %d", job.id, job.type, owner, job.attempts)
+    run(job, owner)
+    return job
+
+def work(owner=None, types=None, once=False, poll=5):
+    """Worker loop: run jobs until none are runnable (once) or forever."""
+    owner = owner or default_owner()
+    while True:
+        job = run_one(owner, types=types)
+        if job is None:
+            # Don't hold a connection while idle.
+            connection.close()
+            if once:
+                return
+            time.sleep(poll)
+
+
+
+#
+# Built-in job types
+#
+# Commands may have effects which must not be repeated (e3000_email
+# sends emails), and they do not notice a lost lease, so they are run
+# once: not retried, and failed if their worker dies.  Enqueue with
+# max_attempts for commands which are safe to run again.
+@register('command', concurrency=1, max_attempts=1)
+def run_command(ctx):
+    """command:NAME, args {"argv": [...]}: a management command."""
+    name = ctx.job.type.split(':', 1)[1]
+    call_command(name, *ctx.args.get('argv', [ ]))
+
+@register('scrape', concurrency=1)
+def scrape(ctx):
+    """scrape:DEVICECLASS: queue a scrape_device job for every device."""
+    from . import devices
+    name = ctx.job.type.split(':', 1)[1]
+    cls = devices.get_class(name)
+    qs = (cls.dbmodel or models.Device).objects.filter(type=cls.pyclass_name())
+    if hasattr(qs.model, 'state'):
+        qs = qs.filter(state='linked')
+    for device in qs:
+        enqueue('scrape_device:'+name, dict(device_id=device.public_id), unique=True,
+                priority=ctx.job.priority)
+
+@register('scrape_device', concurrency=4, max_attempts=5)
+def scrape_device(ctx):
+    """scrape_device:DEVICECLASS, args {"device_id": public_id}"""
+    from . import devices
+    cls = devices.get_class(ctx.job.type.split(':', 1)[1])
+    cls.scrape_one_function(device_id=ctx.args['device_id'], save_data=True, debug=False)
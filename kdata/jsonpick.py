@@ -0,0 +1,260 @@
+"""Partial decoding of JSON text: only the keys which are needed.
+
+Many converters only look at a few keys of big packets: the probe
+names and timestamps of Purple Robot probes, the table name and row
+timestamps of AWARE packets.  json.loads makes Python objects of
+everything; pick() makes them only of what a spec asks for, and skips
+over the rest of the text with regular expressions (numbers, long
+strings and arrays of numbers are skipped without being decoded).
+
+A spec says what to keep of a value:
+
+    None                the whole value (decoded with the json module)
+    {key: spec, ...}    of an object, only these keys (each with its
+                        own spec); of an array, this applied to each
+                        element; of a string which contains a JSON
+                        array or object (starts with [ or {, and is
+                        assumed to be JSON then), this applied to the
+                        decoded string
+
+Other values (numbers, strings, ...) are kept as they are.  The last
+rule is for packets which contain JSON as a string (AWARE storage
+version 1): {"data": {"timestamp": None}} picks the row timestamps
+from both versions.
+
+The result has at least the keys asked for, and may have others:
+arrays of small objects (like AWARE rows) are decoded whole, since the
+json module is faster for them than skipping keys in Python.  So the
+definition is project(pick(text, spec), spec) == project(
+json.loads(text), spec), where project() does the same as pick() on
+decoded objects (and keeps only the keys asked for).
+
+The text is assumed to be valid JSON (as our packets are: they are
+checked at ingest), and keys in an object to be unique.  When all keys
+of an object have been found, the rest of it is skipped without
+decoding, and the rest of the outermost one is not read at all.
+
+Converters declare the spec as their json_fields, and use
+self.loads() (see converter._Converter).  This module does not use
+Django.
+"""
+
+import json
+from json.decoder import scanstring
+import re
+
+_WS = re.compile(r'[ \t\n\r]*')
+# Anything up to the next [ ] { or }, with strings skipped as a whole.
+_PLAIN = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+# The rest of a string after its opening quote.
+_STRING_END = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"')
+_SCALAR_END = re.compile(r'[^ \t\n\r,\]}]*')
+_raw_decode = json.JSONDecoder().raw_decode
+# Arrays of objects smaller than this (the first one) are decoded
+# whole: per key, the json module is faster than skipping in Python.
+# (Only if only keys are asked of them, not parts of their values.)
+SMALL_OBJECT = 2048
+
+
+def _close(s, i, depth=1):
+    """End index of the containers open at s[i] (depth of them)."""
+    plain = _PLAIN.match
+    while True:
+        i = plain(s, i).end()
+        c = s[i]
+        i += 1
+        if c == '[' or c == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if not depth:
+                return i
+
+def _skip(s, i):
+    """End index of the value starting at s[i]."""
+    c = s[i]
+    if c == '"':
+        return _STRING_END.match(s, i+1).end()
+    if c == '[' or c == '{':
+        return _close(s, i+1)
+    return _SCALAR_END.match(s, i).end()
+
+
+def _embedded(value):
+    """Is a string JSON text of an array or object?"""
+    value = value.lstrip(' \t\n\r')
+    return value[:1] in ('[', '{')
+
+def _flat(spec):
+    return all(v is None for v in spec.values())
+
+
+def _pick(s, i, spec, top=False):
+    """Pick from the value starting at s[i] (no whitespace before).
+    Returns (value, end index)."""
+    if spec is None:
+        return _raw_decode(s, i)
+    ws = _WS.match
+    c = s[i]
+    if c == '{':
+        result = { }
+        n_wanted = len(spec)
+        i = ws(s, i+1).end()
+        if s[i] == '}':
+            return result, i+1
+        while True:
+            key, i = scanstring(s, i+1)
+            i = ws(s, ws(s, i).end() + 1).end()    # the ":"
+            if key in spec:
+                result[key], i = _pick(s, i, spec[key])
+                if len(result) == n_wanted:
+                    # All found: the rest is not needed.
+                    return result, (len(s) if top else _close(s, i))
+            else:
+                i = _skip(s, i)
+            i = ws(s, i).end()
+            if s[i] == '}':
+                return result, i+1
+            i = ws(s, i+1).end()    # the ","
+    if c == '[':
+        start = i
+        result = [ ]
+        i = ws(s, i+1).end()
+        if s[i] == ']':
+            return result, i+1
+        if s[i] == '{' and _flat(spec):
+            value, end = _raw_decode(s, i)
+            if end - i < SMALL_OBJECT:
+                return _raw_decode(s, start)
+        while True:
+            value, i = _pick(s, i, spec)
+            result.append(value)
+            i = ws(s, i).end()
+            if s[i] == ']':
+                return result, i+1
+            i = ws(s, i+1).end()    # the ","
+    if c == '"':
+        value, i = scanstring(s, i+1)
+        if _embedded(value):
+            try:
+                value = pick(value, spec)
+            except (ValueError, IndexError, AttributeError):
+                pass    # not JSON after all
+        return value, i
+    return _raw_decode(s, i)
+
+
+def pick(text, spec):
+    """Decode (at least) the parts of JSON text which spec asks for."""
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    i = _WS.match(text).end()
+    return _pick(text, i, spec, top=True)[0]
+
+
+def project(value, spec):
+    """Only what spec asks for, from a decoded value."""
+    if spec is None:
+        return value
+    if isinstance(value, dict):
+        return { k: project(v, spec[k]) for k, v in value.items() if k in spec }
+    if isinstance(value, list):
+        return [ project(v, spec) for v in value ]
+    if isinstance(value, str) and _embedded(value):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return value
+        return project(value, spec)
+    return value
+
+
+def items(text, spec=None):
+    """Elements of a JSON array: [(picked value, length of its text)]."""
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    ws = _WS.match
+    i = ws(text).end()
+    if text[i] != '[':
+        raise ValueError("Not a JSON array")
+    result = [ ]
+    i = ws(text, i+1).end()
+    if text[i] == ']':
+        return result
+    while True:
+        if spec is None:
+            end = _skip(text, i)
+            result.append((_raw_decode(text, i)[0], end-i))
+        else:
+            value, end = _pick(text, i, spec)
+            result.append((value, end-i))
+        i = ws(text, end).end()
+        if text[i] == ']':
+            return result
+        i = ws(text, i+1).end()
+
+
+def find(text, key):
+    """Index of the value of key in the JSON object text (the members
+    before it are skipped, not decoded), or None if there is no key."""
+    ws = _WS.match
+    i = ws(text).end()
+    if text[i] != '{':
+        raise ValueError("Not a JSON object")
+    i = ws(text, i+1).end()
+    if text[i] == '}':
+        return None
+    while True:
+        name, i = scanstring(text, i+1)
+        i = ws(text, ws(text, i).end() + 1).end()    # the ":"
+        if name == key:
+            return i
+        i = ws(text, _skip(text, i)).end()
+        if text[i] == '}':
+            return None
+        i = ws(text, i+1).end()    # the ","
+
+
+def _rws(s, j):
+    while s[j-1] in ' \t\n\r':
+        j -= 1
+    return j
+
+def _rstring(s, j):
+    """Start index of the string which ends at s[j-1] (its quote)."""
+    k = j - 1
+    while True:
+        k = s.rfind('"', 0, k)
+        n = k
+        while s[n-1] == '\\':
+            n -= 1
+        if (k - n) % 2 == 0:
+            return k
+
+def last_end(text):
+    """End index of the last array or object member value of the JSON
+    object text, or None if there is none.
+
+    This reads text from its end, only over the members after that
+    value.  With find(), it gives the span of a big array without
+    reading it, when it is known to be the last one (like "data" in
+    AWARE packets, see kdata/aware_storage.py).
+    """
+    j = _rws(text, len(text)) - 1    # the "}"
+    while True:
+        j = _rws(text, j)
+        c = text[j-1]
+        if c == ']' or c == '}':
+            return j
+        if c == '{':
+            return None
+        if c == '"':
+            j = _rstring(text, j)
+        else:
+            while text[j-1] not in ' \t\n\r:':
+                j -= 1
+        j = _rws(text, _rws(text, j) - 1)    # the ":"
+        j = _rws(text, _rstring(text, j))
+        if text[j-1] == '{':
+            return None
+        j -= 1    # the ","
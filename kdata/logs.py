@@ -1,4 +1,27 @@
+"""Audit log of data access.
 
+log() formats one line per event (who accessed what) for the
+'kdata.datalog' logger.  Writing it (a file write and flush per line,
+or whatever handlers are configured) is done by a background thread:
+messages go into a bounded in-process buffer, which is written every
+FLUSH_MESSAGES messages or FLUSH_INTERVAL seconds, at exit and on
+flush().  Messages keep their order and their time of the event.
+
+If the buffer is full, critical events (data access, access denials
+and account or consent changes, see is_critical()) are written
+synchronously, after everything before them in the buffer.  The
+audit log is for knowing who saw which data, so no access to data is
+lost.  Other messages are dropped and counted in stats().  With
+settings.KOOTA_LOG_BUFFERED = False, everything is written
+synchronously.
+"""
+
+import atexit
+import collections
+import os
+import threading
+
+from django.conf import settings
 
 from . import models
 
@@ -6,19 +29,181 @@ import logging
 
 logger = logging.getLogger('kdata.datalog')
 
+BUFFERED = getattr(settings, 'KOOTA_LOG_BUFFERED', True)
+QUEUE_SIZE = getattr(settings, 'KOOTA_LOG_QUEUE_SIZE', 10000)
+FLUSH_MESSAGES = 100
+FLUSH_INTERVAL = getattr(settings, 'KOOTA_LOG_FLUSH_INTERVAL', 0.2)  # seconds
+# Views which show or hand out data.
+DATA_ACCESS_OPS = {'get_data', 'group_data', 'group_detail',
+                   'group_subject_detail', 'group_subject_detail_notes',
+                   'export_create', 'export_download', 'study_info'}
+CRITICAL_OPS = {'register', 'group_join', 'group_user_create_success',
+                'link_done', 'unlink'} | DATA_ACCESS_OPS
+
+
+def is_critical(op):
+    """Events which may never be dropped."""
+    return op is not None and (op.startswith('denied_') or op in CRITICAL_OPS)
+
+
+class BufferedWriter(object):
+    """Bounded buffer of items, written in batches by a background thread.
+
+    emit(items) is called with lists of items, always in the order
+    they were put(), and never concurrently.  The thread is started
+    on first use, and again in a forked child process.
+    """
+    def __init__(self, emit, maxsize=QUEUE_SIZE, batch=FLUSH_MESSAGES,
+                 interval=FLUSH_INTERVAL):
+        self.emit = emit
+        self.maxsize = maxsize
+        self.batch = batch
+        self.interval = interval
+        self.dropped = 0
+        self.written = 0
+        self.sync_writes = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._init()
+    def _init(self):
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # New process (or first use): locks and buffer from the
+            # parent are not ours, and its thread does not exist here.
+            if self._pid is not None:
+                self._init()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='koota-log-writer',
+                                            daemon=True)
+            self._thread.start()
+
+    def put(self, item, critical=False):
+        """Queue item.  Returns False if it was dropped."""
+        self._ensure_thread()
+        if self._stopping:
+            # At exit, after close(): nothing will write the buffer.
+            self._drain(extra=[item])
+            return True
+        with self._cond:
+            if len(self._buffer) < self.maxsize:
+                self._buffer.append(item)
+                if len(self._buffer) >= self.batch:
+                    self._cond.notify()
+                return True
+        with self._cond:
+            if not critical:
+                self.dropped += 1
+                return False
+            self.sync_writes += 1
+        # Full: write everything before this item, then this item.
+        self._drain(extra=[item])
+        return True
+
+    def _drain(self, extra=()):
+        with self._write_lock:
+            with self._cond:
+                items = list(self._buffer)
+                self._buffer.clear()
+            items.extend(extra)
+            if items:
+                try:
+                    self.emit(items)
+                except Exception:
+                    logging.getLogger(__name__).exception("Writing %d log messages failed", len(items))
+                self.written += len(items)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._buffer) >= self.batch or self._stopping,
+                                    timeout=self.interval)
+                stopping = self._stopping
+            self._drain()
+            if stopping:
+                return
+
+    def flush(self):
+        """Write everything queued so far, now."""
+        self._drain()
+
+    def close(self):
+        """Stop the thread and write everything (at exit)."""
+        if self._thread is not None and self._pid == os.getpid():
+            with self._cond:
+                self._stopping = True
+                self._cond.notify()
+            self._thread.join(timeout=10)
+        self._drain()
+
+    def stats(self):
+        with self._cond:
+            queued = len(self._buffer)
+        return dict(queued=queued, written=self.written, dropped=self.dropped,
+                    sync_writes=self.sync_writes)
+
+
+def _emit_records(records):
+    for record in records:
+        logger.handle(record)
+
+_writer = BufferedWriter(_emit_records)
+atexit.register(_writer.close)
+try:
+    # uwsgi does not run atexit handlers of workers on reload.
+    import uwsgi
+    _uwsgi_atexit = getattr(uwsgi, 'atexit', None)
+    def _close_uwsgi():
+        _writer.close()
+        if _uwsgi_atexit is not None:
+            _uwsgi_atexit()
+    uwsgi.atexit = _close_uwsgi
+except ImportError:
+    pass
+
+
+def flush():
+    """Write all buffered log messages now."""
+    _writer.flush()
+
+def stats():
+    """Counts of the buffered writer: queued, written, dropped, sync_writes."""
+    return _writer.stats()
+
 
 def log(request, message, user=None,
         obj=None, op=None,
         data_of=None,
         duration=None,
+        critical=None,
 ):
     user = request.user
     username = user.username
     ip = request.META.get('REMOTE_ADDR', None)
 
-    logger.info('%s %s %s?%s o=%s op=%s u=%s data_of=%s "%s"'%(
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    msg = '%s %s %s?%s o=%s op=%s u=%s data_of=%s "%s"'%(
         request.get_host(),
         request.method, request.path, request.META['QUERY_STRING'],
         obj, op,username,
         data_of.username if data_of is not None else '',
-        message))
+        message)
+    if not BUFFERED:
+        logger.info(msg)
+        return
+    # Make the record now, so that it has the time of the event.
+    record = logger.makeRecord(logger.name, logging.INFO, __file__, 0, msg, None, None,
+                               func='log')
+    if critical is None:
+        critical = is_critical(op)
+    _writer.put(record, critical=critical)
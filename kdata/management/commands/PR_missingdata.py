@@ -26,7 +26,7 @@ class Command(BaseCommand):
         for device in devices:
             print(device.public_id, device.user.username, device.type)
             rows = Data.objects.filter(device_id=device.device_id,
-                                       ts__gt=timezone.now()-timedelta(days=options['history'])).defer('data')
+                                       ts__gt=timezone.now()-timedelta(days=options['history'])).defer('data', 'data_z')
             print('count:', rows.count())
 
             from kdata import converter
@@ -0,0 +1,89 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata import aware_packed
+from kdata import models
+from kdata import util
+
+class Command(BaseCommand):
+    help = ('Packed storage of AWARE sensor tables (see kdata/aware_packed.py).  '
+            '"bench": size and speed on synthetic data.  "verify DEVICE...": check '
+            'that stored packets decode, and that JSON ones would round-trip exactly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['bench', 'verify'])
+        parser.add_argument('device_id', nargs='*')
+        parser.add_argument('--packets', type=int, default=20,
+                            help="bench: packets per table (default %(default)s).")
+        parser.add_argument('--rows', type=int, default=1000,
+                            help="bench: rows per packet (default %(default)s).")
+
+    def handle(self, *args, **options):
+        if options['action'] == 'bench':
+            self.bench(options['packets'], options['rows'])
+        else:
+            if not options['device_id']:
+                raise CommandError("Give device ids")
+            self.verify(options['device_id'])
+
+    def bench(self, n_packets, n_rows):
+        from kdata.bench import generators, runner
+        fields = {table: cls.fields for cls, table in runner.aware_converters()
+                  if table in aware_packed.TABLES}
+        self.stdout.write('%-22s %10s %10s %10s %7s %9s %9s %9s'%(
+            'table', 'json B', 'packed B', 'zlib B', 'ratio', 'enc ms', 'json ms', 'dec ms'))
+        for table in sorted(aware_packed.TABLES):
+            packets = generators.aware(table, fields.get(table, ()), rnd=1, n_packets=n_packets,
+                                       rows_per_packet=n_rows)
+            rows = [ json.loads(json.loads(data)['data']) for ts, data in packets ]
+            json_size = sum(len(data) for ts, data in packets)
+            raw_size = sum(len(aware_packed.encode(r, compress=False)) for r in rows)
+            t0 = time.perf_counter()
+            texts = [ aware_packed.encode(r) for r in rows ]
+            t1 = time.perf_counter()
+            for ts, data in packets:
+                json.loads(json.loads(data)['data'])
+            t2 = time.perf_counter()
+            for text in texts:
+                aware_packed.columns(text)
+            t3 = time.perf_counter()
+            if not all(aware_packed.verify(r, text) for r, text in zip(rows, texts)):
+                raise CommandError("Round trip failed: %s"%table)
+            zlib_size = sum(len(text) for text in texts)
+            self.stdout.write('%-22s %10d %10d %10d %7.1f %9.1f %9.1f %9.1f'%(
+                table, json_size, raw_size, zlib_size, json_size/zlib_size,
+                (t1-t0)*1000, (t2-t1)*1000, (t3-t2)*1000))
+
+    def verify(self, device_ids):
+        for device_id in device_ids:
+            device = models.Device.get_by_id(device_id[:6])
+            qs = models.Data.objects.filter(device_id=device.device_id).order_by('ts')
+            n = n_packed = n_json = 0
+            for row in util.optimized_queryset_iterator(qs):
+                try:
+                    packet = json.loads(row.data)
+                except ValueError:
+                    continue
+                if not isinstance(packet, dict) or packet.get('table') not in aware_packed.TABLES:
+                    continue
+                n += 1
+                try:
+                    if packet.get('encoding') == aware_packed.ENCODING:
+                        aware_packed.decode(packet['data'])
+                        n_packed += 1
+                        continue
+                    rows = packet['data']
+                    if isinstance(rows, str):    # storage version 1
+                        rows = json.loads(rows)
+                except Exception as e:
+                    self.stdout.write("%s: does not decode: %s"%(row.id, e))
+                    continue
+                text = aware_packed.encode(rows)
+                if text is not None and not aware_packed.verify(rows, text):
+                    self.stdout.write("%s: round trip failed"%row.id)
+                    continue
+                n_json += 1
+            self.stdout.write("%s: %d packets, %d packed ok, %d JSON round-trip ok"%(
+                device.public_id, n, n_packed, n_json))
@@ -0,0 +1,92 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata import aware_storage
+from kdata import converter
+from kdata import jobs
+from kdata import models
+
+class Command(BaseCommand):
+    help = ('Rewrite AWARE packets in storage version 2 (see kdata/aware_storage.py), '
+            'of the given devices or all AWARE devices.  Without --live, only reports '
+            'what would be done.  --bench: size and decode time on synthetic data.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id', nargs='*', help="Devices (public or secret ids).")
+        parser.add_argument('--live', action='store_true', help="Really rewrite.")
+        parser.add_argument('--start-id', type=int, default=0,
+                            help="Continue after this row id.")
+        parser.add_argument('--batch-size', type=int, default=aware_storage.BATCH_SIZE)
+        parser.add_argument('--enqueue', action='store_true',
+                            help="Run as a background job instead (implies --live).")
+        parser.add_argument('--bench', action='store_true')
+        parser.add_argument('--packets', type=int, default=20,
+                            help="--bench: packets per table (default %(default)s).")
+
+    def handle(self, *args, **options):
+        if options['bench']:
+            self.bench(options['packets'])
+            return
+        device_ids = [ ]
+        for id_ in options['device_id']:
+            try:
+                device_ids.append(models.Device.get_by_id(id_[:6]).device_id)
+            except models.Device.DoesNotExist:
+                raise CommandError("Device not found: %s"%id_)
+
+        if options['enqueue']:
+            job = jobs.enqueue('aware_upgrade', dict(device_ids=device_ids,
+                                                     batch_size=options['batch_size']))
+            self.stdout.write("Job %d: %s"%(job.id, job.type))
+            return
+
+        qs = aware_storage.device_queryset(device_ids)
+        n_rows = before = after = 0
+        for last_id, n, b, a in aware_storage.upgrade_rows(qs, live=options['live'],
+                                                           start_id=options['start_id'],
+                                                           batch_size=options['batch_size']):
+            if n:
+                self.stdout.write("%s: %d packets, %d -> %d bytes"%(last_id, n, b, a))
+            n_rows += n
+            before += b
+            after += a
+        self.stdout.write("%d packets %s, %d -> %d bytes"%(
+            n_rows, 'upgraded' if options['live'] else 'would be upgraded', before, after))
+
+    def bench(self, n_packets):
+        from kdata.bench import generators, runner
+        self.stdout.write('%-24s %11s %11s %7s %9s %9s %7s'%(
+            'table', 'v1 B', 'v2 B', 'saved', 'v1 ms', 'v2 ms', 'faster'))
+        totals = [0, 0, 0, 0]
+        tables = { }
+        for cls, table in runner.aware_converters():
+            fields = tables.setdefault(table, [ ])
+            fields.extend(f for f in getattr(cls, 'fields', ()) if f not in fields)
+        for table, fields in sorted(tables.items()):
+            v1 = [ data for ts, data in generators.aware(table, fields, rnd=1,
+                                                         n_packets=n_packets) ]
+            v2 = [ aware_storage.upgrade(data) for data in v1 ]
+            for a, b in zip(v1, v2):
+                if json.dumps(converter.aware_rows(json.loads(a))) \
+                   != json.dumps(converter.aware_rows(json.loads(b))):
+                    raise CommandError("Rows differ: %s"%table)
+            # Decoding as converters do: the packet, then its rows.
+            t0 = time.perf_counter()
+            for data in v1:
+                converter.aware_rows(converter.loads(data))
+            t1 = time.perf_counter()
+            for data in v2:
+                converter.aware_rows(converter.loads(data))
+            t2 = time.perf_counter()
+            size1 = sum(len(d) for d in v1)
+            size2 = sum(len(d) for d in v2)
+            self.stdout.write('%-24s %11d %11d %6.1f%% %9.1f %9.1f %6.2fx'%(
+                table, size1, size2, 100*(1-size2/size1), (t1-t0)*1000, (t2-t1)*1000,
+                (t1-t0)/(t2-t1)))
+            for i, x in enumerate((size1, size2, t1-t0, t2-t1)):
+                totals[i] += x
+        size1, size2, dt1, dt2 = totals
+        self.stdout.write('%-24s %11d %11d %6.1f%% %9.1f %9.1f %6.2fx'%(
+            'total', size1, size2, 100*(1-size2/size1), dt1*1000, dt2*1000, dt1/dt2))
@@ -0,0 +1,51 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata.bench import runner
+
+class Command(BaseCommand):
+    help = 'Benchmark converters on synthetic data (see kdata/bench/).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-k', '--filter', action='append', default=[ ],
+                            help="Only run cases whose converter or source name matches "
+                                 "this regex (can be given multiple times).")
+        parser.add_argument('--format', action='append', default=[ ],
+                            help="Output format(s) to measure: %s.  Default: rows."
+                                 %', '.join(runner.FORMATS))
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help="Multiply the amount of generated data.")
+        parser.add_argument('--repeat', type=int, default=1,
+                            help="Repeat each case, report the fastest.")
+        parser.add_argument('--db', choices=['memory', 'sqlite'], default='memory',
+                            help="Read packets from a list in memory or from a SQLite table.")
+        parser.add_argument('--no-isolate', action='store_true',
+                            help="Run all cases in this process (peak RSS is then cumulative).")
+        parser.add_argument('--output', '-o', help="Write JSON results to this file ('-' for stdout).")
+        parser.add_argument('--list', action='store_true', help="List cases and exit.")
+
+    def handle(self, *args, **options):
+        cases = runner.select_cases(runner.get_cases(), options['filter'])
+        if not cases:
+            raise CommandError("No cases match")
+        if options['list']:
+            for case in cases:
+                self.stdout.write('%-35s %s'%(case.name, case.source))
+            return
+        formats = options['format'] or ['rows']
+        for format in formats:
+            if format not in runner.FORMATS:
+                raise CommandError("Unknown format: %s"%format)
+        log = self.stderr.write if options['output'] == '-' else self.stdout.write
+        results = list(runner.run(cases, formats=formats, isolate=not options['no_isolate'],
+                                  log=log, scale=options['scale'], repeat=options['repeat'],
+                                  db=options['db']))
+        if options['output'] == '-':
+            runner.write_results(results, sys.stdout)
+        elif options['output']:
+            with open(options['output'], 'w') as f:
+                runner.write_results(results, f)
+        n_errors = sum(1 for r in results if r.get('error'))
+        if n_errors:
+            self.stderr.write("%d case(s) failed"%n_errors)
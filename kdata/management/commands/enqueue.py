@@ -0,0 +1,40 @@
+import argparse
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata import jobs
+
+class Command(BaseCommand):
+    help = ('Add a job to the job queue (see kdata/jobs.py).  Examples: '
+            '"enqueue command:PR_missingdata -- --history 7", '
+            '"enqueue --unique scrape:kdata.devices.twitter.Twitter".')
+
+    def add_arguments(self, parser):
+        parser.add_argument('type', help="Job type.")
+        parser.add_argument('argv', nargs=argparse.REMAINDER,
+                            help="Arguments of a command:NAME job.")
+        parser.add_argument('--args', dest='json_args', help="Job arguments, as JSON.")
+        parser.add_argument('--priority', type=int, default=0,
+                            help="Higher runs first (default %(default)s).")
+        parser.add_argument('--delay', type=float, help="Run after this many seconds.")
+        parser.add_argument('--unique', action='store_true',
+                            help="Don't add if the same job is already queued or running.")
+        parser.add_argument('--max-attempts', type=int,
+                            help="Attempts before the job fails (default: of the job type; "
+                                 "command jobs run once unless this is given).")
+
+    def handle(self, *args, **options):
+        job_args = json.loads(options['json_args']) if options['json_args'] else { }
+        argv = options['argv']
+        if argv and argv[0] == '--':
+            argv = argv[1:]
+        if argv:
+            job_args['argv'] = argv
+        try:
+            job = jobs.enqueue(options['type'], job_args, priority=options['priority'],
+                               delay=options['delay'], unique=options['unique'],
+                               max_attempts=options['max_attempts'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Job %d: %s"%(job.id, job.type))
@@ -0,0 +1,93 @@
+import json
+import os
+import re
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata.bench import regress
+
+DEFAULT_BASELINE = getattr(settings, 'PERF_BASELINE',
+                           os.path.join(settings.BASE_DIR, 'perf-baseline.json'))
+
+class Command(BaseCommand):
+    help = ('Check hot paths for performance regressions against a saved baseline '
+            '(see kdata/bench/regress.py).  Exits non-zero on regressions.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                            help="Baseline file (default %(default)s).")
+        parser.add_argument('--save', action='store_true',
+                            help="Run and save results as the new baseline.")
+        parser.add_argument('--repeat', type=int, default=7,
+                            help="Repetitions of each benchmark.")
+        parser.add_argument('--threshold', type=float, default=0.10,
+                            help="Noise threshold: relative slowdown of the median which is "
+                                 "still accepted (default 0.10).")
+        parser.add_argument('--confidence', type=float, default=0.95,
+                            help="Confidence level of the bootstrap interval.")
+        parser.add_argument('--no-calibrate', action='store_true',
+                            help="Do not correct for the overall speed of the machine.")
+        parser.add_argument('-k', '--filter', action='append', default=[ ],
+                            help="Only run benchmarks matching this regex.")
+        parser.add_argument('--no-db', action='store_true',
+                            help="Skip the database (ingest and view) benchmarks.")
+        parser.add_argument('--report', help="Write the comparison as JSON to this file.")
+
+    def handle(self, *args, **options):
+        benchmarks = regress.get_benchmarks(db=not options['no_db'])
+        if options['filter']:
+            regexes = [re.compile(p) for p in options['filter']]
+            benchmarks = [b for b in benchmarks if b.name == regress.CALIBRATION
+                          or any(r.search(b.name) for r in regexes)]
+        if not benchmarks:
+            raise CommandError("No benchmarks match")
+        baseline = None
+        if not options['save']:
+            try:
+                with open(options['baseline']) as f:
+                    meta, baseline = regress.load_baseline(f)
+            except FileNotFoundError:
+                raise CommandError("No baseline %s, create one with --save"%options['baseline'])
+            self.stdout.write("Baseline: commit %s, %s"%(meta.get('commit'), meta.get('hostname')))
+
+        results = self.run_in_test_db(benchmarks, options)
+
+        if options['save']:
+            with open(options['baseline'], 'w') as f:
+                regress.save_baseline(results, f)
+            self.stdout.write("Saved baseline to %s"%options['baseline'])
+            return
+        comparison = regress.compare(baseline, results, threshold=options['threshold'],
+                                     confidence=options['confidence'],
+                                     calibrate=not options['no_calibrate'])
+        self.stdout.write('')
+        if not options['no_calibrate']:
+            self.stdout.write("Machine speed factor vs. baseline: %.3f"%
+                              regress.machine_factor(baseline, results))
+        for name, c in comparison.items():
+            self.stdout.write(regress.format_comparison(name, c))
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(comparison, f, indent=1)
+        regressions = [name for name, c in comparison.items() if c['status'] == 'regression']
+        if regressions:
+            raise CommandError("%d performance regression(s): %s"%(len(regressions),
+                                                                   ', '.join(regressions)))
+
+    def run_in_test_db(self, benchmarks, options):
+        """Run the benchmarks with a fresh test database, never the real one."""
+        if not any(b.db for b in benchmarks):
+            return regress.run_benchmarks(benchmarks, repeat=options['repeat'],
+                                          log=self.stdout.write)
+        from django.test.runner import DiscoverRunner
+        from django.test.utils import setup_test_environment, teardown_test_environment
+        setup_test_environment()
+        test_runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = test_runner.setup_databases()
+        try:
+            return regress.run_benchmarks(benchmarks, repeat=options['repeat'],
+                                          log=self.stdout.write)
+        finally:
+            test_runner.teardown_databases(old_config)
+            teardown_test_environment()
@@ -0,0 +1,54 @@
+import argparse
+import threading
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata import profiler
+
+class Command(BaseCommand):
+    help = ('Run another management command under the sampling profiler (see kdata/profiler.py).  '
+            'Usage: profile [options] COMMAND [ARGS...]')
+
+    def add_arguments(self, parser):
+        parser.add_argument('command', help="Management command to run.")
+        parser.add_argument('args', nargs=argparse.REMAINDER,
+                            help="Arguments of the command.")
+        parser.add_argument('--interval', type=float, default=profiler.DEFAULT_INTERVAL,
+                            help="Seconds between samples (default %(default)s).")
+        parser.add_argument('--seconds', type=float,
+                            help="Only sample this long, the command continues.")
+        parser.add_argument('--output', '-o',
+                            help="Write collapsed stacks to this file.  Default: save to "
+                                 "PROFILE_DIR, where the admin profiler page lists it.")
+
+    def handle(self, *args, **options):
+        if options['interval'] < 0.001:
+            raise CommandError("Interval too small")
+        sampler = profiler.Sampler(interval=options['interval'])
+        ident = threading.get_ident()
+        sampler.add_thread(ident)
+        started = time.time()
+        if options['seconds']:
+            deadline = started + options['seconds']
+            def on_tick():
+                if time.time() > deadline:
+                    sampler.remove_thread(ident)
+            sampler.on_tick = on_tick
+        sampler.start()
+        try:
+            call_command(options['command'], *args)
+        finally:
+            sampler.stop()
+            name = profiler.new_name()
+            meta = dict(name=name, started=started, finished=time.time(),
+                        command=' '.join((options['command'], ) + args),
+                        interval=options['interval'], samples=sampler.n_samples)
+            if options['output']:
+                with open(options['output'], 'w') as f:
+                    f.write(sampler.collapsed())
+                self.stderr.write("%d samples written to %s"%(sampler.n_samples, options['output']))
+            else:
+                profiler.save(name, sampler.collapsed(), meta)
+                self.stderr.write("%d samples saved as %s"%(sampler.n_samples, name))
@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from kdata import devices
+from kdata import ingest
+from kdata import models
+
+class Command(BaseCommand):
+    help = ('Quarantined data packets (see kdata/ingest.py).  Without options, '
+            'list the new ones by device and reason.  --scan checks data which is '
+            'already saved, and --move moves the invalid packets to the quarantine.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="Quarantined packet ids.")
+        parser.add_argument('--device', help="Only this device (public or secret id).")
+        parser.add_argument('--all', action='store_true',
+                            help="All new quarantined packets (of --device).")
+        parser.add_argument('--reprocess', action='store_true',
+                            help="Check again and save as data if valid.")
+        parser.add_argument('--force', action='store_true',
+                            help="With --reprocess: save without checking.")
+        parser.add_argument('--discard', action='store_true')
+        parser.add_argument('--scan', metavar='DEVICE_TYPE',
+                            help="Check saved data of this device type ('all' for all).")
+        parser.add_argument('--move', action='store_true',
+                            help="With --scan: move invalid packets to the quarantine.")
+
+    def handle(self, *args, **options):
+        device_id = None
+        if options['device']:
+            try:
+                device_id = models.Device.get_by_id(options['device'][:6]).device_id
+            except models.Device.DoesNotExist:
+                raise CommandError("Device not found: %s"%options['device'])
+
+        if options['scan']:
+            qs = models.Data.objects.all()
+            if device_id is not None:
+                qs = qs.filter(device_id=device_id)
+            elif options['scan'] != 'all':
+                type_ = devices.get_class(options['scan']).pyclass_name()
+                qs = qs.filter(device_id__in=models.Device.objects.filter(type=type_)
+                                                   .values('device_id'))
+            n = 0
+            for row_id, device_id_, reason in ingest.scan(qs, move=options['move']):
+                self.stdout.write("%s %s %s"%(row_id, device_id_, reason))
+                n += 1
+            self.stdout.write("%d invalid packets%s"%(n, ", moved" if options['move'] else ""))
+            return
+
+        qs = models.QuarantinedData.objects.filter(state='new')
+        if device_id is not None:
+            qs = qs.filter(device_id=device_id)
+        if options['reprocess'] or options['discard']:
+            if options['ids']:
+                qs = qs.filter(id__in=options['ids'])
+            elif not options['all']:
+                raise CommandError("Give the ids, or --all")
+            n_done = 0
+            for q in qs.order_by('id'):
+                if options['discard']:
+                    ingest.discard(q)
+                    n_done += 1
+                    continue
+                reason = ingest.reprocess(q, force=options['force'])
+                if reason is None:
+                    n_done += 1
+                else:
+                    self.stdout.write("%s: not saved: %s"%(q.id, reason))
+            self.stdout.write("%d packets %s"%(n_done, 'discarded' if options['discard']
+                                                       else 'saved as data'))
+            return
+
+        rows = (qs.values('device_id', 'device_type', 'reason')
+                  .annotate(n=Count('id')).order_by('device_id', '-n'))
+        for row in rows:
+            self.stdout.write("%(device_id)s %(device_type)s %(n)d: %(reason)s"%row)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata import jobs
+from kdata import models
+from kdata import rechunk
+
+class Command(BaseCommand):
+    help = ('Split saved data packets larger than --max-bytes (see kdata/rechunk.py).  '
+            'Without --live, only reports what would be split.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id', nargs='*', help="Devices (public or secret ids).")
+        parser.add_argument('--type', help="All devices of this device type.")
+        parser.add_argument('--max-bytes', type=int, default=rechunk.MAX_BYTES,
+                            help="Default %(default)s.")
+        parser.add_argument('--live', action='store_true', help="Really split.")
+        parser.add_argument('--start-id', type=int, default=0,
+                            help="Continue after this row id.")
+        parser.add_argument('--batch-size', type=int, default=rechunk.BATCH_SIZE)
+        parser.add_argument('--enqueue', action='store_true',
+                            help="Run as a background job instead (implies --live).")
+
+    def handle(self, *args, **options):
+        if not options['device_id'] and not options['type']:
+            raise CommandError("Give device ids or --type")
+        device_ids = [ ]
+        for id_ in options['device_id']:
+            try:
+                device_ids.append(models.Device.get_by_id(id_[:6]).device_id)
+            except models.Device.DoesNotExist:
+                raise CommandError("Device not found: %s"%id_)
+
+        if options['enqueue']:
+            job = jobs.enqueue('rechunk', dict(device_type=options['type'],
+                                               device_ids=device_ids,
+                                               max_bytes=options['max_bytes']))
+            self.stdout.write("Job %d: %s"%(job.id, job.type))
+            return
+
+        qs = rechunk.device_queryset(options['type'], device_ids)
+        n_rows = n_new = 0
+        for row_id, n in rechunk.rechunk_rows(qs, options['max_bytes'], live=options['live'],
+                                              start_id=options['start_id'],
+                                              batch_size=options['batch_size']):
+            if n:
+                self.stdout.write("%s: %d packets"%(row_id, n))
+                n_rows += 1
+                n_new += n
+        self.stdout.write("%d rows %s into %d"%(n_rows, 'split' if options['live']
+                                                      else 'would be split', n_new))
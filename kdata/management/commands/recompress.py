@@ -0,0 +1,145 @@
+from fnmatch import fnmatch
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Sum
+
+from kdata import codec
+from kdata import devices
+from kdata import jobs
+from kdata import models
+from kdata import rechunk
+
+class Command(BaseCommand):
+    help = ('Compress stored data packets (see kdata/codec.py).  --codec=none '
+            'decompresses.  --stats: storage by encoding.  --train-dict: train a zstd '
+            'dictionary for --type.  --bench: ratio and decode speed on synthetic data.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id', nargs='*', help="Devices (public or secret ids).")
+        parser.add_argument('--type', help="All devices of this device type.")
+        parser.add_argument('--codec', default='auto',
+                            help="zlib, zstd, auto or none (default %(default)s).")
+        parser.add_argument('--start-id', type=int, default=0,
+                            help="Continue after this row id.")
+        parser.add_argument('--batch-size', type=int, default=codec.BATCH_SIZE)
+        parser.add_argument('--enqueue', action='store_true',
+                            help="Run as a background job instead.")
+        parser.add_argument('--stats', action='store_true')
+        parser.add_argument('--train-dict', action='store_true',
+                            help="Train a zstd dictionary from the packets of --type.")
+        parser.add_argument('--samples', type=int, default=2000,
+                            help="--train-dict: packets to train from (default %(default)s).")
+        parser.add_argument('--bench', action='store_true')
+        parser.add_argument('--source', action='append',
+                            help="--bench: sources to use (glob patterns, default all).")
+        parser.add_argument('--scale', type=float, default=0.2,
+                            help="--bench: amount of data (default %(default)s).")
+
+    def handle(self, *args, **options):
+        if options['bench']:
+            self.bench(options['source'], options['scale'])
+            return
+        device_type = None
+        if options['type']:
+            device_type = devices.get_class(options['type']).pyclass_name()
+        device_ids = [ ]
+        for id_ in options['device_id']:
+            try:
+                device_ids.append(models.Device.get_by_id(id_[:6]).device_id)
+            except models.Device.DoesNotExist:
+                raise CommandError("Device not found: %s"%id_)
+        qs = rechunk.device_queryset(options['type'], device_ids)
+
+        if options['stats']:
+            for r in qs.values('encoding').annotate(n=Count('id'), length=Sum('data_length')) \
+                       .order_by('encoding'):
+                self.stdout.write("%-12s %10d rows %14s bytes"%(r['encoding'] or 'plain', r['n'],
+                                                               r['length']))
+            return
+        if options['train_dict']:
+            if not device_type:
+                raise CommandError("--train-dict needs --type")
+            try:
+                d = codec.train_dictionary(qs, device_type, n_samples=options['samples'])
+            except codec.CodecError as e:
+                raise CommandError(str(e))
+            self.stdout.write("Dictionary %d: %s, %d samples, %d bytes"%(
+                d.id, device_type, d.n_samples, len(d.data)))
+            return
+
+        if not options['device_id'] and not options['type']:
+            raise CommandError("Give device ids or --type")
+        try:
+            codec.resolve(options['codec'])
+        except codec.CodecError as e:
+            raise CommandError(str(e))
+        if options['enqueue']:
+            job = jobs.enqueue('recompress', dict(codec=options['codec'],
+                                                  device_type=options['type'],
+                                                  device_ids=device_ids,
+                                                  batch_size=options['batch_size']))
+            self.stdout.write("Job %d: %s"%(job.id, job.type))
+            return
+        n_rows = before = after = 0
+        for last_id, n, b, a in codec.recompress_rows(qs, options['codec'],
+                                                      start_id=options['start_id'],
+                                                      batch_size=options['batch_size'],
+                                                      device_type=device_type):
+            n_rows += n
+            before += b
+            after += a
+            self.stdout.write("%s: %d rows, %d -> %d bytes"%(last_id, n, b, a))
+        self.stdout.write("%d rows, %d -> %d bytes"%(n_rows, before, after))
+
+    def bench(self, patterns, scale):
+        from kdata.bench import runner
+        codecs = codec.available()
+        if 'zstd' in codecs:
+            codecs.append('zstd+dict')
+        self.stdout.write('%-32s %-10s %8s %12s %12s %7s %9s'%(
+            'source', 'codec', 'packets', 'bytes', 'compressed', 'ratio', 'dec MB/s'))
+        for name, source in runner.get_sources().items():
+            if patterns and not any(fnmatch(name, p) for p in patterns):
+                continue
+            texts = [ data if isinstance(data, str) else data.decode('utf-8')
+                      for ts, data in source(scale) ]
+            if not texts:
+                continue
+            for codec_ in codecs:
+                if codec_ == 'zstd+dict':
+                    # Trained on half of the packets, measured on the others.
+                    size, z, mbs = self._bench_dict(texts[::2], texts[1::2])
+                else:
+                    size, z, mbs = self._bench_codec(texts, codec_)
+                if z is None:
+                    continue
+                self.stdout.write('%-32s %-10s %8d %12d %12d %7.1f %9.0f'%(
+                    name, codec_, len(texts), size, z, size/z, mbs))
+
+    def _bench_codec(self, texts, codec_):
+        blobs = [ codec.compress(t, codec_) for t in texts ]
+        t0 = time.perf_counter()
+        for data_z, encoding in blobs:
+            codec.decode(data_z, encoding)
+        dt = time.perf_counter() - t0
+        size = sum(len(t) for t in texts)
+        return size, sum(len(z) for z, e in blobs), size / 2**20 / max(dt, 1e-9)
+
+    def _bench_dict(self, train, texts):
+        import zstandard
+        if len(train) < 10 or not texts:
+            return 0, None, None
+        try:
+            d = zstandard.train_dictionary(codec.DICT_SIZE, [ t.encode('utf-8') for t in train ])
+        except zstandard.ZstdError:
+            return 0, None, None
+        c = zstandard.ZstdCompressor(level=codec.ZSTD_LEVEL, dict_data=d)
+        blobs = [ c.compress(t.encode('utf-8')) for t in texts ]
+        dec = zstandard.ZstdDecompressor(dict_data=d)
+        t0 = time.perf_counter()
+        for blob in blobs:
+            dec.decompress(blob).decode('utf-8')
+        dt = time.perf_counter() - t0
+        size = sum(len(t) for t in texts)
+        return size, sum(len(b) for b in blobs), size / 2**20 / max(dt, 1e-9)
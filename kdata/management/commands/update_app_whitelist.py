@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from kdata import app_whitelist
+
+class Command(BaseCommand):
+    """Refresh the local app whitelist used by safe converters.
+
+    Downloads the list (default: settings.APP_WHITELIST_URL) and
+    replaces kdata/data/app_whitelist.txt with it, stamped with a new
+    version.  Running servers pick it up on the next conversion.
+    """
+    help = 'Download and store a new app whitelist'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=app_whitelist.DEFAULT_URL)
+        parser.add_argument('--path', default=app_whitelist.DEFAULT_PATH)
+
+    def handle(self, *args, **options):
+        old = app_whitelist.parse(open(options['path'], encoding='utf-8').read())
+        try:
+            new = app_whitelist.refresh(url=options['url'], path=options['path'])
+        except Exception as e:
+            raise CommandError("Could not refresh app whitelist: %s"%e)
+        print("App whitelist %s (%d entries) -> %s (%d entries)"%(
+            old.version, len(old), new.version, len(new)))
@@ -0,0 +1,42 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from kdata import jobs
+
+class Command(BaseCommand):
+    help = ('Run jobs from the job queue (see kdata/jobs.py).  Any number of these '
+            'can run, on any host using the same database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', '-j', type=int, default=1,
+                            help="Number of worker processes (default %(default)s).")
+        parser.add_argument('--type', '-t', action='append', dest='types',
+                            help="Only run jobs of this type (can be repeated).")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit when there are no more runnable jobs.")
+        parser.add_argument('--poll', type=float, default=5,
+                            help="Seconds between checks for new jobs (default %(default)s).")
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1:
+            raise CommandError("Need at least one process")
+        jobs.load_types()
+        kwargs = dict(types=options['types'], once=options['once'], poll=options['poll'])
+        if options['processes'] == 1:
+            jobs.work(**kwargs)
+            return
+        # Children must not share the parent's database connection.
+        connections.close_all()
+        ctx = multiprocessing.get_context('fork')
+        procs = [ctx.Process(target=jobs.work, kwargs=kwargs, name='koota-worker-%d'%i)
+                 for i in range(options['processes'])]
+        for p in procs:
+            p.start()
+        try:
+            for p in procs:
+                p.join()
+        except KeyboardInterrupt:
+            for p in procs:
+                p.terminate()
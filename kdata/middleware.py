@@ -1,6 +1,7 @@
 import urllib
 
 from django.contrib import messages
+from django.core.exceptions import MiddlewareNotUsed
 from django.http import HttpResponseRedirect
 from django.template.response import TemplateResponse
 from django.urls import reverse
@@ -10,6 +11,8 @@ from . import views as kviews
 from . import models
 from . import group
 from . import exceptions
+from . import profiler
+from . import timing
 
 import logging
 log = logging.getLogger(__name__)
@@ -105,3 +108,46 @@ class KdataMiddleware(object):
             response.reason_phrase = exception.message
             return response
 
+
+
+
+class TimingMiddleware(object):
+    """Time the phases of each request, see timing.py.
+
+    Only active if settings.KOOTA_TIMING is true.  This should be the
+    first middleware, so that the total includes the others.
+    """
+    def __init__(self, get_response=None):
+        if not timing.ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+    def __call__(self, request):
+        timer = timing.Timer()
+        previous = timing.activate(timer)
+        try:
+            response = self.get_response(request)
+        finally:
+            timing.activate(previous)
+        timer.endpoint = timing.endpoint_name(request)
+        if response.streaming:
+            # Only the phases before the body can go in the header.
+            response['Server-Timing'] = timer.server_timing()
+            response.streaming_content = timing.timed_stream(
+                timer, response.streaming_content, path=request.path)
+        else:
+            timer.finish()
+            response['Server-Timing'] = timer.server_timing()
+            timing.record(timer)
+        return response
+
+
+
+class ProfilerMiddleware(object):
+    """Sample requests while a profiler session runs, see profiler.py."""
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+    def __call__(self, request):
+        session = profiler._active
+        if session is None:
+            return self.get_response(request)
+        return profiler.profile_request(session, request, self.get_response)
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:31
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('kdata', '0032_attr_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ts_create', models.DateTimeField(auto_now_add=True)),
+                ('ts_start', models.DateTimeField(blank=True, null=True)),
+                ('ts_finish', models.DateTimeField(blank=True, null=True)),
+                ('state', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed'), ('cancelled', 'cancelled')], db_index=True, default='queued', max_length=16)),
+                ('gs_id', models.IntegerField(blank=True, null=True)),
+                ('converter', models.CharField(max_length=128)),
+                ('format', models.CharField(max_length=32)),
+                ('ts_data_start', models.DateTimeField(blank=True, null=True)),
+                ('ts_data_end', models.DateTimeField(blank=True, null=True)),
+                ('lease_owner', models.CharField(blank=True, max_length=128)),
+                ('lease_expires', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('n_units', models.IntegerField(blank=True, null=True)),
+                ('n_units_done', models.IntegerField(default=0)),
+                ('n_rows', models.BigIntegerField(default=0)),
+                ('result_size', models.BigIntegerField(blank=True, null=True)),
+                ('checkpoint', models.TextField(blank=True, help_text='JSON state to resume from')),
+                ('error', models.TextField(blank=True)),
+                ('device', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='kdata.Device')),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='kdata.Group')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
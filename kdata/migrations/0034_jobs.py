@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0033_export_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(db_index=True, max_length=128)),
+                ('args', models.TextField(blank=True, help_text='JSON arguments')),
+                ('priority', models.IntegerField(default=0, help_text='Higher runs first')),
+                ('state', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed'), ('cancelled', 'cancelled')], db_index=True, default='queued', max_length=16)),
+                ('ts_create', models.DateTimeField(auto_now_add=True)),
+                ('run_after', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('ts_start', models.DateTimeField(blank=True, null=True)),
+                ('ts_finish', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField(default=3)),
+                ('lease_owner', models.CharField(blank=True, max_length=128)),
+                ('lease_expires', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('heartbeat', models.DateTimeField(blank=True, null=True)),
+                ('checkpoint', models.TextField(blank=True, help_text='JSON state to resume from')),
+                ('error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='attempts',
+        ),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='lease_expires',
+        ),
+        migrations.RemoveField(
+            model_name='exportjob',
+            name='lease_owner',
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='kdata.Job'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0034_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuarantinedData',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.CharField(db_index=True, max_length=64)),
+                ('device_type', models.CharField(blank=True, max_length=128)),
+                ('ts_received', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('ts', models.DateTimeField(blank=True, null=True)),
+                ('ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('data_length', models.IntegerField(blank=True, null=True)),
+                ('data', models.TextField(blank=True)),
+                ('sha256', models.CharField(db_index=True, max_length=64)),
+                ('reason', models.CharField(max_length=256)),
+                ('state', models.CharField(choices=[('new', 'new'), ('reprocessed', 'reprocessed'), ('discarded', 'discarded')], db_index=True, default='new', max_length=16)),
+                ('ts_processed', models.DateTimeField(blank=True, null=True)),
+                ('data_id', models.IntegerField(blank=True, null=True)),
+            ],
+        ),
+    ]
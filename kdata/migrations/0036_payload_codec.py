@@ -0,0 +1,40 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:12
+
+from django.db import migrations, models
+import kdata.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kdata', '0035_quarantine'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='data',
+            name='data',
+            field=kdata.models.PayloadField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='encoding',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='data',
+            name='data_z',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='PayloadDictionary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_type', models.CharField(db_index=True, max_length=128)),
+                ('codec', models.CharField(default='zstd', max_length=16)),
+                ('ts_created', models.DateTimeField(auto_now_add=True)),
+                ('n_samples', models.IntegerField(default=0)),
+                ('data', models.BinaryField()),
+            ],
+        ),
+    ]
@@ -6,6 +6,7 @@ import hashlib
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.db import models
+from django.db.models.query_utils import DeferredAttribute
 from django.urls import reverse
 from django.utils import timezone
 
@@ -18,6 +19,50 @@ from . import backend
 import logging
 logger = logging.getLogger(__name__)
 
+class PayloadAttribute(DeferredAttribute):
+    """Data.data of compressed rows is decoded from data_z when used.
+
+    Rows with an encoding (see kdata/codec.py) have data='' and the
+    compressed payload in data_z.  The decoded text is kept on the
+    instance, but not in data, so saving the row does not store it
+    twice.  Assigning data makes the row plain again.  If data is
+    deferred, it is loaded in one query with encoding and data_z (if
+    they are deferred too).
+    """
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        if self.field.attname not in instance.__dict__:
+            # Not refresh_from_db(), which would copy the decoded text
+            # into data (making the row plain).
+            fields = [ name for name in (self.field.attname, 'encoding', 'data_z')
+                       if name not in instance.__dict__ ]
+            instance.__dict__.update(
+                type(instance)._base_manager.db_manager(instance._state.db)
+                .filter(pk=instance.pk).values(*fields).get())
+        value = super().__get__(instance, cls)
+        if value == '' and instance.encoding:
+            decoded = instance.__dict__.get('_data_decoded')
+            if decoded is None:
+                from . import codec
+                decoded = instance.__dict__['_data_decoded'] \
+                        = codec.decode(instance.data_z, instance.encoding)
+            return decoded
+        return value
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+        instance.__dict__.pop('_data_decoded', None)
+        if value != '' and instance.__dict__.get('encoding'):
+            instance.encoding = ''
+            instance.data_z = None
+
+class PayloadField(models.TextField):
+    """TextField, which may be stored compressed (see PayloadAttribute)."""
+    descriptor_class = PayloadAttribute
+    def pre_save(self, model_instance, add):
+        # What is stored, not the decoded data.
+        return model_instance.__dict__.get(self.attname, '')
+
 class Data(models.Model):
     class Meta:
         index_together = [
@@ -33,7 +78,10 @@ class Data(models.Model):
                                        help_text="Time packet received (never updated)")
     ip = models.GenericIPAddressField()
     data_length = models.IntegerField(blank=True, null=True)
-    data = models.TextField(blank=True)
+    data = PayloadField(blank=True)
+    # Compressed payload, see kdata/codec.py.  encoding='' means plain.
+    encoding = models.CharField(max_length=32, blank=True, default='')
+    data_z = models.BinaryField(blank=True, null=True)
 
 
 
@@ -604,5 +652,99 @@ class Token(models.Model):
 
 
 
+# Job queue (kdata/jobs.py)
+class Job(models.Model):
+    STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+    type         = models.CharField(max_length=128, db_index=True)
+    args         = models.TextField(blank=True, help_text="JSON arguments")
+    priority     = models.IntegerField(default=0, help_text="Higher runs first")
+    state        = models.CharField(max_length=16, default='queued', db_index=True,
+                                    choices=[(x, x) for x in STATES])
+    ts_create    = models.DateTimeField(auto_now_add=True)
+    run_after    = models.DateTimeField(default=timezone.now, db_index=True)
+    ts_start     = models.DateTimeField(null=True, blank=True)
+    ts_finish    = models.DateTimeField(null=True, blank=True)
+    attempts     = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    # Lease of the worker running this, renewed by its heartbeats.
+    lease_owner  = models.CharField(max_length=128, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True, db_index=True)
+    heartbeat    = models.DateTimeField(null=True, blank=True)
+    checkpoint   = models.TextField(blank=True, help_text="JSON state to resume from")
+    error        = models.TextField(blank=True)
+    def __str__(self):
+        return 'Job(%s, %s, %s)'%(self.id, self.type, self.state)
+
+
+# Background exports (kdata/export.py)
+class ExportJob(models.Model):
+    STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+    user         = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    ts_create    = models.DateTimeField(auto_now_add=True)
+    ts_start     = models.DateTimeField(null=True, blank=True)
+    ts_finish    = models.DateTimeField(null=True, blank=True)
+    state        = models.CharField(max_length=16, default='queued', db_index=True,
+                                    choices=[(x, x) for x in STATES])
+    # What: either one device, or a group (optionally only one subject).
+    device       = models.ForeignKey(Device, on_delete=models.CASCADE, null=True, blank=True)
+    group        = models.ForeignKey(Group, on_delete=models.CASCADE, null=True, blank=True)
+    gs_id        = models.IntegerField(null=True, blank=True)
+    converter    = models.CharField(max_length=128)
+    format       = models.CharField(max_length=32)
+    ts_data_start = models.DateTimeField(null=True, blank=True)
+    ts_data_end  = models.DateTimeField(null=True, blank=True)
+    # The queue entry which runs this.
+    job          = models.ForeignKey(Job, on_delete=models.SET_NULL, null=True, blank=True)
+    # Progress, in (subject, device) units.
+    n_units      = models.IntegerField(null=True, blank=True)
+    n_units_done = models.IntegerField(default=0)
+    n_rows       = models.BigIntegerField(default=0)
+    result_size  = models.BigIntegerField(null=True, blank=True)
+    checkpoint   = models.TextField(blank=True, help_text="JSON state to resume from")
+    error        = models.TextField(blank=True)
+    def __str__(self):
+        return 'ExportJob(%s, %s, %s.%s)'%(self.id, self.state, self.converter, self.format)
+    def get_absolute_url(self):
+        return reverse('export-detail', kwargs=dict(id=self.id))
+    @property
+    def percent_done(self):
+        if not self.n_units:
+            return 100 if self.state == 'done' else 0
+        return int(100 * self.n_units_done / self.n_units)
+
+
+# Packets which failed the ingest checks (kdata/ingest.py)
+class QuarantinedData(models.Model):
+    STATES = ('new', 'reprocessed', 'discarded')
+    device_id    = models.CharField(max_length=64, db_index=True)
+    device_type  = models.CharField(max_length=128, blank=True)
+    ts_received  = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Data timestamp, if it came from models.Data (else ts_received)
+    ts           = models.DateTimeField(null=True, blank=True)
+    ip           = models.GenericIPAddressField(null=True, blank=True)
+    data_length  = models.IntegerField(blank=True, null=True)
+    data         = models.TextField(blank=True)
+    sha256       = models.CharField(max_length=64, db_index=True)
+    reason       = models.CharField(max_length=256)
+    state        = models.CharField(max_length=16, default='new', db_index=True,
+                                    choices=[(x, x) for x in STATES])
+    ts_processed = models.DateTimeField(null=True, blank=True)
+    # models.Data row: where it was moved from, or where it went when reprocessed
+    data_id      = models.IntegerField(null=True, blank=True)
+    def __str__(self):
+        return 'QuarantinedData(%s, %s, %s)'%(self.id, self.device_id, self.reason)
+
+
+class PayloadDictionary(models.Model):
+    """Trained zstd dictionary for compressing the data of one device type."""
+    device_type  = models.CharField(max_length=128, db_index=True)
+    codec        = models.CharField(max_length=16, default='zstd')
+    ts_created   = models.DateTimeField(auto_now_add=True)
+    n_samples    = models.IntegerField(default=0)
+    data         = models.BinaryField()
+    def __str__(self):
+        return 'PayloadDictionary(%s, %s)'%(self.id, self.device_type)
+
+
 # These at bottom to avoid circular import problems
 from . import group
@@ -0,0 +1,149 @@
+"""Fast decoding of Murata bed sensor (BSN) XML packets.
+
+The sensors push one small XML document every few seconds, so the
+cost of decoding is mostly per-packet overhead: ast.literal_eval of the
+stored bytes repr, a full ElementTree parse, and dateutil.  The BSN
+layout is fixed: all we need is
+
+    doc[0].attrib['id']              network id
+    doc[0][0].attrib['id']           node (device) id
+    doc[0][0][0][0].attrib['time']   start time of the record
+    doc[0][0][0][0][9].text          CSV rows of 10 integers
+
+extract() finds exactly these with one precompiled regex scan over the
+tags, without building a tree.  Anything it does not understand
+(DOCTYPE, CDATA, entities in attributes, a different shape...) makes
+it return None, and callers fall back to the full XML parse, so it can
+never silently return something different.
+
+Like converter.py, this module does not depend on django.
+"""
+
+import codecs
+from calendar import timegm
+import csv
+from datetime import datetime
+from functools import lru_cache
+import re
+
+_tag_re = re.compile(r'<(/?)([^\s/>!?]+)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/?)>|<(\?[^>]*\?|!--.*?--)>|<',
+                     re.S)
+_attr_re = re.compile(r'([^\s=/>]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_time_re = re.compile(r'\s*(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.\d+)?'
+                      r'(?:Z|[+-]\d{2}:?\d{2})?\s*$')
+
+
+def decode_stored(data):
+    """Turn a stored packet (maybe a "b'...'" bytes repr) into str.
+
+    Same result as ast.literal_eval(data).decode(), but using the
+    bytes escape decoder directly instead of the Python parser.
+    """
+    if data.startswith("b'") and data.endswith("'"):
+        return codecs.escape_decode(data[2:-1].encode('utf-8'))[0].decode()
+    return data
+
+
+def _attrs(text):
+    attrs = { }
+    for name, v1, v2 in _attr_re.findall(text):
+        attrs[name] = v1 if v1 or not v2 else v2
+    return attrs
+
+
+def extract(text):
+    """Extract (network_id, device_id, start_time, values_text) from a packet.
+
+    Returns None if the document does not have the expected layout or
+    uses any XML feature this scanner does not handle.
+    """
+    # path: child index at each depth of the currently open elements.
+    path = [ ]
+    counts = [0]    # number of children seen at each open depth
+    network_id = device_id = start_time = values = None
+    pos = 0
+    in_values = False
+    for m in _tag_re.finditer(text):
+        if m.group(5) is not None:      # <?xml ... ?> or comment
+            if in_values or m.group(5).startswith('!'):
+                return None
+            continue
+        if m.group(2) is None:          # a bare '<' we do not understand
+            return None
+        if in_values:
+            # Text of doc[0][0][0][0][9] ends at the next tag.
+            values = text[pos:m.start()]
+            in_values = False
+        closing, attrs_text, selfclosing = m.group(1), m.group(3), m.group(4)
+        if closing:
+            if not path:
+                return None
+            path.pop()
+            counts.pop()
+            continue
+        index = counts[-1]
+        if not path and index > 0:      # more than one root element
+            return None
+        counts[-1] += 1
+        path.append(index)
+        counts.append(0)
+        if path == [0, 0]:
+            network_id = _attrs(attrs_text).get('id')
+        elif path == [0, 0, 0]:
+            device_id = _attrs(attrs_text).get('id')
+        elif path == [0, 0, 0, 0, 0]:
+            start_time = _attrs(attrs_text).get('time')
+        elif path == [0, 0, 0, 0, 0, 9]:
+            if selfclosing:
+                values = ''
+            else:
+                in_values = True
+                pos = m.end()
+        if selfclosing:
+            path.pop()
+            counts.pop()
+    if path or network_id is None or device_id is None or start_time is None or values is None:
+        return None
+    if '&' in network_id + device_id + start_time + values:
+        return None
+    return network_id, device_id, start_time, values
+
+
+@lru_cache(maxsize=1024)
+def parse_time(s):
+    """Unix time of a BSN timestamp, as timegm(dateutil.parse(s).timetuple()).
+
+    The wall-clock fields are used as-is (any UTC offset is ignored,
+    as the original converter did).  The usual YYYY-MM-DDTHH:MM:SS
+    format is parsed directly, anything else goes to dateutil.
+    """
+    m = _time_re.match(s)
+    if m is not None:
+        # datetime() to reject invalid dates, as dateutil would.
+        return timegm(datetime(*(int(x) for x in m.groups())).timetuple())
+    from dateutil import parser as date_parser
+    return timegm(date_parser.parse(s).timetuple())
+
+
+def parse_values(values):
+    """Parse the CSV rows of a record into lists of strings."""
+    if '"' in values or '\r' in values:
+        return [row for row in csv.reader(values.split('\n')) if row]
+    return [line.split(',') for line in values.split('\n') if line]
+
+
+def iter_packet_rows(extracted):
+    """Yield (offset_i, last_time_i, start_unixtime, values) for one packet.
+
+    values is the tuple of 9 ints (or '' for empty fields).  Rows
+    which do not have 10 columns are skipped, like in the converter.
+    """
+    network_id, device_id, start_time, values = extracted
+    ts = parse_time(start_time)
+    rows = parse_values(values)
+    last_time_i = int(rows[-1][0])
+    for row in rows:
+        if len(row) != 10 or not row[0]:
+            continue
+        yield int(row[0]), last_time_i, ts, tuple(int(x) if x else '' for x in row[1:])
+
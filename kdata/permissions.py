@@ -8,6 +8,10 @@ from . import exceptions
 from . import models
 
 
+def has_admin_permission(request):
+    """Site admin pages: superusers who have logged in with 2FA."""
+    return request.user.is_superuser and request.user.is_verified()
+
 def has_device_permission(request, device):
     """Test for user having permissions to access device.
     """
@@ -0,0 +1,313 @@
+"""On-demand statistical profiler.
+
+A Sampler is a background thread which, every `interval` seconds,
+looks at the current stack of the threads registered with it
+(sys._current_frames()) and counts each stack.  The result is in
+collapsed-stack format, one line per stack:
+
+    koota_prj/wsgi.py:application;kdata/views.py:post;... 12
+
+which flamegraph.pl, speedscope and similar tools read directly.
+This is pure Python and runs beside the profiled code, so the cost is
+one stack walk per sample and nothing is traced.
+
+Requests are profiled by a Session (at most one per process), started
+from the admin view views_admin.profiler.  A session runs for a number
+of seconds and/or a number of requests, optionally only for requests
+whose path or view name matches a regex.  ProfilerMiddleware registers
+the request threads with the session; when no session is active it
+only checks one module global.  Finished sessions are written to
+PROFILE_DIR, so they can be downloaded from any worker process, but
+sessions are started in the worker process which got the request to
+start it.
+
+Management commands are profiled with "manage.py profile COMMAND ...".
+"""
+
+from collections import Counter, OrderedDict
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = getattr(settings, 'PROFILE_DIR',
+                      os.path.join(tempfile.gettempdir(), 'koota-profiles'))
+DEFAULT_INTERVAL = 0.005
+MAX_SECONDS = 3600
+# Sessions are named like this, and only such files are served.
+NAME_RE = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9a-f]{6}$')
+
+_lock = threading.Lock()
+_active = None
+
+
+
+#
+# Sampling
+#
+_base_dir = getattr(settings, 'BASE_DIR', None)
+def _label(code, _cache={ }):
+    """file:function for one code object, shortened and cached."""
+    label = _cache.get(code)
+    if label is None:
+        filename = code.co_filename
+        if _base_dir and filename.startswith(_base_dir + os.sep):
+            filename = filename[len(_base_dir)+1:]
+        else:
+            filename = '/'.join(filename.rsplit(os.sep, 2)[-2:])
+        label = _cache[code] = ('%s:%s'%(filename, code.co_name)).replace(';', ':').replace(' ', '_')
+    return label
+
+def collapse(frame):
+    """Collapsed-stack string of a frame: outermost first, ';' separated."""
+    stack = [ ]
+    while frame is not None:
+        stack.append(_label(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return ';'.join(stack)
+
+
+class Sampler(object):
+    """Sample the stacks of some threads at regular intervals."""
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self.n_samples = 0
+        self._idents = { }      # thread ident -> number of registrations
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.on_tick = None     # called from the sampling thread
+    def add_thread(self, ident=None):
+        ident = threading.get_ident() if ident is None else ident
+        with self._lock:
+            self._idents[ident] = self._idents.get(ident, 0) + 1
+    def remove_thread(self, ident=None):
+        ident = threading.get_ident() if ident is None else ident
+        with self._lock:
+            n = self._idents.get(ident, 0) - 1
+            if n > 0:
+                self._idents[ident] = n
+            else:
+                self._idents.pop(ident, None)
+    def n_threads(self):
+        with self._lock:
+            return len(self._idents)
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='koota-profiler', daemon=True)
+        self._thread.start()
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+    def sample(self):
+        """Take one sample of all registered threads."""
+        with self._lock:
+            idents = list(self._idents)
+        if not idents:
+            return
+        frames = sys._current_frames()
+        for ident in idents:
+            frame = frames.get(ident)
+            if frame is not None:
+                self.counts[collapse(frame)] += 1
+                self.n_samples += 1
+        del frames
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if self.on_tick is not None:
+                self.on_tick()
+    def collapsed(self):
+        """The samples, as collapsed-stack text."""
+        return ''.join('%s %d\n'%(stack, n) for stack, n in sorted(self.counts.items()))
+
+
+
+#
+# Request profiling sessions
+#
+class Session(object):
+    """Profile requests for some time and/or number of requests.
+
+    pattern: regex searched in request.path, view: regex matched to
+    the resolved view name.  If neither is given, all requests are
+    profiled.
+    """
+    def __init__(self, seconds=None, n_requests=None, pattern=None, view=None,
+                 interval=DEFAULT_INTERVAL, user=None):
+        if not seconds and not n_requests:
+            raise ValueError("Give seconds or a number of requests")
+        if interval < 0.001:
+            raise ValueError("Interval too small")
+        self.name = new_name()
+        seconds = min(seconds or MAX_SECONDS, MAX_SECONDS)
+        self.deadline = time.time() + seconds
+        self.requests_left = n_requests
+        self.n_requests = 0
+        self.in_flight = 0
+        self.pattern = re.compile(pattern) if pattern else None
+        self.view = re.compile(view) if view else None
+        self.meta = OrderedDict([('name', self.name), ('started', time.time()),
+                                 ('seconds', seconds), ('n_requests', n_requests),
+                                 ('pattern', pattern), ('view', view),
+                                 ('interval', interval), ('user', user)])
+        self.sampler = Sampler(interval=interval)
+        self.sampler.on_tick = self._tick
+        self._lock = threading.Lock()
+        self.done = False
+
+    def matches(self, request):
+        if self.pattern is not None and not self.pattern.search(request.path):
+            return False
+        if self.view is not None:
+            from django.urls import resolve, Resolver404
+            try:
+                view_name = resolve(request.path_info).view_name
+            except Resolver404:
+                return False
+            if not self.view.search(view_name):
+                return False
+        return True
+
+    def claim(self):
+        """Count one request, False if this session is already full."""
+        with self._lock:
+            if self.done or time.time() > self.deadline:
+                return False
+            if self.requests_left is not None:
+                if self.requests_left <= 0:
+                    return False
+                self.requests_left -= 1
+            self.n_requests += 1
+            self.in_flight += 1
+            return True
+
+    def request_done(self):
+        """A profiled request ended."""
+        with self._lock:
+            self.in_flight -= 1
+            last = self.requests_left == 0 and self.in_flight == 0
+        if last:
+            finish(self)
+
+    def _tick(self):
+        if time.time() > self.deadline:
+            finish(self)
+
+
+def new_name():
+    """Name for a new set of results: time and random part."""
+    return '%s-%s'%(time.strftime('%Y%m%d-%H%M%S'), os.urandom(3).hex())
+
+def active():
+    """The running session of this process, or None."""
+    return _active
+
+def start(**kwargs):
+    """Start a request profiling Session (see its arguments)."""
+    global _active
+    with _lock:
+        if _active is not None:
+            raise ValueError("A profiling session is already running")
+        session = Session(**kwargs)
+        session.sampler.start()
+        _active = session
+    logger.info("profiler session %s started: %s", session.name, session.meta)
+    return session
+
+def finish(session=None):
+    """Stop a session (default: the active one) and save its results."""
+    global _active
+    with _lock:
+        if session is None:
+            session = _active
+        if session is None or session.done:
+            return None
+        session.done = True
+        if _active is session:
+            _active = None
+    session.sampler.stop()
+    session.meta['finished'] = time.time()
+    session.meta['requests_profiled'] = session.n_requests
+    session.meta['samples'] = session.sampler.n_samples
+    save(session.name, session.sampler.collapsed(), session.meta)
+    logger.info("profiler session %s finished: %d requests, %d samples", session.name,
+                session.n_requests, session.sampler.n_samples)
+    return session
+
+def profile_request(session, request, get_response):
+    """Run get_response, sampling this thread if session wants it."""
+    if not session.matches(request) or not session.claim():
+        return get_response(request)
+    session.sampler.add_thread()
+    try:
+        response = get_response(request)
+    finally:
+        session.sampler.remove_thread()
+    if response.streaming:
+        response.streaming_content = _profiled_stream(session, response.streaming_content)
+    else:
+        session.request_done()
+    return response
+
+def _profiled_stream(session, chunks):
+    """Sample whichever thread produces the chunks, while it does so."""
+    chunks = iter(chunks)
+    try:
+        while True:
+            session.sampler.add_thread()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                session.sampler.remove_thread()
+            yield chunk
+    finally:
+        session.request_done()
+
+
+
+#
+# Results
+#
+def save(name, collapsed, meta):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, name+'.txt'), 'w') as f:
+        f.write(collapsed)
+    with open(os.path.join(PROFILE_DIR, name+'.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+def list_results():
+    """Metadata of all saved sessions, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return [ ]
+    results = [ ]
+    for fname in os.listdir(PROFILE_DIR):
+        name, ext = os.path.splitext(fname)
+        if ext != '.json' or not NAME_RE.match(name):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, fname)) as f:
+                results.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    results.sort(key=lambda meta: meta.get('started', 0), reverse=True)
+    return results
+
+def result_path(name):
+    """Path of the collapsed stacks of a session, or None."""
+    if not NAME_RE.match(name):
+        return None
+    path = os.path.join(PROFILE_DIR, name+'.txt')
+    return path if os.path.exists(path) else None
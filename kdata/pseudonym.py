@@ -0,0 +1,67 @@
+"""Memoized pseudonymization of identifiers.
+
+Safe converters hash every BSSID, SSID, phone number, app name, etc.
+in every row, but the number of distinct values is tiny compared with
+the number of rows.  So hashes are memoized in a bounded LRU keyed on
+(scheme, salt, value).  Converters hash whole columns at once with
+hash_column() (through _Converter.hash_column and util.hash_column).
+
+Schemes:
+  legacy:  urlsafe_b64(sha256(salt+value)[:9]).  The original
+           util.safe_hash / converter._safe_hash output, byte for byte.
+  blake2:  urlsafe_b64(blake2b(value, key=salt, digest_size=9)).  Keyed
+           hashing, faster, but gives different pseudonyms than legacy,
+           so only use it for new groups/exports.
+
+Like converter.py, this module does not depend on django.
+"""
+
+from base64 import urlsafe_b64encode
+from functools import lru_cache
+from hashlib import blake2b, sha256
+
+SCHEMES = ('legacy', 'blake2')
+CACHE_SIZE = 2**16
+
+def _to_bytes(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf8')
+    return data
+
+def _legacy(salt, data):
+    return urlsafe_b64encode(sha256(salt+data).digest()[:9]).decode('ascii')
+
+def _blake2(salt, data):
+    # blake2b keys are at most 64 bytes.
+    if len(salt) > 64:
+        salt = sha256(salt).digest()
+    return urlsafe_b64encode(blake2b(data, key=salt, digest_size=9).digest()).decode('ascii')
+
+_schemes = {'legacy': _legacy, 'blake2': _blake2}
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _hash(scheme, salt, data):
+    return _schemes[scheme](_to_bytes(salt), _to_bytes(data))
+
+def hash_value(salt, data, scheme='legacy'):
+    """Pseudonym of one value (memoized)."""
+    return _hash(scheme, salt, data)
+
+def hash_column(salt, values, scheme='legacy', skip_empty=False):
+    """Pseudonyms of a whole column of values, as a list.
+
+    If skip_empty, falsy values (None, '') are passed through unhashed,
+    as most converters do.
+    """
+    if scheme not in _schemes:
+        raise ValueError("Unknown pseudonym scheme: %s"%scheme)
+    h = _hash
+    if skip_empty:
+        return [h(scheme, salt, v) if v else v for v in values]
+    return [h(scheme, salt, v) for v in values]
+
+def cache_info():
+    return _hash.cache_info()
+
+def cache_clear():
+    _hash.cache_clear()
@@ -0,0 +1,190 @@
+"""Rate limiting of data ingest (posts from devices).
+
+Each ingest request takes a token from a bucket of its device and of
+its remote IP.  Over budget, the request gets a 429 response with
+Retry-After, before the body is read or anything is saved, so that a
+device in a retry loop or resyncing a long backlog does not take all
+workers and database connections from the others.
+
+The buckets are GCRA ("theoretical arrival time") token buckets: one
+integer per key in the Django cache (INGEST_RATE_CACHE), updated with
+cache.incr, so all processes share them if the cache is shared
+(memcached, redis, database).  The default local-memory cache limits
+each process separately.  Fast path: a process takes INGEST_RATE_BATCH
+tokens at once and uses them for up to LEASE seconds without asking
+the cache, and once a key is denied it is denied locally until the
+Retry-After has passed.
+
+Settings: INGEST_RATE_LIMITS = dict(device=(rate, burst), ip=(rate,
+burst)) in requests per second and requests at once,
+INGEST_RATE_EXEMPT: device classes which are never limited,
+INGEST_RATE_LIMIT_ENABLED.
+"""
+
+from collections import Counter
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+
+import logging
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'INGEST_RATE_LIMIT_ENABLED', True)
+LIMITS = getattr(settings, 'INGEST_RATE_LIMITS', dict(device=(2.0, 600), ip=(20.0, 2000)))
+EXEMPT = set(getattr(settings, 'INGEST_RATE_EXEMPT', ()))
+CACHE = getattr(settings, 'INGEST_RATE_CACHE', 'default')
+BATCH = getattr(settings, 'INGEST_RATE_BATCH', 5)
+LEASE = 1.0          # seconds
+MAX_KEYS = 10000     # local fast path state
+TOP_DENIED = 10      # keys shown in stats
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class Limiter(object):
+    """Token buckets of one kind of key (e.g. device or ip)."""
+    def __init__(self, name, rate, burst, batch=BATCH):
+        self.name = name
+        self.interval = max(1, int(1000 / rate))   # ms per token
+        self.tolerance = burst * self.interval     # ms
+        self.batch = max(1, min(batch, burst))
+        self.counters = Counter()
+        self.denied_keys = Counter()
+        self._local = { }    # key -> [tokens, tokens expire, denied until]
+        self._lock = threading.Lock()
+
+    def check(self, key):
+        """Take one token for key.  Returns 0, or seconds to wait."""
+        now = _now_ms()
+        with self._lock:
+            local = self._local.get(key)
+            if local is not None:
+                if local[0] > 0 and now < local[1]:
+                    local[0] -= 1
+                    self.counters['allowed'] += 1
+                    self.counters['fast'] += 1
+                    return 0
+                if now < local[2]:
+                    self.counters['denied'] += 1
+                    self.counters['fast'] += 1
+                    self.denied_keys[key] += 1
+                    return (local[2] - now) / 1000.
+        n = self.batch
+        wait = self._take(key, n, now)
+        if wait and n > 1:
+            n = 1
+            wait = self._take(key, n, now)
+        with self._lock:
+            if len(self._local) > MAX_KEYS:
+                self._local.clear()
+            if len(self.denied_keys) > MAX_KEYS:
+                self.denied_keys = Counter(dict(self.denied_keys.most_common(TOP_DENIED)))
+            if not wait:
+                self._local[key] = [n-1, now + int(LEASE*1000), 0]
+                self.counters['allowed'] += 1
+                return 0
+            self._local[key] = [0, 0, now + wait]
+            self.counters['denied'] += 1
+            self.denied_keys[key] += 1
+            return wait / 1000.
+
+    def _take(self, key, n, now):
+        """Take n tokens from the shared bucket: 0, or ms to wait for one."""
+        cache = caches[CACHE]
+        ckey = 'kdata-ingest:%s:%s'%(self.name, key)
+        cost = n * self.interval
+        timeout = self.tolerance // 1000 + 60
+        self.counters['shared'] += 1
+        try:
+            tat = cache.incr(ckey, cost)
+        except ValueError:
+            # Not in the cache: new or long idle key.
+            if cache.add(ckey, now + cost, timeout):
+                tat = now + cost
+            else:
+                tat = cache.incr(ckey, cost)
+        if tat - cost < now:
+            # Idle for a while, the bucket is full.
+            tat = now + cost
+            cache.set(ckey, tat, timeout)
+        if tat - now <= self.tolerance:
+            return 0
+        # Over: give the tokens back.
+        cache.decr(ckey, cost)
+        cache.touch(ckey, timeout)
+        return max(1, tat - cost + self.interval - self.tolerance - now)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, top_denied=self.denied_keys.most_common(TOP_DENIED))
+
+
+_limiters = { }
+_limiters_lock = threading.Lock()
+def limiter(name):
+    with _limiters_lock:
+        if name not in _limiters:
+            rate, burst = LIMITS[name]
+            _limiters[name] = Limiter(name, rate, burst)
+        return _limiters[name]
+
+_exempt = None
+def is_exempt(device_type):
+    """Is the device class (pyclass name or alias) exempt?"""
+    global _exempt
+    if not EXEMPT or device_type is None:
+        return False
+    from . import devices, util
+    def get_class(name):
+        # Not devices.get_class: unknown names must not all be BaseDevice.
+        if name in devices.device_class_lookup:
+            return devices.device_class_lookup[name]
+        if '.' in name:
+            return util.import_by_name(name, default=name)
+        return name
+    if _exempt is None:
+        _exempt = set(get_class(name) for name in EXEMPT)
+    return get_class(device_type) in _exempt
+
+def device_type(device_id):
+    from . import ingest
+    return ingest.device_type(device_id)
+
+
+def check_request(request, device_id=None, device_type_=None):
+    """A 429 response if this ingest request is over budget, else None.
+
+    device_type_: the device class name, if known (else it is looked
+    up when there are exempt classes).
+    """
+    if not ENABLED:
+        return None
+    if EXEMPT and device_type_ is None and device_id is not None:
+        device_type_ = device_type(device_id)
+    if is_exempt(device_type_):
+        limiter('device').counters['exempt'] += 1
+        return None
+    # Device first: a flooding device is then denied on the fast path
+    # without using up the budget of its IP address.
+    wait = 0
+    if device_id is not None:
+        wait = limiter('device').check(device_id)
+    if not wait:
+        wait = limiter('ip').check(request.META.get('REMOTE_ADDR'))
+    if not wait:
+        return None
+    response = JsonResponse(dict(ok=False, error="Too many requests", retry_after=wait),
+                            status=429, reason="Too many requests")
+    response['Retry-After'] = str(int(math.ceil(wait)))
+    return response
+
+
+def stats():
+    """Counters of the limiters of this process."""
+    return { name: limiter(name).stats() for name in sorted(LIMITS) }
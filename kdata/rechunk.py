@@ -0,0 +1,169 @@
+"""Splitting of large data packets into smaller ones.
+
+Converters load one packet at a time, and optimized_queryset_iterator
+fetches packets by count, so one packet of tens of MB (a long AWARE
+table sync, a PR or iOS backlog) decides the memory use of everything
+that reads it.  Packets over DATA_CHUNK_MAX_BYTES are split:
+
+- at ingest, by views.save_data and save_data_many, before they are
+  checked and saved,
+- in existing data by rechunk_rows(), run with "manage.py rechunk" or
+  as the background job "rechunk" (checkpointed by row id).
+
+How to split is up to the device class: split_packet(data, max_bytes)
+returns the new packets, or None if the packet is not split.  The
+pieces keep the order of the items (and each item is unchanged), and
+the new rows get the ts, ts_received and ip of the original and
+consecutive ids, so reading in (ts, id) order gives the same items in
+the same order.  Only per-packet views of the data (packet sizes and
+counts) change.
+"""
+
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from . import codec
+from . import jobs
+from . import models
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = getattr(settings, 'DATA_CHUNK_MAX_BYTES', 2**20)
+BATCH_SIZE = 100
+
+
+def chunk_list(items, max_bytes, size=len, dumps=json.dumps):
+    """Split items into JSON lists of at most about max_bytes.
+
+    Returns a list of JSON texts.  Each item is encoded once, and a
+    single item over max_bytes is a chunk of its own.  size: the
+    size of an encoded item in the final packet.
+    """
+    chunks = [ ]
+    current = [ ]
+    current_size = 2    # []
+    for item in items:
+        text = dumps(item)
+        n = size(text) + 2    # ", "
+        if current and current_size + n > max_bytes:
+            chunks.append('[' + ', '.join(current) + ']')
+            current = [ ]
+            current_size = 2
+        current.append(text)
+        current_size += n
+    if current or not chunks:
+        chunks.append('[' + ', '.join(current) + ']')
+    return chunks
+
+def split_json_list(data, max_bytes):
+    """split_packet of devices whose packets are JSON lists (PR, iOS)."""
+    try:
+        items = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(items, list):
+        return None
+    chunks = chunk_list(items, max_bytes)
+    if len(chunks) < 2:
+        return None
+    return chunks
+
+
+def split(data, device_class, max_bytes=None):
+    """The packets to save instead of data, or None if it stays as is."""
+    if max_bytes is None:
+        max_bytes = MAX_BYTES
+    if len(data) <= max_bytes:
+        return None
+    if isinstance(data, bytes):
+        try:
+            data = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    return device_class.split_packet(data, max_bytes)
+
+
+def make_row(data, device_id, ip, device_type=None):
+    """A new (unsaved) models.Data row of one packet.
+
+    Compressed if DATA_COMPRESSION is set (see kdata/codec.py).
+    device_type: Device.type, for its compression dictionary.
+    """
+    row = models.Data(device_id=device_id, ip=ip, data=data, data_length=len(data))
+    if codec.COMPRESSION:
+        codec.encode_row(row, device_type=device_type)
+    return row
+
+
+def rechunk_row(row, max_bytes=MAX_BYTES, live=True):
+    """Split one saved models.Data row.  Returns the number of new
+    rows (0 if not split)."""
+    from . import ingest
+    packets = split(row.data, ingest.device_class(row.device_id), max_bytes)
+    if packets is None:
+        return 0
+    if live:
+        device_type = ingest.device_type(row.device_id)
+        with transaction.atomic():
+            new_rows = [ make_row(packet, row.device_id, row.ip, device_type)
+                         for packet in packets ]
+            for new_row in new_rows:
+                new_row.save()
+            ids = [ new_row.id for new_row in new_rows ]
+            # ts and ts_received are auto_now_add, so set them after.
+            models.Data.objects.filter(id__in=ids).update(ts=row.ts,
+                                                          ts_received=row.ts_received)
+            row.delete()
+    return len(packets)
+
+def rechunk_rows(queryset, max_bytes=MAX_BYTES, live=True, start_id=0,
+                 batch_size=BATCH_SIZE):
+    """Split the large rows of queryset, in batches in id order.
+
+    Yields (row id, number of new rows) for each large row.  Resume
+    from start_id (the last id done).
+    """
+    qs = queryset.filter(Q(data_length__gt=max_bytes) | Q(data_length__isnull=True))
+    last_id = start_id
+    while True:
+        ids = list(qs.filter(id__gt=last_id).order_by('id')
+                     .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        # One at a time: these are the large ones.
+        for row_id in ids:
+            row = models.Data.objects.get(id=row_id)
+            yield row.id, rechunk_row(row, max_bytes, live=live)
+        last_id = ids[-1]
+
+
+def device_queryset(device_type=None, device_ids=None):
+    """models.Data of devices, by device type or ids."""
+    qs = models.Data.objects.all()
+    if device_ids:
+        qs = qs.filter(device_id__in=device_ids)
+    elif device_type:
+        from . import devices
+        type_ = devices.get_class(device_type).pyclass_name()
+        qs = qs.filter(device_id__in=models.Device.objects.filter(type=type_)
+                                           .values('device_id'))
+    return qs
+
+
+@jobs.register('rechunk', concurrency=1, max_attempts=5)
+def rechunk_job(ctx):
+    """rechunk, args {"device_type": ..., "device_ids": [...],
+    "max_bytes": ...}: split the large rows of existing data."""
+    qs = device_queryset(ctx.args.get('device_type'), ctx.args.get('device_ids'))
+    max_bytes = ctx.args.get('max_bytes', MAX_BYTES)
+    start_id = (ctx.checkpoint or { }).get('last_id', 0)
+    n_rows = n_new = 0
+    for row_id, n in rechunk_rows(qs, max_bytes, start_id=start_id):
+        n_rows += bool(n)
+        n_new += n
+        ctx.save_checkpoint(dict(last_id=row_id))
+    logger.info("rechunk: split %d rows into %d", n_rows, n_new)
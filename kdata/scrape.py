@@ -0,0 +1,321 @@
+"""Scrape scheduler for the social media (oauth) devices.
+
+The twitter, facebook and instagram modules define scrape_device(),
+which fetches everything of one linked account.  This module has what
+they share:
+
+- scrape_all() runs scrape_device for all linked devices of a class
+  in a pool of SCRAPE_WORKERS threads, so one slow account does not
+  hold up the others.
+
+- Rate limits: token buckets per API (the app-wide limit) and per
+  API and access token (the per-user limit), settings in
+  SCRAPE_RATE_LIMITS.  Every request takes a token from both.  A
+  rate limited response (429, or whatever the API uses) blocks the
+  bucket of the token for Retry-After / X-Rate-Limit-Reset seconds,
+  and the request is retried.  If the wait would be longer than
+  SCRAPE_MAX_WAIT, RateLimited is raised and the device is continued
+  on the next run.  The buckets are per process.
+
+- Scraper.fetch() gets one endpoint, following the pages, and saves
+  all of its pages with one bulk insert (views.save_data_many).  With
+  since_id_key, the newest id is stored in the device attr
+  'last-id-KEY' after the data is saved, and only newer items are
+  requested the next time.
+
+- claim(): a device is fetched at most once per SCRAPE_MIN_INTERVAL.
+
+Database access of the threads goes through database(), which
+serializes it on SQLite (one writer at a time, and in-memory test
+databases fail instead of waiting).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+import email.utils
+from hashlib import sha256
+from json import dumps
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from . import util
+from . import views
+
+import logging
+logger = logging.getLogger(__name__)
+
+WORKERS = getattr(settings, 'SCRAPE_WORKERS', 8)
+MIN_INTERVAL = getattr(settings, 'SCRAPE_MIN_INTERVAL', 3600)  # seconds
+MAX_WAIT = getattr(settings, 'SCRAPE_MAX_WAIT', 120)          # seconds
+RETRIES = getattr(settings, 'SCRAPE_RETRIES', 3)
+TIMEOUT = getattr(settings, 'SCRAPE_TIMEOUT', 60)
+# (requests per second, burst) for the whole API and for each token.
+RATE_LIMITS = {
+    'twitter':   dict(api=(5.0, 50), token=(1.0, 15)),
+    'facebook':  dict(api=(5.0, 50), token=(200/3600., 50)),
+    'instagram': dict(api=(5.0, 50), token=(500/3600., 50)),
+    }
+RATE_LIMITS.update(getattr(settings, 'SCRAPE_RATE_LIMITS', { }))
+DEFAULT_RATE_LIMIT = dict(api=(5.0, 50), token=(1.0, 10))
+
+
+_db_lock = threading.RLock()
+@contextmanager
+def database():
+    """Use around database access from scraper threads."""
+    if connection.vendor != 'sqlite':
+        yield
+        return
+    with _db_lock:
+        yield
+
+def get_device(device_id):
+    from . import models
+    with database():
+        return models.OauthDevice.get_by_id(device_id)
+
+
+class RateLimited(Exception):
+    """The API wants us to wait longer than MAX_WAIT."""
+
+
+class TokenBucket(object):
+    """Allow `rate` requests per second on average, `burst` at once.
+
+    acquire() blocks until the caller may go.  Waiting callers are
+    served in the order they came.
+    """
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.updated = clock()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+    def reserve(self):
+        """Take one token, return how many seconds to wait before using it."""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now-self.updated)*self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens/self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+    def acquire(self):
+        wait = self.reserve()
+        while wait > 0:
+            self.sleep(wait)
+            with self._lock:
+                wait = self.blocked_until - self.clock()
+    def block(self, seconds):
+        """Nobody may go for `seconds` (the server told us so)."""
+        with self._lock:
+            now = self.clock()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = min(self.tokens, 0)
+            self.updated = now
+
+_buckets = { }
+_buckets_lock = threading.Lock()
+def bucket(api, token=None):
+    """The TokenBucket of an API, or of one token of it."""
+    if token is not None:
+        token = sha256(token.encode()).hexdigest()[:16]
+    key = (api, token)
+    with _buckets_lock:
+        if key not in _buckets:
+            limits = RATE_LIMITS.get(api, DEFAULT_RATE_LIMIT)
+            rate, burst = limits['api' if token is None else 'token']
+            _buckets[key] = TokenBucket(rate, burst)
+        return _buckets[key]
+
+
+
+def retry_after(r, default=60):
+    """Seconds to wait after a rate limited response r."""
+    value = r.headers.get('Retry-After')
+    if value:
+        try:
+            return max(0, float(value))
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(value)
+                return max(0, when.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    value = r.headers.get('X-Rate-Limit-Reset')
+    if value:
+        try:
+            return max(0, float(value) - time.time())
+        except ValueError:
+            pass
+    return default
+
+def is_429(r):
+    return r.status_code == 429
+
+def max_id(pages):
+    """Largest 'id' of the items of list pages, or None."""
+    ids = [ item['id'] for j in pages if isinstance(j, list)
+                       for item in j if isinstance(item, dict) and 'id' in item ]
+    return max(ids) if ids else None
+
+
+class Scraper(object):
+    """Requests of one device scrape.
+
+    api: name of the API (key of SCRAPE_RATE_LIMITS).  session: a
+    requests session with the device's auth.  token: the access token,
+    identifies the per-user rate limit.  next_page(r, j, url, params)
+    returns (url, params) of the next page, or None.  rate_limited(r)
+    tells if a response means "too many requests".
+    """
+    def __init__(self, api, device, session, token, next_page,
+                 rate_limited=is_429, save_data=False, debug=False):
+        self.api = api
+        self.device = device
+        self.session = session
+        self.token = token
+        self.next_page = next_page
+        self.rate_limited = rate_limited
+        self.save_data = save_data
+        self.debug = debug
+        self.n_requests = 0
+        self.n_saved = 0
+
+    def get(self, url, params=None):
+        """GET with rate limiting.  Rate limited responses are retried."""
+        api_bucket = bucket(self.api)
+        token_bucket = bucket(self.api, self.token)
+        for attempt in range(RETRIES+1):
+            token_bucket.acquire()
+            api_bucket.acquire()
+            self.n_requests += 1
+            r = self.session.get(url, params=params, timeout=TIMEOUT)
+            if self.debug:
+                print("GET {} {}".format(url, params if params else ''))
+                print("{} {} len={}".format(r.status_code, r.reason, len(r.content)))
+            if not self.rate_limited(r):
+                return r
+            wait = retry_after(r)
+            logger.info("%s rate limited (%s), wait %ds: %s", self.api, self.device.public_id,
+                        wait, url)
+            if wait > MAX_WAIT or attempt == RETRIES:
+                raise RateLimited("%s: %s %s, wait %ds"%(self.api, r.status_code, url, wait))
+            token_bucket.block(wait)
+
+    def fetch(self, endpoint, url, params={}, filter_json=lambda j: j,
+              allowed_fields=None, removed_fields=None,
+              since_id_key=None, since_param='since_id', last_id=max_id):
+        """Get and save all pages of one endpoint, return the list of them.
+
+        filter_json, allowed_fields and removed_fields remove
+        sensitive data from each page before it is saved or
+        returned.  since_id_key: see the module docstring,
+        last_id(pages) finds the value to store.
+        """
+        params = { k:v for k,v in params.items() if v is not None }
+        attr = 'last-id-'+since_id_key if since_id_key is not None else None
+        if self.save_data and attr is not None:
+            with database():
+                since_id = self.device.attrs.get(attr)
+            if self.debug:
+                print('since_id:', since_id)
+            if since_id is not None:
+                params[since_param] = int(since_id)
+        pages = [ ]
+        packets = [ ]
+        complete = False
+        try:
+            next_ = (url, params)
+            while next_ is not None:
+                url, params = next_
+                r = self.get(url, params=params)
+                try:
+                    j = r.json()
+                except ValueError:
+                    j = None
+                if not r.ok or j is None:
+                    logger.warning('%s %s: %s %s: %s', self.api, self.device.public_id,
+                                   r.status_code, endpoint, r.text[:1000])
+                    return pages
+                next_ = self.next_page(r, j, url, dict(params or { }))
+                # Handle privacy-preserving functions
+                j = filter_json(j)
+                util.filter_allowed(j, allowed_fields)
+                util.filter_removed(j, removed_fields)
+                pages.append(j)
+                if self.debug:
+                    print(dumps(j, indent=4, sort_keys=True, separators=(',', ': ')))
+                # Create our data storage object
+                packets.append(dumps(dict(endpoint=endpoint,
+                                          url=url,
+                                          data=dumps(j),
+                                          params=params,
+                                          status_code=r.status_code,
+                                          reason=r.reason,
+                                          timestamp=time.time(),
+                                          version=1,
+                                      )))
+            complete = True
+        finally:
+            # Whatever we got is saved, but the since-id moves only
+            # when everything was.
+            with database():
+                if self.save_data and packets:
+                    self.n_saved += views.save_data_many(packets, self.device.device_id)
+                if self.save_data and complete and attr is not None:
+                    value = last_id(pages)
+                    if value is not None:
+                        self.device.attrs[attr] = value
+        return pages
+
+
+def claim(device, min_interval=MIN_INTERVAL):
+    """Mark device as fetched now, False if it was within min_interval.
+
+    Atomic, so that concurrent runs do not fetch the same device.
+    """
+    now = timezone.now()
+    qs = type(device).objects.filter(pk=device.pk)
+    if min_interval:
+        qs = qs.filter(Q(ts_last_fetch__isnull=True)
+                       | Q(ts_last_fetch__lt=now-timedelta(seconds=min_interval)))
+    with database():
+        if not qs.update(ts_last_fetch=now):
+            return False
+    device.ts_last_fetch = now
+    return True
+
+
+def scrape_all(device_class, scrape_device, save_data=False, debug=False,
+               workers=None):
+    """Run scrape_device for every linked device of device_class.
+
+    Returns the list of public_ids which failed.
+    """
+    qs = device_class.dbmodel.objects.filter(type=device_class.pyclass_name(),
+                                             state='linked')
+    public_ids = list(qs.order_by('pk').values_list('_public_id', flat=True))
+    def run(public_id):
+        try:
+            if debug:
+                print(public_id)
+            scrape_device(public_id, save_data=save_data, debug=debug)
+            return True
+        except Exception:
+            logger.exception("Scraping %s failed", public_id)
+            return False
+        finally:
+            connection.close()
+    with ThreadPoolExecutor(max_workers=workers or WORKERS) as pool:
+        results = list(pool.map(run, public_ids))
+    return [ public_id for public_id, ok in zip(public_ids, results) if not ok ]
@@ -3,6 +3,8 @@ from django.test import TestCase, Client
 # Create your tests here.
 
 from django.test import TestCase
+import json
+import os
 from kdata import models
 
 class p:
@@ -64,3 +66,2021 @@ class BasicTest(TestCase):
         r = c.post('/group/', dict(invite_code='groupinvite', groups='Test Group'))
         models.GroupSubject.objects.filter(user__username='test-user', group__slug='test-group')
         #import IPython ; IPython.embed()
+
+
+
+class DownloadSyncTest(TestCase):
+    """kdata/bin/download_sync.py against a local stand-in server."""
+    def setUp(self):
+        import importlib.util, os
+        path = os.path.join(os.path.dirname(__file__), 'bin', 'download_sync.py')
+        spec = importlib.util.spec_from_file_location('download_sync', path)
+        self.ds = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.ds)
+
+    def serve(self, days):
+        """Serve `days` days of synthetic AwareScreen dumps from 2018-07-10."""
+        import datetime, http.server, threading
+        from urllib.parse import urlparse, parse_qs
+        from kdata import util
+        first = datetime.datetime(2018, 7, 10, 12)
+        requests = [ ]
+        class Handler(http.server.BaseHTTPRequestHandler):
+            failed = [ ]
+            def log_message(self, *args): pass
+            def do_GET(self):
+                url = urlparse(self.path)
+                requests.append(url.path)
+                if url.path.endswith('/json'):
+                    body = json.dumps(dict(data_exists=True,
+                        data_earliest=first.timestamp(),
+                        data_latest=(first+datetime.timedelta(days=days-1)).timestamp()))
+                else:
+                    day = parse_qs(url.query)['start'][0]
+                    # First request of each day fails, to exercise retries.
+                    if day not in self.failed:
+                        self.failed.append(day)
+                        self.send_response(503)
+                        self.end_headers()
+                        return
+                    rows = [(day, i, "it's \"quoted\"", None, 1.5) for i in range(100)]
+                    body = ''.join(util.sqlite3dump_iter(
+                        rows, header=['time', 'user', 'text', 'empty', 'value']))
+                    body = body.replace('"data"', '"AwareScreen"', 1).replace(
+                        'INSERT INTO data ', 'INSERT INTO AwareScreen ')
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%d/devices/abc'%server.server_port, requests
+
+    def run_sync(self, url, outdir, *extra):
+        import os, sqlite3
+        from unittest import mock
+        with mock.patch.dict(os.environ, session_id='x'):
+            self.ds.main([url, 'AwareScreen', outdir, '--workers=3',
+                          '--out-db=%s/out.sqlite3%s'%(outdir, ''.join(extra))])
+        conn = sqlite3.connect(os.path.join(outdir, 'out.sqlite3'))
+        return conn
+
+    def test_download_sync(self):
+        import os, tempfile
+        url, requests = self.serve(days=5)
+        outdir = tempfile.mkdtemp()
+        conn = self.run_sync(url, outdir)
+        self.assertEqual(conn.execute('select count(*) from AwareScreen').fetchone()[0], 500)
+        self.assertEqual(conn.execute('select count(distinct time) from AwareScreen').fetchone()[0], 5)
+        self.assertEqual(conn.execute('select text, empty, value from AwareScreen limit 1').fetchone(),
+                         ("it's \"quoted\"", None, 1.5))
+        self.assertTrue(conn.execute("select 1 from sqlite_master where name='AwareScreen_user_time'").fetchone())
+        self.assertEqual(len(os.listdir(outdir)), 6)
+        # Re-run: nothing new is downloaded
+        n_requests = len(requests)
+        self.run_sync(url, outdir, ':updateonly')
+        self.assertEqual(len(requests), n_requests + 1)
+        # One more day appears: :incremental only loads that one.
+        url, requests = self.serve(days=6)
+        conn = self.run_sync(url, outdir, ':incremental')
+        self.assertEqual(conn.execute('select count(*) from AwareScreen').fetchone()[0], 600)
+        # :updateonly reloads everything into the existing database.
+        os.unlink(os.path.join(outdir, 'AwareScreen.2018-07-12.sqlite3dump'))
+        conn = self.run_sync(url, outdir, ':updateonly')
+        self.assertEqual(conn.execute('select count(*) from AwareScreen').fetchone()[0], 600)
+
+
+
+from django.test import LiveServerTestCase
+
+class ChunkedUploadTest(LiveServerTestCase):
+    """kdata/bin/upload.py chunked sessions against kdata.upload_session."""
+    def setUp(self):
+        import importlib.util, os, tempfile
+        from unittest import mock
+        from kdata import upload_session, util
+        path = os.path.join(os.path.dirname(__file__), 'bin', 'upload.py')
+        spec = importlib.util.spec_from_file_location('upload', path)
+        self.upload = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.upload)
+        self.tmpdir = tempfile.mkdtemp()
+        patcher = mock.patch.object(upload_session, 'SESSION_DIR', self.tmpdir+'/sessions')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.device_id = util.add_checkdigits('0123456789abcdef')
+
+    def test_resume(self):
+        import os
+        url = self.live_server_url + '/post/'
+        data = b''.join(b'%d,line of actiwatch-ish data\n'%i for i in range(20000))
+        fname = os.path.join(self.tmpdir, 'data.csv')
+        open(fname, 'wb').write(data)
+        chunk_size = 2**16
+        # Start a session and send only some chunks, as if interrupted.
+        n_chunks = (len(data) + chunk_size - 1) // chunk_size
+        up = self.upload
+        r = up.request_json(url+'session/', data=json.dumps(dict(
+                size=len(data), chunks=n_chunks, compression=None,
+                sha256=up.file_sha256(fname))).encode(),
+                headers={'Device-ID': self.device_id})
+        session_id = r['session_id']
+        for i in (0, 2):
+            chunk = data[i*chunk_size:(i+1)*chunk_size]
+            up.request_json('%ssession/%s/%d'%(url, session_id, i), data=chunk, method='PUT',
+                            headers={'X-Sha256': up.hashlib.sha256(chunk).hexdigest()})
+        # Bad checksums are rejected and the chunk is not stored.
+        with self.assertRaises(up.HTTPError):
+            up.request_json('%ssession/%s/1'%(url, session_id), data=b'xx', method='PUT',
+                            headers={'X-Sha256': '00'})
+        self.assertEqual(up.request_json('%ssession/%s'%(url, session_id))['received'], [0, 2])
+        open(fname+'.upload-state', 'w').write(json.dumps(dict(
+            session_id=session_id, url=url+'session/', device_id=self.device_id,
+            sha256=up.file_sha256(fname), size=len(data), chunk_size=chunk_size,
+            chunks=n_chunks, compression=None)))
+        # Resume.
+        r = up.upload_chunked(self.device_id, fname, url, chunk_size=chunk_size)
+        self.assertTrue(r['ok'])
+        self.assertFalse(os.path.exists(fname+'.upload-state'))
+        self.assertEqual(models.Data.objects.get(id=r['rowid']).data, str(data))
+        # Committing again does not store the data twice.
+        r2 = up.request_json('%ssession/%s/commit'%(url, session_id), data=b'')
+        self.assertEqual(r2['rowid'], r['rowid'])
+        # Nor does a retry which read the session before that commit
+        # finished, and took the lock after it.
+        from unittest import mock
+        from kdata import upload_session
+        meta = upload_session._load_meta(session_id)
+        del meta['result']
+        real = upload_session._load_meta
+        loads = iter([meta])
+        with mock.patch.object(upload_session, '_load_meta',
+                               lambda sid: next(loads, None) or real(sid)), \
+             mock.patch.object(upload_session, '_received', lambda sid: list(range(n_chunks))):
+            r2 = up.request_json('%ssession/%s/commit'%(url, session_id), data=b'',
+                                 retries=0)
+        self.assertEqual(r2['rowid'], r['rowid'])
+        self.assertEqual(models.Data.objects.filter(device_id=self.device_id).count(), 1)
+        # Compressed, parallel upload from scratch.
+        r = up.upload_chunked(self.device_id, fname, url, chunk_size=chunk_size,
+                              compress=True, workers=3)
+        self.assertTrue(r['ok'])
+        self.assertEqual(models.Data.objects.get(id=r['rowid']).data, str(data))
+
+
+    def test_split_parts(self):
+        """A file larger than a session may be is uploaded in parts."""
+        import ast, os
+        from unittest import mock
+        from kdata import upload_session
+        url = self.live_server_url + '/post/'
+        data = b''.join(b'%d,line of actiwatch-ish data\n'%i for i in range(20000))
+        fname = os.path.join(self.tmpdir, 'data.csv')
+        open(fname, 'wb').write(data)
+        with mock.patch.object(upload_session, 'MAX_SESSION_SIZE', 100000):
+            r = self.upload.upload_file(self.device_id, fname, url, chunk_size=2**16,
+                                        compress=True, workers=2)
+        self.assertTrue(r['ok'])
+        self.assertEqual(len(r['parts']), len(data) // 100000 + 1)
+        rows = models.Data.objects.filter(device_id=self.device_id).order_by('id')
+        packets = [ast.literal_eval(x.data) for x in rows]
+        self.assertEqual([x.id for x in rows], [p['rowid'] for p in r['parts']])
+        self.assertEqual(b''.join(packets), data)
+        self.assertTrue(all(len(p) <= 100000 and p.endswith(b'\n') for p in packets))
+        self.assertEqual([f for f in os.listdir(self.tmpdir) if 'upload-state' in f], [ ])
+        # No line ends: cut at max_size.
+        open(fname, 'wb').write(b'x' * 2500)
+        self.assertEqual(self.upload.split_file(fname, 1000, read_size=300),
+                         [(0, 1000), (1000, 1000), (2000, 500)])
+
+    def test_lock(self):
+        import os
+        from kdata import upload_session
+        fname = os.path.join(self.tmpdir, 'commit.lock')
+        token = upload_session._take_lock(fname)
+        self.assertIsNotNone(token)
+        self.assertIsNone(upload_session._take_lock(fname))
+        # The owner died: its lock is broken after the timeout.
+        self.assertIsNone(upload_session._take_lock(fname, timeout=3600))
+        token2 = upload_session._take_lock(fname, timeout=-1)
+        self.assertIsNotNone(token2)
+        self.assertEqual(json.load(open(fname))['pid'], os.getpid())
+        # The old owner does not remove the new lock.
+        upload_session._release_lock(fname, token)
+        self.assertTrue(os.path.exists(fname))
+        upload_session._release_lock(fname, token2)
+        self.assertFalse(os.path.exists(fname))
+        self.assertEqual(os.listdir(self.tmpdir), [ ])
+
+
+
+class PostBodyTest(TestCase):
+    """Raw bodies in kdata.views.post are hashed and spooled as streamed."""
+    def setUp(self):
+        from kdata import util
+        self.device_id = util.add_checkdigits('0123456789abcdef')
+
+    def test_spool(self):
+        from hashlib import sha256
+        from unittest import mock
+        from kdata import util
+        for size in (10, 100000):
+            data = bytes(range(256)) * (size // 256 + 1)
+            data = data[:size]
+            bodies = [ ]
+            real = util.request_body
+            def request_body(request):
+                bodies.append(real(request, max_memory=2**12))
+                return bodies[-1]
+            with mock.patch.object(util, 'request_body', request_body):
+                r = self.client.post('/post/%s'%self.device_id, data,
+                                     content_type='application/octet-stream',
+                                     HTTP_X_SHA256=sha256(data).hexdigest())
+            self.assertEqual(r.json()['data_sha256'], sha256(data).hexdigest())
+            self.assertEqual(r.json()['bytes'], size)
+            self.assertEqual(bodies[0].in_memory, size <= 2**12)
+            self.assertEqual(models.Data.objects.last().data, str(data))
+        r = self.client.post('/post/%s'%self.device_id, b'xxx',
+                             content_type='application/octet-stream',
+                             HTTP_X_SHA256='00')
+        self.assertEqual(r.status_code, 400)
+
+    def test_too_large(self):
+        from kdata import util
+        from unittest import mock
+        with mock.patch.object(util, 'BODY_MAX_SIZE', 1000):
+            for size in (1000, 1001):
+                r = self.client.post('/post/%s'%self.device_id, b'x' * size,
+                                     content_type='application/octet-stream')
+                self.assertEqual(r.status_code, 200 if size <= 1000 else 413)
+        # Without a Content-Length, the limit is checked while reading.
+        body = util.SpooledBody(max_memory=10, max_size=100)
+        body.write(b'x' * 60)
+        self.assertRaises(util.BodyTooLarge, body.write, b'x' * 41)
+
+    def test_actiwatch(self):
+        import io
+        from kdata.devices.actiwatch import Actiwatch
+        lines = [b'"Identity:","A Person"\r\n', b'"Full Name:","Someone Else"\n',
+                 b'"Gender:","\n', b'x\n', b'"\n', b'"Country:",Finland\n', b'Phone:,"\n',
+                 b'1,2,"3"\n', b'"Initials:",,"AB"\n', b'"Street Address:","']
+        for i in range(200):
+            data = b''.join(lines[(i*7+j*3) % len(lines)] for j in range(i % 13))
+            self.assertEqual(Actiwatch.process_upload_file(None, io.BytesIO(data)),
+                             Actiwatch.process_upload(None, data))
+        self.assertNotIn(b'Someone', Actiwatch.process_upload_file(None, io.BytesIO(lines[1])))
+
+    def test_murata(self):
+        body = ('<BSN><NODE><NODE_DATA id="%s" time="1"><DATA>1,2</DATA></NODE_DATA>'
+                '</NODE></BSN>'%self.device_id).encode()
+        r = self.client.post('/data/push/', body, content_type='text/xml')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(models.Data.objects.get(device_id=self.device_id).data, str(body))
+
+
+
+class FunfTest(TestCase):
+    """Funf uploads, using locally generated (encrypted) databases."""
+    def make_db(self, n):
+        import sqlite3, tempfile
+        with tempfile.NamedTemporaryFile(suffix='.db') as f:
+            conn = sqlite3.connect(f.name)
+            conn.execute('create table data (_id, name, timestamp, value)')
+            conn.execute('create table android_metadata (locale)')
+            conn.execute('create table file_info (_id, name, value)')
+            conn.executemany('insert into data values (?,?,?,?)',
+                             [(i, 'edu.mit.media.funf.probe.builtin.ScreenProbe',
+                               1500000000+i, '{"screenOn": %s}'%(i%2 == 0)) for i in range(n)])
+            conn.execute("insert into android_metadata values ('en_US')")
+            conn.execute("insert into file_info values (1, 'x', 'y')")
+            conn.commit()
+            conn.close()
+            return open(f.name, 'rb').read()
+
+    def encrypt(self, data):
+        from Crypto.Cipher import DES
+        from kdata.devices import funf_decrypt
+        n_pad = 8 - len(data) % 8
+        data = data + bytes([n_pad]) * n_pad
+        return DES.new(funf_decrypt.key_from_password(b'changeme'), DES.MODE_ECB).encrypt(data)
+
+    def test_funf_post(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from kdata import util
+        from kdata.devices import funf_decrypt
+        device_id = util.add_checkdigits('0123456789abcdef')
+        db = self.make_db(500)
+        for data in (db, self.encrypt(db), self.encrypt(self.make_db(10))):
+            r = self.client.post('/funf/post1/%s'%device_id,
+                                 dict(uploadedfile=SimpleUploadedFile('archive.db', data)))
+            self.assertEqual(r.json(), dict(status='success'))
+        import ast
+        # Saved as bytes, like all posted data.
+        rows = [json.loads(ast.literal_eval(x.data).decode())
+                for x in models.Data.objects.filter(device_id=device_id).order_by('id')]
+        self.assertEqual(len(rows[0]['data']), 500)
+        self.assertEqual(rows[0]['data'], rows[1]['data'])
+        self.assertEqual(rows[1]['android_metadata'], [['en_US']])
+        self.assertEqual(rows[1]['filename'], 'archive.db')
+        self.assertEqual(len(rows[2]['data']), 10)
+        # The key was derived only once.
+        self.assertEqual(funf_decrypt.cached_key.cache_info().misses, 1)
+
+    def test_funf_on_disk(self):
+        import io
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.test import override_settings
+        from kdata import util
+        from kdata.devices import funf_decrypt
+        db = self.make_db(300)
+        data = self.encrypt(db)
+        key = funf_decrypt.cached_key(b'changeme')
+        for read_size in (8, 13, 1000, 2**16):
+            out = io.BytesIO()
+            funf_decrypt.decrypt_file(io.BytesIO(data + b'xyz'), out, key, read_size=read_size)
+            self.assertEqual(out.getvalue(), funf_decrypt.decrypt_bytes(data, key))
+        self.assertEqual(out.getvalue(), db)
+        device_id = util.add_checkdigits('0123456789abcdef')
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1000):
+            for upload in (db, data):
+                r = self.client.post('/funf/post1/%s'%device_id,
+                                     dict(uploadedfile=SimpleUploadedFile('archive.db', upload)))
+                self.assertEqual(r.json(), dict(status='success'))
+        import ast
+        rows = [json.loads(ast.literal_eval(x.data).decode())
+                for x in models.Data.objects.filter(device_id=device_id).order_by('id')]
+        self.assertEqual(len(rows[0]['data']), 300)
+        self.assertEqual(rows[0]['data'], rows[1]['data'])
+
+
+
+class PurpleRobotTest(TestCase):
+    """The PR fast path stores exactly what full parsing stores."""
+    def upload(self, payload, checksum=None, **extra):
+        import hashlib
+        from urllib.parse import urlencode
+        envelope = dict(Operation='SubmitProbes', UserHash='a0b1c2', Payload=payload, **extra)
+        envelope['Checksum'] = checksum or hashlib.md5(
+            ('a0b1c2'+'SubmitProbes'+payload).encode('utf-8')).hexdigest()
+        return urlencode(dict(json=json.dumps(envelope)))
+
+    def test_parity(self):
+        from unittest import mock
+        from kdata import util
+        from kdata.devices import purplerobot
+        device_id = util.add_checkdigits('0123456789abcdef')
+        probes = [dict(PROBE='edu.northwestern.cbits.purple_robot_manager.probes.builtin.ScreenProbe',
+                       TIMESTAMP=1500000000+i, SCREEN_ACTIVE=bool(i%2)) for i in range(50)]
+        probes.append(dict(PROBE='x', TIMESTAMP=1, NAME='Sää "quoted" \\ back\nslash \U0001F600'))
+        payloads = [json.dumps(probes), json.dumps(probes, ensure_ascii=False),
+                    json.dumps(probes[:5])]
+        uploads = [self.upload(p) for p in payloads]
+        uploads.append(self.upload(payloads[2], Extra='"Payload": "x"'))
+        for body in uploads:
+            stored = [ ]
+            for validate in (True, False):
+                with mock.patch.object(purplerobot, 'VALIDATE', validate), \
+                     mock.patch.object(purplerobot.PurpleRobot, 'post_full',
+                                       wraps=purplerobot.PurpleRobot.post_full) as full:
+                    r = self.client.post('/post/purple/%s'%device_id, body,
+                                         content_type='application/x-www-form-urlencoded')
+                self.assertEqual(r.json()['Status'], 'success')
+                self.assertEqual(full.called, validate)
+                stored.append(models.Data.objects.last().data)
+            self.assertEqual(stored[0], stored[1])
+        # Bad checksums are left to the full method.
+        with mock.patch.object(purplerobot.PurpleRobot, 'post_full',
+                               wraps=purplerobot.PurpleRobot.post_full) as full:
+            r = self.client.post('/post/purple/%s'%device_id,
+                                 self.upload(payloads[0], checksum='0'*32),
+                                 content_type='application/x-www-form-urlencoded')
+        self.assertTrue(full.called)
+
+
+
+class AppWhitelistTest(TestCase):
+    def test_safe_launches(self):
+        from unittest import mock
+        from kdata import app_whitelist, converter
+        self.addCleanup(app_whitelist.set_source, None)
+        probe = 'edu.northwestern.cbits.purple_robot_manager.probes.builtin.ApplicationLaunchProbe'
+        data = json.dumps([dict(PROBE=probe, TIMESTAMP=i, CURRENT_APP_PKG=pkg) for i, pkg in
+                           enumerate(['com.good.app', 'com.vendor.x', 'com.secret.app'])])
+        # The shipped list is empty until downloaded: if that fails,
+        # refuse (once), don't hash all.
+        self.assertEqual(len(app_whitelist.get_matcher()), 0)
+        with mock.patch('requests.get', side_effect=IOError("no network")) as get:
+            with self.assertRaises(app_whitelist.WhitelistMissing):
+                list(converter.PRApplicationLaunchesSafe().convert([(0, data)]))
+            c = converter.PRApplicationLaunchesSafe(rows=[(0, data)]*3)
+            self.assertEqual(list(c.run()), [ ])
+            self.assertEqual(len(c.errors), 1)
+            self.assertEqual(get.call_count, 1)    # not again until DOWNLOAD_RETRY
+        # Downloaded on first use and stored.
+        import os, shutil, tempfile
+        path = os.path.join(tempfile.mkdtemp(), 'app_whitelist.txt')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('# version: none\n')
+        app_whitelist.set_source(app_whitelist.file_source(path))
+        response = mock.Mock(text='com.good.app,Good\ncom.vendor.*\n')
+        with mock.patch('requests.get', return_value=response):
+            rows = list(converter.PRApplicationLaunchesSafe(rows=[(0, data)]).run())
+        self.assertEqual(rows[0], (0, 'com.good.app'))
+        self.assertEqual(len(app_whitelist.parse(open(path).read())), 2)
+        app_whitelist.set_source(lambda: '# version: t1\ncom.good.app,Good\ncom.vendor.*\n')
+        with mock.patch('requests.get', side_effect=AssertionError("network used")):
+            c = converter.PRApplicationLaunchesSafe()
+            rows = list(c.convert([(0, data)]))
+        self.assertEqual(rows[:2], [(0, 'com.good.app'), (1, 'com.vendor.x')])
+        self.assertEqual(rows[2], (2, c.safe_hash('com.secret.app')))
+        self.assertEqual(app_whitelist.get_matcher().version, 't1')
+
+
+
+class PseudonymTest(TestCase):
+    def test_legacy_identical(self):
+        import random
+        from base64 import urlsafe_b64encode
+        from hashlib import sha256
+        from kdata import converter, pseudonym, util
+        def legacy(data, salt):
+            if not isinstance(data, bytes):
+                data = data.encode('utf8')
+            return urlsafe_b64encode(sha256(salt+data).digest()[:9]).decode('ascii')
+        rnd = random.Random(5)
+        values = ['', 'a', 'Sää', '00:11:22:33:44:55', '+358 40 123', b'\x00\xff', '\U0001F600']
+        values += [''.join(chr(rnd.randint(32, 0x2000)) for _ in range(rnd.randint(0, 40)))
+                   for _ in range(200)]
+        seed = b'group-seed'
+        for v in values * 2:   # second round is from the cache
+            self.assertEqual(util.safe_hash(v), legacy(v, util.SALT_KEY))
+            self.assertEqual(util.safe_hash(v, hash_seed=seed), legacy(v, seed))
+            self.assertEqual(converter._safe_hash(v), legacy(v, converter.SALT_KEY))
+            self.assertEqual(converter._safe_hash(v, hash_seed=seed), legacy(v, seed))
+        self.assertEqual(pseudonym.hash_column(seed, values), [legacy(v, seed) for v in values])
+        self.assertEqual(pseudonym.hash_column(seed, ['', None, 'x'], skip_empty=True),
+                         ['', None, legacy('x', seed)])
+        self.assertEqual(util.hash_column(values, hash_seed=seed), [legacy(v, seed) for v in values])
+        self.assertGreater(pseudonym.cache_info().hits, 0)
+
+    def test_blake2(self):
+        from kdata import pseudonym
+        h = lambda v, salt=b'k'*100, scheme='blake2': pseudonym.hash_value(salt, v, scheme=scheme)
+        self.assertEqual(h('abc'), h(b'abc'))
+        self.assertEqual(len(h('abc')), 12)
+        self.assertNotEqual(h('abc'), h('abc', scheme='legacy'))
+        self.assertNotEqual(h('abc'), h('abc', salt=b'j'))
+        with self.assertRaises(ValueError):
+            pseudonym.hash_column(b'k', ['abc'], scheme='md5')
+
+    def test_columns(self):
+        """Converters hashing columns give what per-value hashing gave."""
+        from types import SimpleNamespace
+        from kdata import converter, group, util
+        h = converter._safe_hash
+        prefix = 'edu.northwestern.cbits.purple_robot_manager.probes.builtin.'
+        aps = [dict(SSID=s, BSSID=b, LEVEL=-50) for s, b in
+               [('net', 'aa:bb'), ('', 'cc:dd'), ('x', '')]]
+        pr = json.dumps([
+            dict(PROBE=prefix+'WifiAccessPointsProbe', TIMESTAMP=1, CURRENT_SSID='"net"',
+                 CURRENT_BSSID='aa:bb', CURRENT_RSSI=-40, ACCESS_POINTS=aps),
+            dict(PROBE=prefix+'WifiAccessPointsProbe', TIMESTAMP=2, CURRENT_SSID='',
+                 CURRENT_BSSID='', CURRENT_RSSI=-40, ACCESS_POINTS=aps[1:]),
+            dict(PROBE=prefix+'BluetoothDevicesProbe', TIMESTAMP=3,
+                 DEVICES=[dict(BLUETOOTH_NAME='n'), dict(BLUETOOTH_ADDRESS='a')]),
+            ])
+        self.assertEqual(list(converter.PRWifiSafe().convert([(0, pr)])), [
+            (1, h('net'), h('aa:bb'), 1, -40), (1, h('net'), h('aa:bb'), 0, -50),
+            (1, '', h('cc:dd'), 0, -50), (1, h('x'), '', 0, -50),
+            (2, '', h(''), 1, -40), (2, '', h('cc:dd'), 0, -50), (2, h('x'), '', 0, -50)])
+        self.assertEqual(list(converter.PRBluetoothSafe().convert([(0, pr)])), [
+            (3, h('n'), h(''), '', ''), (3, h(''), h('a'), '', '')])
+        def aware(table, rows):
+            return json.dumps(dict(table=table, data=rows, version=2))
+        rows = [dict(timestamp=1000, ssid='s', bssid='', rssi=1), dict(timestamp=2000, rssi=2)]
+        self.assertEqual(list(converter.AwareWifi().convert([(0, aware('wifi', rows))])),
+                         [(1, h('s'), h(''), '', 1), (2, '', '', '', 2)])
+        rows = [dict(timestamp=1000, trace='t', call_type='1'), dict(timestamp=2000, call_type='3')]
+        self.assertEqual(list(converter.AwareCalls(hash_seed=b's').convert([(0, aware('calls', rows))])),
+                         [(1, 'incoming', '', h('t', hash_seed=b's')), (2, 'missed', '', '')])
+        # Group subject and device pseudonyms.
+        grp = SimpleNamespace(salt='salt')
+        pairs = [(SimpleNamespace(user=SimpleNamespace(username=u)), SimpleNamespace(public_id=d))
+                 for u, d in [('u1', 'd1'), ('u1', 'd2'), ('u2', 'd3')]]
+        self.assertEqual(group.device_hashes(grp, { }, pairs),
+                         [(util.safe_hash('salt'+u), util.safe_hash('salt'+d))
+                          for u, d in [('u1', 'd1'), ('u1', 'd2'), ('u2', 'd3')]])
+        self.assertEqual(group.device_hashes(grp, {'data_has_raw_usernames': True}, pairs[:1]),
+                         [('u1', 'd1')])
+
+
+
+def legacy_murata_convert(self, rows, time=lambda x:x):
+    """converter.MurataBSN.convert before kdata.murata_decode, for parity tests."""
+    import ast, csv
+    from calendar import timegm
+    from defusedxml.ElementTree import fromstring as xml_fromstring
+    from dateutil import parser as date_parser
+    only_network_id = self.params.get('network_id', None)
+    for ts_packet, data in rows:
+        if data.startswith("b'") and data.endswith("'"):
+            data = ast.literal_eval(data).decode()
+        if not data.startswith('<'):
+            continue
+        unixtime_packet = timegm(ts_packet.timetuple())
+        doc = xml_fromstring(data)
+        node = doc[0][0]
+        network_id = doc[0].attrib['id']
+        if only_network_id and network_id != only_network_id:
+            continue
+        start_time = doc[0][0][0][0].attrib['time']
+        ts = date_parser.parse(start_time)
+        values = doc[0][0][0][0][9]
+        rows = [row for row in csv.reader(values.text.split('\n')) if row]
+        last_time_i = int(rows[-1][0])
+        for row in rows:
+            if len(row) != 10 or not row[0]: continue
+            unixtime = timegm(ts.timetuple()) + int(row[0])
+            data_values = tuple(int(x) if x else '' for x in row[1:])
+            if self.safe:
+                data_values = tuple( "" for _ in data_values )
+            unixtime_from_packet = unixtime_packet - ( last_time_i - int(row[0]))
+            if not self.debug:
+                extra_data = (time(unixtime_from_packet), )
+            else:
+                extra_data = (time(unixtime_from_packet), int(row[0]), last_time_i - int(row[0]),
+                              time(unixtime_packet), unixtime_from_packet-unixtime, start_time)
+            yield (time(unixtime), ) + data_values + extra_data
+
+class MurataDecodeTest(TestCase):
+    def random_packet(self, rnd):
+        times = ['2017-05-01T10:00:%02d'%rnd.randint(0, 59), '2017-05-01 23:59:59',
+                 '2017-05-01T10:00:00.250+03:00', '2017-05-01T10:00:00Z', '2017-02-30T10:00:00',
+                 '1 May 2017 10:00', ' 2017-05-01T10:00:00 ']
+        q = rnd.choice('"\'')
+        rows = [ ]
+        for i in range(rnd.randint(1, 8)):
+            row = [str(i*rnd.randint(1, 3))] + [rnd.choice(['', str(rnd.randint(-5, 9999))])
+                                                 for _ in range(9)]
+            if rnd.random() < 0.1:
+                row = row[:rnd.randint(1, 9)]
+            rows.append(','.join(row))
+        sep = rnd.choice(['\n', '\r\n'])
+        values = sep + sep.join(rows) + rnd.choice(['', sep])
+        if rnd.random() < 0.05:
+            values = '<![CDATA[%s]]>'%values
+        if rnd.random() < 0.05:
+            values += '&amp;'
+        spacer = rnd.choice(['', ' ', '\n  ', '<!-- c -->'])
+        children = ''.join('<F%d>%d</F%d>%s'%(i, i, i, spacer) if rnd.random() < 0.5 else '<F%d/>'%i
+                           for i in range(9))
+        doc = ('%s<BSN>%s<NETWORK id=%snet%d%s>%s<NODE  id = %sdev%s><SET><REC time=%s%s%s >%s<VALUES>%s</VALUES>'
+               '</REC></SET></NODE></NETWORK></BSN>')%(
+            rnd.choice(['', '<?xml version="1.0" encoding="UTF-8"?>\n']), spacer,
+            q, rnd.randint(0, 2), q, spacer, q, q, q, rnd.choice(times), q, children, values)
+        if rnd.random() < 0.5:
+            doc = str(doc.encode())
+        return doc
+
+    def test_parity(self):
+        import datetime, random
+        from kdata import converter, murata_decode
+        rnd = random.Random(3)
+        packet_ts = datetime.datetime(2017, 5, 1, 10, 1)
+        def run(func, conv, packet):
+            try:
+                return list(func(conv, [(packet_ts, packet)]))
+            except Exception as e:
+                return type(e)
+        for i in range(400):
+            packet = self.random_packet(rnd)
+            for cls in (converter.MurataBSN, converter.MurataBSNDebug, converter.MurataBSNSafe):
+                conv = cls(params={'network_id': 'net1'} if i%3 == 0 else {})
+                new = run(cls.convert, conv, packet)
+                old = run(legacy_murata_convert, conv, packet)
+                if isinstance(old, type):
+                    self.assertTrue(isinstance(new, type), (packet, old, new))
+                else:
+                    self.assertEqual(new, old, packet)
+            self.assertEqual(murata_decode.decode_stored(packet),
+                             ast_decode(packet))
+
+def ast_decode(data):
+    import ast
+    if data.startswith("b'") and data.endswith("'"):
+        return ast.literal_eval(data).decode()
+    return data
+
+
+
+ACTIWATCH_LEGACY_RE = {
+    'epochs': r'--- Epoch-by-Epoch Data -+"\s+.*?("Line",.*)',
+    'statistics': r'--- Statistics -+"\s+.*?("Interval Type",.*?)\r\n\r\n\r\n',
+    'markers': r'--- Marker/Score List -+"\s+.*?("Line","Date",.*?)\r\n\r\n\r\n',
+    }
+
+def legacy_actiwatch_rows(data, key):
+    """Section rows as found by the converters before kdata.actiwatch_parse."""
+    import csv, io, re
+    m = re.search(ACTIWATCH_LEGACY_RE[key], data, re.DOTALL)
+    return list(csv.reader(io.StringIO(m.group(1))))
+
+def legacy_actiwatch_convert(cls, rows):
+    """Run an Actiwatch converter with the old section search and date parser."""
+    from unittest import mock
+    from kdata import actiwatch_parse, converter
+    class LegacyFile(object):
+        def __init__(self, data):
+            self.tzoffset = actiwatch_parse.find_tzoffset(data)
+            self.rows = lambda key: legacy_actiwatch_rows(data, key)
+    def parse(data):
+        data = ast_decode(data)
+        if '---- Subject Properties------' not in data:
+            return None
+        return LegacyFile(data)
+    with mock.patch.object(actiwatch_parse, 'parse', parse), \
+         mock.patch.object(converter, 'actiwatch_parse_date', actiwatch_parse.parse_date_slow):
+        return list(cls().convert(rows))
+
+class ActiwatchParseTest(TestCase):
+    def test_sections_and_dates(self):
+        import random
+        from kdata import actiwatch_parse
+        from kdata.bench import generators
+        rnd = random.Random(5)
+        for locale in ('us', 'eu', 'dot'):
+            for tz in ('+03:00', '-05:30', '+00:00'):
+                data = generators.actiwatch_file(rnd, n_epochs=300, locale=locale, tz=tz)
+                parsed = actiwatch_parse.parse(str(data.encode()))
+                self.assertIs(parsed, actiwatch_parse.parse(str(data.encode())))  # cached
+                for key in ('epochs', 'statistics', 'markers'):
+                    self.assertEqual(list(parsed.rows(key)), legacy_actiwatch_rows(data, key))
+                for line in list(parsed.rows('epochs'))[1:] + list(parsed.rows('markers'))[1:]:
+                    for dayfirst in (True, False, None):
+                        self.assertEqual(actiwatch_parse.parse_date(line[1], line[2], parsed.tzoffset, dayfirst),
+                                         actiwatch_parse.parse_date_slow(line[1], line[2], parsed.tzoffset, dayfirst))
+        for b in ('12:00:00 AM', '12:30:01 PM', '13:00:00 PM', '1:2:3', '24:00:00', '10:00', '23:59:59', '10.11.12'):
+            for a in ('1/5/2017', '13.05.2017', '2017-05-01'):
+                try:
+                    slow = actiwatch_parse.parse_date_slow(a, b, '+0200', True)
+                except ValueError:
+                    self.assertRaises(ValueError, actiwatch_parse.parse_date, a, b, '+0200', True)
+                else:
+                    self.assertEqual(actiwatch_parse.parse_date(a, b, '+0200', True), slow)
+
+    def test_converters(self):
+        import datetime, random
+        from kdata import actiwatch_parse, converter
+        from kdata.bench import generators
+        rnd = random.Random(6)
+        rows = [(datetime.datetime(2017, 1, 1), str(generators.actiwatch_file(rnd, locale=locale, tz=tz).encode()))
+                for locale, tz in (('us', '+03:00'), ('eu', '+01:00'), ('dot', '-05:30'))]
+        rows.append((datetime.datetime(2017, 1, 1), "b'not actiwatch'"))
+        for cls in (converter.ActiwatchFull, converter.ActiwatchStatistics, converter.ActiwatchMarkers):
+            new = list(cls().convert(rows))
+            self.assertTrue(new)
+            # repr, since NaN != NaN
+            self.assertEqual(repr(new), repr(legacy_actiwatch_convert(cls, rows)))
+        # Only the sections a converter uses are parsed.
+        from unittest import mock
+        actiwatch_parse.cache_clear()
+        with mock.patch.object(actiwatch_parse.csv, 'reader', wraps=actiwatch_parse.csv.reader) as reader:
+            list(converter.ActiwatchMarkers().convert(rows))
+            list(converter.ActiwatchStatistics().convert(rows))
+        sections = [ call[0][0].getvalue()[:16] for call in reader.call_args_list ]
+        self.assertEqual(len(sections), 6)
+        self.assertFalse([ x for x in sections if x.startswith('"Line",') and not x.startswith('"Line","Date"') ])
+        actiwatch_parse.cache_clear()
+
+
+
+class BenchTest(TestCase):
+    def test_generators_deterministic(self):
+        from kdata.bench import generators
+        self.assertEqual(generators.purple_robot(1, n_packets=3), generators.purple_robot(1, n_packets=3))
+        self.assertEqual(generators.aware('battery', ['battery_level'], rnd=2, n_packets=2),
+                         generators.aware('battery', ['battery_level'], rnd=2, n_packets=2))
+        self.assertNotEqual(generators.survey(1, n_packets=2), generators.survey(2, n_packets=2))
+
+    def test_all_cases(self):
+        """Every benchmark case runs, without errors, in every format."""
+        import io
+        from kdata.bench import generators, runner
+        sources = runner.get_sources()
+        packets = {name: func(0.02) for name, func in sources.items()}
+        packets['actiwatch'] = generators.actiwatch(4, n_packets=1, n_epochs=200)
+        results = [ ]
+        for case in runner.get_cases():
+            for format in runner.FORMATS:
+                result = runner.run_case(case, format=format, packets=packets[case.source])
+                self.assertIsNone(result['error'], result['name'])
+                results.append(result)
+        self.assertTrue(all(r['rows'] > 0 for r in results
+                            if r['converter'] not in ('ActiwatchMarkers', )), [r['name'] for r in results if not r['rows']])
+        f = io.StringIO()
+        runner.write_results(results, f)
+        f.seek(0)
+        meta, by_name = runner.read_results(f)
+        self.assertEqual(meta['version'], runner.RESULTS_VERSION)
+        self.assertEqual(by_name['AwareScreen/csv']['rows'], by_name['AwareScreen/rows']['rows'])
+        self.assertGreater(by_name['AwareScreen/csv']['bytes_out'], 0)
+
+
+class PerfCheckTest(TestCase):
+    def _result(self, times, queries=None):
+        import statistics
+        return dict(times=times, median=statistics.median(times), queries=queries)
+
+    def test_compare(self):
+        from kdata.bench import regress
+        base = self._result([1.0, 1.02, 0.98, 1.01, 0.99, 1.0, 1.03])
+        slow = self._result([1.5, 1.52, 1.48, 1.51, 1.49, 1.5, 1.53])
+        noisy = self._result([1.0, 1.3, 0.9, 1.05, 0.95, 1.1, 0.97])
+        self.assertEqual(regress.compare_one(base, slow)['status'], 'regression')
+        self.assertEqual(regress.compare_one(slow, base)['status'], 'improvement')
+        self.assertEqual(regress.compare_one(base, noisy)['status'], 'ok')
+        self.assertEqual(regress.compare_one(None, base)['status'], 'new')
+        # More queries are always a regression.
+        c = regress.compare_one(self._result(base['times'], 10), self._result(base['times'], 11))
+        self.assertEqual((c['status'], c.get('reason')), ('regression', 'queries'))
+        # A uniformly slower machine is calibrated out.
+        baseline = {regress.CALIBRATION: base, 'x': base}
+        current = {regress.CALIBRATION: slow, 'x': slow}
+        self.assertEqual(regress.compare(baseline, current)['x']['status'], 'ok')
+        self.assertEqual(regress.compare(baseline, current, calibrate=False)['x']['status'],
+                         'regression')
+
+    def test_run_and_baseline(self):
+        import io
+        from kdata.bench import regress
+        benchmarks = [b for b in regress.get_benchmarks()
+                      if b.name in ('convert:PRTimestamps', 'db:device_data_csv')]
+        self.assertEqual(len(benchmarks), 2)
+        results = regress.run_benchmarks(benchmarks, repeat=2)
+        self.assertEqual(len(results['convert:PRTimestamps']['times']), 2)
+        self.assertGreater(results['db:device_data_csv']['queries'], 0)
+        f = io.StringIO()
+        regress.save_baseline(results, f)
+        f.seek(0)
+        meta, baseline = regress.load_baseline(f)
+        comparison = regress.compare(baseline, results)
+        self.assertTrue(all(c['status'] != 'new' for c in comparison.values()))
+
+
+
+class TimingTest(TestCase):
+    def test_disabled(self):
+        from kdata import timing
+        rows = [1, 2, 3]
+        self.assertIsNone(timing.current())
+        self.assertIs(timing.timed_iter('db', rows), rows)
+        self.assertIs(timing.timed_rows('convert', rows), rows)
+        with timing.span('x'):
+            pass
+
+    def test_spans(self):
+        from kdata import timing
+        timer = timing.Timer('test')
+        previous = timing.activate(timer)
+        try:
+            with timing.span('outer'):
+                with timing.span('inner'):
+                    sum(range(10000))
+            def rows():
+                yield 1
+                yield 2
+                raise ValueError()
+            got = [ ]
+            with self.assertRaises(ValueError):
+                for row in timing.timed_rows('convert', rows(), batch=10):
+                    got.append(row)
+            self.assertEqual(got, [1, 2])
+            self.assertEqual(list(timing.timed_iter('db', range(5))), list(range(5)))
+        finally:
+            timing.activate(previous)
+        timer.finish()
+        self.assertEqual(list(timer.phases), ['inner', 'outer', 'convert', 'db'])
+        summary = timer.summary()
+        self.assertAlmostEqual(sum(v for k, v in summary.items() if k != 'total'),
+                               summary['total'], places=6)
+        self.assertIn('inner;dur=', timer.server_timing())
+
+    def test_requests(self):
+        from unittest import mock
+        from django.test import Client, RequestFactory
+        from kdata import timing, util, views_admin
+        from kdata.bench import generators
+        timing.reset_stats()
+        user = models.User.objects.create_user('timing-user', password='pw')
+        device_id = util.add_checkdigits('00112233445566ff')
+        models.Device(user=user, name='t', type='kdata.devices.purplerobot.PurpleRobot',
+                      device_id=device_id, _public_id=device_id[:6], _secret_id=device_id).save()
+        with mock.patch.object(timing, 'ENABLED', True):
+            client = Client()
+            for ts, data in generators.purple_robot(1, n_packets=3):
+                r = client.post('/post/%s'%device_id, data.encode(),
+                                content_type='application/json')
+                self.assertEqual(r.status_code, 200)
+                self.assertIn('save;dur=', r['Server-Timing'])
+                self.assertIn('total;dur=', r['Server-Timing'])
+            client.force_login(user)
+            with self.assertLogs('kdata.timing', 'INFO') as logs:
+                r = client.get('/devices/%s/PRBattery.csv'%device_id[:6])
+                self.assertTrue(r.streaming)
+                self.assertIn('auth;dur=', r['Server-Timing'])
+                content = b''.join(r.streaming_content)
+            self.assertGreater(len(content.splitlines()), 1)
+            self.assertIn('complete', logs.output[0])
+        # Not enabled: no header.
+        r = Client().post('/post/%s'%device_id, b'{}', content_type='application/json')
+        self.assertNotIn('Server-Timing', r)
+
+        stats = timing.get_stats()
+        self.assertEqual(stats['post']['count'], 3)
+        download = [s for name, s in stats.items() if name != 'post']
+        self.assertEqual(len(download), 1)
+        for phase in ('auth', 'db', 'convert', 'format'):
+            self.assertIn(phase, download[0]['phases_mean_ms'])
+
+        request = RequestFactory().get('/timing/', dict(format='json'))
+        request.user = user
+        request.user.is_verified = lambda: True
+        self.assertEqual(views_admin.timing_stats(request).status_code, 403)
+        user.is_superuser = True
+        r = views_admin.timing_stats(request)
+        self.assertEqual(json.loads(r.content.decode())['endpoints']['post']['count'], 3)
+        timing.reset_stats()
+
+
+
+class ProfilerTest(TestCase):
+    def setUp(self):
+        import tempfile
+        from unittest import mock
+        from kdata import profiler
+        self.tmpdir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(profiler, 'PROFILE_DIR', self.tmpdir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+        self.addCleanup(profiler.finish)
+
+    def test_sampler(self):
+        import time
+        from kdata import profiler
+        def busy_function():
+            t = time.time()
+            while time.time() < t + 0.2:
+                sum(range(100))
+        sampler = profiler.Sampler(interval=0.002)
+        sampler.add_thread()
+        sampler.start()
+        busy_function()
+        sampler.stop()
+        self.assertGreater(sampler.n_samples, 10)
+        lines = sampler.collapsed().splitlines()
+        self.assertTrue(any('tests.py:busy_function' in line for line in lines))
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in lines), sampler.n_samples)
+
+    def test_requests(self):
+        from django.test import RequestFactory
+        from kdata import profiler, util, views_admin
+        device_id = util.add_checkdigits('0123456789abcdef')
+        user = models.User.objects.create_user('profiler-user')
+        request = RequestFactory().post('/profiler/', dict(n_requests=2, pattern='^/post/',
+                                                           interval=0.001))
+        request.user = user
+        request.user.is_verified = lambda: True
+        self.assertEqual(views_admin.profiler_view(request).status_code, 403)
+        user.is_superuser = True
+        r = views_admin.profiler_view(request)
+        self.assertEqual(r.status_code, 302)
+        session = profiler.active()
+        self.assertIsNotNone(session)
+        self.client.get('/time/')      # does not match
+        for _ in range(3):
+            r = self.client.post('/post/%s'%device_id, b'{}', content_type='application/json')
+            self.assertEqual(r.status_code, 200)
+        self.assertIsNone(profiler.active())
+        results = profiler.list_results()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['requests_profiled'], 2)
+        request = RequestFactory().get('/profiler/')
+        request.user = user
+        self.assertIn(session.name, views_admin.profiler_view(request).render().content.decode())
+
+        request = RequestFactory().get('/profiler/%s.txt'%session.name)
+        request.user = user
+        r = views_admin.profiler_download(request, session.name)
+        self.assertEqual(r.status_code, 200)
+        with self.assertRaises(Exception):
+            views_admin.profiler_download(request, '../../etc/passwd')
+
+
+
+class AuditLogTest(TestCase):
+    def test_order_under_load(self):
+        """Per-thread order is kept, critical items are never lost."""
+        import threading
+        from kdata import logs
+        written = [ ]
+        writer = logs.BufferedWriter(written.extend, maxsize=50, batch=10, interval=0.005)
+        n_threads, n_items = 8, 500
+        def produce(thread):
+            for i in range(n_items):
+                writer.put((thread, i), critical=(i % 10 == 0))
+        threads = [threading.Thread(target=produce, args=(t, )) for t in range(n_threads)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        writer.close()
+        stats = writer.stats()
+        self.assertEqual(len(written) + stats['dropped'], n_threads * n_items)
+        self.assertEqual(stats['written'], len(written))
+        self.assertEqual(stats['queued'], 0)
+        for thread in range(n_threads):
+            seq = [i for t, i in written if t == thread]
+            self.assertEqual(seq, sorted(seq))
+            self.assertTrue(set(range(0, n_items, 10)) <= set(seq))
+
+    def test_flush_and_close(self):
+        from kdata import logs
+        written = [ ]
+        writer = logs.BufferedWriter(written.extend, maxsize=100, batch=1000, interval=60)
+        for i in range(5):
+            writer.put(i)
+        self.assertEqual(written, [ ])
+        writer.flush()
+        self.assertEqual(written, [0, 1, 2, 3, 4])
+        writer.put(5)
+        writer.close()
+        self.assertEqual(written, list(range(6)))
+        writer.put(6)        # after close: written directly
+        self.assertEqual(written, list(range(7)))
+        # Full and not critical: dropped.
+        writer = logs.BufferedWriter(written.extend, maxsize=1, batch=1000, interval=60)
+        self.assertTrue(writer.put('a'))
+        self.assertFalse(writer.put('b'))
+        self.assertTrue(writer.put('c', critical=True))
+        self.assertEqual(written[-2:], ['a', 'c'])
+        self.assertEqual(writer.stats()['dropped'], 1)
+        writer.close()
+
+    def test_log(self):
+        from django.test import RequestFactory
+        from kdata import logs
+        user = models.User.objects.create_user('log-user')
+        request = RequestFactory().get('/devices/abc/X', dict(a='1'))
+        request.user = user
+        with self.assertLogs('kdata.datalog', 'INFO') as cm:
+            logs.log(request, 'get device data', obj='abc', op='get_data', data_of=user)
+            logs.log(request, 'device data denied', obj='abc', op='denied_get_data')
+            logs.flush()
+        self.assertEqual(len(cm.output), 2)
+        self.assertIn('/devices/abc/X?a=1 o=abc op=get_data u=log-user data_of=log-user',
+                      cm.output[0])
+        self.assertIn('denied_get_data', cm.output[1])
+        # Data access is never dropped.
+        for op in ('get_data', 'group_data', 'export_download', 'denied_get_data', 'register'):
+            self.assertTrue(logs.is_critical(op), op)
+        self.assertFalse(logs.is_critical('update'))
+        self.assertFalse(logs.is_critical(None))
+
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        from datetime import datetime, timedelta, timezone
+        from kdata import util
+        self.device_id = util.add_checkdigits('0011223344556677')
+        self.user = models.User.objects.create_user('page-user')
+        models.Device(user=self.user, name='p', type='kdata.devices.purplerobot.PurpleRobot',
+                      device_id=self.device_id, _public_id=self.device_id[:6],
+                      _secret_id=self.device_id).save()
+        t0 = datetime(2017, 1, 1, tzinfo=timezone.utc)
+        # Groups of three with the same ts, to need the id tie-breaker.
+        for i in range(100):
+            # ts is auto_now_add, so it has to be updated afterwards.
+            row = models.Data.objects.create(device_id=self.device_id, ip='127.0.0.1',
+                                             data_length=2, data='[]')
+            models.Data.objects.filter(id=row.id).update(
+                ts=t0 + timedelta(seconds=i//3, microseconds=7))
+        self.queryset = models.Data.objects.filter(device_id=self.device_id)
+        self.all_keys = list(self.queryset.order_by('ts', 'id').values_list('ts', 'id'))
+
+    def test_walk(self):
+        from kdata import util
+        for descending in (False, True):
+            expected = self.all_keys[::-1] if descending else self.all_keys
+            # Forwards from the first page.
+            keys, has_prev, has_next = util.keyset_page(self.queryset, 7, first=True,
+                                                        descending=descending)
+            self.assertFalse(has_prev)
+            got = list(keys)
+            while has_next:
+                after = util.parse_cursor(util.cursor_token(*keys[-1]))
+                keys, has_prev, has_next = util.keyset_page(self.queryset, 7, after=after,
+                                                            descending=descending)
+                self.assertTrue(has_prev)
+                got.extend(keys)
+            self.assertEqual(got, expected)
+            # Backwards from the last page.
+            keys, has_prev, has_next = util.keyset_page(self.queryset, 7, descending=descending)
+            self.assertFalse(has_next)
+            got = list(keys)
+            while has_prev:
+                keys, has_prev, has_next = util.keyset_page(self.queryset, 7, before=keys[0],
+                                                            descending=descending)
+                got[:0] = keys
+            self.assertEqual(got, expected)
+        # Jump to a date.
+        at = self.all_keys[50][0]
+        keys, has_prev, has_next = util.keyset_page(self.queryset, 5, at=at)
+        self.assertEqual(keys[0][0], at)
+        self.assertTrue(has_prev and has_next)
+        with self.assertRaises(ValueError):
+            util.parse_cursor('123')
+        for token in ('%d_1'%10**30, '-%d_1'%10**30, '%d_1'%10**20):
+            with self.assertRaises(ValueError):
+                util.parse_cursor(token)
+
+    def test_view(self):
+        from django.db import connection
+        from django.test import RequestFactory
+        from django.test.utils import CaptureQueriesContext
+        from kdata import exceptions, util, views_data
+        def get(params):
+            request = RequestFactory().get('/devices/%s/PRBattery'%self.device_id[:6], params)
+            request.user = self.user
+            r = views_data.device_data(request, self.device_id[:6], 'PRBattery', None)
+            r.render()
+            return r
+        n_queries = [ ]
+        for params in (dict(first=1), dict(after=util.cursor_token(*self.all_keys[60])), { }):
+            with CaptureQueriesContext(connection) as queries:
+                get(params)
+            n_queries.append(len(queries))
+            self.assertNotIn('COUNT(', ' '.join(q['sql'] for q in queries))
+            self.assertNotIn('OFFSET', ' '.join(q['sql'] for q in queries))
+        self.assertEqual(len(set(n_queries)), 1, n_queries)
+        r = get(dict(first=1))
+        self.assertIn('next &rarr;', r.content.decode())
+        self.assertNotIn('previous', r.content.decode())
+        r = get(dict(at='2017-01-01 02:00:20'))   # TIME_ZONE is UTC+2
+        self.assertIn('previous', r.content.decode())
+        self.assertEqual(r.context_data['page_start'], self.all_keys[60][0])
+        with self.assertRaises(exceptions.BaseMessageKootaException):
+            get(dict(after='x'))
+
+
+
+from kdata import converter as _converter, group as _group
+class ExportTestGroup(_group.BaseGroup):
+    converters = [type('PRBattery', (_group._GroupConverter, ),
+                       dict(converter=_converter.PRBattery,
+                            device_class='kdata.devices.purplerobot.PurpleRobot'))]
+
+class ExportJobTest(TestCase):
+    def setUp(self):
+        import tempfile
+        from unittest import mock
+        from kdata import export, util
+        self.patch = mock.patch.object(export, 'EXPORT_DIR', tempfile.mkdtemp())
+        self.patch.start()
+        self.addCleanup(self.patch.stop)
+        self.user = models.User.objects.create_user('export-user')
+        label = models.DeviceLabel.objects.create(name='Primary', slug='primary', analyze=True)
+        self.group = models.Group.objects.create(slug='export-group', name='Export group',
+                                                 pyclass='kdata.tests.ExportTestGroup')
+        models.GroupResearcher.objects.create(group=self.group, user=self.user)
+        self.devices = [ ]
+        for i in range(3):
+            subject = self.user if i == 0 else models.User.objects.create_user('export-subject-%d'%i)
+            models.GroupSubject.objects.create(group=self.group, user=subject)
+            device_id = util.add_checkdigits('e%d'%i + '0'*14)
+            device = models.Device(user=subject, name='d%d'%i,
+                                   type='kdata.devices.purplerobot.PurpleRobot', label=label,
+                                   device_id=device_id, _public_id=device_id[:6],
+                                   _secret_id=device_id)
+            device.save()
+            self.devices.append(device)
+            for j in range(20):
+                models.Data.objects.create(device_id=device_id, ip='127.0.0.1', data=json.dumps(
+                    [dict(PROBE='edu.northwestern.cbits.purple_robot_manager.probes.builtin.BatteryProbe',
+                          TIMESTAMP=1500000000+j, level=j, plugged=i)]))
+
+    def read(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_device_export(self):
+        from django.test import RequestFactory
+        from kdata import jobs, views_data
+        device = self.devices[0]
+        self.client.force_login(self.user)
+        r = self.client.post('/export/create', dict(device=device.public_id, converter='PRBattery',
+                                                    format='csv'))
+        job = models.ExportJob.objects.get()
+        self.assertRedirects(r, '/export/%d/'%job.id, fetch_redirect_response=False)
+        self.assertEqual(job.state, 'queued')
+        self.assertEqual(jobs.run_one('w1').id, job.job_id)
+        self.assertIsNone(jobs.run_one('w1'))
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.n_units_done, job.n_rows), ('done', 1, 20))
+        self.assertContains(self.client.get('/export/%d/'%job.id), 'Download')
+        # Same as the direct download.
+        request = RequestFactory().get('/devices/%s/PRBattery.csv'%device.public_id)
+        request.user = self.user
+        direct = self.read(views_data.device_data(request, device.public_id, 'PRBattery', 'csv'))
+        r = self.client.get('/export/%d/download'%job.id)
+        self.assertEqual(r['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.read(r), direct)
+        # Ranges
+        r = self.client.get('/export/%d/download'%job.id, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r['Content-Range'], 'bytes 10-19/%d'%len(direct))
+        self.assertEqual(self.read(r), direct[10:20])
+        r = self.client.get('/export/%d/download'%job.id, HTTP_RANGE='bytes=-5')
+        self.assertEqual(self.read(r), direct[-5:])
+        r = self.client.get('/export/%d/download'%job.id, HTTP_RANGE='bytes=%d-'%len(direct))
+        self.assertEqual(r.status_code, 416)
+        # Only the owner
+        other = models.User.objects.create_user('export-other')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get('/export/%d/download'%job.id).status_code, 403)
+        r = self.client.post('/export/create', dict(device=device.public_id, converter='PRBattery',
+                                                    format='csv'))
+        self.assertEqual(r.status_code, 403)
+
+    def test_group_resume(self):
+        from unittest import mock
+        from django.utils import timezone
+        from kdata import export, jobs
+        def make():
+            job = models.ExportJob.objects.create(user=self.user, group=self.group,
+                                                  converter='PRBattery', format='json')
+            job.job = jobs.enqueue('export', dict(id=job.id))
+            job.save()
+            return job
+        job = make()
+        rows = export._GroupExport.rows
+        calls = [ ]
+        failed = [ ]
+        def failing_rows(self, unit):
+            calls.append(unit)
+            if len(calls) == 2 and not failed:
+                failed.append(unit)
+                raise RuntimeError("worker died")
+            return rows(self, unit)
+        with mock.patch.object(export._GroupExport, 'rows', failing_rows):
+            jobs.run_one('w1')
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.n_units, job.n_units_done), ('running', 3, 1))
+        self.assertIn('worker died', job.error)
+        # Retried after a backoff, from the second device.
+        self.assertIsNone(jobs.run_one('w2'))
+        models.Job.objects.update(run_after=timezone.now())
+        calls.clear()
+        with mock.patch.object(export._GroupExport, 'rows', failing_rows):
+            jobs.run_one('w2')
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.n_rows, len(calls)), ('done', 60, 2))
+        data = json.loads(open(export.result_path(job)).read())
+        self.assertEqual(len(data), 60)
+        self.assertEqual(sorted(map(tuple, data)), sorted(set(map(tuple, data))))
+        # Same rows as an uninterrupted export.
+        job2 = make()
+        jobs.run_one('w1')
+        self.assertEqual(sorted(data), sorted(json.loads(open(export.result_path(job2)).read())))
+        # Cancelling
+        job3 = make()
+        export.cancel(job3)
+        self.assertIsNone(jobs.run_one('w1'))
+        self.assertEqual(models.Job.objects.get(id=job3.job_id).state, 'cancelled')
+
+
+
+from kdata import jobs as _jobs
+_job_calls = [ ]
+def _job_failed(job, error, final):
+    _job_calls.append(('failed', job.id, final))
+@_jobs.register('test_job', concurrency=1, max_attempts=2, backoff=10, on_failure=_job_failed)
+def _test_job(ctx):
+    _job_calls.append((ctx.job.id, ctx.checkpoint))
+    if ctx.args.get('fail'):
+        ctx.save_checkpoint(dict(step=1))
+        raise RuntimeError("failing on purpose")
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        _job_calls.clear()
+
+    def test_priority_concurrency(self):
+        from kdata import jobs
+        low = jobs.enqueue('test_job')
+        high = jobs.enqueue('test_job', priority=5)
+        other = jobs.enqueue('test_job:other')
+        self.assertEqual(jobs.lease('w1').id, high.id)
+        # test_job is at its limit, its :other variant has its own.
+        self.assertEqual(jobs.lease('w1').id, other.id)
+        self.assertIsNone(jobs.lease('w1'))
+        jobs.run(models.Job.objects.get(id=high.id), 'w1')
+        self.assertEqual(jobs.lease('w1', types=['test_job']).id, low.id)
+        self.assertEqual(models.Job.objects.get(id=high.id).state, 'done')
+        self.assertEqual(jobs.enqueue('test_job', unique=True).id, low.id)
+        with self.assertRaises(ValueError):
+            jobs.enqueue('no_such_type')
+
+    def test_retry(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from kdata import jobs
+        job = jobs.enqueue('test_job', dict(fail=True))
+        jobs.run_one('w1')
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.attempts), ('queued', 1))
+        self.assertIn('failing on purpose', job.error)
+        self.assertAlmostEqual((job.run_after - timezone.now()).total_seconds(), 10, delta=2)
+        self.assertIsNone(jobs.run_one('w1'))
+        models.Job.objects.update(run_after=timezone.now())
+        jobs.run_one('w1')
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'failed')
+        # The second attempt saw the checkpoint of the first.
+        self.assertEqual(_job_calls, [(job.id, None), ('failed', job.id, False),
+                                      (job.id, dict(step=1)), ('failed', job.id, True)])
+
+    def test_expired_lease(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from kdata import jobs
+        job = jobs.enqueue('test_job')
+        leased = jobs.lease('w1')
+        ctx = jobs.Context(leased, 'w1')
+        ctx.heartbeat()
+        self.assertIsNone(jobs.lease('w2'))
+        # The worker died: its lease expires and w2 takes over.
+        models.Job.objects.update(lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(jobs.lease('w2').attempts, 2)
+        with self.assertRaises(jobs.LeaseLost):
+            ctx.heartbeat()
+        # After max_attempts expired leases it is failed.
+        models.Job.objects.update(lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(jobs.lease('w3'))
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(_job_calls, [('failed', job.id, True)])
+
+    def test_enqueue_command(self):
+        from django.core.management import call_command
+        call_command('enqueue', 'command:PR_missingdata', '--', '--history', '3',
+                     stdout=open(os.devnull, 'w'))
+        job = models.Job.objects.get()
+        self.assertEqual((job.type, json.loads(job.args)),
+                         ('command:PR_missingdata', dict(argv=['--history', '3'])))
+        # Commands run once, unless enqueued as safe to repeat.
+        self.assertEqual(job.max_attempts, 1)
+        call_command('enqueue', '--max-attempts', '3', 'command:PR_missingdata',
+                     stdout=open(os.devnull, 'w'))
+        self.assertEqual(models.Job.objects.order_by('id').last().max_attempts, 3)
+
+
+from django.test import TransactionTestCase
+class JobLeaseThreadsTest(TransactionTestCase):
+    def test_threads(self):
+        """Every job is leased exactly once by concurrent workers (the
+        SQLite lock fallback)."""
+        import threading
+        from django.db import connection
+        from kdata import jobs
+        ids = [jobs.enqueue('test_job:%d'%i).id for i in range(30)]
+        leased = [ ]
+        def worker(n):
+            try:
+                while True:
+                    job = jobs.lease('w%d'%n)
+                    if job is None:
+                        return
+                    leased.append(job.id)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=worker, args=(n, )) for n in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(sorted(leased), ids)
+
+
+
+class ScrapeTest(TransactionTestCase):
+    """kdata/scrape.py with the twitter scraper, against a local
+    stand-in of the API."""
+    def serve(self):
+        import http.server, threading, time
+        from urllib.parse import urlparse, parse_qs
+        state = dict(tweets=list(range(1, 6)), requests=[ ], in_flight=0, max_in_flight=0,
+                     limited=set())
+        lock = threading.Lock()
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = { k:v[0] for k,v in parse_qs(url.query).items() }
+                endpoint = url.path[len('/1.1/'):-len('.json')]
+                token = self.headers['Authorization'].split('oauth_token="')[1].split('"')[0]
+                with lock:
+                    state['requests'].append((token, endpoint, query))
+                    state['in_flight'] += 1
+                    state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+                try:
+                    time.sleep(.05)
+                    self.respond(token, endpoint, query)
+                finally:
+                    with lock:
+                        state['in_flight'] -= 1
+            def respond(self, token, endpoint, query):
+                headers = { }
+                if token == 'slow':
+                    status, body = 429, dict(errors=[dict(code=88)])
+                    headers['X-Rate-Limit-Reset'] = str(int(time.time()) + 900)
+                elif endpoint == 'statuses/user_timeline' and (token, endpoint) not in state['limited']:
+                    # Everyone is rate limited once, and may retry at once.
+                    state['limited'].add((token, endpoint))
+                    status, body = 429, dict(errors=[dict(code=88)])
+                    headers['Retry-After'] = '0'
+                elif endpoint == 'account/verify_credentials':
+                    status, body = 200, dict(id=1, screen_name='user-'+token)
+                elif endpoint == 'statuses/user_timeline':
+                    since_id = int(query.get('since_id', 0))
+                    status, body = 200, [ dict(id=i, text='tweet %d'%i, created_at='x')
+                                          for i in state['tweets'] if i > since_id ]
+                elif endpoint == 'friends/ids':
+                    if query.get('cursor') == '7':
+                        status, body = 200, dict(ids=[3], next_cursor=0)
+                    else:
+                        status, body = 200, dict(ids=[1, 2], next_cursor=7)
+                else:
+                    status, body = 200, [ ]
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%d/1.1/%%s.json'%server.server_port, state
+
+    def setUp(self):
+        from unittest import mock
+        from kdata import scrape, util
+        from kdata.devices import twitter
+        api_base, self.state = self.serve()
+        for patch in [mock.patch.object(twitter, 'API_BASE', api_base),
+                      mock.patch.object(twitter, 'client_key', 'key'),
+                      mock.patch.object(twitter, 'client_secret', 'secret'),
+                      mock.patch.dict(scrape.RATE_LIMITS, twitter=dict(api=(100, 10), token=(100, 10))),
+                      mock.patch.dict(scrape._buckets, clear=True)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        user = models.User.objects.create_user('scrape-user')
+        self.devices = { }
+        for i, token in enumerate(['tok0', 'tok1', 'tok2', 'slow']):
+            device_id = util.add_checkdigits('5c%d'%i + '0'*13)
+            self.devices[token] = models.OauthDevice.objects.create(
+                user=user, name=token, type='kdata.devices.twitter.Twitter', device_id=device_id,
+                _public_id=device_id[:6], _secret_id=device_id, state='linked',
+                resource_key=token, resource_secret='secret-'+token)
+
+    def packets(self, token, endpoint):
+        rows = models.Data.objects.filter(device_id=self.devices[token].device_id).order_by('id')
+        return [ json.loads(p['data']) for p in map(json.loads, rows.values_list('data', flat=True))
+                 if p['endpoint'] == endpoint ]
+
+    def test_scrape_all(self):
+        from kdata.devices import twitter
+        failed = twitter.scrape_all(save_data=True)
+        # The account which is rate limited for 15 minutes is given up.
+        self.assertEqual(failed, [self.devices['slow'].public_id])
+        self.assertGreater(self.state['max_in_flight'], 1)
+        for token in ['tok0', 'tok1', 'tok2']:
+            # Retried after the 429, only allowed fields are saved.
+            self.assertEqual(self.packets(token, 'statuses/user_timeline'),
+                             [[dict(id=i, created_at='x') for i in range(1, 6)]])
+            # Both pages of the cursor.
+            self.assertEqual([p['ids'] for p in self.packets(token, 'friends/ids')], [[1, 2], [3]])
+            self.assertEqual(self.devices[token].attrs['last-id-user-timeline'], '5')
+        self.assertEqual(models.Data.objects.filter(
+            device_id=self.devices['slow'].device_id).count(), 0)
+
+        # Fetched recently: nothing is done.
+        n_requests = len(self.state['requests'])
+        twitter.scrape_all(save_data=True)
+        self.assertEqual(len(self.state['requests']), n_requests)
+
+        # Next run: only the new tweets.
+        models.OauthDevice.objects.update(ts_last_fetch=None)
+        self.state['tweets'].extend([6, 7])
+        twitter.scrape_all(save_data=True)
+        self.assertIn(('tok0', 'statuses/user_timeline',
+                       dict(screen_name='user-tok0', include_rts='false', since_id='5')),
+                      self.state['requests'])
+        self.assertEqual([t['id'] for t in self.packets('tok0', 'statuses/user_timeline')[-1]],
+                         [6, 7])
+        self.assertEqual(self.devices['tok0'].attrs['last-id-user-timeline'], '7')
+
+    def test_token_bucket(self):
+        from kdata import scrape
+        now = [0.0]
+        def sleep(t):
+            now[0] += t
+        bucket = scrape.TokenBucket(rate=2, burst=3, clock=lambda: now[0], sleep=sleep)
+        for i in range(9):
+            bucket.acquire()
+        # Three at once, then two per second.
+        self.assertAlmostEqual(now[0], 3.0)
+        bucket.block(10)
+        bucket.acquire()
+        self.assertAlmostEqual(now[0], 13.0)
+
+
+
+class IngestRateLimitTest(TestCase):
+    def setUp(self):
+        from unittest import mock
+        from django.core.cache import caches
+        from kdata import ratelimit, util
+        self.now = [1500000000000]
+        for patch in [mock.patch.object(ratelimit, '_now_ms', lambda: self.now[0]),
+                      mock.patch.object(ratelimit, 'LIMITS', dict(device=(2, 5), ip=(100, 1000))),
+                      mock.patch.dict(ratelimit._limiters, clear=True)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        caches[ratelimit.CACHE].clear()
+        self.user = models.User.objects.create_user('ratelimit-user')
+        self.device_ids = [ ]
+        for i in range(4):
+            device_id = util.add_checkdigits('7a%d'%i + '0'*13)
+            models.Device.objects.create(user=self.user, name='d%d'%i, device_id=device_id,
+                                         type='kdata.devices.purplerobot.PurpleRobot',
+                                         _public_id=device_id[:6], _secret_id=device_id)
+            self.device_ids.append(device_id)
+
+    def post(self, device_id, ip):
+        return self.client.post('/post/', dict(device_id=device_id, data='[]'), REMOTE_ADDR=ip)
+
+    def test_fairness(self):
+        """One device floods (100/s), three send once a second, for 10
+        seconds of (simulated) time."""
+        from collections import Counter
+        from kdata import ratelimit
+        flooder = self.device_ids[0]
+        status = { device_id: Counter() for device_id in self.device_ids }
+        for step in range(1000):
+            self.now[0] += 10
+            r = self.post(flooder, '10.0.0.1')
+            status[flooder][r.status_code] += 1
+            if r.status_code == 429:
+                self.assertGreaterEqual(int(r['Retry-After']), 1)
+            if step % 100 == 0:
+                for i, device_id in enumerate(self.device_ids[1:]):
+                    r = self.post(device_id, '10.0.1.%d'%i)
+                    status[device_id][r.status_code] += 1
+        # The flooder gets its burst plus the rate, the others everything.
+        self.assertAlmostEqual(status[flooder][200], 5 + 2*10, delta=2)
+        self.assertEqual(status[flooder][429], 1000 - status[flooder][200])
+        for device_id in self.device_ids[1:]:
+            self.assertEqual(status[device_id], Counter({200: 10}))
+        self.assertEqual(models.Data.objects.filter(device_id=flooder).count(), status[flooder][200])
+        # Counters, most of the denials did not need the cache.
+        stats = ratelimit.stats()['device']
+        self.assertEqual(stats['denied'], status[flooder][429])
+        self.assertGreater(stats['fast'], stats['shared'])
+        self.assertEqual(stats['top_denied'], [(flooder, status[flooder][429])])
+
+    def test_ip_and_exempt(self):
+        from unittest import mock
+        from kdata import ratelimit
+        # Four devices behind one address: the per-IP limit applies.
+        with mock.patch.object(ratelimit, 'LIMITS', dict(device=(100, 100), ip=(1, 3))), \
+             mock.patch.dict(ratelimit._limiters, clear=True):
+            codes = [self.post(device_id, '10.0.2.1').status_code for device_id in self.device_ids]
+            self.assertEqual(codes, [200, 200, 200, 429])
+        # Exempt device classes are not limited at all.
+        with mock.patch.object(ratelimit, 'EXEMPT', {'PurpleRobot'}), \
+             mock.patch.object(ratelimit, '_exempt', None):
+            codes = set(self.post(self.device_ids[0], '10.0.3.1').status_code for i in range(20))
+            self.assertEqual(codes, {200})
+            self.assertEqual(ratelimit.stats()['device']['exempt'], 20)
+
+    def test_before_body(self):
+        """A device_id from the URL or header is limited before the
+        device code reads the body."""
+        from unittest import mock
+        from kdata.devices.purplerobot import PurpleRobot
+        device_id = self.device_ids[0]
+        with mock.patch.object(PurpleRobot, 'post', side_effect=AssertionError) as post:
+            for i in range(5):
+                self.client.post('/post/', dict(device_id=device_id, data='[]'),
+                                 REMOTE_ADDR='10.0.4.1')
+            r = self.client.post('/post/purple/%s'%device_id, dict(json='{}'),
+                                 REMOTE_ADDR='10.0.4.1')
+            self.assertEqual(r.status_code, 429)
+            r = self.client.post('/post/purple/', dict(json='{}'), REMOTE_ADDR='10.0.4.1',
+                                 HTTP_DEVICE_ID=device_id)
+            self.assertEqual(r.status_code, 429)
+            self.assertFalse(post.called)
+
+
+
+class QuarantineTest(TestCase):
+    """Invalid packets go to the quarantine, not to the data."""
+    def setUp(self):
+        from kdata import ingest, util
+        ingest._device_types.clear()
+        self.user = models.User.objects.create_user('quarantine-user')
+        self.device_id = util.add_checkdigits('9b'+'0'*13)
+        models.Device.objects.create(user=self.user, name='pr', device_id=self.device_id,
+                                     type='PurpleRobot', _public_id=self.device_id[:6],
+                                     _secret_id=self.device_id)
+
+    def post(self, data):
+        return self.client.post('/post/', dict(device_id=self.device_id, data=data))
+
+    def test_post(self):
+        from kdata import ingest
+        probes = json.dumps([dict(PROBE='x.y.ScreenProbe', TIMESTAMP=1500000000,
+                                  SCREEN_ACTIVE=True)])
+        self.assertNotIn('quarantined', self.post(probes).json())
+        for data in (probes[:-10], probes[:-10], '{"a": 1}', 'Sää\x00'+probes, probes+'  x'):
+            r = self.post(data)
+            self.assertEqual(r.status_code, 200)
+            self.assertTrue(r.json()['quarantined'])
+        # Only the valid packet is data (saved as bytes, like all posted data).
+        import ast
+        rows = models.Data.objects.filter(device_id=self.device_id)
+        self.assertEqual([ast.literal_eval(x.data).decode() for x in rows], [probes])
+        # The same packet is quarantined once.
+        reasons = [q.reason for q in models.QuarantinedData.objects.order_by('id')]
+        self.assertEqual(len(reasons), 4)
+        self.assertTrue(reasons[0].startswith('truncated JSON'))
+        self.assertTrue(reasons[1].startswith('not JSON'))
+        self.assertEqual(reasons[2], 'binary data (NUL bytes)')
+        # Reprocessing: still invalid, unless forced.
+        q = models.QuarantinedData.objects.order_by('id').first()
+        self.assertIsNotNone(ingest.reprocess(q))
+        self.assertIsNone(ingest.reprocess(q, force=True))
+        self.assertEqual(q.state, 'reprocessed')
+        self.assertEqual(models.Data.objects.get(id=q.data_id).data, probes[:-10])
+        self.assertEqual(ingest.reprocess(q, force=True), 'already reprocessed')
+        # Size limits.
+        from unittest import mock
+        from kdata.devices.purplerobot import PurpleRobot
+        with mock.patch.object(PurpleRobot, 'max_packet_size', 10):
+            self.assertTrue(PurpleRobot.validate_packet(probes).startswith('too large'))
+        self.assertIsNone(PurpleRobot.validate_packet(probes.encode()))
+        self.assertEqual(PurpleRobot.validate_packet(b'[\xff\xfe]'), 'binary data (not UTF-8)')
+
+    def test_scan(self):
+        from django.core.management import call_command
+        from io import StringIO
+        good = models.Data.objects.create(device_id=self.device_id, data='[]', ip='127.0.0.1')
+        bad = models.Data.objects.create(device_id=self.device_id, data='[{"a', ip='127.0.0.1')
+        out = StringIO()
+        call_command('quarantine', scan='PurpleRobot', stdout=out)
+        self.assertIn('1 invalid packets', out.getvalue())
+        self.assertEqual(models.Data.objects.count(), 2)
+        call_command('quarantine', scan='all', move=True, stdout=out)
+        self.assertEqual(list(models.Data.objects.values_list('id', flat=True)), [good.id])
+        q = models.QuarantinedData.objects.get()
+        self.assertEqual((q.data_id, q.data, q.ts), (bad.id, bad.data, bad.ts))
+        call_command('quarantine', q.id, discard=True, stdout=out)
+        self.assertEqual(models.QuarantinedData.objects.get().state, 'discarded')
+
+
+
+class RechunkTest(TestCase):
+    """Split packets convert to the same rows as the originals."""
+    def setUp(self):
+        from kdata import ingest, util
+        ingest._device_types.clear()
+        self.user = models.User.objects.create_user('rechunk-user')
+        self.device_ids = { }
+        for i, type_ in enumerate(['PurpleRobot', 'Aware', 'Ios']):
+            device_id = util.add_checkdigits('8c%d'%i + '0'*12)
+            models.Device.objects.create(user=self.user, name=type_, device_id=device_id,
+                                         type=type_, _public_id=device_id[:6],
+                                         _secret_id=device_id)
+            self.device_ids[type_] = device_id
+
+    def save(self, type_, packets):
+        from django.utils import timezone
+        from django.utils.timezone import utc
+        for ts, data in packets:
+            row = models.Data.objects.create(device_id=self.device_ids[type_], ip='127.0.0.1',
+                                             data=data, data_length=len(data))
+            models.Data.objects.filter(id=row.id).update(ts=timezone.make_aware(ts, utc))
+
+    def convert(self, type_, converters):
+        rows = (models.Data.objects.filter(device_id=self.device_ids[type_])
+                .order_by('ts', 'id').values_list('ts', 'data'))
+        return [ list(c(list(rows)).run()) for c in converters ]
+
+    def test_rechunk(self):
+        from django.core.management import call_command
+        from io import StringIO
+        from kdata import converter
+        from kdata.bench import generators
+        cases = [
+            ('PurpleRobot', generators.purple_robot(1, n_packets=3, probes_per_packet=200),
+             [converter.PRProbes, converter.PRTimestamps, converter.PRScreen]),
+            ('Aware', generators.aware('accelerometer', converter.AwareAccelerometer.fields,
+                                       rnd=1, n_packets=3, rows_per_packet=300),
+             [converter.AwareTimestamps, converter.AwareAccelerometer]),
+            ('Ios', generators.ios(1, n_packets=3, rows_per_packet=200),
+             [converter.IosTimestamps, converter.IosLocation, converter.IosScreen]),
+            ]
+        for type_, packets, converters in cases:
+            self.save(type_, packets)
+            before = self.convert(type_, converters)
+            self.assertTrue(all(before), type_)
+            n_before = models.Data.objects.filter(device_id=self.device_ids[type_]).count()
+            call_command('rechunk', type=type_, max_bytes=8000, stdout=StringIO())
+            self.assertEqual(self.convert(type_, converters), before)
+            call_command('rechunk', type=type_, max_bytes=8000, live=True, stdout=StringIO())
+            rows = models.Data.objects.filter(device_id=self.device_ids[type_])
+            self.assertGreater(rows.count(), 3*n_before, type_)
+            self.assertLessEqual(max(len(x.data) for x in rows), 8000, type_)
+            self.assertEqual(self.convert(type_, converters), before, type_)
+
+    def test_ingest_and_job(self):
+        from unittest import mock
+        from kdata import jobs, rechunk, views
+        from kdata.bench import generators
+        device_id = self.device_ids['PurpleRobot']
+        packets = generators.purple_robot(2, n_packets=2, probes_per_packet=100)
+        with mock.patch.object(rechunk, 'MAX_BYTES', 4000):
+            row_id = views.save_data(packets[0][1], device_id)
+        rows = models.Data.objects.filter(device_id=device_id).order_by('ts', 'id')
+        self.assertEqual(rows[0].id, row_id)
+        self.assertGreater(len(rows), 1)
+        self.assertEqual([p for x in rows for p in json.loads(x.data)], json.loads(packets[0][1]))
+        # Existing rows, as a background job.
+        models.Data.objects.all().delete()
+        self.save('PurpleRobot', packets)
+        job = jobs.enqueue('rechunk', dict(device_type='PurpleRobot', max_bytes=4000))
+        jobs.run_one('test')
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'done')
+        rows = rows.all()
+        self.assertGreater(len(rows), 2)
+        self.assertEqual([p for x in rows for p in json.loads(x.data)],
+                         [p for ts, data in packets for p in json.loads(data)])
+
+    def test_split_before_check(self):
+        """Packets over the ingest size limit are split, not
+        quarantined, and all new rows are compressed."""
+        from unittest import mock
+        from kdata import codec, ingest, rechunk, views
+        from kdata.bench import generators
+        device_id = self.device_ids['PurpleRobot']
+        packets = generators.purple_robot(3, n_packets=3, probes_per_packet=100)
+        items = [p for ts, data in packets for p in json.loads(data)]
+        with mock.patch.object(rechunk, 'MAX_BYTES', 4000), \
+             mock.patch.object(ingest, 'MAX_PACKET_SIZE', 6000), \
+             mock.patch.object(codec, 'COMPRESSION', 'zlib'):
+            self.assertGreater(len(packets[0][1]), 6000)
+            self.assertIsNotNone(views.save_data(packets[0][1], device_id))
+            n = views.save_data_many([data for ts, data in packets[1:]], device_id)
+            self.assertGreater(n, 2)
+            self.assertEqual(models.QuarantinedData.objects.count(), 0)
+            # Existing large rows.
+            self.save('PurpleRobot', packets)
+            list(rechunk.rechunk_rows(models.Data.objects.filter(device_id=device_id), 4000))
+        rows = models.Data.objects.filter(device_id=device_id).order_by('id')
+        self.assertTrue(all(x.encoding == 'zlib' for x in rows))
+        self.assertLessEqual(max(x.data_length for x in rows), 6000)
+        self.assertEqual([p for x in rows for p in json.loads(x.data)], items + items)
+
+
+
+class AwarePackedTest(TestCase):
+    """Packed AWARE sensor storage gives back exactly the same rows."""
+    def test_round_trip(self):
+        import random
+        from kdata import aware_packed
+        rnd = random.Random(3)
+        for n in (1, 2, 50, 1000):
+            t = 1500000000000
+            rows = [ ]
+            for i in range(n):
+                t += rnd.choice([1, 5, 20, -3, 2**40])
+                rows.append({'_id': i, 'timestamp': t, 'device_id': 'ab-cd',
+                             'double_values_0': rnd.choice([rnd.uniform(-1e5, 1e5), 0.0, -0.0,
+                                                            1e-300, float('inf')]),
+                             'double_values_1': rnd.choice([1.5, 2]),   # int and float
+                             'accuracy': rnd.choice([0, 3, True, None, 2**70]),
+                             'label': rnd.choice(['', 'Sää', {'x': [1]}])})
+            for compress in (True, False):
+                text = aware_packed.encode(rows, compress=compress)
+                self.assertTrue(aware_packed.verify(rows, text))
+                self.assertEqual(json.dumps(aware_packed.decode(text)), json.dumps(rows))
+        # Not packable: different keys.
+        self.assertIsNone(aware_packed.encode([{'a': 1}, {'b': 1}]))
+        self.assertIsNone(aware_packed.encode([{'a': 1, 'b': 2}, {'b': 2, 'a': 1}]))
+        self.assertIsNone(aware_packed.encode([]))
+        self.assertFalse(aware_packed.verify([{'a': 1}], aware_packed.encode([{'a': 1.0}])))
+
+    def test_converters(self):
+        from kdata import converter
+        from kdata.bench import generators
+        for cls in (converter.AwareAccelerometer, converter.AwareGyroscope,
+                    converter.AwareMagnetometer):
+            args = (cls.table, cls.fields + ['accuracy', 'label'])
+            plain = generators.aware(*args, rnd=4, n_packets=3)
+            packed = generators.aware_packed(*args, rnd=4, n_packets=3)
+            self.assertLess(sum(len(d) for t, d in packed), sum(len(d) for t, d in plain)/3)
+            for conv in (cls, converter.AwareTimestamps, converter.AwarePacketTimeRange):
+                rows = list(conv(plain).run())
+                self.assertTrue(rows)
+                if conv is converter.AwarePacketTimeRange:    # (packet_size differs)
+                    rows = [ r[:5] for r in rows ]
+                    self.assertEqual([r[:5] for r in conv(packed).run()], rows)
+                else:
+                    self.assertEqual(list(conv(packed).run()), rows)
+
+    def test_insert(self):
+        from unittest import mock
+        from kdata import aware_packed, converter, util
+        from kdata.devices import aware
+        device_id = util.add_checkdigits('7d'+'0'*13)
+        user = models.User.objects.create_user('packed-user')
+        models.Device.objects.create(user=user, name='aware', device_id=device_id, type='Aware',
+                                     _public_id=device_id[:6], _secret_id=device_id)
+        rows = [{'_id': i, 'timestamp': 1500000000000+20*i, 'device_id': 'x',
+                 'double_values_0': i/7., 'double_values_1': 1.0, 'double_values_2': -i/3.,
+                 'accuracy': 3, 'label': ''} for i in range(1500)]
+        for table in ('accelerometer', 'screen'):
+            with mock.patch.object(aware, 'PACKED_STORAGE', True), \
+                 mock.patch.object(aware, 'PACKED_VERIFY', True):
+                r = self.client.post('/aware/v1/%s/%s/insert'%(device_id, table),
+                                     dict(data=json.dumps(rows)))
+            self.assertEqual(r.status_code, 200)
+        packets = [ json.loads(x.data) for x in models.Data.objects.order_by('id') ]
+        self.assertEqual([(p['table'], p.get('encoding')) for p in packets],
+                         [('accelerometer', 'packed')]*2 + [('screen', None)]*2)
+        self.assertEqual([row for p in packets[:2] for row in converter.aware_rows(p)], rows)
+
+
+class PayloadCodecTest(TestCase):
+    """Compressed rows read back the same data as plain ones."""
+    def setUp(self):
+        from kdata import codec, ingest, util
+        ingest._device_types.clear()
+        codec.clear_cache()
+        self.user = models.User.objects.create_user('codec-user')
+        self.device_id = util.add_checkdigits('9e'+'0'*13)
+        models.Device.objects.create(user=self.user, name='pr', device_id=self.device_id,
+                                     type='PurpleRobot', _public_id=self.device_id[:6],
+                                     _secret_id=self.device_id)
+
+    def test_save_and_read(self):
+        from unittest import mock
+        from kdata import codec, converter, util, views
+        from kdata.bench import generators
+        packets = [ data for ts, data in generators.purple_robot(3, n_packets=4) ]
+        with mock.patch.object(codec, 'COMPRESSION', 'zlib'):
+            ids = [ views.save_data(data, self.device_id) for data in packets ]
+            ids.append(views.save_data('[]', self.device_id))       # too small
+            views.save_data_many(packets[:2], self.device_id)
+            views.save_data(packets[0].encode(), self.device_id)
+        raw = models.Data.objects.order_by('id').values_list('encoding', 'data', 'data_length')
+        self.assertEqual([(e, d) for e, d, l in raw][:4], [('zlib', '')]*4)
+        self.assertEqual(raw[4], ('', '[]', 2))
+        self.assertEqual([l for e, d, l in raw][:4], [len(p) for p in packets])
+        rows = models.Data.objects.order_by('id')
+        self.assertEqual([x.data for x in rows], packets + ['[]'] + packets[:2]
+                                                 + [str(packets[0].encode())])
+        self.assertEqual([x.data for x in util.optimized_queryset_iterator_1(rows)],
+                         [x.data for x in rows])
+        # A deferred compressed row is loaded in one query.
+        row = rows.defer('data', 'data_z').get(id=ids[0])
+        with self.assertNumQueries(1):
+            self.assertEqual(row.data, packets[0])
+        self.assertEqual(row.encoding, 'zlib')
+        self.assertEqual(list(converter.PRTimestamps([(x.ts, x.data) for x in rows[:4]]).run()),
+                         list(converter.PRTimestamps([(x.ts, p) for x, p
+                                                      in zip(rows[:4], packets)]).run()))
+        # Assigning new data makes the row plain.
+        row = rows[0]
+        row.data = '[1]'
+        row.save()
+        row = models.Data.objects.get(id=ids[0])
+        self.assertEqual((row.encoding, row.data_z, row.data), ('', None, '[1]'))
+
+    def test_recompress(self):
+        from django.core.management import call_command
+        from io import StringIO
+        from kdata import jobs
+        from kdata.bench import generators
+        packets = [ data for ts, data in generators.purple_robot(4, n_packets=5) ]
+        for data in packets:
+            models.Data.objects.create(device_id=self.device_id, ip='127.0.0.1', data=data,
+                                       data_length=len(data))
+        rows = models.Data.objects.order_by('id')
+        call_command('recompress', type='PurpleRobot', codec='zlib', batch_size=2,
+                     stdout=StringIO())
+        self.assertEqual([x.encoding for x in rows.all()], ['zlib']*5)
+        self.assertEqual([x.data for x in rows.all()], packets)
+        call_command('recompress', self.device_id[:6], codec='none', stdout=StringIO())
+        self.assertEqual([(x.encoding, x.data) for x in rows.all()], [('', p) for p in packets])
+        job = jobs.enqueue('recompress', dict(device_type='PurpleRobot', codec='zlib'))
+        jobs.run_one('test')
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual([(x.encoding, x.data) for x in rows.all()],
+                         [('zlib', p) for p in packets])
+
+
+class AwareStorageTest(TestCase):
+    """AWARE storage version 2 converts the same as version 1."""
+    def setUp(self):
+        from kdata import ingest, util
+        ingest._device_types.clear()
+        self.user = models.User.objects.create_user('aware-v2-user')
+        self.device_id = util.add_checkdigits('6f'+'0'*13)
+        models.Device.objects.create(user=self.user, name='aware', device_id=self.device_id,
+                                     type='Aware', _public_id=self.device_id[:6],
+                                     _secret_id=self.device_id)
+
+    def convert(self, converters):
+        rows = [ (x.ts, x.data) for x in models.Data.objects.order_by('ts', 'id') ]
+        return [ list(c(rows).run()) for c in converters ]
+
+    def test_upgrade(self):
+        from django.core.management import call_command
+        from io import StringIO
+        from kdata import converter
+        from kdata.bench import generators
+        for ts, data in (generators.aware('accelerometer', converter.AwareAccelerometer.fields,
+                                          rnd=2, n_packets=3)
+                         + generators.aware('screen', converter.AwareScreen.fields, rnd=2,
+                                            n_packets=2)):
+            models.Data.objects.create(device_id=self.device_id, ip='127.0.0.1', data=data,
+                                       data_length=len(data))
+        models.Data.objects.create(device_id=self.device_id, ip='127.0.0.1',
+                                   data=json.dumps(dict(table='study_check', data='{}',
+                                                        version=1)))
+        converters = [converter.AwareAccelerometer, converter.AwareScreen,
+                      converter.AwareTimestamps, converter.AwarePacketTimeRange,
+                      converter.AwareUploads, converter.AwareTableData]
+        before = self.convert(converters)
+        self.assertTrue(all(before))
+        call_command('aware_upgrade', stdout=StringIO())
+        self.assertEqual(models.Data.objects.filter(data__contains='"version": 2').count(), 0)
+        call_command('aware_upgrade', live=True, batch_size=2, stdout=StringIO())
+        packets = [ json.loads(x.data) for x in models.Data.objects.order_by('id') ]
+        self.assertEqual([p.get('version') for p in packets], [2]*5 + [1])
+        self.assertTrue(all(isinstance(p['data'], list) for p in packets[:5]))
+        self.assertEqual(self.convert(converters), before)
+        rows = models.Data.objects.order_by('id')
+        self.assertEqual([x.data_length for x in rows[:5]], [len(x.data) for x in rows[:5]])
+
+    def test_insert_and_split(self):
+        from kdata import converter
+        from kdata.devices import aware
+        rows = [{'_id': i, 'timestamp': 1500000000000+1000*i, 'device_id': 'x',
+                 'screen_status': i%2, 'label': 'Sää "x"'} for i in range(300)]
+        r = self.client.post('/aware/v1/%s/screen/insert'%self.device_id,
+                             dict(data=json.dumps(rows)))
+        self.assertEqual(r.status_code, 200)
+        text = models.Data.objects.get().data
+        packet = json.loads(text)
+        self.assertEqual((packet['version'], packet['data']), (2, rows))
+        self.assertEqual(converter.aware_data_length(packet, text), len(json.dumps(rows)))
+        pieces = aware.Aware.split_packet(text, 4000)
+        self.assertGreater(len(pieces), 2)
+        self.assertTrue(all(len(p) <= 4000 for p in pieces))
+        self.assertEqual([row for p in pieces for row in converter.aware_rows(json.loads(p))],
+                         rows)
+
+
+class JsonPickTest(TestCase):
+    """Partial decoding gives the same as full decoding (randomized)."""
+    def random_value(self, rnd, depth=0):
+        kind = rnd.choice(['int', 'float', 'str', 'lit', 'list', 'dict', 'dict', 'embedded']
+                          if depth < 4 else ['int', 'float', 'str', 'lit'])
+        if kind == 'int':
+            return rnd.choice([0, -1, rnd.randint(-2**70, 2**70)])
+        if kind == 'float':
+            return rnd.choice([0.0, -0.0, 1e-300, 1.5e300, rnd.uniform(-1e6, 1e6)])
+        if kind == 'str':
+            # (Not starting with [ or {, which is taken to be JSON.)
+            return 'a' + ''.join(rnd.choice(['a', ' ', '"', '\\', '\n', '[', '}', ',', ':',
+                                             'ä', ' ', '\U0001f600', '{"x": 1}'])
+                                 for _ in range(rnd.randint(0, 8)))
+        if kind == 'lit':
+            return rnd.choice([True, False, None])
+        if kind == 'list':
+            return [ self.random_value(rnd, depth+1) for _ in range(rnd.randint(0, 4)) ]
+        if kind == 'embedded':
+            return json.dumps(self.random_value(rnd, depth+1))
+        return { rnd.choice(['a', 'b', 'ts', 'x y', '"q"', 'ä', 'data', 'table']) + str(i):
+                     self.random_value(rnd, depth+1) for i in range(rnd.randint(0, 5)) }
+
+    def random_spec(self, rnd, value, depth=0):
+        if isinstance(value, str) and value.lstrip()[:1] in ('[', '{'):
+            value = json.loads(value)
+        if isinstance(value, list) and value and rnd.random() < .8:
+            return self.random_spec(rnd, rnd.choice(value), depth)
+        if not isinstance(value, dict) or rnd.random() < .2 or depth > 4:
+            return None if rnd.random() < .5 or depth == 0 else {'missing': None}
+        keys = [ k for k in value if rnd.random() < .5 ] + ['missing']
+        return { k: self.random_spec(rnd, value.get(k), depth+1) for k in keys }
+
+    def test_random(self):
+        import random
+        from unittest import mock
+        from kdata import jsonpick
+        rnd = random.Random(11)
+        for i in range(3000):
+            value = self.random_value(rnd)
+            spec = self.random_spec(rnd, value) or { }
+            text = json.dumps(value, indent=rnd.choice([None, 0, 2]),
+                              separators=rnd.choice([None, (',', ':')]),
+                              ensure_ascii=rnd.choice([True, False]))
+            expected = json.dumps(jsonpick.project(json.loads(text), spec))
+            for small in (0, jsonpick.SMALL_OBJECT, 10**9):
+                with self.subTest(i=i, text=text, spec=spec, small=small):
+                    with mock.patch.object(jsonpick, 'SMALL_OBJECT', small):
+                        picked = jsonpick.pick(text, spec)
+                    self.assertEqual(json.dumps(jsonpick.project(picked, spec)), expected)
+            if isinstance(value, list):
+                # Sizes are those of the text of each element.
+                items = jsonpick.items(text, spec)
+                self.assertEqual(len(items), len(value))
+                decoder = json.JSONDecoder()
+                i = text.index('[') + 1
+                for picked, size in items:
+                    while text[i] in ' \n,':
+                        i += 1
+                    v, end = decoder.raw_decode(text, i)
+                    self.assertEqual(size, end - i)
+                    self.assertEqual(json.dumps(jsonpick.project(picked, spec)),
+                                     json.dumps(jsonpick.project(v, spec)))
+                    i = end
+            if isinstance(value, dict):
+                # Spans of values, from the start and from the end.
+                decoder = json.JSONDecoder()
+                ends = [ ]
+                for k, v in value.items():
+                    i = jsonpick.find(text, k)
+                    self.assertEqual(decoder.raw_decode(text, i)[0], v)
+                    if isinstance(v, (list, dict)):
+                        ends.append(decoder.raw_decode(text, i)[1])
+                self.assertIsNone(jsonpick.find(text, 'missing'))
+                self.assertEqual(jsonpick.last_end(text), ends[-1] if ends else None)
+
+    def test_converters(self):
+        import collections
+        from unittest import mock
+        from kdata import converter
+        from kdata.bench import generators
+        full = lambda self, data: converter.loads(data)
+        pr = generators.purple_robot(5, n_packets=10)
+        aware = (generators.aware('accelerometer', rnd=5, n_packets=3)
+                 + generators.aware('screen', rnd=5, n_packets=3, version=2)
+                 + generators.aware_packed('gyroscope', rnd=5, n_packets=2)
+                 + [(pr[0][0], json.dumps(dict(table='study_check', data='{"a": 1}')))])
+        for cls, packets in ((converter.PRTimestamps, pr), (converter.AwareTimestamps, aware),
+                             (converter.AwareDataSize, aware)):
+            rows = list(cls(packets).run())
+            self.assertTrue(rows)
+            with mock.patch.object(converter._Converter, 'loads', full):
+                self.assertEqual(rows, list(cls(packets).run()), cls.__name__)
+        # AwareUploads measures the data in the text.
+        self.assertEqual([r[2] for r in converter.AwareUploads(aware).run()],
+                         [converter.aware_data_length(json.loads(text), text)
+                          for ts, text in aware])
+        # PRDataSize counts each probe re-encoded, PRStoredDataSize
+        # its text in the packet (here compact and with non-ASCII
+        # unescaped, unlike dumps()).
+        pr = [ (ts, json.dumps([dict(p, extra='Sää') for p in json.loads(data)],
+                               separators=(',', ':'), ensure_ascii=False))
+               for ts, data in pr ]
+        sizes = collections.defaultdict(int)
+        stored = collections.defaultdict(int)
+        for ts, data in pr:
+            for probe in json.loads(data):
+                sizes[probe['PROBE']] += len(converter.dumps(probe))
+                stored[probe['PROBE']] += len(json.dumps(probe, separators=(',', ':'),
+                                                         ensure_ascii=False))
+        self.assertNotEqual(sizes, stored)
+        rows = list(converter.PRDataSize(pr).run())
+        self.assertEqual({r[0]: r[2] for r in rows[:-1]}, sizes)
+        rows = list(converter.PRStoredDataSize(pr).run())
+        self.assertEqual({r[0]: r[2] for r in rows[:-1]}, stored)
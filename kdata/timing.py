@@ -0,0 +1,280 @@
+"""Per-phase timing of requests.
+
+When settings.KOOTA_TIMING is true, TimingMiddleware (in middleware.py)
+starts a Timer for every request.  Code marks its phases with
+
+    with timing.span('db'):
+        ...
+    rows = timing.timed_iter('db', rows)       # time spent inside next()
+    rows = timing.timed_rows('convert', rows)  # same, batched for many rows
+
+Times are exclusive: a span nested inside another one is subtracted
+from the outer one, so the phases add up to the request time.  Normal
+responses get a Server-Timing header.  Streaming responses get a
+header with the phases up to the start of the body, and the full
+summary (including 'format', time in the output writer, and 'write',
+time waiting for the client) is logged when the stream ends.  Every
+request is added to per-endpoint histograms kept in this process,
+shown by the admin view views_admin.timing_stats.
+
+When disabled, no Timer is ever started: span() returns a shared
+no-op context manager and the iterator wrappers return their argument
+unchanged.
+"""
+
+from collections import OrderedDict
+import bisect
+import itertools
+import threading
+import time
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'KOOTA_TIMING', False)
+# Upper edges of the histogram buckets, in seconds.
+BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1, 2, 5, 10, 30, 60, 300, float('inf')]
+ROWS_BATCH = 100
+
+_local = threading.local()
+_lock = threading.Lock()
+_endpoints = { }
+
+
+
+class Timer(object):
+    """Exclusive time per phase, for one request."""
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.phases = OrderedDict()
+        self.elapsed = None
+        self._stack = [ ]
+        self._start = time.perf_counter()
+    def enter(self):
+        self._stack.append(0.)
+        return time.perf_counter()
+    def exit(self, name, t0):
+        elapsed = time.perf_counter() - t0
+        children = self._stack.pop()
+        self.phases[name] = self.phases.get(name, 0.) + elapsed - children
+        if self._stack:
+            self._stack[-1] += elapsed
+    def add(self, name, seconds):
+        """Add time measured elsewhere to a phase."""
+        self.phases[name] = self.phases.get(name, 0.) + seconds
+    def finish(self):
+        self.elapsed = time.perf_counter() - self._start
+    def summary(self):
+        """Phases (ms) including 'other' and 'total', if finished."""
+        phases = OrderedDict((name, t*1000) for name, t in self.phases.items())
+        if self.elapsed is not None:
+            phases['other'] = max(self.elapsed - sum(self.phases.values()), 0.) * 1000
+            phases['total'] = self.elapsed * 1000
+        return phases
+    def server_timing(self):
+        """Value for the Server-Timing header."""
+        return ', '.join('%s;dur=%.1f'%(name, ms) for name, ms in self.summary().items())
+
+
+class _Span(object):
+    __slots__ = ('timer', 'name', 't0')
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+    def __enter__(self):
+        self.t0 = self.timer.enter()
+    def __exit__(self, *exc_info):
+        self.timer.exit(self.name, self.t0)
+
+class _NoSpan(object):
+    __slots__ = ()
+    def __enter__(self):
+        pass
+    def __exit__(self, *exc_info):
+        pass
+_NO_SPAN = _NoSpan()
+
+
+
+#
+# Instrumentation API
+#
+def current():
+    """The active Timer of this thread, or None."""
+    return getattr(_local, 'timer', None)
+
+def activate(timer):
+    """Make timer the active one of this thread, returns the previous one."""
+    previous = getattr(_local, 'timer', None)
+    _local.timer = timer
+    return previous
+
+def span(name):
+    """Context manager timing a phase of the current request."""
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return _NO_SPAN
+    return _Span(timer, name)
+
+def timed_iter(name, iterable):
+    """Count time spent producing each item of iterable as phase name.
+
+    Use for iterators with few, expensive items (like database rows
+    of data packets).  The timer is bound when this is called, so this
+    works when the iterator is consumed later by a streaming response.
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return iterable
+    return _timed_iter(timer, name, iter(iterable))
+
+def _timed_iter(timer, name, it):
+    while True:
+        t0 = timer.enter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            timer.exit(name, t0)
+        yield item
+
+def timed_rows(name, rows, batch=ROWS_BATCH):
+    """Like timed_iter, but read ahead in batches.
+
+    Converters produce many cheap rows, timing each one separately
+    would cost more than we want to measure.
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return rows
+    return _timed_rows(timer, name, iter(rows), batch)
+
+def _timed_rows(timer, name, it, batch):
+    while True:
+        chunk = [ ]
+        t0 = timer.enter()
+        try:
+            chunk.extend(itertools.islice(it, batch))
+        except Exception:
+            timer.exit(name, t0)
+            # Rows before the error are still returned (extend
+            # keeps what it got).
+            yield from chunk
+            raise
+        timer.exit(name, t0)
+        if not chunk:
+            return
+        yield from chunk
+
+
+
+#
+# Requests and streams
+#
+def endpoint_name(request):
+    """Name used to group requests: the URL name or view path."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name
+
+def timed_stream(timer, chunks, path=None):
+    """Wrap the content of a streaming response.
+
+    Each chunk is produced with timer active (as phase 'format', with
+    nested phases of the converter subtracted), time between chunks is
+    'write'.  When the stream ends or is closed, the timer is recorded
+    and its summary logged.
+    """
+    chunks = iter(chunks)
+    n_bytes = 0
+    status = 'aborted'
+    t_out = None
+    try:
+        while True:
+            previous = activate(timer)
+            t0 = timer.enter()
+            if t_out is not None:
+                timer.add('write', t0 - t_out)
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                status = 'complete'
+                return
+            finally:
+                timer.exit('format', t0)
+                activate(previous)
+            n_bytes += len(chunk)
+            t_out = time.perf_counter()
+            yield chunk
+    finally:
+        timer.finish()
+        record(timer)
+        logger.info("timing %s %s (%s, %d bytes): %s", timer.endpoint, path, status,
+                    n_bytes, timer.server_timing())
+
+
+
+#
+# Statistics
+#
+class EndpointStats(object):
+    """Histogram of total times and sums of phases, for one endpoint."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.histogram = [0] * len(BUCKETS)
+        self.phases = OrderedDict()
+    def add(self, timer):
+        self.count += 1
+        self.total += timer.elapsed
+        self.max = max(self.max, timer.elapsed)
+        self.histogram[bisect.bisect_left(BUCKETS, timer.elapsed)] += 1
+        for name, t in timer.phases.items():
+            self.phases[name] = self.phases.get(name, 0.) + t
+    def quantile(self, q):
+        """Upper edge of the bucket containing quantile q."""
+        if not self.count:
+            return None
+        target = q * self.count
+        n = 0
+        for edge, count in zip(BUCKETS, self.histogram):
+            n += count
+            if n >= target:
+                return min(edge, self.max)
+        return self.max
+    def as_dict(self):
+        return OrderedDict([
+            ('count', self.count),
+            ('mean_ms', self.total / self.count * 1000 if self.count else None),
+            ('p50_ms', self.quantile(.5) * 1000 if self.count else None),
+            ('p90_ms', self.quantile(.9) * 1000 if self.count else None),
+            ('p99_ms', self.quantile(.99) * 1000 if self.count else None),
+            ('max_ms', self.max * 1000),
+            ('histogram', OrderedDict((str(edge), n) for edge, n
+                                      in zip(BUCKETS, self.histogram) if n)),
+            ('phases_mean_ms', OrderedDict((name, t / self.count * 1000)
+                                           for name, t in self.phases.items())),
+            ])
+
+def record(timer):
+    """Add a finished timer to the statistics of its endpoint."""
+    with _lock:
+        stats = _endpoints.get(timer.endpoint)
+        if stats is None:
+            stats = _endpoints[timer.endpoint] = EndpointStats()
+        stats.add(timer)
+
+def get_stats():
+    """{endpoint: stats dict} of this process."""
+    with _lock:
+        return OrderedDict((name, _endpoints[name].as_dict()) for name in sorted(_endpoints))
+
+def reset_stats():
+    with _lock:
+        _endpoints.clear()
@@ -0,0 +1,409 @@
+"""Chunked, resumable uploads.
+
+Large files (Actiwatch/Murata archive backfills and the like) can not
+be sent as one POST: the body would have to fit in
+DATA_UPLOAD_MAX_MEMORY_SIZE and be retransmitted in full on any
+failure.  Instead, the client (kdata/bin/upload.py) does:
+
+    POST   post/session/                 create session, returns session_id
+    PUT    post/session/<id>/<n>         chunk n (header X-Sha256 of the
+                                         bytes sent), any order, in parallel
+    GET    post/session/<id>             which chunks have been received
+                                         (for resuming)
+    POST   post/session/<id>/commit      assemble and ingest
+
+Chunks are streamed straight to disk, so receiving them takes memory
+only for the read buffer, not the chunk or file size.  If the session
+was created with compression=gzip, every chunk is an independent gzip
+stream which is decompressed while assembling.  The assembled data
+goes through the normal process_upload -> save_data path, so it is
+stored exactly as if it had been POSTed in one go.  Device classes
+with process_upload_file() parse the assembled file directly, others
+get it as bytes: a session can be at most as large as a packet
+(INGEST_MAX_PACKET_SIZE), so this is the same memory as a normal post.
+Creating a larger session gets a 413 response with max_size, and the
+client then uploads the file in parts of at most that size, cut at
+line ends, each in its own session and stored as its own packet.
+
+Only one commit of a session runs at a time (commit.lock, with the
+pid and time of its owner).  A lock older than UPLOAD_COMMIT_LOCK_TIMEOUT
+is of a worker which died while committing, and is broken.
+
+The session_id is 128 random bits and acts as the credential for the
+session, like the device secret_id does for normal posts.
+"""
+
+import glob
+from hashlib import sha256
+import json
+import os
+import shutil
+import time
+import zlib
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from . import ingest
+from . import models
+from . import ratelimit
+from . import util
+
+import logging
+logger = logging.getLogger(__name__)
+
+SESSION_DIR = getattr(settings, 'UPLOAD_SESSION_DIR',
+                      os.path.join(settings.BASE_DIR, 'upload-sessions'))
+MAX_CHUNK_SIZE = getattr(settings, 'UPLOAD_MAX_CHUNK_SIZE', 16 * 2**20)
+MAX_SESSION_SIZE = min(getattr(settings, 'UPLOAD_MAX_SESSION_SIZE', ingest.MAX_PACKET_SIZE),
+                       ingest.MAX_PACKET_SIZE)
+MAX_SESSION_AGE = getattr(settings, 'UPLOAD_MAX_SESSION_AGE', 7*24*3600)
+COMMIT_LOCK_TIMEOUT = getattr(settings, 'UPLOAD_COMMIT_LOCK_TIMEOUT', 600)
+READ_SIZE = 2**16
+COMPRESSIONS = (None, 'gzip')
+
+
+def _error(error, status=400):
+    return JsonResponse(dict(ok=False, error=error), status=status, reason=error)
+
+def _session_dir(session_id):
+    return os.path.join(SESSION_DIR, session_id)
+
+def _chunk_name(session_id, index):
+    return os.path.join(_session_dir(session_id), 'chunk-%08d'%index)
+
+def _load_meta(session_id):
+    """Return session metadata, or None if no such session."""
+    if len(session_id) != 32 or not all(c in '0123456789abcdef' for c in session_id):
+        return None
+    try:
+        with open(os.path.join(_session_dir(session_id), 'session.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _write_json(fname, data):
+    """Write JSON atomically, so that readers never see partial files."""
+    with open(fname+'.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(fname+'.tmp', fname)
+
+def _received(session_id):
+    return sorted(int(os.path.basename(x)[6:]) for x in
+                  glob.glob(os.path.join(_session_dir(session_id), 'chunk-????????')))
+
+def expire_sessions(max_age=None):
+    """Remove sessions which have not been touched in max_age seconds."""
+    if max_age is None:
+        max_age = MAX_SESSION_AGE
+    if not os.path.isdir(SESSION_DIR):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(SESSION_DIR):
+        path = os.path.join(SESSION_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+
+@csrf_exempt
+def session_create(request):
+    """Create a new upload session.
+
+    Request body is JSON: size (uncompressed total bytes), sha256
+    (of the uncompressed data), chunks (number of chunks), and
+    optionally compression ('gzip').  The device_id is given the
+    same ways as for normal posts.
+    """
+    if request.method != "POST":
+        return _error("invalid HTTP method (must POST)", status=405)
+    try:
+        params = json.loads(request.body.decode('utf8'))
+        size = int(params['size'])
+        n_chunks = int(params['chunks'])
+        data_sha256 = str(params['sha256']).lower()
+        compression = params.get('compression')
+    except (ValueError, KeyError, TypeError):
+        return _error("Invalid session parameters")
+    device_id = (request.META.get('HTTP_DEVICE_ID') or request.GET.get('device_id')
+                 or params.get('device_id'))
+    if not device_id:
+        return _error("No device_id provided")
+    try:
+        int(device_id, 16)
+    except ValueError:
+        return _error("Invalid device_id")
+    device_id = device_id.lower()
+    if not util.check_checkdigits(device_id):
+        return _error("Invalid device_id checkdigits")
+    limited = ratelimit.check_request(request, device_id)
+    if limited is not None:
+        return limited
+    if compression not in COMPRESSIONS:
+        return _error("Unknown compression")
+    if size < 0 or size > MAX_SESSION_SIZE:
+        # The client splits the file into sessions of at most max_size.
+        return JsonResponse(dict(ok=False, error="Upload too large",
+                                 max_size=MAX_SESSION_SIZE),
+                            status=413, reason="Upload too large")
+    if n_chunks < 1 or n_chunks > MAX_SESSION_SIZE // READ_SIZE + 1:
+        return _error("Invalid number of chunks")
+
+    expire_sessions()
+    session_id = os.urandom(16).hex()
+    os.makedirs(_session_dir(session_id))
+    meta = dict(device_id=device_id, size=size, chunks=n_chunks,
+                sha256=data_sha256, compression=compression,
+                created=time.time())
+    _write_json(os.path.join(_session_dir(session_id), 'session.json'), meta)
+    logger.info("Upload session %s created for %s (%d bytes, %d chunks)",
+                session_id, device_id, size, n_chunks)
+    return JsonResponse(dict(ok=True, session_id=session_id,
+                             max_chunk_size=MAX_CHUNK_SIZE))
+
+
+
+@csrf_exempt
+def session_chunk(request, session_id, index):
+    """Receive one chunk (PUT), streaming it to disk.
+
+    The chunk is checked against the X-Sha256 header before it is
+    made visible, so a received chunk is always a complete, correct
+    one.  Re-sending a chunk (e.g. on retry) simply replaces it.
+    """
+    if request.method != "PUT":
+        return _error("invalid HTTP method (must PUT)", status=405)
+    meta = _load_meta(session_id)
+    if meta is None or 'result' in meta:
+        return _error("No such upload session", status=404)
+    limited = ratelimit.check_request(request, meta['device_id'])
+    if limited is not None:
+        return limited
+    index = int(index)
+    if index >= meta['chunks']:
+        return _error("Chunk index out of range")
+    if 'HTTP_X_SHA256' not in request.META:
+        return _error("X-Sha256 header required")
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > MAX_CHUNK_SIZE:
+        return _error("Chunk too large", status=413)
+
+    fname = _chunk_name(session_id, index)
+    tmpname = '%s.%s.tmp'%(fname, os.urandom(4).hex())
+    hasher = sha256()
+    n = 0
+    try:
+        with open(tmpname, 'wb') as f:
+            while True:
+                block = request.read(READ_SIZE)
+                if not block:
+                    break
+                n += len(block)
+                if n > MAX_CHUNK_SIZE:
+                    return _error("Chunk too large", status=413)
+                hasher.update(block)
+                f.write(block)
+        if hasher.hexdigest() != request.META['HTTP_X_SHA256'].lower():
+            return _error("Checksum mismatch")
+        os.rename(tmpname, fname)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+    return JsonResponse(dict(ok=True, chunk=index, bytes=n,
+                             sha256=hasher.hexdigest()))
+
+
+
+@csrf_exempt
+def session_status(request, session_id):
+    """Report received chunks, so that clients can resume."""
+    meta = _load_meta(session_id)
+    if meta is None:
+        return _error("No such upload session", status=404)
+    if 'result' in meta:
+        return JsonResponse(dict(meta['result'], committed=True))
+    return JsonResponse(dict(ok=True, committed=False, chunks=meta['chunks'],
+                             received=_received(session_id)))
+
+
+
+def _assemble(session_id, meta, out):
+    """Write the (decompressed) chunks in order to file object out.
+
+    Returns (bytes, sha256 hexdigest) of the assembled data.
+    """
+    hasher = sha256()
+    n = 0
+    for index in range(meta['chunks']):
+        decomp = zlib.decompressobj(16+zlib.MAX_WBITS) if meta['compression'] == 'gzip' else None
+        with open(_chunk_name(session_id, index), 'rb') as f:
+            while True:
+                block = f.read(READ_SIZE)
+                if not block:
+                    break
+                if decomp is not None:
+                    block = decomp.decompress(block)
+                n += len(block)
+                if n > meta['size']:
+                    raise ValueError("Assembled data larger than declared")
+                hasher.update(block)
+                out.write(block)
+        if decomp is not None:
+            block = decomp.flush()
+            if not decomp.eof:
+                raise ValueError("Truncated compressed chunk %d"%index)
+            n += len(block)
+            hasher.update(block)
+            out.write(block)
+    return n, hasher.hexdigest()
+
+
+def _lock_time(fname):
+    """Time a commit lock was taken, None if there is no lock."""
+    try:
+        with open(fname) as f:
+            return float(json.load(f)['time'])
+    except (ValueError, KeyError, TypeError):
+        # Just created, not written yet: its mtime is the time.
+        try:
+            return os.stat(fname).st_mtime
+        except OSError:
+            return None
+    except (IOError, OSError):
+        return None
+
+def _take_lock(fname, timeout=None):
+    """Create the lock file fname.  Returns its token if it was taken,
+    None if another commit holds it.
+
+    A lock older than timeout is broken.  It is first renamed to a
+    name of our own, so that of several workers breaking it at once,
+    only one succeeds.
+    """
+    if timeout is None:
+        timeout = COMMIT_LOCK_TIMEOUT
+    token = os.urandom(8).hex()
+    for attempt in range(2):
+        try:
+            fd = os.open(fname, os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+        except FileExistsError:
+            ts = _lock_time(fname)
+            if attempt or ts is None or ts > time.time() - timeout:
+                return None
+            stale = '%s.%s'%(fname, token)
+            try:
+                os.rename(fname, stale)
+            except OSError:
+                return None
+            ts = _lock_time(stale)
+            if ts is not None and ts > time.time() - timeout:
+                # Someone else's new lock: put it back, unless taken again.
+                try:
+                    os.link(stale, fname)
+                except OSError:
+                    pass
+                os.unlink(stale)
+                return None
+            logger.warning("Breaking stale commit lock %s", fname)
+            os.unlink(stale)
+            continue
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(pid=os.getpid(), time=time.time(), token=token), f)
+        return token
+    return None
+
+def _release_lock(fname, token):
+    """Remove the lock, if it still is ours (it may have been broken)."""
+    try:
+        with open(fname) as f:
+            if json.load(f).get('token') != token:
+                return
+    except (IOError, OSError, ValueError):
+        return
+    os.unlink(fname)
+
+
+def _device_class(device_id):
+    """The registered device class for device_id, if any."""
+    device = models.Device.objects.filter(Q(_secret_id=device_id) | Q(device_id=device_id)).first()
+    if device is None:
+        return None
+    try:
+        return device.get_class()
+    except Exception:
+        logger.exception("Can not get class of device %s", device.public_id)
+        return None
+
+
+@csrf_exempt
+def session_commit(request, session_id):
+    """Assemble all chunks and ingest them as one data packet.
+
+    Committing is idempotent: the result is remembered and returned
+    again if a client retries a commit whose response it did not get,
+    so data is never saved twice.
+    """
+    from .views import save_data
+    if request.method != "POST":
+        return _error("invalid HTTP method (must POST)", status=405)
+    meta = _load_meta(session_id)
+    if meta is None:
+        return _error("No such upload session", status=404)
+    if 'result' in meta:
+        return JsonResponse(meta['result'])
+    sdir = _session_dir(session_id)
+    missing = sorted(set(range(meta['chunks'])) - set(_received(session_id)))
+    if missing:
+        return JsonResponse(dict(ok=False, error="Missing chunks", missing=missing[:1000]),
+                            status=400, reason="Missing chunks")
+    # Only one commit may run at a time.
+    lockname = os.path.join(sdir, 'commit.lock')
+    token = _take_lock(lockname)
+    if token is None:
+        return _error("Commit already in progress", status=409)
+    assembled = os.path.join(sdir, 'assembled-'+token)
+    try:
+        # A commit which finished while we waited for the lock has
+        # stored its result and removed the chunks.
+        meta = _load_meta(session_id)
+        if meta is None:
+            return _error("No such upload session", status=404)
+        if 'result' in meta:
+            return JsonResponse(meta['result'])
+        try:
+            with open(assembled, 'wb') as out:
+                n, data_sha256 = _assemble(session_id, meta, out)
+        except (ValueError, zlib.error) as e:
+            return _error("Invalid upload data: %s"%e)
+        if n != meta['size'] or data_sha256 != meta['sha256']:
+            return _error("Checksum mismatch")
+        device_class = _device_class(meta['device_id'])
+        with open(assembled, 'rb') as f:
+            if device_class is not None and hasattr(device_class, 'process_upload_file'):
+                data = device_class.process_upload_file(None, f)
+            else:
+                data = f.read()
+                if device_class is not None and hasattr(device_class, 'process_upload'):
+                    data = device_class.process_upload(None, data)
+        rowid = save_data(data=data, device_id=meta['device_id'], request=request)
+        result = dict(ok=True, data_sha256=data_sha256, bytes=n, rowid=rowid)
+        # Remember the result first, then free the disk space.
+        meta['result'] = result
+        _write_json(os.path.join(sdir, 'session.json'), meta)
+        for fname in glob.glob(os.path.join(sdir, 'chunk-*')):
+            os.unlink(fname)
+        logger.info("Upload session %s committed: %d bytes, rowid %s",
+                    session_id, n, rowid)
+        return JsonResponse(result)
+    finally:
+        if os.path.exists(assembled):
+            os.unlink(assembled)
+        _release_lock(lockname, token)
@@ -2,8 +2,10 @@ from django.conf import settings
 from django.conf.urls import url, include
 from django.views.generic import TemplateView
 
+from kdata import export
 from kdata import group
 from kdata import survey
+from kdata import upload_session
 from kdata import views as kviews
 from kdata import views_admin
 from kdata import views_data
@@ -26,6 +28,15 @@ urls_data = [
     # Actigraphs - process and remove data
     url(r'^post/actiwatch/?(?P<device_id>\w+)?/?$', kviews.post,
         dict(device_class=Actiwatch), name='post-actiwatch'),
+    # Chunked, resumable uploads (see kdata/upload_session.py)
+    url(r'^post/session/?$', upload_session.session_create,
+        name='post-session'),
+    url(r'^post/session/(?P<session_id>[0-9a-f]{32})/?$', upload_session.session_status,
+        name='post-session-status'),
+    url(r'^post/session/(?P<session_id>[0-9a-f]{32})/(?P<index>\d+)$', upload_session.session_chunk,
+        name='post-session-chunk'),
+    url(r'^post/session/(?P<session_id>[0-9a-f]{32})/commit$', upload_session.session_commit,
+        name='post-session-commit'),
     # Generic POST url.
     url(r'^post/?(?P<device_id>[A-Fa-f0-9]+)?/?$', kviews.post, name='post'),
     # Murata sleep sensor: this has a hard-coded POST URL.
@@ -92,8 +103,18 @@ urls_ui = [
 
     # Various admin things
     url(r'^stats/', views_admin.stats),
+    url(r'^timing/', views_admin.timing_stats, name='timing-stats'),
+    url(r'^profiler/$', views_admin.profiler_view, name='profiler'),
+    url(r'^profiler/(?P<name>[0-9a-f-]+)\.txt$', views_admin.profiler_download,
+        name='profiler-download'),
     url(r'^time/', views_admin.current_time),
 
+    # Background exports
+    url(r'^export/$', export.export_list, name='export-list'),
+    url(r'^export/create$', export.export_create, name='export-create'),
+    url(r'^export/(?P<id>[0-9]+)/$', export.export_detail, name='export-detail'),
+    url(r'^export/(?P<id>[0-9]+)/download$', export.export_download, name='export-download'),
+
     # Misc
     #
     # Purple Robot log POST url (doesn't work)
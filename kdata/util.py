@@ -6,6 +6,7 @@ import datetime
 from datetime import timedelta
 from hashlib import sha256
 import importlib
+import io
 import itertools
 import json
 from json import dumps, loads
@@ -13,17 +14,21 @@ from math import isnan, log
 import os
 import random
 import re
+import tempfile
 import time
 
 import six
 from six import StringIO as IO
 import yaml
 
+from django.conf import settings
 from django.utils import timezone
 import django.db.models
 import django.forms
 
 from . import models
+from . import pseudonym
+from . import timing
 
 import logging
 logger = logging.getLogger(__name__)
@@ -66,13 +71,16 @@ def import_by_name(name, default=None, raise_if_none=False):
 
 from django.conf import settings
 SALT_KEY = settings.SALT_KEY
+PSEUDONYM_SCHEME = getattr(settings, 'PSEUDONYM_SCHEME', 'legacy')
 def safe_hash(data, hash_seed=None):
-    """Make a safe hash function for identifiers."""
-    if not isinstance(data, bytes):
-        data = data.encode('utf8')
-    if hash_seed:
-        return urlsafe_b64encode(sha256(hash_seed+data).digest()[:9]).decode('ascii')
-    return urlsafe_b64encode(sha256(SALT_KEY+data).digest()[:9]).decode('ascii')
+    """Make a safe hash function for identifiers.
+
+    Memoized, see kdata/pseudonym.py."""
+    return pseudonym.hash_value(hash_seed or SALT_KEY, data, scheme=PSEUDONYM_SCHEME)
+
+def hash_column(values, hash_seed=None):
+    """safe_hash of a whole column of values, as a list."""
+    return pseudonym.hash_column(hash_seed or SALT_KEY, values, scheme=PSEUDONYM_SCHEME)
 
 def random_salt_b64(nbytes=18):
     """Random """
@@ -89,7 +97,7 @@ class IntegerMap(object):
 
 
 def csv_iter(table, converter=None, header=None):
-    rows = iter(table)
+    rows = iter(timing.timed_rows('convert', table))
     fo = IO()
     csv_writer = csv.writer(fo)
     csv_writer.writerow(header)
@@ -117,6 +125,7 @@ def csv_iter(table, converter=None, header=None):
 # Tab-separated values
 def tsv_iter(table, converter=None, header=None, sep='\t'):
     """Tab separated values"""
+    table = timing.timed_rows('convert', table)
     yield sep.join(str(x) for x in header)+'\n'
     # Data
     for row in table:
@@ -138,6 +147,7 @@ def csv_aligned_iter(table, converter=None, header=None):
     CSV lines, and each field is aligned to the length of longest
     field in that column seen so far.  It also includes a bottom header.
     """
+    table = timing.timed_rows('convert', table)
     # Header
     yield ','.join(str(x) for x in header)+'\n'
     # Data
@@ -158,7 +168,7 @@ def csv_aligned_iter(table, converter=None, header=None):
             yield str(error)+'\n'
 
 def json_lines_iter(table, converter=None, header=None):
-    rows = iter(table)
+    rows = iter(timing.timed_rows('convert', table))
     try:
         while True:
             yield dumps(next(rows))+'\n'
@@ -170,7 +180,7 @@ def json_lines_iter(table, converter=None, header=None):
         for error in converter.errors:
             yield str(error)+'\n'
 def json_iter(table, converter=None, header=None):
-    rows = iter(table)
+    rows = iter(timing.timed_rows('convert', table))
     yield '[\n'
     try:
         yield dumps(next(rows))  # first one (hope there is no StopIteration now)
@@ -188,6 +198,7 @@ def json_iter(table, converter=None, header=None):
             yield str(error)+'\n'
 def sqlite3dump_iter(table, converter=None, header=None, filename=None):
     table_name = converter.__class__.__name__ if converter else 'data'
+    table = timing.timed_rows('convert', table)
     yield '-- Koota sqlite3 dump\n'
     if filename:
         yield '-- filename: %s\n'%filename
@@ -224,10 +235,11 @@ def optimized_queryset_iterator_1(queryset):
     """Wrapper to read queryset.
 
     This is the primitive version of the one below.  It defers loading
-    data, so has to do it for every row.  This is inefficient.
+    data, so has to do it for every row (one query per row, with
+    data_z, see models.PayloadAttribute).  This is inefficient.
 
     """
-    return queryset.defer('data').iterator()
+    return queryset.defer('data', 'data_z').iterator()
 def optimized_queryset_iterator(queryset):
     """Queryset wrapper that optimizes lots of data access.
 
@@ -283,6 +295,85 @@ def optimized_queryset_iterator(queryset):
         ts = ts_next
 
 
+#
+# Keyset ("cursor") pagination on (ts, id).  Every page is one index
+# range scan, so deep pages are as fast as the first one, unlike
+# OFFSET pagination and its COUNT(*).
+#
+def cursor_token(ts, id_):
+    """Cursor string of a (ts, id) position: microseconds since epoch and id."""
+    return '%d_%d'%(timegm(ts.utctimetuple())*1000000 + ts.microsecond, id_)
+
+def parse_cursor(token):
+    """(ts, id) of a cursor_token().  Raises ValueError if invalid."""
+    us, id_ = token.split('_')
+    us, id_ = int(us), int(id_)
+    try:
+        ts = datetime.datetime.fromtimestamp(us // 1000000, datetime.timezone.utc)
+    except (OverflowError, OSError):
+        raise ValueError("Cursor out of range: %r"%token)
+    return ts.replace(microsecond=us % 1000000), id_
+
+def keyset_after(queryset, key, descending=False):
+    """Rows after key=(ts, id) in (ts, id) order (before it if descending)."""
+    ts, id_ = key
+    if descending:
+        return queryset.filter(django.db.models.Q(ts__lt=ts) | django.db.models.Q(ts=ts, id__lt=id_))
+    return queryset.filter(django.db.models.Q(ts__gt=ts) | django.db.models.Q(ts=ts, id__gt=id_))
+
+def keyset_page(queryset, per_page, after=None, before=None, at=None, first=False,
+                descending=False):
+    """One page of (ts, id) keys, in display order.
+
+    Display order is (ts, id), or reverse if descending.  The page is
+    the per_page rows following key `after`, preceding key `before`,
+    starting at datetime `at`, the first page if `first`, or else
+    the last page.
+
+    Returns (keys, has_prev, has_next).
+    """
+    forward = ('-ts', '-id') if descending else ('ts', 'id')
+    backward = ('ts', 'id') if descending else ('-ts', '-id')
+    keys_qs = queryset.values_list('ts', 'id')
+    if after is not None or at is not None or first:
+        if after is not None:
+            keys_qs = keyset_after(keys_qs, after, descending)
+        elif at is not None:
+            keys_qs = keys_qs.filter(ts__lte=at) if descending else keys_qs.filter(ts__gte=at)
+        keys = list(keys_qs.order_by(*forward)[:per_page+1])
+        has_next = len(keys) > per_page
+        keys = keys[:per_page]
+        has_prev = bool(keys) and keyset_after(queryset, keys[0], not descending).exists()
+    else:
+        if before is not None:
+            keys_qs = keyset_after(keys_qs, before, not descending)
+        keys = list(keys_qs.order_by(*backward)[:per_page+1])
+        has_prev = len(keys) > per_page
+        keys = keys[:per_page]
+        keys.reverse()
+        has_next = bool(keys) and keyset_after(queryset, keys[-1], descending).exists()
+    return keys, has_prev, has_next
+
+def estimate_count(queryset):
+    """Planner estimate of the number of rows, or None if not available.
+
+    Only on PostgreSQL: EXPLAIN costs about as much as planning the
+    query, while an exact COUNT(*) reads every row.
+    """
+    from django.db import connections
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+
 def time_slice_iterator(it, maxduration):
     """Time iterator ending after a certain number of seconds.
 
@@ -300,6 +391,108 @@ def time_slice_iterator(it, maxduration):
 
 
 
+# Request bodies up to this size are kept in memory, larger ones are
+# spooled to a temporary file.
+BODY_SPOOL_MAX_MEMORY = getattr(settings, 'BODY_SPOOL_MAX_MEMORY', 2**20)
+# Larger bodies are refused.  Django checks DATA_UPLOAD_MAX_MEMORY_SIZE
+# only in request.body, so streamed reads need their own limit.
+BODY_MAX_SIZE = getattr(settings, 'BODY_MAX_SIZE',
+                        getattr(settings, 'INGEST_MAX_PACKET_SIZE', 64 * 2**20))
+BODY_READ_SIZE = 2**16
+
+class BodyTooLarge(ValueError):
+    """The request body is over BODY_MAX_SIZE."""
+
+class SpooledBody(object):
+    """A request body, hashed as it is written and spilled to disk if large.
+
+    .file is a file object positioned at the start of the data, so
+    device code can parse it incrementally.  .path() returns a
+    filesystem name for it (for sqlite3 and such), writing it out first
+    if it is still in memory.
+    """
+    def __init__(self, max_memory=None, max_size=None):
+        if max_memory is None:
+            max_memory = BODY_SPOOL_MAX_MEMORY
+        if max_size is None:
+            max_size = BODY_MAX_SIZE
+        self.max_memory = max_memory
+        self.max_size = max_size
+        self._f = io.BytesIO()
+        self._hash = sha256()
+        self.size = 0
+    def write(self, block):
+        if self.size + len(block) > self.max_size:
+            raise BodyTooLarge("Request body over %d bytes"%self.max_size)
+        self._hash.update(block)
+        self.size += len(block)
+        if self.in_memory and self.size > self.max_memory:
+            self._rollover()
+        self._f.write(block)
+    def _rollover(self):
+        f = tempfile.NamedTemporaryFile(prefix='koota-body-')
+        f.write(self._f.getvalue())
+        self._f = f
+    @property
+    def in_memory(self):
+        return isinstance(self._f, io.BytesIO)
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+    @property
+    def file(self):
+        self._f.seek(0)
+        return self._f
+    def path(self):
+        if self.in_memory:
+            self._rollover()
+        self._f.flush()
+        return self._f.name
+    def read(self):
+        """Return the whole body as bytes."""
+        if self.in_memory:
+            return self._f.getvalue()
+        return self.file.read()
+    def close(self):
+        self._f.close()
+
+def request_body(request, max_memory=None, max_size=None):
+    """Read the request body in fixed-size chunks into a SpooledBody.
+
+    The result is cached on the request, so device .post() methods and
+    kdata.views.post can both use it with only one read.  If Django has
+    already read the body (e.g. to parse request.POST), that is used.
+    Raises BodyTooLarge if the body is over max_size (BODY_MAX_SIZE),
+    before reading if Content-Length says so.
+    """
+    body = getattr(request, '_koota_body', None)
+    if body is not None:
+        return body
+    body = SpooledBody(max_memory, max_size)
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > body.max_size:
+        raise BodyTooLarge("Request body over %d bytes"%body.max_size)
+    try:
+        if getattr(request, '_read_started', False) or hasattr(request, '_body'):
+            body.write(request.body)
+        else:
+            # This reads request.META['wsgi.input'], limited to CONTENT_LENGTH.
+            while True:
+                block = request.read(BODY_READ_SIZE)
+                if not block:
+                    break
+                body.write(block)
+    except BodyTooLarge:
+        body.close()
+        raise
+    request._koota_body = body
+    return body
+
+
+
 # For Mosquitto server passwords
 from django.contrib.auth.hashers import PBKDF2PasswordHasher
 import base64
@@ -443,7 +636,6 @@ def filter_allowed(val, allowed_fields):
     """In-place modify dict or list of dicts, allowing only certain fields"""
     if allowed_fields is None:
         return
-    print(allowed_fields)
     if isinstance(val, dict):
         for k in list(val.keys()):
             if k not in allowed_fields:
@@ -457,7 +649,6 @@ def filter_removed(val, removed_fields):
     """In-place modify dict or list of dicts, removing certain fields"""
     if removed_fields is None:
         return
-    print(removed_fields)
     if isinstance(val, dict):
         for field in removed_fields:
             if field in val:
@@ -465,7 +656,7 @@ def filter_removed(val, removed_fields):
     else:
         for dct in val:
             for field in removed_fields:
-                if field in val:
+                if field in dct:
                     dct.pop(field)
 
 
@@ -7,6 +7,7 @@ import sys
 
 from django.shortcuts import render
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
 from django.urls import reverse
 from django.utils import timezone
 from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, Http404
@@ -18,9 +19,13 @@ from django.views.generic import TemplateView, UpdateView
 from . import devices
 from . import exceptions
 from . import group
+from . import ingest
 from . import logs
 from . import models
 from . import permissions
+from . import ratelimit
+from . import rechunk
+from . import timing
 from . import tokens
 from . import util
 
@@ -31,38 +36,19 @@ logger = logging.getLogger(__name__)
 
 # Create your views here.
 
-@csrf_exempt
-def post(request, device_id=None, device_class=None):
-    #import IPython ; IPython.embed()
-    if request.method != "POST":
-        return JsonResponse(dict(ok=False, message="invalid HTTP method (must POST)"),
-                            status=405)
-    # Custom device code, if available.
-    results = { }
-    if device_class is not None and hasattr(device_class, 'post'):
-        results = device_class.post(request)
+def _body_too_large():
+    return JsonResponse(dict(ok=False, error="Request body too large"),
+                        status=413, reason="Request body too large")
 
-    # Find device_id.  Try different things until found.
-    if device_id is not None:
-        pass
-    elif 'device_id' in results:  # results from custom device code
-        device_id = results['device_id']
-    elif 'HTTP_DEVICE_ID' in request.META:
-        device_id = request.META['HTTP_DEVICE_ID']
-    elif 'device_id' in request.GET:
-        device_id = request.GET['device_id']
-    elif 'device_id' in request.POST:
-        device_id = request.POST['device_id']
-    else:
-        return JsonResponse(dict(ok=False, error="No device_id provided"),
-                            status=400, reason="No device_id provided")
+def _check_device_id(device_id):
+    """Normalize device_id.  Returns (device_id, error response or None)."""
     try:
         int(device_id, 16)
     except:
         logger.warning("Invalid device_id: %r"%device_id)
-        return JsonResponse(dict(ok=False, error="Invalid device_id",
-                                 device_id=device_id),
-                            status=400, reason="Invalid device_id")
+        return device_id, JsonResponse(dict(ok=False, error="Invalid device_id",
+                                            device_id=device_id),
+                                       status=400, reason="Invalid device_id")
     device_id = device_id.lower()
     # Return an error if device checkdigits do not work out.  Since
     # the server may not have a complete list of all registered
@@ -71,22 +57,80 @@ def post(request, device_id=None, device_class=None):
     # attacks.
     if not util.check_checkdigits(device_id):
         logger.warning("Invalid device_id checkdigits: %r"%device_id)
-        return JsonResponse(dict(ok=False, error='Invalid device_id checkdigits',
-                                 device_id=device_id),
-                            status=400, reason="Invalid device_id checkdigits")
+        return device_id, JsonResponse(dict(ok=False, error='Invalid device_id checkdigits',
+                                            device_id=device_id),
+                                       status=400, reason="Invalid device_id checkdigits")
+    return device_id, None
+
+@csrf_exempt
+def post(request, device_id=None, device_class=None):
+    #import IPython ; IPython.embed()
+    if request.method != "POST":
+        return JsonResponse(dict(ok=False, message="invalid HTTP method (must POST)"),
+                            status=405)
+    # Find device_id.  Try different things until found.  The URL,
+    # header and query string are known without reading the body, so
+    # the rate limit is checked before any device code reads it.
+    if device_id is None:
+        if 'HTTP_DEVICE_ID' in request.META:
+            device_id = request.META['HTTP_DEVICE_ID']
+        elif 'device_id' in request.GET:
+            device_id = request.GET['device_id']
+    device_type_ = device_class.pyclass_name() if device_class is not None else None
+    if device_id is not None:
+        device_id, error = _check_device_id(device_id)
+        if error is not None:
+            return error
+        # Over the ingest rate limit?
+        limited = ratelimit.check_request(request, device_id, device_type_)
+        if limited is not None:
+            return limited
+
+    # Custom device code, if available.
+    results = { }
+    if device_class is not None and hasattr(device_class, 'post'):
+        with timing.span('device'):
+            try:
+                results = device_class.post(request)
+            except util.BodyTooLarge:
+                return _body_too_large()
+
+    if device_id is None:
+        if 'device_id' in results:  # results from custom device code
+            device_id = results['device_id']
+        elif 'device_id' in request.POST:
+            device_id = request.POST['device_id']
+        else:
+            return JsonResponse(dict(ok=False, error="No device_id provided"),
+                                status=400, reason="No device_id provided")
+        device_id, error = _check_device_id(device_id)
+        if error is not None:
+            return error
+        # Only known from the body (e.g. MurataBSN): checked after
+        # reading it.
+        limited = ratelimit.check_request(request, device_id, device_type_)
+        if limited is not None:
+            return limited
 
     # Find the data to store
-    if 'data' in results:  # results from custom device code
-        data = results['data']
-    elif 'data' in request.POST:
-        data = request.POST['data']
-    else:
-        data = request.body
+    body = None
+    with timing.span('read'):
+        if 'data' in results:  # results from custom device code
+            data = results['data']
+        elif 'data' in request.POST:
+            data = request.POST['data']
+        else:
+            # Raw body: read in chunks, hashing as we go, spooling large
+            # bodies to disk.
+            try:
+                body = util.request_body(request)
+            except util.BodyTooLarge:
+                return _body_too_large()
     # Encode everything to utf8.  the body is bytes, but request.POST
     # is decoded.  We need to encode in order to checksum and compute
     # len() properly.  TODO: make more efficient by not first decoding
     # the POST data.
-    if not isinstance(data, six.binary_type):
+    if body is None and not isinstance(data, six.binary_type):
         data = data.encode('utf8')
 
     # Get nonce if provided.  Nonce is just any string which is
@@ -98,21 +142,36 @@ def post(request, device_id=None, device_class=None):
     elif 'nonce' in request.POST:        nonce = request.POST['nonce']
 
     # Check checksum if provided
-    data_sha256 = sha256(data).hexdigest()
+    if body is not None:
+        data_sha256 = body.sha256
+    else:
+        with timing.span('hash'):
+            data_sha256 = sha256(data).hexdigest()
     if 'HTTP_X_SHA256' in request.META:
         if data_sha256 != request.META['HTTP_X_SHA256'].lower():
             return JsonResponse(dict(ok=False, error="Checksum mismatch"),
                                      status=400, reason="Checksum mismatch")
 
-    # Do device-specifc processing of data
-    if device_class is not None and hasattr(device_class, 'process_upload'):
-        # hack: this is an instance method.  Eventually define
-        # semantics: should this be a class method?
-        data = device_class.process_upload(None, data)
+    # Do device-specifc processing of data.  Devices which can work
+    # from a file object get the spooled body directly.
+    packet_class = device_class
+    with timing.span('process'):
+        if body is not None:
+            if device_class is not None and hasattr(device_class, 'process_upload_file'):
+                data = device_class.process_upload_file(None, body.file)
+                device_class = None  # already processed
+            else:
+                data = body.read()
+            body.close()
+        if device_class is not None and hasattr(device_class, 'process_upload'):
+            # hack: this is an instance method.  Eventually define
+            # semantics: should this be a class method?
+            data = device_class.process_upload(None, data)
 
     # Store data in DB.  (Uses django models for now, but should
     # be made more efficient later).
-    rowid = save_data(data=data, device_id=device_id, request=request)
+    rowid = save_data(data=data, device_id=device_id, request=request,
+                      device_class=packet_class)
     logger.debug("Saved data from device_id=%r"%device_id)
 
     # HTTP response
@@ -123,6 +182,9 @@ def post(request, device_id=None, device_class=None):
                     bytes=len(data),
                     #rowid=rowid,
                     )
+    if rowid is None:
+        # Stored, but not as data: the client must not retry it.
+        response['quarantined'] = True
     if nonce is not None:
         response['nonce'] = nonce
     if 'HTTP_X_ROWID' in request.META:
@@ -130,7 +192,8 @@ def post(request, device_id=None, device_class=None):
     return JsonResponse(response)
 
 def save_data(data, device_id, request=None,
-              received_ts=None, data_ts=None):
+              received_ts=None, data_ts=None, device_class=None, validate=True,
+              split=True):
     """Save data which our server receives.
 
     This is the master "save data in DB" function.
@@ -145,6 +208,18 @@ def save_data(data, device_id, request=None,
                  received" timestamp
     data_ts:     If given, this is used as the timestamp to index by,
                  and represents the time the data was actually received.
+    device_class: device class which checks the packet (looked up
+                 from device_id if not given).
+    validate:    if true, packets which fail the check of their device
+                 class are quarantined (see kdata/ingest.py) and None
+                 is returned.  Split packets are checked piece by
+                 piece.
+    split:       if true, packets over DATA_CHUNK_MAX_BYTES are split
+                 by the device class (see kdata/rechunk.py) and the id
+                 of the first row is returned.
+
+    If DATA_COMPRESSION is set, the row is stored compressed (see
+    kdata/codec.py).
     """
     if not isinstance(data, (str, bytes)):
         raise ValueError("save_data data must be str or bytes!")
@@ -154,27 +229,86 @@ def save_data(data, device_id, request=None,
     remote_ip = '127.0.0.1'
     if request is not None:
         remote_ip = request.META['REMOTE_ADDR']
+    if device_class is None:
+        device_class = ingest.device_class(device_id)
+    packets = _packets(data, device_id, device_class, remote_ip,
+                       validate=validate, split=split)
+    if not packets:
+        return None
     # Actual saving process.
-    row = models.Data(device_id=device_id, ip=remote_ip, data=data)
-    row.data_length = len(data)
-    row.save()
-    # If necessary, set custom timestamps on the data.  It's unlikely
-    # that we get both, so save twice.
-    if received_ts is not None:
-        if isinstance(received_ts, int):
-            received_ts = timezone.make_aware(timezone.datetime.fromtimestamp(received_ts))
-        row.ts_received = received_ts
-        row.save()
-    if data_ts is not None:
-        if isinstance(data_ts, int):
-            data_ts = timezone.make_aware(timezone.datetime.fromtimestamp(data_ts))
-        row.ts = data_ts
-        row.save()
-    # Return row_id of inserted data.
-    row_id = row.id
-    del row, data
+    device_type = ingest.device_type(device_id)
+    with timing.span('save'):
+        with transaction.atomic():
+            rows = [ rechunk.make_row(packet, device_id, remote_ip, device_type)
+                     for packet in packets ]
+            for row in rows:
+                row.save()
+            # If necessary, set custom timestamps on the data.
+            timestamps = { }
+            if received_ts is not None:
+                if isinstance(received_ts, int):
+                    received_ts = timezone.make_aware(timezone.datetime.fromtimestamp(received_ts))
+                timestamps['ts_received'] = received_ts
+            if data_ts is not None:
+                if isinstance(data_ts, int):
+                    data_ts = timezone.make_aware(timezone.datetime.fromtimestamp(data_ts))
+                timestamps['ts'] = data_ts
+            if timestamps:
+                models.Data.objects.filter(id__in=[row.id for row in rows]).update(**timestamps)
+    # Return row_id of (the first) inserted data.
+    row_id = rows[0].id
+    del rows, data, packets
     return row_id
 
+def _packets(data, device_id, device_class, remote_ip, validate=True, split=True):
+    """The packets to save of data: split (see kdata/rechunk.py), then
+    each piece checked.  Pieces which fail are quarantined and left
+    out, so a packet over the ingest size limit which can be split is
+    not quarantined whole."""
+    packets = None
+    if split and len(data) > rechunk.MAX_BYTES:
+        with timing.span('split'):
+            packets = rechunk.split(data, device_class)
+    if packets is None:
+        packets = [ data ]
+    if not validate:
+        return packets
+    valid = [ ]
+    with timing.span('validate'):
+        for packet in packets:
+            reason = ingest.check(packet, device_id, device_class)
+            if reason is not None:
+                ingest.quarantine(packet, device_id, reason, ip=remote_ip,
+                                  device_class_=device_class)
+                continue
+            valid.append(packet)
+    return valid
+
+def save_data_many(datas, device_id, request=None):
+    """Save many data packets of one device in one bulk insert.
+
+    Like save_data, for server-side producers (scrapers) which make
+    many packets at once.  Returns the number of rows saved (large
+    packets are split, invalid ones quarantined).
+    """
+    device_id = device_id.lower()
+    if not util.check_checkdigits(device_id):
+        raise exceptions.InvalidDeviceID("Invalid device ID: checkdigits invalid.")
+    remote_ip = '127.0.0.1'
+    if request is not None:
+        remote_ip = request.META['REMOTE_ADDR']
+    device_class = ingest.device_class(device_id)
+    device_type = ingest.device_type(device_id)
+    rows = [ ]
+    for data in datas:
+        if not isinstance(data, (str, bytes)):
+            raise ValueError("save_data data must be str or bytes!")
+        for packet in _packets(data, device_id, device_class, remote_ip):
+            rows.append(rechunk.make_row(packet, device_id, remote_ip, device_type))
+    with timing.span('save'):
+        models.Data.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
 
 
 @csrf_exempt
@@ -18,6 +18,7 @@ from datetime import datetime, timedelta
 import hashlib
 import json
 import os
+import re
 import time
 
 from . import models
@@ -26,6 +27,9 @@ from . import exceptions
 from . import group
 from . import logs
 from . import permissions
+from . import profiler
+from . import ratelimit
+from . import timing
 from . import util
 from . import views
 from .util import human_bytes
@@ -305,6 +309,16 @@ def stats(request):
     from django.db import connection
     c = connection.cursor()
     stats = [ ]
+    stats.append('Audit log writer (this process): %s'%', '.join(
+        '%s=%s'%(k, v) for k, v in sorted(logs.stats().items())))
+    for name, counts in ratelimit.stats().items():
+        top_denied = counts.pop('top_denied')
+        stats.append('Ingest rate limit per %s (this process): %s'%(name, ', '.join(
+            '%s=%s'%(k, v) for k, v in sorted(counts.items()))))
+        if top_denied:
+            stats.append('    most denied: %s'%', '.join('%s (%d)'%kv for kv in top_denied))
+    stats.append('Quarantined packets (new): %d'%models.QuarantinedData.objects.filter(
+        state='new').count())
 
     # This is a list of time intervals to compute stats for.  Time
     # ranges are (now-startatago) -- (now-startatago-duration)
@@ -378,6 +392,95 @@ def stats(request):
 
 
 
+def timing_stats(request):
+    """Per-endpoint request timing histograms of this process.
+
+    Only for verified (2FA) superusers.  See kdata/timing.py, needs
+    settings.KOOTA_TIMING.  ?format=json gives the raw numbers.
+    """
+    if not permissions.has_admin_permission(request):
+        return HttpResponse("Forbidden", status=403, content_type='text/plain')
+    stats = timing.get_stats()
+    if request.GET.get('format') == 'json':
+        return JsonResponse(dict(enabled=timing.ENABLED, endpoints=stats))
+    lines = [ ]
+    if not timing.ENABLED:
+        lines.append('Timing is disabled (settings.KOOTA_TIMING)')
+    for endpoint, s in stats.items():
+        lines.append('='*40)
+        lines.append(endpoint)
+        lines.append('count %d, mean %.1f ms, p50 <=%.1f ms, p90 <=%.1f ms, p99 <=%.1f ms, max %.1f ms'%(
+            s['count'], s['mean_ms'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['max_ms']))
+        lines.append('phases (mean ms): ' + ', '.join('%s %.1f'%(name, ms)
+                                                    for name, ms in s['phases_mean_ms'].items()))
+        for edge, n in s['histogram'].items():
+            lines.append('    <= %-6s s: %s'%(edge, n))
+        lines.append('')
+    return HttpResponse('\n'.join(lines), content_type='text/plain')
+
+
+
+class ProfilerForm(forms.Form):
+    seconds = forms.FloatField(required=False, min_value=0.1, max_value=profiler.MAX_SECONDS,
+                               help_text="Profile for this long")
+    n_requests = forms.IntegerField(required=False, min_value=1, label="Requests",
+                                    help_text="... or until this many matching requests")
+    pattern = forms.CharField(required=False, help_text="Regex searched in the URL path")
+    view = forms.CharField(required=False, help_text="Regex searched in the view name")
+    interval = forms.FloatField(initial=profiler.DEFAULT_INTERVAL, min_value=0.001,
+                                help_text="Seconds between samples")
+    def clean(self):
+        data = super(ProfilerForm, self).clean()
+        if not data.get('seconds') and not data.get('n_requests'):
+            raise forms.ValidationError("Give a time or a number of requests")
+        for field in ('pattern', 'view'):
+            try:
+                re.compile(data.get(field) or '')
+            except re.error as e:
+                self.add_error(field, "Invalid regex: %s"%e)
+        return data
+
+def profiler_view(request):
+    """Start and stop profiler sessions, list results (see profiler.py).
+
+    Only for verified (2FA) superusers.
+    """
+    if not permissions.has_admin_permission(request):
+        return HttpResponse("Forbidden", status=403, content_type='text/plain')
+    context = c = { }
+    form = c['form'] = ProfilerForm()
+    if request.method == 'POST':
+        if 'stop' in request.POST:
+            profiler.finish()
+            return HttpResponseRedirect(reverse('profiler'))
+        form = c['form'] = ProfilerForm(request.POST)
+        if form.is_valid():
+            try:
+                profiler.start(user=request.user.username, **form.cleaned_data)
+            except ValueError as e:
+                form.add_error(None, str(e))
+            else:
+                logs.log(request, 'start profiler', obj='profiler', op='profiler_start')
+                return HttpResponseRedirect(reverse('profiler'))
+    c['active'] = profiler.active()
+    c['results'] = profiler.list_results()
+    for meta in c['results']:
+        meta['started_str'] = datetime.fromtimestamp(meta['started']).strftime('%Y-%m-%d %H:%M:%S')
+    return TemplateResponse(request, 'koota/profiler.html', context)
+
+def profiler_download(request, name):
+    """Collapsed stacks of one profiler session."""
+    if not permissions.has_admin_permission(request):
+        return HttpResponse("Forbidden", status=403, content_type='text/plain')
+    path = profiler.result_path(name)
+    if path is None:
+        raise Http404()
+    response = HttpResponse(open(path).read(), content_type='text/plain')
+    response['Content-Disposition'] = 'attachment; filename="koota-profile-%s.txt"'%name
+    return response
+
+
+
 def current_time(request):
     """Function to return current server time: debugging purposes."""
     ret = "\n".join([
@@ -7,7 +7,6 @@ from django.shortcuts import render
 import django.contrib.auth as auth
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
-from django.core.paginator import InvalidPage, Paginator
 from django.urls import reverse
 from django import forms
 from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, Http404
@@ -18,9 +17,11 @@ from django.views.generic import ListView, DetailView, CreateView, UpdateView, F
 
 from . import devices
 from . import exceptions
+from . import export
 from . import logs
 from . import models
 from . import permissions
+from . import timing
 from . import util
 
 import logging
@@ -118,20 +119,41 @@ def replace_page(request, n):
     for key in list(dict_):
         if not dict_[key]:  del dict_[key]
     return dict_.urlencode()
+class DeviceDataListForm(DataListForm):
+    """DataListForm with a date to jump to (device_data keyset pages)."""
+    at = forms.DateTimeField(label="Jump to", required=False,
+                             widget=forms.TextInput(attrs=dict(size=20)),
+                             error_messages={'invalid':'Enter a valid date/time to jump to, YYYY-MM-DD [HH:MM[:SS]].'})
+CURSOR_PARAMS = ('page', 'after', 'before', 'first', 'at')
+def replace_cursor(request, **params):
+    """Manipulate query parameters: replace the page position.
+
+    Like replace_page, for the keyset pagination of device_data:
+    removes all position parameters and sets the given ones.
+    """
+    dict_ = request.GET.copy()
+    for key in CURSOR_PARAMS:
+        dict_.pop(key, None)
+    for key, value in params.items():
+        dict_[key] = value
+    for key in list(dict_):
+        if not dict_[key]:  del dict_[key]
+    return dict_.urlencode()
 
 def device_data(request, public_id, converter, format):
     """List data from one device+converter on a """
     context = c = { }
     # Get devices and other data
-    device = c['device'] = models.Device.get_by_id(public_id=public_id)
-    logs.log(request, 'get device data', user=request.user,
-             obj=device.public_id, op='get_data',
-             data_of=device.user)
-    if not permissions.has_device_permission(request, device):
-        logs.log(request, 'device data denied', user=request.user,
-                 obj=device.public_id, op='denied_get_data',
+    with timing.span('auth'):
+        device = c['device'] = models.Device.get_by_id(public_id=public_id)
+        logs.log(request, 'get device data', user=request.user,
+                 obj=device.public_id, op='get_data',
                  data_of=device.user)
-        raise exceptions.NoDevicePermission("No permission for device")
+        if not permissions.has_device_permission(request, device):
+            logs.log(request, 'device data denied', user=request.user,
+                     obj=device.public_id, op='denied_get_data',
+                     data_of=device.user)
+            raise exceptions.NoDevicePermission("No permission for device")
     device_class = c['device_class'] = device.get_class()
     converter_class = c['converter_class'] = \
         [ x for x in device_class.converters if x.name() == converter ]
@@ -140,7 +162,7 @@ def device_data(request, public_id, converter, format):
                             content_type='text/plain',
                             status=404)
     converter_class = converter_class[0]
-    c['query_params_nopage'] = replace_page(request, '')
+    c['query_params_nopage'] = replace_cursor(request)
 
     # Fetch all relevant data
     queryset = models.Data.objects.filter(device_id=device.device_id, ).order_by('ts')
@@ -148,7 +170,7 @@ def device_data(request, public_id, converter, format):
         queryset = converter_class.query(queryset)
 
     # Process the form and apply options
-    form = c['select_form'] = DataListForm(request.GET)
+    form = c['select_form'] = DeviceDataListForm(request.GET)
     if form.is_valid():
         if form.cleaned_data['start']:
             queryset = queryset.filter(ts__gte=form.cleaned_data['start'])
@@ -160,44 +182,31 @@ def device_data(request, public_id, converter, format):
         # Bad data, return early and make the user fix the form
         return TemplateResponse(request, 'koota/device_data.html', context)
 
-    # Paginate, if needed
+    # Paginate, if needed.  Keyset pagination: pages are found by the
+    # (ts, id) of their first or last row, never by offset.
     if converter_class.per_page is not None and not format:
-        page_number = request.GET.get('page', 'last')
-        paginator = Paginator(queryset, min(int(request.GET.get('perpage', converter_class.per_page)), 100))
-        c['pages_total'] = paginator.num_pages
-        if page_number == 'last':
-            page_number = paginator.num_pages
-        elif page_number:
-            page_number = int(page_number)
-            if int(page_number) > paginator.num_pages:
-                # Page is out of bounds.  This can happen if someone
-                # adjusts the date filters and , now there are fewer
-                # pages and we are too far forward.  Redirect to same
-                # URL with no page given.  Alternative solution: when
-                # applying new filters, remove the page number?  Would
-                # need to remove page from the filter form.
-                return HttpResponseRedirect('?'+replace_page(request, n=None),
-                                            reason='Page out of bounds')
-        else:
-            page_number = paginator.num_pages
-        c['page_number'] = page_number
-        page_obj = c['page_obj'] = paginator.page(page_number)
-        # Set our URLs for pagination.  Need to do this here because
-        # you can't embed tags within filter arguments, at least so I
-        # see.
-        # NOTE: 1-indexed
-        if page_number > 1:   c['page_first'] = replace_page(request, 1)
-        if page_obj.has_previous(): c['page_prev']  = replace_page(request, page_number-1)
-        if page_obj.has_next(): c['page_next']  = replace_page(request, page_number+1)
-        if page_number < paginator.num_pages:
-                              c['page_last']  = replace_page(request, 'last')
-        c['prev_pages'] = [ (n, replace_page(request, n))
-                            for n in range(max(2,page_number-5), page_number) ]
-        if page_number - 5 > 2: c['prev_pages'].insert(0, None)
-        c['next_pages'] = [ (n, replace_page(request, n))
-                            for n in range(page_number+1, min(page_number+5+1, paginator.num_pages)) ]
-        if page_number + 5+1 < paginator.num_pages: c['next_pages'].append(None)
-        data = page_obj.object_list
+        per_page = min(int(request.GET.get('perpage', converter_class.per_page)), 100)
+        descending = form.cleaned_data['reversed']
+        try:
+            after = util.parse_cursor(request.GET['after']) if request.GET.get('after') else None
+            before = util.parse_cursor(request.GET['before']) if request.GET.get('before') else None
+        except ValueError:
+            raise exceptions.BaseMessageKootaException(message="Invalid page position")
+        keys, has_prev, has_next = util.keyset_page(
+            queryset, per_page, after=after, before=before, at=form.cleaned_data['at'],
+            first=bool(request.GET.get('first')), descending=descending)
+        c['paginated'] = True
+        c['approx_total'] = util.estimate_count(queryset)
+        if has_prev:
+            c['page_first'] = replace_cursor(request, first=1)
+            c['page_prev']  = replace_cursor(request, before=util.cursor_token(*keys[0]))
+        if has_next:
+            c['page_next']  = replace_cursor(request, after=util.cursor_token(*keys[-1]))
+            c['page_last']  = replace_cursor(request)
+        if keys:
+            c['page_start'], c['page_end'] = keys[0][0], keys[-1][0]
+        data = models.Data.objects.filter(id__in=[id_ for ts, id_ in keys]) \
+                                  .order_by(*(('-ts', '-id') if descending else ('ts', 'id')))
     else:
         # not paginating data
         data = queryset
@@ -227,12 +236,15 @@ def device_data(request, public_id, converter, format):
     catch_errors = 1
     if catch_errors:
         converter = c['converter'] \
-                = converter_class(((x.ts, x.data) for x in data),
+                = converter_class(timing.timed_iter('db', ((x.ts, x.data) for x in data)),
                                    time=time_converter,
                                    params=request.GET,
                                    device=device)
         table = c['table'] = \
                 converter.run()
+        if not format:
+            # Downloads are timed by the util.*_iter writers.
+            table = c['table'] = timing.timed_rows('convert', table)
     else:
         converter = c['converter'] = converter_class()
         table = c['table'] = converter.convert(((x.ts, x.data) for x in data),
@@ -246,6 +258,9 @@ def device_data(request, public_id, converter, format):
 
     # Convert to custom formats if it was requested.
     context['download_formats'] = DOWNLOAD_FORMATS
+    context['export_form'] = export.ExportForm(initial=dict(
+        device=device.public_id, converter=converter.name(),
+        start=form.cleaned_data['start'], end=form.cleaned_data['end']))
     filename_base = '%s_%s_%s_%s-%s'%(
         device.public_id,
         device.type,
@@ -59,10 +59,16 @@ LOGOUT_REDIRECT_URL = 'main'
 DATA_UPLOAD_MAX_MEMORY_SIZE = 15 * 2**20
 FILE_UPLOAD_MAX_MEMORY_SIZE = 15 * 2**20
 WEB_COMPONENTS = set(('ui', 'data', 'admin'))
+# Ingest rate limits, (requests/second, burst) per device and per IP
+# (kdata/ratelimit.py), and device classes which are never limited.
+INGEST_RATE_LIMITS = dict(device=(2.0, 600), ip=(20.0, 2000))
+INGEST_RATE_EXEMPT = set()
 SITE_PRIVACY_URL = 'https://github.com/CxAalto/koota-server/wiki/PrivacyPolicy'
 GENERAL_LOG = os.path.join(BASE_DIR, 'log.txt')
 DATA_ACCESS_LOG = GENERAL_LOG
+KOOTA_LOG_BUFFERED = True  # audit log written by a background thread (kdata/logs.py)
 CONN_MAX_AGE = 60    # database connenction timeout (s)
+KOOTA_TIMING = False # per-phase request timing, Server-Timing headers (kdata/timing.py)
 
 #### The following settings should go into settings_local.py, NOT here.
 # Make a random salt using this and paste it here.  By default we have
@@ -129,6 +135,8 @@ INSTALLED_APPS = [
 
 # TODO: django 1.10, middleware change
 MIDDLEWARE = [
+    'kdata.middleware.TimingMiddleware',
+    'kdata.middleware.ProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',